@@ -0,0 +1,62 @@
+import numpy as np
+from ymmsl.v0_2 import (
+        Component, Conduit, Configuration, Operator, Ports, Model, Settings)
+
+from libmuscle import Instance, Message
+from libmuscle.runner import run_simulation
+
+
+NUM_MICROS = 3
+
+
+def macro():
+    instance = Instance({
+            Operator.O_I: ['out[]'],
+            Operator.S: ['in[]']})
+
+    state = np.zeros(100000)
+    while instance.reuse_instance():
+        for i in range(4):
+            # o_i
+            state[:] = i
+            for slot in range(NUM_MICROS):
+                instance.send('out', Message(float(i), data=state), slot, True)
+            instance.flush()
+            state[:] = -1.0
+
+            # s
+            for msg in instance.receive_all('in'):
+                assert (msg.data.array == i).all()
+
+
+def micro():
+    instance = Instance({
+            Operator.F_INIT: ['in'],
+            Operator.O_F: ['out']})
+
+    while instance.reuse_instance():
+        # f_init
+        msg = instance.receive('in')
+
+        # o_f
+        instance.send('out', Message(msg.timestamp, data=msg.data), deferred=True)
+
+
+def test_deferred_send(log_file_in_tmpdir):
+    elements = [
+            Component('macro', Ports(o_i='out', s='in'), '', 'macro'),
+            Component(
+                'micro', Ports(f_init='in', o_f='out'), '', 'micro', False,
+                [NUM_MICROS])]
+
+    conduits = [
+                Conduit('macro.out', 'micro.in'),
+                Conduit('micro.out', 'macro.in')]
+
+    model = Model('test_model', None, '', None, elements, conduits)
+    configuration = Configuration('deferred_send', None, [model], None, Settings())
+
+    implementations = {
+            'macro': macro,
+            'micro': micro}
+    run_simulation(configuration, implementations)
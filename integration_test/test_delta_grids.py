@@ -0,0 +1,58 @@
+import numpy as np
+from ymmsl.v0_2 import (
+        Component, Conduit, Configuration, Operator, Ports, Model, Settings)
+
+from libmuscle import Grid, Instance, Message
+from libmuscle.runner import run_simulation
+
+
+NUM_STEPS = 5
+
+
+def macro():
+    instance = Instance({
+            Operator.O_I: ['out'],
+            Operator.S: ['in']})
+
+    state = np.zeros((100, 100))
+    while instance.reuse_instance():
+        for i in range(NUM_STEPS):
+            # o_i
+            state[i, :i] = i
+            instance.send('out', Message(float(i), data=Grid.delta(state)))
+
+            # s
+            msg = instance.receive('in')
+            assert (msg.data.array == state).all()
+
+
+def micro():
+    instance = Instance({
+            Operator.F_INIT: ['in'],
+            Operator.O_F: ['out']})
+
+    while instance.reuse_instance():
+        # f_init
+        msg = instance.receive('in')
+
+        # o_f
+        data = Grid.sparse(msg.data.array)
+        instance.send('out', Message(msg.timestamp, data=data))
+
+
+def test_delta_grids(log_file_in_tmpdir):
+    elements = [
+            Component('macro', Ports(o_i='out', s='in'), '', 'macro'),
+            Component('micro', Ports(f_init='in', o_f='out'), '', 'micro')]
+
+    conduits = [
+                Conduit('macro.out', 'micro.in'),
+                Conduit('micro.out', 'macro.in')]
+
+    model = Model('test_model', None, '', None, elements, conduits)
+    configuration = Configuration('delta_grids', None, [model], None, Settings())
+
+    implementations = {
+            'macro': macro,
+            'micro': micro}
+    run_simulation(configuration, implementations)
@@ -0,0 +1,61 @@
+import numpy as np
+from ymmsl.v0_2 import (
+        Component, Conduit, Configuration, Operator, Ports, Model, Settings)
+
+from libmuscle import Instance, Message
+from libmuscle.runner import run_simulation
+
+
+NUM_STEPS = 20
+
+
+def macro():
+    instance = Instance({
+            Operator.O_I: ['out'],
+            Operator.S: ['in']})
+
+    while instance.reuse_instance():
+        for i in range(NUM_STEPS):
+            # o_i
+            instance.send('out', Message(float(i), data=np.full(1000, i)))
+
+            # s
+            msg = instance.receive('in')
+            assert msg.timestamp == float(i)
+            assert (msg.data.array == 2 * i).all()
+
+
+def micro():
+    instance = Instance({
+            Operator.F_INIT: ['in'],
+            Operator.O_F: ['out']})
+
+    while instance.reuse_instance():
+        # f_init
+        msg = instance.receive('in')
+
+        # o_f
+        instance.send('out', Message(msg.timestamp, data=msg.data.array * 2))
+
+
+def test_prefetch(log_file_in_tmpdir):
+    elements = [
+            Component('macro', Ports(o_i='out', s='in'), '', 'macro'),
+            Component('micro', Ports(f_init='in', o_f='out'), '', 'micro')]
+
+    conduits = [
+                Conduit('macro.out', 'micro.in'),
+                Conduit('micro.out', 'macro.in')]
+
+    model = Model('test_model', None, '', None, elements, conduits)
+    settings = Settings({
+            'micro.muscle_prefetch_depth': 2,
+            'macro.muscle_prefetch_depth_in': 1,
+            'muscle_prefetch_max_bytes': 4096})
+
+    configuration = Configuration('prefetch', None, [model], None, settings)
+
+    implementations = {
+            'macro': macro,
+            'micro': micro}
+    run_simulation(configuration, implementations)
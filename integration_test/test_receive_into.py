@@ -0,0 +1,59 @@
+import numpy as np
+from ymmsl.v0_2 import (
+        Component, Conduit, Configuration, Operator, Ports, Model, Settings)
+
+from libmuscle import Grid, Instance, Message
+from libmuscle.runner import run_simulation
+
+
+SHAPE = (200, 300)
+
+
+def macro():
+    instance = Instance({
+            Operator.O_I: ['out'],
+            Operator.S: ['in']})
+
+    state = np.zeros(SHAPE)
+    while instance.reuse_instance():
+        for i in range(4):
+            # o_i
+            instance.send('out', Message(float(i), data=np.full(SHAPE, float(i))))
+
+            # s
+            msg = instance.receive_into('in', state)
+            assert msg.data.array is state
+            assert (state == 2 * i).all()
+
+
+def micro():
+    instance = Instance({
+            Operator.F_INIT: ['in'],
+            Operator.O_F: ['out']})
+
+    state = np.empty(SHAPE, order='F')
+    while instance.reuse_instance():
+        # f_init
+        msg = instance.receive_into('in', state)
+        assert msg.data.array is state
+
+        # o_f
+        instance.send('out', Message(msg.timestamp, data=Grid(state * 2, ['x', 'y'])))
+
+
+def test_receive_into(log_file_in_tmpdir):
+    elements = [
+            Component('macro', Ports(o_i='out', s='in'), '', 'macro'),
+            Component('micro', Ports(f_init='in', o_f='out'), '', 'micro')]
+
+    conduits = [
+                Conduit('macro.out', 'micro.in'),
+                Conduit('micro.out', 'macro.in')]
+
+    model = Model('test_model', None, '', None, elements, conduits)
+    configuration = Configuration('receive_into', None, [model], None, Settings())
+
+    implementations = {
+            'macro': macro,
+            'micro': micro}
+    run_simulation(configuration, implementations)
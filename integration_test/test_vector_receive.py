@@ -0,0 +1,63 @@
+from ymmsl.v0_2 import (
+        Component, Conduit, Configuration, Operator, Ports, Model, Settings)
+
+from libmuscle import Instance, Message
+from libmuscle.runner import run_simulation
+
+
+NUM_MICROS = 5
+
+
+def macro():
+    instance = Instance({
+            Operator.O_I: ['out[]'],
+            Operator.S: ['in[]']})
+
+    while instance.reuse_instance():
+        for i in range(4):
+            # o_i
+            for slot in range(NUM_MICROS):
+                instance.send('out', Message(float(i), data=slot), slot)
+
+            # s
+            if i % 2 == 0:
+                msgs = instance.receive_all('in')
+                assert [msg.data for msg in msgs] == list(range(NUM_MICROS))
+            else:
+                received = list(instance.receive_any('in'))
+                assert sorted(slot for slot, _ in received) == list(
+                        range(NUM_MICROS))
+                assert all(msg.data == slot for slot, msg in received)
+
+
+def micro():
+    instance = Instance({
+            Operator.F_INIT: ['in'],
+            Operator.O_F: ['out']})
+
+    while instance.reuse_instance():
+        # f_init
+        msg = instance.receive('in')
+
+        # o_f
+        instance.send('out', Message(msg.timestamp, data=msg.data))
+
+
+def test_vector_receive(log_file_in_tmpdir):
+    elements = [
+            Component('macro', Ports(o_i='out', s='in'), '', 'macro'),
+            Component(
+                'micro', Ports(f_init='in', o_f='out'), '', 'micro', False,
+                [NUM_MICROS])]
+
+    conduits = [
+                Conduit('macro.out', 'micro.in'),
+                Conduit('micro.out', 'macro.in')]
+
+    model = Model('test_model', None, '', None, elements, conduits)
+    configuration = Configuration('vector_receive', None, [model], None, Settings())
+
+    implementations = {
+            'macro': macro,
+            'micro': micro}
+    run_simulation(configuration, implementations)
@@ -14,7 +14,17 @@ enum class ExtTypeId : int8_t {
     grid_int64 = 3,
     grid_float32 = 4,
     grid_float64 = 5,
-    grid_bool = 6
+    grid_bool = 6,
+    // sent by Python only, not (yet) supported here
+    grid_int8 = 7,
+    grid_int16 = 8,
+    grid_uint8 = 9,
+    grid_uint16 = 10,
+    grid_uint32 = 11,
+    grid_uint64 = 12,
+    grid_float16 = 13,
+    grid_complex64 = 14,
+    grid_complex128 = 15
 };
 
 } } }
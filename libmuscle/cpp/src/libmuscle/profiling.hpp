@@ -28,7 +28,8 @@ enum class ProfileEventType {
     shutdown_wait = 9,
     disconnect_wait = 8,
     shutdown = 10,
-    deregister = 1
+    deregister = 1,
+    outbox_high_water = 11
 };
 
 
@@ -1,15 +1,30 @@
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
 import logging
-from typing import Any, Dict, List, Optional, Tuple, cast
+from queue import Empty, Queue
+import time
+from typing import (
+        Any, Callable, Deque, Dict, Generator, List, NoReturn, Optional, Tuple, cast)
+from typing_extensions import Buffer
+
+import numpy as np
 from ymmsl.v0_2 import Identifier, Reference, Settings
 
+from libmuscle.compression import Compressor
 from libmuscle.endpoint import Endpoint
+from libmuscle.grid import Grid
 from libmuscle.mmp_client import MMPClient
-from libmuscle.mpp_message import ClosePort, MPPMessage
+from libmuscle.mpp_message import (
+        BufferPlacer, ClosePort, DeltaReferences, EncodedData, MPPMessage)
 from libmuscle.mpp_client import MPPClient
 from libmuscle.mpp_server import MPPServer
-from libmuscle.mcp.tcp_util import SocketClosed
+from libmuscle.mcp.tcp_util import is_disconnect
+from libmuscle.mcp.transport_client import ProfileData, TimeoutHandler
 from libmuscle.peer_info import PeerInfo
+from libmuscle.port import Port
 from libmuscle.port_manager import PortManager
+from libmuscle.prefetcher import PrefetchBudget, Prefetcher
 from libmuscle.profiler import Profiler
 from libmuscle.profiling import (
         ProfileEvent, ProfileEventType, ProfileTimestamp)
@@ -22,6 +37,25 @@ _logger = logging.getLogger(__name__)
 MessageObject = Any
 
 
+_DEFAULT_PREFETCH_MAX_BYTES = 256 * 1024 * 1024
+"""Default limit on the memory used for prefetched messages."""
+
+
+_MAX_RECEIVE_THREADS = 64
+"""Maximum number of messages to receive concurrently."""
+
+
+_MAX_BATCH_MESSAGES = 64
+"""Maximum number of messages to fetch from a peer at once."""
+
+
+_MAX_BATCH_BYTES = 1024 * 1024
+"""Maximum size of the messages fetched along with the requested one."""
+
+
+_Fetcher = Callable[[Optional[TimeoutHandler]], Tuple[Buffer, ProfileData]]
+
+
 class Message:
     """A message to be sent or received.
 
@@ -33,6 +67,8 @@ class Message:
         next_timestamp (Optional[float]): Simulation time for the next
                 message to be transmitted through this port.
         data (MessageObject): An object to send or that was received.
+                For received messages, this is decoded when it is first
+                used.
         settings (Settings): Overlay settings to send or that was
                 received.
     """
@@ -58,9 +94,103 @@ class Message:
 
         self.timestamp = timestamp
         self.next_timestamp = next_timestamp
+        self._data: MessageObject = None
+        self._encoded_data: Optional[EncodedData] = None
+        self._frame: Optional[memoryview] = None
         self.data = data
         self.settings = settings
 
+    @property
+    def data(self) -> MessageObject:
+        """An object to send or that was received."""
+        if self._encoded_data is not None:
+            self._data = self._encoded_data.decoded()
+            self._encoded_data = None
+            self._frame = None
+        return self._data
+
+    @data.setter
+    def data(self, data: MessageObject) -> None:
+        self._data = data
+        self._encoded_data = None
+        self._frame = None
+
+    @property
+    def frame(self) -> Optional[memoryview]:
+        """The message as it was received, if its data was not used.
+
+        Components that pass on or store messages without looking at their
+        contents can use this read-only view of the received message,
+        without decoding it. Sending a message whose data has not been used
+        reuses the received data, so that it does not need to be encoded
+        again.
+
+        Once :attr:`data` has been used or set, this is None.
+        """
+        return self._frame
+
+
+def copy_data_into(message: Message, out: np.ndarray) -> None:
+    """Makes a received message's data refer to the given array.
+
+    The data must be a Grid with the same shape and data type as out. Its
+    contents are copied into out, unless they were received there, and
+    the data is replaced by a Grid that refers to out.
+
+    Args:
+        message: A received message.
+        out: The array to put the data into.
+
+    Raises:
+        RuntimeError: If the data is not a Grid of the right shape and type.
+    """
+    data = message.data
+    if (
+            not isinstance(data, Grid) or data.array.shape != out.shape or
+            data.array.dtype != out.dtype):
+        if isinstance(data, Grid):
+            received = (
+                    f'an array of shape {data.array.shape} and type'
+                    f' {data.array.dtype}')
+        else:
+            received = f'an object of type {type(data).__name__}'
+        raise RuntimeError(
+                f'Expected an array of shape {out.shape} and type {out.dtype},'
+                f' but received {received}')
+
+    if not np.may_share_memory(data.array, out):
+        np.copyto(out, data.array)
+    elif data.array.strides != out.strides:
+        # received in place, but in a different order
+        out[...] = data.array.copy()
+
+    message.data = Grid(out, data.indexes)
+
+
+class _Route:
+    """The endpoints that messages on a port and slot go between.
+
+    These are worked out when a port and slot are first used, so that
+    sending and receiving many messages doesn't redo it every time.
+
+    Attributes:
+        endpoint: Our endpoint.
+        ref: Reference to our endpoint.
+        peers: The endpoints of the connected peers, if any.
+        peer_refs: References to the peer endpoints.
+    """
+    def __init__(self, endpoint: Endpoint, peers: List[Endpoint]) -> None:
+        """Create a _Route.
+
+        Args:
+            endpoint: Our endpoint.
+            peers: The endpoints of the connected peers, if any.
+        """
+        self.endpoint = endpoint
+        self.ref = endpoint.ref()
+        self.peers = peers
+        self.peer_refs = [peer.ref() for peer in peers]
+
 
 class Communicator:
     """Communication engine for MUSCLE3.
@@ -100,6 +230,54 @@ class Communicator:
         # indexed by remote instance id
         self._clients: Dict[Reference, MPPClient] = {}
 
+        # indexed by port name and slot, made when first used
+        self._routes: Dict[Tuple[str, Optional[int]], _Route] = {}
+
+        # indexed by port name, only ports with prefetching enabled
+        self._prefetch_depths: Dict[str, int] = {}
+        self._prefetch_budget = PrefetchBudget(_DEFAULT_PREFETCH_MAX_BYTES)
+        # indexed by port name and slot
+        self._prefetchers: Dict[Tuple[str, Optional[int]], Prefetcher] = {}
+
+        # indexed by client, the ports and slots that receive through it
+        # without prefetching, and their receiver references, in order of
+        # first use
+        self._batch_receivers: Dict[
+                MPPClient, Dict[Tuple[str, Optional[int]], Reference]] = {}
+        # indexed by port name and slot, messages that were fetched along
+        # with an earlier one and have not been received yet
+        self._fetched: Dict[Tuple[str, Optional[int]], Deque[Buffer]] = {}
+
+        # created when first needed by receive_messages()
+        self._receive_pool: Optional[ThreadPoolExecutor] = None
+
+        # indexed by port name, only ports with compression enabled
+        self._compressors: Dict[str, Compressor] = {}
+
+        # created when first needed by send_message(), with the sends that
+        # have not yet been encoded
+        self._send_executor: Optional[ThreadPoolExecutor] = None
+        self._deferred_sends: List['Future[None]'] = []
+
+        # indexed by port name and slot, references for delta grids
+        self._send_deltas: Dict[Tuple[str, Optional[int]], DeltaReferences] = {}
+        self._receive_deltas: Dict[
+                Tuple[str, Optional[int]], DeltaReferences] = {}
+
+        # the last settings overlay sent to each receiver (encoded), and
+        # received on each port and slot, so that unchanged overlays need not
+        # be sent again
+        self._sent_overlays: Dict[Reference, Optional[bytes]] = {}
+        self._received_overlays: Dict[Tuple[str, Optional[int]], Settings] = {}
+
+        # indexed by receiver, largest number of bytes waiting for it, and
+        # the port, slot and time at which it was reached, tracked only if
+        # outbox limits are set
+        self._outboxes_limited = False
+        self._high_water: Dict[
+                Reference,
+                Tuple[int, Port, Optional[int], ProfileTimestamp]] = {}
+
     def get_locations(self) -> List[str]:
         """Returns a list of locations that we can be reached at.
 
@@ -122,6 +300,8 @@ class Communicator:
             peer_info: Information about the peers.
         """
         self._peer_info = peer_info
+        self._routes.clear()
+        self._batch_receivers.clear()
 
     def set_receive_timeout(self, receive_timeout: float) -> None:
         """Update the timeout after which the manager is notified that we are waiting
@@ -133,68 +313,162 @@ class Communicator:
         """
         self._receive_timeout = receive_timeout
 
+    def set_prefetch_depth(self, port_name: str, depth: int) -> None:
+        """Enable or disable prefetching of messages on a port.
+
+        With prefetching enabled, the next message for the port is requested
+        in the background as soon as the previous one has been received, so
+        that it is transferred while the model does other work. Each
+        prefetching port (or slot, for vector ports) gets its own connection
+        to the peer.
+
+        Args:
+            port_name: Name of the receiving port.
+            depth: Maximum number of messages to prefetch, 0 to disable.
+        """
+        if depth > 0:
+            self._prefetch_depths[port_name] = depth
+            for receivers in self._batch_receivers.values():
+                for key in [key for key in receivers if key[0] == port_name]:
+                    del receivers[key]
+        else:
+            self._prefetch_depths.pop(port_name, None)
+
+    def set_prefetch_max_bytes(self, max_bytes: int) -> None:
+        """Limit the memory used for prefetched messages.
+
+        The limit applies to all ports together. One message is always
+        prefetched for each prefetching port, even if that exceeds the limit.
+
+        Args:
+            max_bytes: Maximum total size of prefetched messages.
+        """
+        self._prefetch_budget.set_max_bytes(max_bytes)
+
+    def set_compression(
+            self, port_name: str, compressor: Optional[Compressor]) -> None:
+        """Enable or disable compression of messages sent on a port.
+
+        Array data in messages sent on the port is compressed for receivers
+        that connect over the network, if they support the codec.
+
+        Args:
+            port_name: Name of the sending port.
+            compressor: The compressor to use, or None to disable.
+        """
+        if compressor is not None:
+            self._compressors[port_name] = compressor
+        else:
+            self._compressors.pop(port_name, None)
+
+    def set_outbox_limits(
+            self, max_bytes: Optional[int], total_max_bytes: Optional[int],
+            spill: bool) -> None:
+        """Limits the memory used by sent messages not yet received.
+
+        Args:
+            max_bytes: Maximum number of bytes waiting for a single
+                    receiver, if any.
+            total_max_bytes: Maximum number of bytes waiting for all
+                    receivers together, if any.
+            spill: If True, write messages to disk when over a limit,
+                    otherwise block in send_message() until there is room.
+        """
+        self._server.set_outbox_limits(max_bytes, total_max_bytes, spill)
+        self._outboxes_limited = (
+                max_bytes is not None or total_max_bytes is not None)
+
     def send_message(
             self, port_name: str, message: Message,
             slot: Optional[int] = None,
-            checkpoints_considered_until: float = float('-inf')) -> None:
+            checkpoints_considered_until: float = float('-inf'),
+            deferred: bool = False) -> None:
         """Send a message and settings to the outside world.
 
         Sending is non-blocking, a copy of the message will be made
         and stored until the receiver is ready to receive it.
 
+        If deferred is True, then the message is encoded and copied in
+        a background thread, and this returns immediately. The message
+        and its data must then not be modified until :meth:`flush` has
+        been called. Messages are encoded in the order in which they were
+        sent, and a send that is not deferred calls :meth:`flush` first.
+
         Args:
             port_name: The port on which this message is to be sent.
             message: The message to be sent.
             slot: The slot to send the message on, if any.
             checkpoints_considered_until: When we last checked if we
                 should save a snapshot (wallclock time).
+            deferred: Whether to encode the message in the background.
         """
-        if slot is None:
-            _logger.debug('Sending message on {}'.format(port_name))
-            slot_list: List[int] = []
-        else:
-            _logger.debug('Sending message on {}[{}]'.format(port_name, slot))
-            slot_list = [slot]
+        _logger.debug('Sending message on %s', _port_and_slot(port_name, slot))
 
-        snd_endpoint = self.__get_endpoint(port_name, slot_list)
-        if not self._port_manager.get_port(str(snd_endpoint.port)).is_connected():
+        route = self.__get_route(port_name, slot)
+        port = self._port_manager.get_port(port_name)
+        if not port.is_connected():
             # log sending on disconnected port
             return
 
-        port = self._port_manager.get_port(port_name)
-        profile_event = ProfileEvent(
-                ProfileEventType.SEND, ProfileTimestamp(), None, port, None,
-                slot, port.get_num_messages(slot), None, message.timestamp)
-
-        recv_endpoints = self._peer_info.get_peer_endpoints(
-                snd_endpoint.port, slot_list)
+        profile_event: Optional[ProfileEvent] = None
+        if not isinstance(message._data, ClosePort):
+            profile_event = ProfileEvent(
+                    ProfileEventType.SEND, ProfileTimestamp(), None, port, None,
+                    slot, port.get_num_messages(slot), None, message.timestamp)
+            if port.is_vector():
+                profile_event.port_length = port.get_length()
 
         port_length = None
         if port.is_resizable():
             port_length = port.get_length()
 
-        for recv_endpoint in recv_endpoints:
-            mpp_message = MPPMessage(snd_endpoint.ref(), recv_endpoint.ref(),
-                                     port_length,
-                                     message.timestamp, message.next_timestamp,
-                                     cast(Settings, message.settings),
-                                     port.get_num_messages(slot),
-                                     checkpoints_considered_until,
-                                     message.data)
-            encoded_message = mpp_message.encoded()
-            self._server.deposit(recv_endpoint.ref(), encoded_message)
+        mpp_messages = [
+                MPPMessage(route.ref, peer_ref,
+                           port_length,
+                           message.timestamp, message.next_timestamp,
+                           cast(Settings, message.settings),
+                           port.get_num_messages(slot),
+                           checkpoints_considered_until,
+                           message._data)
+                for peer_ref in route.peer_refs]
+
+        if deferred:
+            if self._send_executor is None:
+                self._send_executor = ThreadPoolExecutor(1, 'muscle3_send')
+
+            def encode() -> None:
+                if profile_event is not None:
+                    profile_event.start()
+                self.__deposit_messages(
+                        port_name, slot, mpp_messages, message._encoded_data,
+                        profile_event)
+
+            self._deferred_sends.append(self._send_executor.submit(encode))
+        else:
+            self.flush()
+            self.__deposit_messages(
+                    port_name, slot, mpp_messages, message._encoded_data,
+                    profile_event)
 
         port.increment_num_messages(slot)
 
-        profile_event.stop()
-        if port.is_vector():
-            profile_event.port_length = port.get_length()
-        profile_event.message_size = len(memoryview(encoded_message))
-        if not isinstance(message.data, ClosePort):
-            self._profiler.record_event(profile_event)
+    def flush(self) -> None:
+        """Waits until all deferred sends have been encoded.
+
+        After this, the messages and their data may be modified again.
+
+        Raises:
+            Exception: Any error that occurred while encoding a message.
+        """
+        try:
+            for future in self._deferred_sends:
+                future.result()
+        finally:
+            self._deferred_sends.clear()
 
     def receive_message(
-            self, port_name: str, slot: Optional[int] = None) -> Tuple[Message, float]:
+            self, port_name: str, slot: Optional[int] = None,
+            out: Optional[np.ndarray] = None) -> Tuple[Message, float]:
         """Receive a message and attached settings overlay.
 
         Receiving is a blocking operation. This function will contact
@@ -205,10 +479,15 @@ class Communicator:
         returned if one was given, exactly as it was given. If no
         default was given then a RuntimeError will be raised.
 
+        If out is given, then array data is received straight into it
+        where possible. Use :func:`copy_data_into` on the received message
+        to make sure that the data ends up there.
+
         Args:
             port_name: The endpoint on which a message is to be
                     received.
             slot: The slot to receive the message on, if any.
+            out: An array to receive the data into, if any.
 
         Returns:
             The received message, with message.settings holding
@@ -220,68 +499,537 @@ class Communicator:
             RuntimeError: If the network connection had an error, or the
                     message number was incorrect.
         """
-        if port_name == 'muscle_settings_in':
-            port = self._port_manager._muscle_settings_in
-        else:
-            port = self._port_manager.get_port(port_name)
-
-        if slot is None:
-            port_and_slot = port_name
-            slot_list: List[int] = []
-        else:
-            port_and_slot = f"{port_name}[{slot}]"
-            slot_list = [slot]
-        _logger.debug('Waiting for message on {}'.format(port_and_slot))
-
-        recv_endpoint = self.__get_endpoint(port_name, slot_list)
-
+        port = self.__get_receive_port(port_name)
         receive_event = ProfileEvent(
                 ProfileEventType.RECEIVE, ProfileTimestamp(), None, port, None,
                 slot, port.get_num_messages())
 
+        _logger.debug('Waiting for message on %s', _port_and_slot(port_name, slot))
+
+        placer = None
+        if out is not None and (out.flags.c_contiguous or out.flags.f_contiguous):
+            placer = BufferPlacer(out.reshape(-1, order='A').view(np.uint8).data)
+
+        _, fetch = self.__get_fetcher(port_name, slot, placer)
+        try:
+            mpp_message_bytes, profile = fetch(
+                    self.__get_timeout_handler(port_name, slot))
+        except Exception as exc:
+            self.__reraise_receive_error(exc, port_name, slot)
+
+        return self.__process_message(
+                port_name, slot, mpp_message_bytes, profile, receive_event,
+                out, placer)
+
+    def receive_messages(
+            self, port_name: str, slots: List[int], in_order: bool = True
+            ) -> Generator[Tuple[int, Message, float], None, None]:
+        """Receive a message on each of the given slots of a vector port.
+
+        The messages are requested from all the senders at once, and
+        transferred concurrently. Slots whose messages come from the same
+        peer instance are received one after the other, as they share a
+        connection.
+
+        The generator must be run to completion, otherwise the remaining
+        messages are lost.
+
+        Args:
+            port_name: The vector port to receive on.
+            slots: The slots to receive on.
+            in_order: Whether to yield the messages in the order of the
+                    given slots, or in the order in which they arrive.
+
+        Yields:
+            The slot, the received message and the saved_until metadata
+            field, as for :meth:`receive_message`.
+
+        Raises:
+            RuntimeError: If the network connection had an error, or a
+                    message number was incorrect.
+        """
+        port = self.__get_receive_port(port_name)
+        start = ProfileTimestamp()
+
+        # Fetches from the same source must not run concurrently
+        groups: Dict[int, List[Tuple[int, _Fetcher]]] = {}
+        for slot in slots:
+            source, fetch = self.__get_fetcher(port_name, slot)
+            groups.setdefault(id(source), []).append((slot, fetch))
+
+        results: 'Queue[Tuple[int, Any]]' = Queue()
+
+        def fetch_group(group: List[Tuple[int, _Fetcher]]) -> None:
+            for i, (slot, fetch) in enumerate(group):
+                try:
+                    results.put((slot, fetch(None)))
+                except Exception as exc:
+                    for slot, _ in group[i:]:
+                        results.put((slot, exc))
+                    return
+
+        if self._receive_pool is None:
+            self._receive_pool = ThreadPoolExecutor(
+                    _MAX_RECEIVE_THREADS, thread_name_prefix='Receiver')
+        for group in groups.values():
+            self._receive_pool.submit(fetch_group, group)
+
+        waiting = list(slots)
+        # in order of arrival
+        arrived: Dict[int, Any] = {}
+
+        def next_slot() -> Optional[int]:
+            if in_order:
+                return waiting[0] if waiting[0] in arrived else None
+            return next(iter(arrived), None)
+
+        while waiting:
+            if next_slot() is None:
+                _logger.debug(
+                        'Waiting for message on %s',
+                        _port_and_slot(port_name, waiting[0]))
+                try:
+                    self.__await_results(
+                            results, arrived,
+                            self.__get_timeout_handler(port_name, waiting[0]),
+                            lambda: next_slot() is not None)
+                except Exception as exc:
+                    self.__reraise_receive_error(exc, port_name, waiting[0])
+
+            slot = cast(int, next_slot())
+            waiting.remove(slot)
+            result = arrived.pop(slot)
+            if isinstance(result, Exception):
+                self.__reraise_receive_error(result, port_name, slot)
+
+            receive_event = ProfileEvent(
+                    ProfileEventType.RECEIVE, start, None, port, None, slot,
+                    port.get_num_messages())
+            message, saved_until = self.__process_message(
+                    port_name, slot, result[0], result[1], receive_event)
+            yield slot, message, saved_until
+
+    def shutdown(self) -> None:
+        """Shuts down the Communicator, closing connections.
+        """
+        try:
+            self.flush()
+        except Exception as e:
+            _logger.error(f'Failed to send a message: {e}')
+
+        self._close_ports()
+
+        if self._send_executor is not None:
+            self._send_executor.shutdown()
+
+        for prefetcher in self._prefetchers.values():
+            prefetcher.close()
+
+        if self._receive_pool is not None:
+            self._receive_pool.shutdown(wait=False)
+
+        for client in self._clients.values():
+            client.close()
+
+        for high_water, port, slot, when in self._high_water.values():
+            self._profiler.record_event(ProfileEvent(
+                    ProfileEventType.OUTBOX_HIGH_WATER, when, when, port, None,
+                    slot, None, high_water))
+
+        wait_event = ProfileEvent(ProfileEventType.DISCONNECT_WAIT, ProfileTimestamp())
+        self._server.wait_for_receivers()
+        self._profiler.record_event(wait_event)
+
+        shutdown_event = ProfileEvent(ProfileEventType.SHUTDOWN, ProfileTimestamp())
+        self._server.shutdown()
+        self._profiler.record_event(shutdown_event)
+
+    def __instance_id(self) -> Reference:
+        """Returns our complete instance id.
+        """
+        return self._kernel + self._index
+
+    def __deposit_messages(
+            self, port_name: str, slot: Optional[int],
+            mpp_messages: List[MPPMessage], encoded_data: Optional[EncodedData],
+            profile_event: Optional[ProfileEvent]) -> None:
+        """Encodes messages and deposits them for their receivers.
+
+        Args:
+            port_name: The port the messages are sent on.
+            slot: The slot they are sent on, if any.
+            mpp_messages: The messages, one for each receiver.
+            encoded_data: The already encoded data of the messages, if any.
+            profile_event: The SEND event to record, if any.
+        """
+        port = self._port_manager.get_port(port_name)
+
+        # The data is encoded once and shared by the messages to all receivers.
+        # Received messages that are passed on already have it.
+        if encoded_data is not None:
+            encoded_data.shared = True
+        compressor = self._compressors.get(port_name)
+        deltas = self._send_deltas.setdefault((port_name, slot), DeltaReferences())
+
+        for mpp_message in mpp_messages:
+            previous_overlay = self._sent_overlays.get(mpp_message.receiver)
+            encoded_message = mpp_message.encoded_out_of_band(
+                    encoded_data, deltas, previous_overlay)
+            self._sent_overlays[mpp_message.receiver] = (
+                    encoded_message.settings_overlay)
+            encoded_data = encoded_message.data
+            if compressor is not None:
+                encoded_data.compress(compressor)
+            self._server.deposit(mpp_message.receiver, encoded_message)
+            if self._outboxes_limited:
+                self.__update_high_water(mpp_message.receiver, port, slot)
+
+        if profile_event is not None:
+            profile_event.stop()
+            profile_event.message_size = encoded_message.nbytes
+            self._profiler.record_event(profile_event)
+
+    def __update_high_water(
+            self, receiver: Reference, port: Port, slot: Optional[int]) -> None:
+        """Records when the outbox of a receiver reaches a new maximum.
+
+        Args:
+            receiver: The receiver that a message was deposited for.
+            port: The port the message was sent on.
+            slot: The slot the message was sent on, if any.
+        """
+        high_water = self._server.get_high_water(receiver)
+        previous = self._high_water.get(receiver)
+        if previous is None or high_water > previous[0]:
+            self._high_water[receiver] = (
+                    high_water, port, slot, ProfileTimestamp())
+
+    def __get_client(self, instance: Reference) -> MPPClient:
+        """Get or create a client to connect to the given instance.
+
+        Args:
+            instance: A reference to the instance to connect to.
+
+        Returns:
+            An existing or new MCP client.
+        """
+        if instance not in self._clients:
+            locations = self._peer_info.get_peer_locations(instance)
+            _logger.info(f'Connecting to peer {instance} at {locations}')
+            self._clients[instance] = MPPClient(locations)
+
+        return self._clients[instance]
+
+    def __get_prefetcher(
+            self, port_name: str, slot: Optional[int], recv_endpoint: Endpoint,
+            snd_endpoint: Endpoint) -> Prefetcher:
+        """Get or create a prefetcher for the given port and slot.
+
+        Args:
+            port_name: The port to receive on.
+            slot: The slot to receive on, if any.
+            recv_endpoint: The endpoint on our side.
+            snd_endpoint: The endpoint on the sending side.
+
+        Returns:
+            An existing or new Prefetcher.
+        """
+        key = (port_name, slot)
+        if key not in self._prefetchers:
+            instance = snd_endpoint.instance()
+            locations = self._peer_info.get_peer_locations(instance)
+            _logger.info(
+                    f'Connecting to peer {instance} at {locations} to prefetch'
+                    f' messages for {recv_endpoint.ref()}')
+            self._prefetchers[key] = Prefetcher(
+                    MPPClient(locations), recv_endpoint.ref(),
+                    self._prefetch_depths[port_name], self._prefetch_budget)
+
+        return self._prefetchers[key]
+
+    def __get_fetcher(
+            self, port_name: str, slot: Optional[int],
+            placer: Optional[BufferPlacer] = None) -> Tuple[Any, _Fetcher]:
+        """Get a function that fetches the next message on a port.
+
+        Fetches through the same source must not run concurrently, so this
+        returns the source as well.
+
+        Args:
+            port_name: The port to receive on.
+            slot: The slot to receive on, if any.
+            placer: Placer to receive the message with, if any. This is not
+                    used for prefetched messages.
+
+        Returns:
+            The source of the message, and the function to call to get it.
+        """
+        route = self.__get_route(port_name, slot)
+        snd_endpoint = route.peers[0]
+        key = (port_name, slot)
+
+        if port_name in self._prefetch_depths:
+            fetched = self._fetched.get(key)
+            if fetched:
+                return fetched, partial(self.__pop_fetched, fetched)
+            prefetcher = self.__get_prefetcher(
+                    port_name, slot, route.endpoint, snd_endpoint)
+            return prefetcher, prefetcher.receive
+
+        client = self.__get_client(snd_endpoint.instance())
+        if client.supports_batches:
+            receivers = self._batch_receivers.setdefault(client, {})
+            receivers.setdefault(key, route.ref)
+        return client, partial(self.__fetch, client, key, route.ref, placer)
+
+    def __fetch(
+            self, client: MPPClient, key: Tuple[str, Optional[int]],
+            receiver: Reference, placer: Optional[BufferPlacer],
+            timeout_handler: Optional[TimeoutHandler]
+            ) -> Tuple[Buffer, ProfileData]:
+        """Fetches the next message on a port and slot from a peer.
+
+        If the message was already fetched along with an earlier one, then
+        it is returned straight away. Otherwise, if the peer supports it,
+        any messages that it has waiting for this or other ports that
+        receive from it are fetched along with the requested one, and kept
+        until they are received. Ports that still have such messages are
+        left out, so that at most one batch is kept for each.
+
+        Args:
+            client: The client connected to the peer.
+            key: The port name and slot to receive on.
+            receiver: Our endpoint for the port and slot.
+            placer: Placer to receive the message with, if any. Messages
+                    are not fetched in batches if one is given.
+            timeout_handler: Timeout handler for deadlock detection, if
+                    any.
+
+        Returns:
+            The fetched message and profiling data.
+        """
+        fetched = self._fetched.get(key)
+        if fetched:
+            return self.__pop_fetched(fetched, timeout_handler)
+
+        if placer is not None:
+            return client.receive(receiver, timeout_handler, placer=placer)
+        if not client.supports_batches:
+            return client.receive(receiver, timeout_handler)
+
+        receivers = dict(self._batch_receivers[client])
+        keys = [key] + [
+                other for other in receivers
+                if other != key and not self._fetched.get(other)]
+        messages, profile = client.receive_batch(
+                [receiver] + [receivers[other] for other in keys[1:]],
+                timeout_handler, _MAX_BATCH_MESSAGES, _MAX_BATCH_BYTES)
+        for index, frame in messages[1:]:
+            self._fetched.setdefault(keys[index], deque()).append(frame)
+        return messages[0][1], profile
+
+    def __pop_fetched(
+            self, fetched: Deque[Buffer],
+            timeout_handler: Optional[TimeoutHandler]
+            ) -> Tuple[Buffer, ProfileData]:
+        """Returns a message that was fetched along with an earlier one.
+
+        Args:
+            fetched: The queue of messages to take it from.
+            timeout_handler: Unused, for compatibility with other fetchers.
+
+        Returns:
+            The message, and profiling data for a transfer that took no
+            time.
+        """
+        now = ProfileTimestamp()
+        return fetched.popleft(), (now, now, now)
+
+    def __get_timeout_handler(
+            self, port_name: str, slot: Optional[int]
+            ) -> Optional[ReceiveTimeoutHandler]:
+        """Creates a timeout handler for receiving on a port.
+
+        Args:
+            port_name: The port to receive on.
+            slot: The slot to receive on, if any.
+
+        Returns:
+            A new handler, or None if deadlock detection is disabled.
+        """
+        if self._receive_timeout < 0:
+            return None
+        return ReceiveTimeoutHandler(
+                self._manager, self.__get_sender(port_name, slot).instance(),
+                port_name, slot, self._receive_timeout)
+
+    def __get_sender(self, port_name: str, slot: Optional[int]) -> Endpoint:
+        """Determines the endpoint that sends to a port.
+
+        Args:
+            port_name: The receiving port.
+            slot: The slot to receive on, if any.
+        """
         # peer_info already checks that there is at most one snd_endpoint
         # connected to the port we receive on
-        snd_endpoint = self._peer_info.get_peer_endpoints(
-                recv_endpoint.port, slot_list)[0]
-        client = self.__get_client(snd_endpoint.instance())
-        timeout_handler = None
-        if self._receive_timeout >= 0:
-            timeout_handler = ReceiveTimeoutHandler(
-                    self._manager, snd_endpoint.instance(),
-                    port_name, slot, self._receive_timeout)
-        try:
-            mpp_message_bytes, profile = client.receive(
-                    recv_endpoint.ref(), timeout_handler)
-        except (ConnectionError, SocketClosed) as exc:
+        return self.__get_route(port_name, slot).peers[0]
+
+    def __get_route(self, port_name: str, slot: Optional[int]) -> _Route:
+        """Returns the endpoints that a port and slot connect.
+
+        Args:
+            port_name: Name of the port to send or receive on.
+            slot: The slot to send or receive on, if any.
+        """
+        route = self._routes.get((port_name, slot))
+        if route is None:
+            slot_list = [] if slot is None else [slot]
+            endpoint = self.__get_endpoint(port_name, slot_list)
+            peers: List[Endpoint] = []
+            if self._peer_info.is_connected(endpoint.port):
+                peers = self._peer_info.get_peer_endpoints(
+                        endpoint.port, slot_list)
+            route = _Route(endpoint, peers)
+            self._routes[(port_name, slot)] = route
+        return route
+
+    def __get_receive_port(self, port_name: str) -> Port:
+        """Returns the port to receive on, including muscle_settings_in.
+        """
+        if port_name == 'muscle_settings_in':
+            return self._port_manager._muscle_settings_in
+        return self._port_manager.get_port(port_name)
+
+    def __await_results(
+            self, results: 'Queue[Tuple[int, Any]]', arrived: Dict[int, Any],
+            timeout_handler: Optional[TimeoutHandler], done: Callable[[], bool]
+            ) -> None:
+        """Collects results of concurrent receives until done() is True.
+
+        Args:
+            results: Queue that the results are put on.
+            arrived: Dictionary to put the results into, by slot.
+            timeout_handler: Handler to call if we wait too long.
+            done: Function returning whether we have what we need.
+        """
+        deadline = None
+        if timeout_handler is not None:
+            deadline = time.monotonic() + timeout_handler.timeout
+        did_timeout = False
+
+        while not done():
+            try:
+                if deadline is None:
+                    slot, result = results.get()
+                else:
+                    slot, result = results.get(
+                            timeout=max(0.0, deadline - time.monotonic()))
+            except Empty:
+                assert timeout_handler is not None      # mypy
+                assert deadline is not None             # mypy
+                timeout_handler.on_timeout()
+                deadline += timeout_handler.timeout
+                did_timeout = True
+                continue
+            arrived[slot] = result
+
+        if did_timeout:
+            assert timeout_handler is not None      # mypy
+            timeout_handler.on_receive()
+
+    def __reraise_receive_error(
+            self, exc: Exception, port_name: str, slot: Optional[int]
+            ) -> NoReturn:
+        """Raises an appropriate error for a failed receive.
+
+        Args:
+            exc: The exception raised while receiving.
+            port_name: The port we were receiving on.
+            slot: The slot we were receiving on, if any.
+        """
+        if is_disconnect(exc):
             raise RuntimeError(
                 "Error while receiving a message: connection with peer"
-                f" '{snd_endpoint.kernel}' was lost. Did the peer crash?"
+                f" '{self.__get_sender(port_name, slot).kernel}' was lost. Did"
+                " the peer crash?"
             ) from exc
-        except Deadlock:
+        if isinstance(exc, Deadlock):
             # Profiler messages may be used for debugging the deadlock
             self._profiler.shutdown()
             raise RuntimeError(
                 "Deadlock detected while receiving a message on "
-                f"port '{port_and_slot}'. See manager logs for more detail."
+                f"port '{_port_and_slot(port_name, slot)}'. See manager logs for"
+                " more detail."
             ) from None
+        raise exc
+
+    def __process_message(
+            self, port_name: str, slot: Optional[int],
+            mpp_message_bytes: Buffer, profile: ProfileData,
+            receive_event: ProfileEvent, out: Optional[np.ndarray] = None,
+            placer: Optional[BufferPlacer] = None) -> Tuple[Message, float]:
+        """Decodes and checks a received message, and updates the port.
+
+        Args:
+            port_name: The port the message was received on.
+            slot: The slot the message was received on, if any.
+            mpp_message_bytes: The received message.
+            profile: Profiling data from the transport.
+            receive_event: The RECEIVE event to record.
+            out: Array to receive into, if any, used if the message is
+                    discarded and another one received.
+            placer: The placer the message was received with, if any.
+
+        Returns:
+            The received message and the saved_until field, as for
+            :meth:`receive_message`.
+        """
+        port = self.__get_receive_port(port_name)
+        port_and_slot = _port_and_slot(port_name, slot)
 
         recv_decode_event = ProfileEvent(
                 ProfileEventType.RECEIVE_DECODE, ProfileTimestamp(), None,
                 port, None, slot, port.get_num_messages(),
                 len(memoryview(mpp_message_bytes)))
         mpp_message = MPPMessage.from_bytes(mpp_message_bytes)
+        placed = placer is not None and placer.placed
+        if placer is not None and mpp_message.encoded_data is not None:
+            mpp_message.encoded_data = placer.encoded_data(
+                    mpp_message.encoded_data)
+        if mpp_message.encoded_data is not None:
+            # decompress here, so that it's included in the event
+            mpp_message.encoded_data.decompress()
+            recv_decode_event.message_size = (
+                    len(memoryview(mpp_message_bytes)) +
+                    mpp_message.encoded_data.compression_savings)
+            # delta grids must be decoded in order, so do that now
+            if mpp_message.encoded_data.has_deltas:
+                deltas = self._receive_deltas.setdefault(
+                        (port_name, slot), DeltaReferences())
+                mpp_message.data = mpp_message.encoded_data.decoded(deltas)
+        settings_overlay = self.__received_overlay(
+                port_name, slot, mpp_message)
         recv_decode_event.stop()
 
         if mpp_message.port_length is not None:
             if port.is_resizable():
                 port.set_length(mpp_message.port_length)
 
-        if isinstance(mpp_message.data, ClosePort):
+        is_close_port = mpp_message.is_close_port()
+        if is_close_port:
             port.set_closed(slot)
 
         message = Message(
                 mpp_message.timestamp, mpp_message.next_timestamp,
-                mpp_message.data, mpp_message.settings_overlay)
+                None, settings_overlay)
+        if is_close_port:
+            message.data = ClosePort()
+        elif mpp_message.encoded_data is None:
+            message.data = mpp_message.data
+        else:
+            message._encoded_data = mpp_message.encoded_data
+            if not placed:
+                message._frame = memoryview(mpp_message_bytes).toreadonly()
 
         recv_wait_event = ProfileEvent(
                 ProfileEventType.RECEIVE_WAIT, profile[0], profile[1], port,
@@ -304,7 +1052,7 @@ class Communicator:
 
         receive_event.message_size = len(memoryview(mpp_message_bytes))
 
-        if not isinstance(mpp_message.data, ClosePort):
+        if not is_close_port:
             self._profiler.record_event(recv_wait_event)
             self._profiler.record_event(recv_xfer_event)
             self._profiler.record_event(recv_decode_event)
@@ -317,7 +1065,7 @@ class Communicator:
                 _logger.debug(f'Discarding received message on {port_and_slot}'
                               ': resuming from weakly consistent snapshot')
                 port.set_resumed(slot)
-                return self.receive_message(port_name, slot)
+                return self.receive_message(port_name, slot, out)
             raise RuntimeError(f'Received message on {port_and_slot} with'
                                ' unexpected message number'
                                f' {mpp_message.message_number}. Was expecting'
@@ -325,48 +1073,41 @@ class Communicator:
                                ' from an inconsistent snapshot?')
         port.increment_num_messages(slot)
 
-        _logger.debug('Received message on {}'.format(port_and_slot))
-        if isinstance(mpp_message.data, ClosePort):
+        _logger.debug('Received message on %s', port_and_slot)
+        if is_close_port:
             _logger.debug('Port {} is now closed'.format(port_and_slot))
 
         return message, mpp_message.saved_until
 
-    def shutdown(self) -> None:
-        """Shuts down the Communicator, closing connections.
-        """
-        self._close_ports()
-
-        for client in self._clients.values():
-            client.close()
+    def __received_overlay(
+            self, port_name: str, slot: Optional[int],
+            mpp_message: MPPMessage) -> Settings:
+        """Returns the settings overlay of a received message.
 
-        wait_event = ProfileEvent(ProfileEventType.DISCONNECT_WAIT, ProfileTimestamp())
-        self._server.wait_for_receivers()
-        self._profiler.record_event(wait_event)
-
-        shutdown_event = ProfileEvent(ProfileEventType.SHUTDOWN, ProfileTimestamp())
-        self._server.shutdown()
-        self._profiler.record_event(shutdown_event)
-
-    def __instance_id(self) -> Reference:
-        """Returns our complete instance id.
-        """
-        return self._kernel + self._index
-
-    def __get_client(self, instance: Reference) -> MPPClient:
-        """Get or create a client to connect to the given instance.
+        If the sender left it out because it did not change, then this is
+        the overlay of the previous message on the port and slot.
 
         Args:
-            instance: A reference to the instance to connect to.
+            port_name: The port the message was received on.
+            slot: The slot the message was received on, if any.
+            mpp_message: The received message.
 
         Returns:
-            An existing or new MCP client.
+            The overlay, which the caller may modify.
         """
-        if instance not in self._clients:
-            locations = self._peer_info.get_peer_locations(instance)
-            _logger.info(f'Connecting to peer {instance} at {locations}')
-            self._clients[instance] = MPPClient(locations)
-
-        return self._clients[instance]
+        if mpp_message.same_settings_overlay:
+            overlay = self._received_overlays.get((port_name, slot))
+            if overlay is None:
+                raise RuntimeError(
+                        f'Received a message on'
+                        f' {_port_and_slot(port_name, slot)} without its'
+                        ' settings overlay, and there is no earlier one')
+            return overlay.copy()
+
+        overlay = mpp_message.settings_overlay
+        if overlay is not None:
+            self._received_overlays[(port_name, slot)] = overlay.copy()
+        return overlay
 
     def __get_endpoint(self, port_name: str, slot: List[int]) -> Endpoint:
         """Determines the endpoint on our side.
@@ -440,9 +1181,10 @@ class Communicator:
         port = self._port_manager.get_port(port_name)
         while not all([not port.is_open(slot)
                        for slot in range(port.get_length())]):
-            for slot in range(port.get_length()):
-                if port.is_open(slot):
-                    self.receive_message(port_name, slot)
+            open_slots = [
+                    slot for slot in range(port.get_length()) if port.is_open(slot)]
+            for _ in self.receive_messages(port_name, open_slots, False):
+                pass
 
     def _close_incoming_ports(self) -> None:
         """Closes incoming ports.
@@ -480,3 +1222,10 @@ class Communicator:
         """
         self._close_outgoing_ports()
         self._close_incoming_ports()
+
+
+def _port_and_slot(port_name: str, slot: Optional[int]) -> str:
+    """Returns a description of a port and slot for use in messages."""
+    if slot is None:
+        return port_name
+    return f'{port_name}[{slot}]'
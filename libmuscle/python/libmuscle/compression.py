@@ -0,0 +1,200 @@
+from enum import IntEnum
+import importlib
+from types import ModuleType
+from typing import Dict, List, Optional
+from typing_extensions import Buffer
+
+from libmuscle.mcp.protocol import MPPFeature
+
+
+class Codec(IntEnum):
+    """Compression codecs for message data.
+
+    The values are used to identify the codec in the wire format.
+    """
+    NONE = 0
+    ZLIB = 1
+    LZMA = 2
+    BZ2 = 3
+
+    def feature(self) -> MPPFeature:
+        """Returns the MPP feature that signals support for this codec."""
+        return MPPFeature[self.name]
+
+
+def _import_codec(name: str) -> Optional[ModuleType]:
+    """Imports a codec module, if this Python has it."""
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        return None
+
+
+_modules: Dict[Codec, Optional[ModuleType]] = {
+        Codec.ZLIB: _import_codec('zlib'),
+        Codec.LZMA: _import_codec('lzma'),
+        Codec.BZ2: _import_codec('bz2')}
+
+
+def codec_features() -> List[MPPFeature]:
+    """Returns the MPP features for the codecs that are available."""
+    return [codec.feature() for codec, module in _modules.items() if module]
+
+
+_MIN_SIZE = 1024
+"""Buffers smaller than this are never compressed."""
+
+
+_SAMPLE_CHUNK_SIZE = 16384
+"""Size of each of the parts of a buffer that adaptive mode compresses."""
+
+
+_SAMPLE_CHUNKS = 4
+"""Number of parts of a buffer that adaptive mode compresses."""
+
+
+class CompressedBuffer:
+    """An out-of-band buffer, possibly compressed.
+
+    Attributes:
+        codec: The codec the data was compressed with, or Codec.NONE.
+        data: The (compressed) data.
+        size: Size of the data after decompression.
+    """
+    def __init__(self, codec: Codec, data: Buffer, size: int) -> None:
+        """Create a CompressedBuffer.
+
+        Args:
+            codec: The codec the data was compressed with, or Codec.NONE.
+            data: The (compressed) data.
+            size: Size of the data after decompression.
+        """
+        self.codec = codec
+        self.data = data
+        self.size = size
+
+    def decompressed(self) -> memoryview:
+        """Returns the decompressed data.
+
+        This is a writable copy, unless the data was not compressed, in
+        which case it is returned as is.
+
+        Raises:
+            RuntimeError: If the codec is not available, or the data is
+                    corrupt.
+        """
+        if self.codec == Codec.NONE:
+            return memoryview(self.data)
+
+        module = _modules[self.codec]
+        if module is None:
+            raise RuntimeError(
+                    f'Received data compressed with {self.codec.name.lower()},'
+                    ' which is not available in this Python installation')
+
+        data = bytearray(module.decompress(self.data))
+        if len(data) != self.size:
+            raise RuntimeError('Received corrupt compressed data')
+        return memoryview(data)
+
+
+class Compressor:
+    """Compresses out-of-band buffers before they are sent.
+
+    Compression is only worth it for data that compresses well, and only
+    if the link is slow enough. In adaptive mode, a sample of each buffer
+    is compressed quickly first, and the buffer is compressed only if
+    that shrinks the sample to at most ``threshold`` times its size.
+    """
+    def __init__(
+            self, codec: Codec, adaptive: bool = False, threshold: float = 0.8
+            ) -> None:
+        """Create a Compressor.
+
+        Args:
+            codec: The codec to compress with.
+            adaptive: Whether to sample the buffers first.
+            threshold: Maximum compressed to uncompressed size ratio of
+                    the sample for a buffer to be compressed.
+        """
+        module = _modules[codec]
+        if module is None:
+            raise RuntimeError(
+                    f'Codec {codec.name.lower()} is not available in this'
+                    ' Python installation')
+
+        self.codec = codec
+        self._module = module
+        self._adaptive = adaptive
+        self._threshold = threshold
+
+    @staticmethod
+    def from_setting(mode: str, threshold: float) -> Optional['Compressor']:
+        """Creates a Compressor from a muscle_compression setting.
+
+        Args:
+            mode: One of 'none', 'zlib', 'lzma', 'bz2' or 'adaptive'.
+            threshold: Threshold for adaptive mode.
+
+        Returns:
+            A Compressor, or None if mode is 'none'.
+
+        Raises:
+            ValueError: If the mode is not known.
+        """
+        if mode == 'none':
+            return None
+        if mode == 'adaptive':
+            return Compressor(Codec.ZLIB, True, threshold)
+        if mode in ('zlib', 'lzma', 'bz2'):
+            return Compressor(Codec[mode.upper()])
+        raise ValueError(
+                f'Unknown compression mode "{mode}", expected one of none, zlib,'
+                ' lzma, bz2 or adaptive')
+
+    def compress(self, buf: Buffer) -> CompressedBuffer:
+        """Compresses a buffer, if that makes it smaller.
+
+        Args:
+            buf: The buffer to compress.
+
+        Returns:
+            The compressed buffer, or the original if it is not worth
+            compressing.
+        """
+        view = memoryview(buf).cast('B')
+        uncompressed = CompressedBuffer(Codec.NONE, buf, view.nbytes)
+        if view.nbytes < _MIN_SIZE:
+            return uncompressed
+
+        if self._adaptive:
+            return self._compress_adaptive(view, uncompressed)
+
+        data = self._module.compress(view)
+        if len(data) >= view.nbytes:
+            return uncompressed
+        return CompressedBuffer(self.codec, data, view.nbytes)
+
+    def _compress_adaptive(
+            self, view: memoryview, uncompressed: CompressedBuffer
+            ) -> CompressedBuffer:
+        """Compresses a buffer quickly, if a sample compresses well.
+
+        Args:
+            view: The buffer to compress.
+            uncompressed: The buffer as is, to return if it's not worth it.
+        """
+        size = view.nbytes
+        if size > _SAMPLE_CHUNKS * _SAMPLE_CHUNK_SIZE:
+            stride = size // _SAMPLE_CHUNKS
+            sample = b''.join(
+                    view[i * stride:i * stride + _SAMPLE_CHUNK_SIZE]
+                    for i in range(_SAMPLE_CHUNKS))
+            ratio = len(self._module.compress(sample, 1)) / len(sample)
+            if ratio > self._threshold:
+                return uncompressed
+
+        data = self._module.compress(view, 1)
+        if len(data) > self._threshold * size:
+            return uncompressed
+        return CompressedBuffer(self.codec, data, size)
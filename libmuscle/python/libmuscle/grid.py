@@ -14,9 +14,15 @@ class Grid:
     use :external:py:meth:`array.copy()<numpy.ndarray.copy>` to create a
     writable copy. See the tutorial for examples.
 
+    Grids are normally sent in full. Grids created using :meth:`sparse` or
+    :meth:`delta` are sent in a more compact form if possible, but are
+    received as an ordinary Grid with the complete array.
+
     Attributes:
         array (np.ndarray): An array of data
         indexes (Optional[List[str]]): The names of the array's indexes.
+        encoding (str): How to send the array, one of ``'dense'``,
+                ``'sparse'`` or ``'delta'``.
     """
     def __init__(
             self, array: np.ndarray, indexes: Optional[List[str]] = None
@@ -33,6 +39,12 @@ class Grid:
         (:external:py:class:`numpy.bool_`, :external:py:attr:`numpy.bool8`). The
         ``data`` argument must be a NumPy array of one of those types.
 
+        Python components can also send 1- and 2-byte integers, unsigned
+        integers of any size, 2-byte floats (:external:py:attr:`numpy.float16`)
+        and complex numbers (:external:py:attr:`numpy.complex64`,
+        :external:py:attr:`numpy.complex128`), but only to other Python
+        components.
+
         If ``indexes`` is given, then it must be a list of strings of
         the same length as the number of dimensions of ``data``, and
         contain the names of the indexes of the array. For a 2D
@@ -51,3 +63,44 @@ class Grid:
 
         self.array = array
         self.indexes = indexes
+        self.encoding = 'dense'
+
+    @staticmethod
+    def sparse(array: np.ndarray, indexes: Optional[List[str]] = None) -> 'Grid':
+        """Creates a Grid that is sent as its non-zero elements.
+
+        The positions and values of the elements that are not zero are
+        sent, rather than the whole array. This is smaller if most
+        elements are zero, otherwise the array is sent in full.
+
+        Components written in other languages receive it as an ordinary
+        grid.
+
+        Args:
+            array: An array of data, of a supported type.
+            indexes: Names of the indexes, as for the constructor.
+        """
+        grid = Grid(array, indexes)
+        grid.encoding = 'sparse'
+        return grid
+
+    @staticmethod
+    def delta(array: np.ndarray, indexes: Optional[List[str]] = None) -> 'Grid':
+        """Creates a Grid that is sent as the changes to the previous one.
+
+        The sender and the receiver both keep the array that was last sent
+        in the corresponding place in a message on the same port and slot.
+        If the next one has the same shape and type, then only the positions
+        and values of the elements that changed are sent. The first array,
+        and any array that changed too much, is sent in full.
+
+        Components written in other languages receive it as an ordinary
+        grid. Received delta grids are read-only.
+
+        Args:
+            array: An array of data, of a supported type.
+            indexes: Names of the indexes, as for the constructor.
+        """
+        grid = Grid(array, indexes)
+        grid.encoding = 'delta'
+        return grid
@@ -3,20 +3,24 @@ from enum import Flag, auto
 import logging
 import os
 import sys
-from typing import cast, Dict, List, Literal, Optional, Tuple, overload
+from typing import (
+        cast, Dict, Generator, Iterator, List, Literal, Optional, Tuple, overload)
 
+import numpy as np
 from ymmsl.v0_2 import (
         Identifier, Operator, SettingValue, Port, Reference, Settings)
 
 from libmuscle.api_guard import APIGuard
 from libmuscle.checkpoint_triggers import TriggerManager
-from libmuscle.communicator import Communicator, Message
+from libmuscle.communicator import Communicator, Message, copy_data_into
+from libmuscle.compression import Compressor
 from libmuscle.settings_manager import SettingsManager
 from libmuscle.logging import LogLevel
 from libmuscle.logging_handler import MuscleManagerHandler
 from libmuscle.mpp_message import ClosePort
-from libmuscle.mmp_client import MMPClient
+from libmuscle.mmp_client import CheckpointInfoType, MMPClient
 from libmuscle.mmsf_validator import MMSFValidator
+from libmuscle.peer_info import PeerInfo
 from libmuscle.port_manager import PortManager
 from libmuscle.profiler import Profiler
 from libmuscle.profiling import (
@@ -102,6 +106,17 @@ _CHECKPOINT_SUPPORT_MASK = (
         InstanceFlags.STATE_NOT_REQUIRED_FOR_NEXT_USE)
 
 
+def _is_close_port(message: Message) -> bool:
+    """Returns whether a message closes its port.
+
+    Received messages carrying a ClosePort have it decoded on receipt, so
+    this avoids decoding the data of any other received message.
+    """
+    if isinstance(message, Message) and message.frame is not None:
+        return False
+    return isinstance(message.data, ClosePort)
+
+
 class Instance:
     """Represents a component instance in a MUSCLE3 simulation.
 
@@ -184,9 +199,9 @@ class Instance:
         self._f_init_cache: _FInitCacheType = {}
         """Stores pre-received messages for f_init ports"""
 
-        self._register()
+        peer_info, checkpoint_info = self._register()
         try:
-            self._connect()
+            self._connect(peer_info)
         except Exception:
             # Clean up when we cannot connect to our peers. This could happen when peers
             # are not started (in time) in a pytest context, but we still want to run
@@ -195,12 +210,15 @@ class Instance:
             raise
         # Note: self._setup_checkpointing() needs to have the ports initialized
         # so it comes after self._connect()
-        self._setup_checkpointing()
+        self._setup_checkpointing(checkpoint_info)
         # profiling and logging need settings, so come after register_()
         self._set_local_log_level()
         self._set_remote_log_level()
         self._setup_profiling()
         self._setup_receive_timeout()
+        self._setup_prefetch()
+        self._setup_compression()
+        self._setup_outbox_limits()
         # MMSFValidator needs a connected port manager, and does some logging
         self._mmsf_validator = (
                 None if InstanceFlags.SKIP_MMSF_SEQUENCE_CHECKS in self._flags
@@ -243,6 +261,7 @@ class Instance:
         self._api_guard.verify_reuse_instance()
         if self._mmsf_validator:
             self._mmsf_validator.reuse_instance()
+        self._communicator.flush()
 
         if self._do_reuse is not None:
             # thank you, should_save_final_snapshot, for running this already
@@ -468,16 +487,24 @@ class Instance:
         self._port_manager.get_port(port).set_length(length)
 
     def send(self, port_name: str, message: Message,
-             slot: Optional[int] = None) -> None:
+             slot: Optional[int] = None, deferred: bool = False) -> None:
         """Send a message to the outside world.
 
         Sending is non-blocking, a copy of the message will be made
         and stored in memory until the receiver is ready to receive it.
 
+        Making that copy takes time for large messages. With
+        ``deferred=True``, it is made in the background instead, and this
+        function returns immediately. In that case, you must not modify
+        the message or its data until you have called :meth:`flush`. A
+        send without ``deferred`` and :meth:`reuse_instance` call
+        :meth:`flush` automatically.
+
         Args:
             port_name: The port on which this message is to be sent.
             message: The message to be sent.
             slot: The slot to send the message on, if any.
+            deferred: Whether to copy the message in the background.
         """
         self.__check_port(port_name, slot, True)
         if self._mmsf_validator:
@@ -488,7 +515,17 @@ class Instance:
 
         self._communicator.send_message(
                 port_name, message, slot,
-                self._trigger_manager.checkpoints_considered_until())
+                self._trigger_manager.checkpoints_considered_until(), deferred)
+
+    def flush(self) -> None:
+        """Wait until messages sent with ``deferred=True`` have been copied.
+
+        After this, the data of those messages may be modified again. If
+        one of those messages could not be encoded, for example because it
+        contained an unsupported object, then the error that :meth:`send`
+        would have raised is raised here.
+        """
+        self._communicator.flush()
 
     def receive(self, port_name: str, slot: Optional[int] = None,
                 default: Optional[Message] = None
@@ -522,6 +559,95 @@ class Instance:
         """
         return self.__receive_message(port_name, slot, default, False)
 
+    def receive_into(
+            self, port_name: str, out: np.ndarray, slot: Optional[int] = None,
+            default: Optional[Message] = None) -> Message:
+        """Receive a message containing an array into an existing array.
+
+        This works like :meth:`receive`, but the data of the received
+        message must be an array (a :class:`Grid`) of the same shape and
+        data type as ``out``. It is put into ``out``, and the data of the
+        returned message is a :class:`Grid` referring to ``out``.
+
+        Where possible, the array is received straight into ``out``,
+        without allocating memory for it or copying it. This is the case
+        for messages received over the network from a sender that sends
+        only this array, if ``out`` is contiguous. Otherwise, the array is
+        copied into ``out``.
+
+        Args:
+            port_name: The endpoint on which a message is to be
+                    received.
+            out: A writable array to receive the data into.
+            slot: The slot to receive the message on, if any.
+            default: A default value to return if this port is not
+                    connected. Its data is not put into ``out``.
+
+        Returns:
+            The received message. The settings attribute of the
+            received message will be None.
+
+        Raises:
+            RuntimeError: If the given port is not connected and no
+                    default value was given, or if the received data
+                    does not fit into ``out``. In the latter case, the
+                    contents of ``out`` are undefined.
+        """
+        if not out.flags.writeable:
+            raise ValueError('The array to receive into must be writable')
+        return self.__receive_message(port_name, slot, default, False, out)
+
+    def receive_all(self, port_name: str) -> List[Message]:
+        """Receive a message on every slot of a vector port.
+
+        This is equivalent to calling :meth:`receive` for each slot in
+        turn, but the messages are received concurrently. This takes
+        about as long as the slowest transfer, rather than the sum of all
+        of them.
+
+        Args:
+            port_name: The vector port on which messages are to be
+                    received.
+
+        Returns:
+            The received messages, in slot order. The settings attributes
+            of the received messages will be None.
+
+        Raises:
+            RuntimeError: If the given port is not a connected vector
+                    port.
+        """
+        return [msg for _, msg in self.__receive_vector(port_name, True)]
+
+    def receive_any(self, port_name: str) -> Iterator[Tuple[int, Message]]:
+        """Receive a message on every slot of a vector port, as they arrive.
+
+        This is like :meth:`receive_all`, but gives each message as soon
+        as it arrives, so that it can be processed while the others are
+        still being received. Use it as
+
+        .. code-block:: python
+
+            for slot, msg in instance.receive_any('state_in'):
+                ...
+
+        and make sure to go through all the messages.
+
+        Args:
+            port_name: The vector port on which messages are to be
+                    received.
+
+        Returns:
+            An iterator over the slots and the messages received on them,
+            in order of arrival. The settings attributes of the received
+            messages will be None.
+
+        Raises:
+            RuntimeError: If the given port is not a connected vector
+                    port.
+        """
+        return self.__receive_vector(port_name, False)
+
     def receive_with_settings(
             self, port_name: str, slot: Optional[int] = None,
             default: Optional[Message] = None
@@ -722,31 +848,41 @@ class Instance:
                 (msg.timestamp for msg in self._f_init_cache.values()),
                 default=None)
 
-    def _register(self) -> None:
+    def _register(self) -> Tuple[Optional[PeerInfo], CheckpointInfoType]:
         """Register this instance with the manager.
+
+        This also gets the base settings, and the peers and checkpoint info
+        for :meth:`_connect` and :meth:`_setup_checkpointing`, which are
+        returned.
         """
         register_event = ProfileEvent(
                 ProfileEventType.REGISTER, ProfileTimestamp())
         locations = self._communicator.get_locations()
         port_list = self.__list_declared_ports()
-        self.__manager.register_instance(locations, port_list)
+        peer_info, settings, checkpoint_info = self.__manager.bootstrap(
+                locations, port_list)
+        self._settings_manager.base = settings
         self._profiler.record_event(register_event)
-        _logger.info('Registered with the manager')
+        _logger.info('Registered with the manager and received base settings')
+        return peer_info, checkpoint_info
 
-    def _connect(self) -> None:
+    def _connect(self, peer_info: Optional[PeerInfo]) -> None:
         """Connect this instance to the given peers / conduits.
+
+        Args:
+            peer_info: Peers received on registration, or None if the
+                manager did not have them yet.
         """
         connect_event = ProfileEvent(
                 ProfileEventType.CONNECT, ProfileTimestamp())
 
-        peer_info = self.__manager.request_peers()
+        if peer_info is None:
+            peer_info = self.__manager.request_peers()
         self._port_manager.connect_ports(peer_info)
         self._communicator.set_peer_info(peer_info)
 
-        self._settings_manager.base = self.__manager.get_settings()
-
         self._profiler.record_event(connect_event)
-        _logger.info('Received peer locations and base settings')
+        _logger.info('Received peer locations')
 
     def _deregister(self) -> None:
         """Deregister this instance from the manager.
@@ -765,18 +901,21 @@ class Instance:
 
         # This is the last thing we'll profile, so flush messages
         self._profiler.shutdown()
-        self.__manager.deregister_instance()
 
-        # Remove handler, the manager may be gone at this point so we
-        # cannot send it any more log messages.
+        # Remove handler and send any waiting log messages, the manager may
+        # be gone after we deregister so we cannot send it any more then.
         logging.getLogger().removeHandler(self._mmp_handler)
+        self._mmp_handler.close()
+
+        self.__manager.deregister_instance()
         _logger.info('Deregistered from the manager')
 
-    def _setup_checkpointing(self) -> None:
+    def _setup_checkpointing(self, checkpoint_info: CheckpointInfoType) -> None:
         """Setup checkpointing.
-        """
-        checkpoint_info = self.__manager.get_checkpoint_info()
 
+        Args:
+            checkpoint_info: Checkpoint info received on registration.
+        """
         elapsed_time, checkpoints = checkpoint_info[0:2]
         self._trigger_manager.set_checkpoint_info(elapsed_time, checkpoints)
 
@@ -877,6 +1016,93 @@ class Instance:
                 "Timeout on receiving messages set to %f",
                 self._communicator._receive_timeout)
 
+    def _setup_prefetch(self) -> None:
+        """Configures receive prefetching with settings from settings.
+
+        Prefetching is enabled for all receiving ports by
+        muscle_prefetch_depth, and for a single port by
+        muscle_prefetch_depth_<port>, which overrides the former.
+        """
+        try:
+            max_bytes = self.get_setting('muscle_prefetch_max_bytes', 'int')
+            self._communicator.set_prefetch_max_bytes(max_bytes)
+        except KeyError:
+            pass  # do nothing and keep the default
+
+        default_depth = self.get_setting('muscle_prefetch_depth', 'int', default=0)
+        for operator, port_names in self._port_manager.list_ports().items():
+            if not operator.allows_receiving():
+                continue
+            for port_name in port_names:
+                depth = self.get_setting(
+                        f'muscle_prefetch_depth_{port_name}', 'int',
+                        default=default_depth)
+                if depth > 0:
+                    _logger.debug(
+                            'Prefetching up to %d messages on port %s',
+                            depth, port_name)
+                self._communicator.set_prefetch_depth(port_name, depth)
+
+    def _setup_compression(self) -> None:
+        """Configures compression of sent messages with settings.
+
+        Compression is enabled for all sending ports by muscle_compression,
+        and for a single port by muscle_compression_<port>, which overrides
+        the former. The threshold for adaptive mode is set by
+        muscle_compression_threshold.
+        """
+        default_mode = self.get_setting('muscle_compression', 'str', default='none')
+        threshold = self.get_setting(
+                'muscle_compression_threshold', 'float', default=0.8)
+
+        for operator, port_names in self._port_manager.list_ports().items():
+            if not operator.allows_sending():
+                continue
+            for port_name in port_names:
+                mode = self.get_setting(
+                        f'muscle_compression_{port_name}', 'str',
+                        default=default_mode)
+                try:
+                    compressor = Compressor.from_setting(mode, threshold)
+                except (RuntimeError, ValueError) as e:
+                    _logger.warning(
+                            f'{e}. Not compressing messages on port {port_name}.')
+                    compressor = None
+                if compressor is not None:
+                    _logger.debug('Compressing with %s on port %s', mode, port_name)
+                self._communicator.set_compression(port_name, compressor)
+
+    def _setup_outbox_limits(self) -> None:
+        """Configures limits on memory used by sent messages with settings.
+
+        muscle_outbox_max_bytes limits the size of the messages waiting for
+        a single receiver, and muscle_outbox_total_max_bytes that of all of
+        them together. muscle_outbox_overflow sets what happens if a limit
+        is exceeded, either 'block' (the default) or 'spill'.
+        """
+        limits: List[Optional[int]] = []
+        for name in ('muscle_outbox_max_bytes', 'muscle_outbox_total_max_bytes'):
+            try:
+                limits.append(self.get_setting(name, 'int'))
+            except KeyError:
+                limits.append(None)
+
+        overflow = self.get_setting(
+                'muscle_outbox_overflow', 'str', default='block')
+        if overflow not in ('block', 'spill'):
+            _logger.warning(
+                    f'Invalid value "{overflow}" for muscle_outbox_overflow,'
+                    ' expected "block" or "spill". Using "block".')
+            overflow = 'block'
+
+        if limits != [None, None]:
+            _logger.debug(
+                    'Limiting outboxes to %s bytes each and %s in total, %s',
+                    limits[0], limits[1],
+                    'spilling' if overflow == 'spill' else 'blocking')
+        self._communicator.set_outbox_limits(
+                limits[0], limits[1], overflow == 'spill')
+
     def _decide_reuse_instance(self) -> bool:
         """Decide whether and how to reuse the instance.
 
@@ -943,12 +1169,13 @@ class Instance:
 
     def __receive_message(
             self, port_name: str, slot: Optional[int],
-            default: Optional[Message], with_settings: bool
+            default: Optional[Message], with_settings: bool,
+            out: Optional[np.ndarray] = None
             ) -> Message:
         """Receives a message on the given port.
 
-        This implements receive and receive_with_settings, see the
-        description of those.
+        This implements receive, receive_into and receive_with_settings,
+        see the description of those.
         """
         self.__check_port(port_name, slot, False, True)
         if self._mmsf_validator:
@@ -1003,7 +1230,8 @@ class Instance:
                     return default
 
             else:
-                msg, saved_until = self._communicator.receive_message(port_name, slot)
+                msg, saved_until = self._communicator.receive_message(
+                        port_name, slot, out)
                 if not port.is_open(slot):
                     err_msg = (('Port {} was closed while trying to'
                                 ' receive on it, did the peer crash?'
@@ -1014,8 +1242,64 @@ class Instance:
                     self.__check_compatibility(port_name, msg.settings)
                     msg.settings = None
                 self._trigger_manager.harmonise_wall_time(saved_until)
+
+        if out is not None:
+            try:
+                copy_data_into(msg, out)
+            except RuntimeError as e:
+                err_msg = (
+                        'Could not receive into the given array on port'
+                        f' "{port_name}": {e}')
+                self.__shutdown(err_msg)
+                raise RuntimeError(err_msg) from None
         return msg
 
+    def __receive_vector(
+            self, port_name: str, in_order: bool
+            ) -> Generator[Tuple[int, Message], None, None]:
+        """Receives a message on every slot of a vector port.
+
+        This implements receive_all and receive_any, see the description
+        of those.
+        """
+        self.__check_port(port_name, None, False)
+        port = self._port_manager.get_port(port_name)
+        if not port.is_vector():
+            err_msg = (f'Port "{port_name}" is not a vector port. Please use'
+                       ' receive() to receive on it.')
+            self.__shutdown(err_msg)
+            raise RuntimeError(err_msg)
+
+        if not port.is_connected() or port.operator == Operator.F_INIT:
+            # F_INIT messages have been received already, and this
+            # produces the same errors as receive() if not connected.
+            for slot in range(port.get_length() if port.is_connected() else 1):
+                yield slot, self.__receive_message(port_name, slot, None, False)
+            return
+
+        slots = list(range(port.get_length()))
+        if port.is_resizable():
+            # The length comes with the first message
+            yield 0, self.__receive_message(port_name, 0, None, False)
+            slots = list(range(1, port.get_length()))
+
+        if self._mmsf_validator:
+            for slot in slots:
+                self._mmsf_validator.check_receive(port_name, slot)
+
+        for slot, msg, saved_until in self._communicator.receive_messages(
+                port_name, slots, in_order):
+            if not port.is_open(slot):
+                err_msg = (('Port {} was closed while trying to'
+                            ' receive on it, did the peer crash?'
+                            ).format(port_name))
+                self.__shutdown(err_msg)
+                raise RuntimeError(err_msg)
+            self.__check_compatibility(port_name, msg.settings)
+            msg.settings = None
+            self._trigger_manager.harmonise_wall_time(saved_until)
+            yield slot, msg
+
     def __make_full_name(self
                          ) -> Tuple[Reference, List[int]]:
         """Returns instance name and index.
@@ -1144,7 +1428,7 @@ class Instance:
 
         self.__pre_receive_f_init()
         for message in self._f_init_cache.values():
-            if isinstance(message.data, ClosePort):
+            if _is_close_port(message):
                 all_ports_open = False
 
         if not all_ports_open:
@@ -1189,6 +1473,11 @@ class Instance:
 
         def pre_receive(port_name: str, slot: Optional[int]) -> None:
             msg, saved_until = self._communicator.receive_message(port_name, slot)
+            cache(port_name, slot, msg, saved_until)
+
+        def cache(
+                port_name: str, slot: Optional[int], msg: Message,
+                saved_until: float) -> None:
             if apply_overlay:
                 self.__apply_overlay(msg)
                 self.__check_compatibility(port_name, msg.settings)
@@ -1209,8 +1498,9 @@ class Instance:
                 pre_receive(port_name, 0)
                 # The above receives the length, if needed, so now we can
                 # get the rest.
-                for slot in range(1, port.get_length()):
-                    pre_receive(port_name, slot)
+                for slot, msg, saved_until in self._communicator.receive_messages(
+                        port_name, list(range(1, port.get_length()))):
+                    cache(port_name, slot, msg, saved_until)
 
     def _set_remote_log_level(self) -> None:
         """Sets the remote log level.
@@ -61,6 +61,7 @@ class LogMessage:
                 simulation).
         level: Log level of the message.
         text: Content of the message.
+        count: Number of times the message was logged in a row.
 
     Attributes:
         instance_id: The identifier of the instance that generated \
@@ -69,16 +70,19 @@ class LogMessage:
                 simulation).
         level: Log level of the message.
         text: Content of the message.
+        count: Number of times the message was logged in a row.
     """
     def __init__(
             self,
             instance_id: str,
             timestamp: Timestamp,
             level: LogLevel,
-            text: str
+            text: str,
+            count: int = 1
             ) -> None:
 
         self.instance_id = instance_id
         self.timestamp = timestamp
         self.level = level
         self.text = text
+        self.count = count
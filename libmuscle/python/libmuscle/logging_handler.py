@@ -1,7 +1,16 @@
+from collections import deque
 import logging
+from threading import Condition, Thread
+import time
+from typing import Deque, List
 
 from libmuscle.logging import LogLevel, LogMessage, Timestamp
-from libmuscle.mmp_client import ConnectionLockedError, MMPClient
+from libmuscle.mmp_client import MMPClient
+
+
+_BATCH_SIZE = 100               # messages
+_BUFFER_SIZE = 10000            # messages
+_FLUSH_INTERVAL = 1.0           # seconds
 
 
 class MuscleManagerHandler(logging.Handler):
@@ -10,6 +19,12 @@ class MuscleManagerHandler(logging.Handler):
     A MuscleManagerHandler is a standard Python log handler, which can
     be attached to a logger, and forwards log messages to the Muscle
     Manager for central logging.
+
+    Messages are sent in batches by a background thread, so that logging
+    does not have to wait for the manager. A message that is logged again
+    right after itself is sent once, together with the number of times it
+    was logged. If more messages are waiting than fit in the buffer, then
+    the oldest ones are dropped.
     """
     def __init__(self, instance_id: str, level: int, mmp_client: MMPClient
                  ) -> None:
@@ -23,30 +38,98 @@ class MuscleManagerHandler(logging.Handler):
         super().__init__(level)
         self._instance_id = instance_id
         self._manager = mmp_client
+
+        # Protects the member variables below
+        self._cv = Condition()
+        self._messages: Deque[LogMessage] = deque()
         self._num_dropped = 0
+        self._next_send = time.monotonic() + _FLUSH_INTERVAL
+        self._done = False
+
+        self._thread = Thread(
+                target=self._ship, name='MuscleManagerHandler', daemon=True)
+        self._thread.start()
 
     def emit(self, record: logging.LogRecord) -> None:
-        """Do the actual send to the manager
+        """Queue a message to be sent to the manager.
+
+        If the buffer is full, then the oldest message is dropped, but we do keep
+        track of how many messages were dropped and try to get that into the manager
+        log, referring the user to the instance log.
+        """
+        level = LogLevel.from_python_level(record.levelno)
+        text = self.format(record)
+
+        with self._cv:
+            if self._messages:
+                last = self._messages[-1]
+                if last.level == level and last.text == text:
+                    last.count += 1
+                    return
+
+            if len(self._messages) >= _BUFFER_SIZE:
+                self._num_dropped += self._messages.popleft().count
 
-        If this fails, then we drop the message, but we do keep track of how many
-        messages were dropped and try to get that into the manager log, referring the
-        user to the instance log.
+            self._messages.append(LogMessage(
+                    self._instance_id, Timestamp(record.created), level, text))
+            if len(self._messages) >= _BATCH_SIZE:
+                self._cv.notify()
+
+    def close(self) -> None:
+        """Send any waiting messages and stop the background thread."""
+        with self._cv:
+            done = self._done
+            self._done = True
+            self._cv.notify()
+
+        if not done:
+            self._thread.join()
+        super().close()
+
+    def _ship(self) -> None:
+        """Background thread that sends messages to the manager.
+
+        This sends messages when enough have been logged or when the oldest
+        has waited for long enough, and once more when the handler is closed.
         """
-        message = LogMessage(self._instance_id, Timestamp(record.created),
-                             LogLevel.from_python_level(record.levelno),
-                             self.format(record))
+        with self._cv:
+            while not self._done:
+                timeout = self._next_send - time.monotonic()
+                if len(self._messages) < _BATCH_SIZE and timeout > 0.0:
+                    self._cv.wait(timeout)
+                    continue
+                self._flush()
+
+            self._flush()
+
+    def _flush(self) -> None:
+        """Send waiting messages to the manager and empty the buffer.
+
+        Make sure to lock self._cv before calling this. It is released while
+        sending, so that logging can continue meanwhile.
+        """
+        self._next_send = time.monotonic() + _FLUSH_INTERVAL
+        if not self._messages:
+            return
+
+        messages: List[LogMessage] = list(self._messages)
+        num_lost = self._num_dropped + sum(m.count for m in messages)
+        self._messages.clear()
+        if self._num_dropped > 0:
+            messages.insert(0, LogMessage(
+                    self._instance_id, Timestamp(), LogLevel.WARNING,
+                    f'{self._num_dropped} log messages were not sent to the manager'
+                    ' log due to manager overload or network connectivity problems.'
+                    ' Please see the instance log to read them.'))
+            self._num_dropped = 0
 
+        self._cv.release()
         try:
-            if self._num_dropped > 0:
-                dropped_msg = LogMessage(
-                        self._instance_id, Timestamp(), LogLevel.WARNING,
-                        f'{self._num_dropped} log messages were not sent to the manager'
-                        ' log due to manager overload or network connectivity problems.'
-                        ' Please see the instance log to read them.')
-                self._manager.submit_log_message(dropped_msg)
-                self._num_dropped = 0
-
-            self._manager.submit_log_message(message)
-
-        except ConnectionLockedError:
-            self._num_dropped += 1
+            self._manager.submit_log_messages(messages)
+            num_lost = 0
+        except Exception:
+            # Logging about this would only get us back here, so count and drop
+            pass
+        finally:
+            self._cv.acquire()
+        self._num_dropped += num_lost
@@ -1,5 +1,6 @@
+from concurrent.futures import Future
 from threading import Condition
-from typing import Dict, List, Set
+from typing import Dict, Iterable, List, Set, Tuple
 
 from ymmsl.v0_2 import Port, Reference
 
@@ -21,6 +22,8 @@ class InstanceRegistry:
         self._ports: Dict[Reference, List[Port]] = {}
         self._seen: Set[Reference] = set()
         self._startup = True
+        self._waiters: Dict[
+                Reference, List[Tuple[Set[Reference], Future[None]]]] = {}
 
     def add(self, name: Reference, locations: List[str], ports: List[Port]
             ) -> None:
@@ -45,6 +48,41 @@ class InstanceRegistry:
             self._seen.add(name)
             self._startup = False
 
+            ready = []
+            for missing, future in self._waiters.pop(name, []):
+                missing.discard(name)
+                if not missing:
+                    ready.append(future)
+
+        for future in ready:
+            if future.set_running_or_notify_cancel():
+                future.set_result(None)
+
+    def when_registered(self, names: Iterable[Reference]) -> 'Future[None]':
+        """Returns a future that completes when the instances are registered.
+
+        The future completes immediately if they are registered already.
+        Cancel it to stop waiting.
+
+        Args:
+            names: Names of the instances to wait for.
+        """
+        future: Future[None] = Future()
+        with self._deregistered_one:
+            missing = {name for name in names if name not in self._locations}
+            if missing:
+                for name in missing:
+                    waiters = [
+                            waiter for waiter in self._waiters.get(name, [])
+                            if not waiter[1].cancelled()]
+                    waiters.append((missing, future))
+                    self._waiters[name] = waiters
+                return future
+
+        future.set_running_or_notify_cancel()
+        future.set_result(None)
+        return future
+
     def get_locations(self, name: Reference) -> List[str]:
         """Retrieves the locations of a registered instance.
 
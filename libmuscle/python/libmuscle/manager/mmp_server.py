@@ -1,7 +1,11 @@
+from concurrent.futures import Future, ThreadPoolExecutor
 import errno
+from functools import partial
+import heapq
 import logging
+from threading import Condition, Thread
 import time
-from typing import Any, Dict, cast, List, Optional
+from typing import Any, Callable, Dict, cast, List, Optional, Tuple
 from typing_extensions import Buffer
 
 import msgpack
@@ -18,8 +22,8 @@ from libmuscle.manager.run_dir import RunDir
 from libmuscle.manager.snapshot_registry import SnapshotRegistry
 from libmuscle.manager.topology_store import TopologyStore
 from libmuscle.mcp.protocol import RequestType, ResponseType
-from libmuscle.mcp.tcp_transport_server import TcpTransportServer
-from libmuscle.mcp.transport_server import RequestHandler
+from libmuscle.mcp.async_tcp_transport_server import AsyncTcpTransportServer
+from libmuscle.mcp.transport_server import Frame, RequestHandler
 from libmuscle.manager.profile_store import ProfileStore
 from libmuscle.manager.deadlock_detector import DeadlockDetector
 from libmuscle.profiling import (
@@ -54,6 +58,16 @@ def encode_ports(ports: Ports) -> list[list[str]]:
     ]
 
 
+def pack(value: Any) -> bytes:
+    """Encode a MsgPack-compatible value as MsgPack."""
+    return cast(bytes, msgpack.packb(value, use_bin_type=True))
+
+
+def pack_array(items: List[bytes]) -> bytes:
+    """Encode a list of already encoded values as a MsgPack array."""
+    return cast(bytes, msgpack.Packer().pack_array_header(len(items))) + b''.join(items)
+
+
 def encode_checkpoint_rule(rule: CheckpointRule) -> Dict[str, Any]:
     """Convert a CheckpointRule to a MsgPack-compatible value."""
     if isinstance(rule, CheckpointAtRule):
@@ -77,6 +91,65 @@ def encode_checkpoints(checkpoints: Checkpoints) -> Dict[str, Any]:
     }
 
 
+class _Timeouts:
+    """Cancels futures that are still waiting when their time is up.
+
+    A single background thread does this for all futures. It is started
+    when the first future is added.
+    """
+    def __init__(self) -> None:
+        # Protects all member variables
+        self._cv = Condition()
+        self._deadlines: List[Tuple[float, int, Future]] = []
+        self._num_added = 0
+        self._thread: Optional[Thread] = None
+        self._done = False
+
+    def add(self, future: Future, timeout: float) -> None:
+        """Cancel the future after timeout seconds, unless it is done."""
+        with self._cv:
+            deadline = time.monotonic() + timeout
+            heapq.heappush(self._deadlines, (deadline, self._num_added, future))
+            self._num_added += 1
+            if self._thread is None and not self._done:
+                self._thread = Thread(
+                        target=self._cancel_expired, name='MMPTimeouts', daemon=True)
+                self._thread.start()
+            self._cv.notify()
+
+    def close(self) -> None:
+        """Stops the background thread, if any."""
+        with self._cv:
+            self._done = True
+            self._cv.notify()
+            thread = self._thread
+        if thread is not None:
+            thread.join()
+
+    def _cancel_expired(self) -> None:
+        """Background thread that cancels futures at their deadlines.
+
+        Cancelling a future runs its callbacks, so this is done without
+        holding the lock, so as not to hold up add().
+        """
+        expired: List[Future] = []
+        while True:
+            for future in expired:
+                future.cancel()
+
+            with self._cv:
+                if self._done:
+                    return
+                now = time.monotonic()
+                expired = []
+                while self._deadlines and self._deadlines[0][0] <= now:
+                    expired.append(heapq.heappop(self._deadlines)[2])
+
+                if not expired:
+                    timeout = self._deadlines[0][0] - now if self._deadlines else None
+                    self._cv.wait(timeout)
+
+
 class MMPRequestHandler(RequestHandler):
     """Handles Manager requests."""
     def __init__(
@@ -107,6 +180,17 @@ class MMPRequestHandler(RequestHandler):
         self._deadlock_detector = deadlock_detector
         self._run_dir = run_dir
         self._reference_time = time.monotonic()
+        self._timeouts = _Timeouts()
+        # Makes the responses to requests that waited for peers to register,
+        # so that the request that registered the last of them doesn't have
+        # to. Threads are started when first needed.
+        self._responders = ThreadPoolExecutor(thread_name_prefix='MMPResponder')
+
+        # Encoded response parts that are the same every time. These are
+        # created on first use, and if two threads do that at the same time
+        # then they'll make the same thing, so we don't need a lock.
+        self._packed_settings: Optional[bytes] = None
+        self._packed_topology: Dict[Reference, Tuple[bytes, bytes, bytes]] = dict()
 
     def handle_request(self, request: Buffer) -> Buffer:
         """Handles a manager request.
@@ -123,13 +207,19 @@ class MMPRequestHandler(RequestHandler):
         if req_type == RequestType.REGISTER_INSTANCE.value:
             response = self._register_instance(*req_args)
         elif req_type == RequestType.GET_PEERS.value:
-            response = self._get_peers(*req_args)
+            if len(req_args) > 1:
+                return cast(bytes, self._wait_for_peers(*req_args).result())
+            return self._get_peers(*req_args)
+        elif req_type == RequestType.BOOTSTRAP.value:
+            return cast(bytes, self._bootstrap(*req_args).result())
         elif req_type == RequestType.DEREGISTER_INSTANCE.value:
             response = self._deregister_instance(*req_args)
         elif req_type == RequestType.GET_SETTINGS.value:
-            response = self._get_settings(*req_args)
+            return self._get_settings(*req_args)
         elif req_type == RequestType.SUBMIT_LOG_MESSAGE.value:
             response = self._submit_log_message(*req_args)
+        elif req_type == RequestType.SUBMIT_LOG_MESSAGES.value:
+            response = self._submit_log_messages(*req_args)
         elif req_type == RequestType.SUBMIT_PROFILE_EVENTS.value:
             response = self._submit_profile_events(*req_args)
         elif req_type == RequestType.SUBMIT_SNAPSHOT.value:
@@ -143,7 +233,30 @@ class MMPRequestHandler(RequestHandler):
         elif req_type == RequestType.IS_DEADLOCKED.value:
             response = self._is_deadlocked(*req_args)
 
-        return cast(bytes, msgpack.packb(response, use_bin_type=True))
+        return pack(response)
+
+    def handle_request_async(self, request: Buffer) -> Optional['Future[Frame]']:
+        """Handles requests that wait for something to happen.
+
+        Currently, these are GET_PEERS requests with a timeout and BOOTSTRAP
+        requests, which are answered once all peers have registered, or when
+        the timeout expires.
+
+        Args:
+            request: The encoded request
+
+        Returns:
+            A future for the encoded response, or None for other requests.
+        """
+        unpacker = msgpack.Unpacker(raw=False)
+        unpacker.feed(request)
+        length = unpacker.read_array_header()
+        req_type = unpacker.unpack()
+        if req_type == RequestType.GET_PEERS.value and length == 3:
+            return self._wait_for_peers(unpacker.unpack(), unpacker.unpack())
+        if req_type == RequestType.BOOTSTRAP.value:
+            return self._bootstrap(*[unpacker.unpack() for _ in range(length - 1)])
+        return None
 
     def close(self) -> None:
         """Free per-thread resources.
@@ -152,6 +265,8 @@ class MMPRequestHandler(RequestHandler):
         thread before it shuts down.
         """
         self._profile_store.close()
+        self._timeouts.close()
+        self._responders.shutdown()
 
     def _register_instance(
             self, instance_id: str, locations: List[str],
@@ -193,14 +308,14 @@ class MMPRequestHandler(RequestHandler):
                     ' registered. Did you start a non-MPI component using'
                     ' mpirun?']
 
-    def _get_peers(self, instance_id: str) -> Any:
+    def _get_peers(self, instance_id: str) -> bytes:
         """Handle a get peers request.
 
         Args:
             instance_id: ID of the instance requesting peers
 
         Returns:
-            A list containing the following values on success:
+            An encoded list containing the following values on success:
 
             status (ResponseType): SUCCESS
             conduits (List[List[str]]): Conduits from/to peers
@@ -224,15 +339,7 @@ class MMPRequestHandler(RequestHandler):
         instance = Reference(instance_id)
         component = instance.without_trailing_ints()
         if not self._topology_store.has_component(component):
-            return [ResponseType.ERROR.value, f'Unknown component {component}']
-
-        conduits = self._topology_store.get_conduits(component)
-        mmp_conduits = [encode_conduit(c) for c in conduits]
-        ports = self._topology_store.get_ports(component)
-        mmp_ports = encode_ports(ports)
-
-        peer_dims = self._topology_store.get_peer_dimensions(component)
-        mmp_dimensions = {str(name): dims for name, dims in peer_dims.items()}
+            return pack([ResponseType.ERROR.value, f'Unknown component {component}'])
 
         # generate instances
         try:
@@ -241,14 +348,138 @@ class MMPRequestHandler(RequestHandler):
                     str(peer): self._instance_registry.get_locations(peer)
                     for peer in peers}
         except KeyError as e:
-            return [
+            return pack([
                     ResponseType.PENDING.value,
-                    f'Waiting for component {e.args[0]}']
+                    f'Waiting for component {e.args[0]}'])
+
+        conduits, dimensions, ports = self._get_packed_topology(component)
 
         _logger.debug(f'Sent peers to {instance_id}')
-        return [
-                ResponseType.SUCCESS.value,
-                mmp_conduits, mmp_dimensions, instance_locations, mmp_ports]
+        return pack_array([
+                pack(ResponseType.SUCCESS.value),
+                conduits, dimensions, pack(instance_locations), ports])
+
+    def _get_packed_topology(self, component: Reference) -> Tuple[bytes, bytes, bytes]:
+        """Returns the encoded conduits, peer dimensions and ports of a component.
+
+        These are the same for all instances of the component, so they're
+        encoded once and then kept.
+
+        Args:
+            component: The component to get them for, must exist
+        """
+        packed = self._packed_topology.get(component)
+        if packed is None:
+            conduits = self._topology_store.get_conduits(component)
+            peer_dims = self._topology_store.get_peer_dimensions(component)
+            packed = (
+                    pack([encode_conduit(c) for c in conduits]),
+                    pack({str(name): dims for name, dims in peer_dims.items()}),
+                    pack(encode_ports(self._topology_store.get_ports(component))))
+            self._packed_topology[component] = packed
+        return packed
+
+    def _wait_for_peers(self, instance_id: str, timeout: float) -> 'Future[Frame]':
+        """Handle a get peers request that waits for the peers.
+
+        Args:
+            instance_id: ID of the instance requesting peers
+            timeout: Maximum time to wait, in seconds
+
+        Returns:
+            A future for the encoded response, see :meth:`_get_peers`. It
+            will be PENDING only if the timeout expired.
+        """
+        return self._when_peers_registered(
+                instance_id, timeout, partial(self._get_peers, instance_id))
+
+    def _bootstrap(
+            self, instance_id: str, locations: List[str], ports: List[List[str]],
+            version: str, timeout: float) -> 'Future[Frame]':
+        """Handle a bootstrap request.
+
+        This registers the instance, and then answers with everything it needs
+        to start up once its peers have registered, or when the timeout expires.
+
+        Args:
+            instance_id: ID of the instance to register
+            locations: Locations where it can be reached
+            ports: Ports of this instance
+            version: Version of libmuscle that this instance uses
+            timeout: Maximum time to wait for the peers, in seconds
+
+        Returns:
+            A future for the encoded response, which is a list containing the
+            following values on success:
+
+            status (ResponseType): SUCCESS
+            peers (list): A response to a get peers request, see
+                :meth:`_get_peers`. It will be PENDING only if the timeout
+                expired.
+            settings (Dict[str, SettingValue]): The global settings
+            checkpoint_info (list): Checkpoint info, see
+                :meth:`_get_checkpoint_info`, without the status.
+
+            Or the following values if registration failed:
+
+            status (ResponseType): ERROR
+            error_msg (str): An error message
+        """
+        registration = self._register_instance(instance_id, locations, ports, version)
+        if registration[0] != ResponseType.SUCCESS.value:
+            response: Future[Frame] = Future()
+            response.set_result(pack(registration))
+            return response
+
+        def bootstrap_response() -> bytes:
+            return pack_array([
+                    pack(ResponseType.SUCCESS.value),
+                    self._get_peers(instance_id),
+                    self._get_packed_settings(),
+                    pack(self._get_checkpoint_info(instance_id)[1:])])
+
+        return self._when_peers_registered(instance_id, timeout, bootstrap_response)
+
+    def _when_peers_registered(
+            self, instance_id: str, timeout: float, make_response: Callable[[], bytes]
+            ) -> 'Future[Frame]':
+        """Creates a response once the peers of an instance have registered.
+
+        Args:
+            instance_id: ID of the instance whose peers to wait for
+            timeout: Maximum time to wait, in seconds
+            make_response: Function that creates the encoded response, which
+                is called when the peers have registered or when the timeout
+                expires, whichever comes first.
+
+        If the peers have registered already, then the response is made
+        right away. Otherwise, it is made on a separate thread, rather than
+        by whoever completes the wait.
+
+        Returns:
+            A future for the encoded response.
+        """
+        response: Future[Frame] = Future()
+
+        def respond() -> None:
+            try:
+                response.set_result(make_response())
+            except Exception as e:
+                response.set_exception(e)
+
+        instance = Reference(instance_id)
+        peers: List[Reference] = []
+        if self._topology_store.has_component(instance.without_trailing_ints()):
+            peers = self._topology_store.get_peer_instances(instance)
+        # else _get_peers() will return an error right away
+
+        registered = self._instance_registry.when_registered(peers)
+        if registered.done():
+            respond()
+        else:
+            self._timeouts.add(registered, timeout)
+            registered.add_done_callback(lambda _: self._responders.submit(respond))
+        return response
 
     def _deregister_instance(self, instance_id: str) -> Any:
         """Handle a deregister instance request.
@@ -275,18 +506,28 @@ class MMPRequestHandler(RequestHandler):
                     ResponseType.ERROR.value,
                     f'No instance with name {instance_id} was registered']
 
-    def _get_settings(self) -> Any:
+    def _get_settings(self) -> bytes:
         """Handle a get settings request.
 
         Returns:
-            A list containing the following values on success:
+            An encoded list containing the following values on success:
 
             status (ResponseType): SUCCESS
             settings (Dict[str, SettingValue]): The global settings
         """
-        return [
-                ResponseType.SUCCESS.value,
-                self._configuration.settings.as_ordered_dict()]
+        return pack_array([
+                pack(ResponseType.SUCCESS.value), self._get_packed_settings()])
+
+    def _get_packed_settings(self) -> bytes:
+        """Returns the encoded global settings.
+
+        These don't change during the run, so they're encoded once and then
+        kept.
+        """
+        if self._packed_settings is None:
+            self._packed_settings = pack(
+                    self._configuration.settings.as_ordered_dict())
+        return self._packed_settings
 
     def _submit_log_message(
             self, instance_id: str, timestamp: float, level: int, text: str
@@ -308,6 +549,27 @@ class MMPRequestHandler(RequestHandler):
                 instance_id, Timestamp(timestamp), LogLevel(level), text)
         return [ResponseType.SUCCESS.value]
 
+    def _submit_log_messages(
+            self, instance_id: str, messages: List[List[Any]]) -> Any:
+        """Handle a submit log messages request.
+
+        Args:
+            instance_id: Sending instance
+            messages: Time since epoch, log level, text and the number of
+                    times in a row it was logged, for each message
+
+        Returns:
+            A list containing the following values on success:
+
+            status (ResponseType): SUCCESS
+        """
+        for timestamp, level, text, count in messages:
+            if count > 1:
+                text = f'{text} (repeated {count} times)'
+            self._logger.log_message(
+                    instance_id, Timestamp(timestamp), LogLevel(level), text)
+        return [ResponseType.SUCCESS.value]
+
     def _submit_profile_events(
             self, instance_id: str, events: List[List[Any]]) -> Any:
         """Handle a submit profile events request.
@@ -453,11 +715,11 @@ class MMPServer:
                 logger, profile_store, configuration, instance_registry,
                 topology_store, snapshot_registry, deadlock_detector, run_dir)
         try:
-            self._server = TcpTransportServer(self._handler, 9000)
+            self._server = AsyncTcpTransportServer(self._handler, 9000)
         except OSError as e:
             if e.errno != errno.EADDRINUSE:
                 raise
-            self._server = TcpTransportServer(self._handler)
+            self._server = AsyncTcpTransportServer(self._handler)
 
     def get_location(self) -> str:
         """Returns this server's network location.
@@ -51,3 +51,18 @@ def test_registry_remove(registry, port):
 
     with pytest.raises(KeyError):
         registry.remove('non-existant-instance')
+
+
+def test_registry_when_registered(registry, port):
+    registry.add('instance1', 'tcp://localhost:6253', [port])
+    assert registry.when_registered(['instance1']).done()
+
+    future = registry.when_registered(['instance1', 'instance2', 'instance3'])
+    cancelled = registry.when_registered(['instance2'])
+    cancelled.cancel()
+
+    registry.add('instance2', 'tcp://localhost:6254', [port])
+    assert not future.done()
+    registry.add('instance3', 'tcp://localhost:6255', [port])
+    assert future.done()
+    assert registry._waiters == {}
@@ -1,14 +1,17 @@
+from concurrent.futures import Future
 import dataclasses
 from pathlib import Path
-from unittest.mock import MagicMock
+import threading
+from unittest.mock import MagicMock, patch
 
 import msgpack
+import pytest
 from ymmsl.v0_2 import (
         Operator, Reference, Checkpoints, CheckpointRangeRule, CheckpointAtRule)
 
 import libmuscle
 from libmuscle.logging import LogLevel
-from libmuscle.manager.mmp_server import MMPRequestHandler
+from libmuscle.manager.mmp_server import MMPRequestHandler, _Timeouts
 from libmuscle.mcp.protocol import RequestType, ResponseType
 from libmuscle.snapshot import SnapshotMetadata
 
@@ -41,6 +44,25 @@ def test_log_message(mmp_request_handler, caplog):
     assert caplog.records[0].message == 'Testing log message'
 
 
+def test_log_messages(mmp_request_handler, caplog):
+    request = [
+            RequestType.SUBMIT_LOG_MESSAGES.value, 'test_instance_id', [
+                [0.0, LogLevel.WARNING.value, 'First message', 1],
+                [1.0, LogLevel.ERROR.value, 'Second message', 3]]]
+    encoded_request = msgpack.packb(request, use_bin_type=True)
+
+    result = mmp_request_handler.handle_request(encoded_request)
+
+    decoded_result = msgpack.unpackb(result, raw=False)
+    assert decoded_result == [ResponseType.SUCCESS.value]
+
+    assert caplog.records[0].levelname == 'WARNING'
+    assert caplog.records[0].message == 'First message'
+    assert caplog.records[1].name == 'test_instance_id'
+    assert caplog.records[1].levelname == 'ERROR'
+    assert caplog.records[1].message == 'Second message (repeated 3 times)'
+
+
 def test_get_settings(mmp_configuration, mmp_request_handler):
     request = [RequestType.GET_SETTINGS.value]
     encoded_request = msgpack.packb(request, use_bin_type=True)
@@ -52,6 +74,11 @@ def test_get_settings(mmp_configuration, mmp_request_handler):
     assert decoded_result[0] == ResponseType.SUCCESS.value
     assert decoded_result[1] == {}
 
+
+def test_get_settings_values(mmp_configuration, mmp_request_handler):
+    request = [RequestType.GET_SETTINGS.value]
+    encoded_request = msgpack.packb(request, use_bin_type=True)
+
     mmp_configuration.settings['test1'] = 13
     mmp_configuration.settings['test2'] = 12.3
     mmp_configuration.settings['test3'] = 'testing'
@@ -223,6 +250,130 @@ def test_get_peers_pending(mmp_request_handler):
     assert decoded_result[0] == ResponseType.PENDING.value
 
 
+def test_get_peers_wait(mmp_request_handler, instance_registry):
+    request = [RequestType.GET_PEERS.value, 'micro[0][0]', 10.0]
+    encoded_request = msgpack.packb(request, use_bin_type=True)
+
+    future = mmp_request_handler.handle_request_async(encoded_request)
+    assert not future.done()
+
+    instance_registry.add(Reference('macro'), ['direct:macro'], [])
+    decoded_result = msgpack.unpackb(future.result(1.0), raw=False)
+    assert decoded_result[0] == ResponseType.SUCCESS.value
+    assert decoded_result[3] == {'macro': ['direct:macro']}
+
+    mmp_request_handler.close()
+
+
+def test_get_peers_wait_responder(mmp_request_handler, instance_registry):
+    request = [RequestType.GET_PEERS.value, 'micro[0][0]', 10.0]
+    encoded_request = msgpack.packb(request, use_bin_type=True)
+
+    get_peers = mmp_request_handler._get_peers
+    threads = []
+
+    def record_thread(instance_id):
+        threads.append(threading.current_thread())
+        return get_peers(instance_id)
+
+    with patch.object(mmp_request_handler, '_get_peers', record_thread):
+        future = mmp_request_handler.handle_request_async(encoded_request)
+        instance_registry.add(Reference('macro'), ['direct:macro'], [])
+        decoded_result = msgpack.unpackb(future.result(1.0), raw=False)
+
+    # the response is not made by the registering thread
+    assert decoded_result[0] == ResponseType.SUCCESS.value
+    assert threads[0] is not threading.current_thread()
+
+    mmp_request_handler.close()
+
+
+def test_get_peers_wait_timeout(mmp_request_handler):
+    request = [RequestType.GET_PEERS.value, 'micro[0][0]', 0.01]
+    encoded_request = msgpack.packb(request, use_bin_type=True)
+
+    result = mmp_request_handler.handle_request(encoded_request)
+    decoded_result = msgpack.unpackb(result, raw=False)
+    assert decoded_result[0] == ResponseType.PENDING.value
+
+    mmp_request_handler.close()
+
+
+def test_timeouts_cancel_unlocked():
+    timeouts = _Timeouts()
+    cancelled = threading.Event()
+    added = threading.Event()
+    waited = []
+
+    def callback(_):
+        cancelled.set()
+        waited.append(added.wait(5.0))
+
+    future: Future = Future()
+    future.add_done_callback(callback)
+    timeouts.add(future, 0.0)
+    assert cancelled.wait(5.0)
+
+    # the callback is running, but this doesn't have to wait for it
+    timeouts.add(Future(), 10.0)
+    added.set()
+    timeouts.close()
+    assert waited == [True]
+
+
+def test_get_peers_wait_error(mmp_request_handler, instance_registry):
+    request = [RequestType.GET_PEERS.value, 'micro[0][0]', 10.0]
+    encoded_request = msgpack.packb(request, use_bin_type=True)
+
+    with patch.object(
+            mmp_request_handler, '_get_peers', side_effect=RuntimeError('test')):
+        future = mmp_request_handler.handle_request_async(encoded_request)
+        instance_registry.add(Reference('macro'), ['direct:macro'], [])
+        with pytest.raises(RuntimeError):
+            future.result(1.0)
+
+    mmp_request_handler.close()
+
+
+def test_bootstrap(mmp_request_handler, instance_registry):
+    request = [
+            RequestType.BOOTSTRAP.value, 'micro[0][0]', ['direct:micro[0][0]'],
+            [['in', 'F_INIT']], libmuscle.__version__, 10.0]
+    encoded_request = msgpack.packb(request, use_bin_type=True)
+
+    future = mmp_request_handler.handle_request_async(encoded_request)
+    assert not future.done()
+    assert instance_registry.get_locations(Reference('micro[0][0]')) == [
+            'direct:micro[0][0]']
+
+    instance_registry.add(Reference('macro'), ['direct:macro'], [])
+    decoded_result = msgpack.unpackb(future.result(1.0), raw=False)
+    status, peers, settings, checkpoint_info = decoded_result
+    assert status == ResponseType.SUCCESS.value
+    assert peers[0] == ResponseType.SUCCESS.value
+    assert peers[3] == {'macro': ['direct:macro']}
+    assert settings == {}
+    assert checkpoint_info[1:] == [
+            {'at_end': False, 'wallclock_time': [], 'simulation_time': []},
+            None, None]
+
+    mmp_request_handler.close()
+
+
+def test_bootstrap_version_mismatch(mmp_request_handler, instance_registry):
+    request = [
+            RequestType.BOOTSTRAP.value, 'micro[0][0]', ['direct:micro[0][0]'],
+            [], libmuscle.__version__ + '_dev', 10.0]
+    encoded_request = msgpack.packb(request, use_bin_type=True)
+
+    result = mmp_request_handler.handle_request(encoded_request)
+    decoded_result = msgpack.unpackb(result, raw=False)
+    assert decoded_result[0] == ResponseType.ERROR.value
+    assert 'version' in decoded_result[1]
+
+    mmp_request_handler.close()
+
+
 def test_request_peers_fanout(registered_mmp_request_handler):
     request = [RequestType.GET_PEERS.value, 'macro']
     encoded_request = msgpack.packb(request, use_bin_type=True)
@@ -269,6 +420,19 @@ def test_request_peers_fanin(registered_mmp_request_handler):
     assert ports == [["in", "F_INIT"], ["out", "O_F"]]
 
 
+def test_request_peers_same_component(registered_mmp_request_handler):
+    results = list()
+    for instance in ('micro[4][3]', 'micro[5][6]'):
+        request = [RequestType.GET_PEERS.value, instance]
+        encoded_request = msgpack.packb(request, use_bin_type=True)
+        result = registered_mmp_request_handler.handle_request(encoded_request)
+        results.append(msgpack.unpackb(result, raw=False))
+
+    assert results[0] == results[1]
+    assert results[0][0] == ResponseType.SUCCESS.value
+    assert results[0][3] == {'macro': ['direct:macro']}
+
+
 def test_request_peers_bidir(registered_mmp_request_handler2):
     request = [RequestType.GET_PEERS.value, 'meso[2]']
     encoded_request = msgpack.packb(request, use_bin_type=True)
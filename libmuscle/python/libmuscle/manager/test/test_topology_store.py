@@ -41,3 +41,8 @@ def test_get_peer_dimensions(topology_store) -> None:
     assert len(micro_peer_dims) == 1
     assert Reference('macro') in micro_peer_dims
     assert micro_peer_dims[Reference('macro')] == []
+
+
+def test_get_unknown(topology_store) -> None:
+    assert topology_store.get_conduits(Reference('meso')) == []
+    assert topology_store.get_peer_dimensions(Reference('meso')) == {}
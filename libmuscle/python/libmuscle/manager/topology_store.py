@@ -8,7 +8,9 @@ class TopologyStore:
     """Holds a description of how the simulation is wired together.
 
     This class contains the list of conduits through which the
-    submodels are connected.
+    submodels are connected. The conduits and peers of each component
+    are indexed on creation, so that looking them up does not require
+    going through all the conduits in the model.
 
     Attributes:
         conduits (List[Conduit]): A list of conduits.
@@ -24,6 +26,21 @@ class TopologyStore:
         """
         self.model = config.root_model()
 
+        self._conduits: Dict[Reference, List[Conduit]] = dict()
+        self._peer_dimensions: Dict[Reference, Dict[Reference, List[int]]] = dict()
+        for conduit in self.model.conduits:
+            snd = conduit.sending_component()
+            recv = conduit.receiving_component()
+            self._conduits.setdefault(snd, []).append(conduit)
+            self._conduits.setdefault(recv, []).append(conduit)
+
+            if recv in self.model.components:
+                self._peer_dimensions.setdefault(snd, {})[recv] = (
+                        self.model.components[recv].multiplicity)
+            if snd in self.model.components:
+                self._peer_dimensions.setdefault(recv, {})[snd] = (
+                        self.model.components[snd].multiplicity)
+
     def has_component(self, component: Reference) -> bool:
         """Returns True iff the given component is in the model.
 
@@ -41,13 +58,7 @@ class TopologyStore:
         Returns:
             All conduits that this component is a sender or receiver of.
         """
-        ret = list()
-        for conduit in self.model.conduits:
-            if conduit.sending_component() == component:
-                ret.append(conduit)
-            if conduit.receiving_component() == component:
-                ret.append(conduit)
-        return ret
+        return list(self._conduits.get(component, []))
 
     def get_ports(self, component: Reference) -> Ports:
         """Returns the port declaration (from the yMMSL) for a component.
@@ -73,15 +84,7 @@ class TopologyStore:
         Returns:
             A dict of peer components and their dimensions.
         """
-        ret = dict()
-        for conduit in self.model.conduits:
-            if conduit.sending_component() == component:
-                recv = conduit.receiving_component()
-                ret[recv] = self.model.components[recv].multiplicity
-            if conduit.receiving_component() == component:
-                snd = conduit.sending_component()
-                ret[snd] = self.model.components[snd].multiplicity
-        return ret
+        return dict(self._peer_dimensions.get(component, {}))
 
     def get_peer_instances(self, instance: Reference) -> List[Reference]:
         """Generates the names of all peer instances of an instance.
@@ -95,7 +98,7 @@ class TopologyStore:
         component = instance.without_trailing_ints()
         indices = instance_indices(instance)
         dims = self.model.components[component].multiplicity
-        all_peer_dims = self.get_peer_dimensions(component)
+        all_peer_dims = self._peer_dimensions.get(component, {})
 
         peers = []
         for peer, peer_dims in all_peer_dims.items():
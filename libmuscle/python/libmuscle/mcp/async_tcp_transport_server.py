@@ -0,0 +1,406 @@
+import asyncio
+from concurrent.futures import Future
+import logging
+from queue import Queue
+import socket
+import threading
+from typing import Awaitable, cast, Dict, List, Optional, Set, Tuple, Union
+
+from typing_extensions import Buffer
+
+from libmuscle.mcp.session_state import SessionState
+from libmuscle.mcp.tcp_transport_server import TcpTransportServer
+from libmuscle.mcp.tcp_util import MULTIPLEXED_SESSION, is_disconnect
+from libmuscle.mcp.transport_server import Frame, RequestHandler, TransportServer
+from libmuscle.util import Retrier
+
+
+_logger = logging.getLogger(__name__)
+
+
+class _Session:
+    """A SessionState plus a way for coroutines to wait for a response.
+
+    All coroutines run on the same event loop, so the condition is only
+    needed to wake up coroutines that are waiting for a response that is
+    being produced by another one, after a reconnect.
+    """
+    def __init__(self) -> None:
+        self.state = SessionState()
+        self.response_ready = asyncio.Condition()
+
+    async def set_response(self, response: Frame) -> None:
+        """Set the response and wake up anyone waiting for it."""
+        self.state.set_response(response)
+        async with self.response_ready:
+            self.response_ready.notify_all()
+
+    async def wait_get_response(self, request_nr: int) -> Optional[Frame]:
+        """Wait for a response to be available and return it.
+
+        See :meth:`SessionState.wait_get_response`.
+        """
+        async with self.response_ready:
+            while True:
+                ready, response = self.state.try_get_response(request_nr)
+                if ready:
+                    return response
+                await self.response_ready.wait()
+
+
+class _MultiplexedSession:
+    """The state of a session in which requests may overlap.
+
+    Responses are kept until the client says that it has received them,
+    so that they can be sent again after a reconnect without handling the
+    request a second time.
+
+    Attributes:
+        responses: Responses by request number, as they are being made.
+        writer: The connection to send responses on.
+        write_lock: Stops responses being sent at the same time.
+    """
+    def __init__(self, writer: asyncio.StreamWriter) -> None:
+        self.responses: Dict[int, 'asyncio.Future[Frame]'] = {}
+        self.writer = writer
+        self.write_lock = asyncio.Lock()
+
+
+class _WorkerPool:
+    """Threads for running a handler's blocking handle_request().
+
+    A handler may block until something else happens, which may in turn
+    require another request to be handled, so every request gets a
+    thread. Threads are reused, so there are only as many as there have
+    been requests in progress at the same time.
+
+    Each thread calls the handler's close() method when the pool is shut
+    down, as the handler may have per-thread resources.
+    """
+    def __init__(self, handler: RequestHandler) -> None:
+        self._handler = handler
+        self._queue: Queue[Optional[Tuple[Buffer, Future[Frame]]]] = Queue()
+        self._threads: List[threading.Thread] = []
+        self._lock = threading.Lock()
+        self._idle = 0
+
+    def submit(self, request: Buffer) -> 'Future[Frame]':
+        """Have the handler handle the request on a worker thread.
+
+        Returns:
+            A future for the response.
+        """
+        with self._lock:
+            if self._idle > 0:
+                self._idle -= 1
+            else:
+                thread = threading.Thread(
+                        target=self._work,
+                        name=f'TcpHandler-{len(self._threads)}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+        future: Future[Frame] = Future()
+        self._queue.put((request, future))
+        return future
+
+    def shutdown(self) -> None:
+        """Stops the worker threads.
+
+        If no threads were started, then the handler is closed from the
+        calling thread.
+        """
+        if not self._threads:
+            self._handler.close()
+
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def _work(self) -> None:
+        """Handles requests until shut down."""
+        item = self._queue.get()
+        while item is not None:
+            request, future = item
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(self._handler.handle_request(request))
+                except Exception as e:
+                    future.set_exception(e)
+
+            with self._lock:
+                self._idle += 1
+            item = self._queue.get()
+
+        self._handler.close()
+
+
+class AsyncTcpTransportServer(TcpTransportServer):
+    """A TransportServer that uses TCP to communicate, using asyncio.
+
+    This serves all connections from a single thread running an event
+    loop, rather than using a thread for each connection, so that it
+    scales to many thousands of clients. The protocol and the locations
+    are the same as for :class:`TcpTransportServer`.
+
+    Responses from handlers that implement
+    :meth:`RequestHandler.handle_request_async` are waited for on the event
+    loop. Other handlers are run on worker threads.
+
+    Clients that set :data:`MULTIPLEXED_SESSION` when starting a session
+    may send a request before the response to the previous one arrives.
+    Such requests are handled concurrently, and each response is sent
+    back with the number of its request as soon as it is ready.
+    """
+    def __init__(
+            self, handler: RequestHandler, port: int = 0, host: str = '') -> None:
+        """Create an AsyncTcpTransportServer.
+
+        Args:
+            handler: A RequestHandler to handle requests
+            port: The port to use.
+            host: The address to listen on, all interfaces by default.
+
+        Raises:
+            OSError: With errno set to errno.EADDRINUSE if the port is not
+                available.
+        """
+        TransportServer.__init__(self, handler)
+        self._workers = _WorkerPool(handler)
+
+        self._sessions: Dict[int, Union[_Session, _MultiplexedSession]] = {}
+        self._session_lock = threading.Lock()
+        self._next_session = 1
+        self._connections: Set[asyncio.Task] = set()
+        self._requests: Set['asyncio.Future[None]'] = set()
+
+        self._loop = asyncio.new_event_loop()
+        try:
+            self._aio_server = self._loop.run_until_complete(
+                    asyncio.start_server(
+                        self._handle_connection, host or '0.0.0.0', port,
+                        reuse_address=True))
+        except Exception:
+            self._loop.close()
+            raise
+
+        for sock in self._aio_server.sockets:
+            if sock.family in (socket.AF_INET, socket.AF_INET6):
+                if hasattr(socket, "TCP_NODELAY"):
+                    sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
+                if hasattr(socket, "TCP_QUICKACK"):
+                    sock.setsockopt(socket.SOL_TCP, socket.TCP_QUICKACK, 1)
+
+        self._server_thread = threading.Thread(
+                target=self._loop.run_forever, name='AsyncTcpTransportServer',
+                daemon=True)
+        self._server_thread.start()
+
+    def get_port(self) -> int:
+        """Returns the TCP port this server listens on."""
+        # IPv6 may give two more (unneeded) items, so can't unpack directly
+        return cast(int, self._aio_server.sockets[0].getsockname()[1])
+
+    def close(self, graceful: bool = True) -> None:
+        """Closes this server.
+
+        Waits for all sessions to be closed by the clients, stops the server listening,
+        closes any remaining connections, then frees any other resources.
+
+        Args:
+            graceful: Wait for clients to finish their sessions, where applicable.
+        """
+        if graceful:
+            retrier = Retrier(60.0, 0.1)
+            while not retrier.should_give_up():
+                with self._session_lock:
+                    if len(self._sessions) == 0:
+                        break
+                retrier.sleep()
+
+        asyncio.run_coroutine_threadsafe(self._stop(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._server_thread.join()
+        self._loop.close()
+        self._workers.shutdown()
+
+    async def _stop(self) -> None:
+        """Stops listening and closes all connections."""
+        self._aio_server.close()
+        tasks = self._connections | self._requests
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _handle_connection(
+            self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+            ) -> None:
+        """Handles a connection, until the client closes it."""
+        task = asyncio.current_task()
+        assert task is not None     # mypy
+        self._connections.add(task)
+        try:
+            session_id, session = await self._start_session(reader, writer)
+            if isinstance(session, _MultiplexedSession):
+                await self._serve_multiplexed(reader, writer, session)
+            else:
+                await self._serve(reader, writer, session)
+            self._end_session(session_id)
+
+        except asyncio.IncompleteReadError:
+            pass
+
+        except Exception as e:
+            if not is_disconnect(e):
+                raise
+
+        finally:
+            writer.close()
+            self._connections.discard(task)
+
+    async def _serve(
+            self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+            session: _Session) -> None:
+        """Handles requests one at a time, until the session ends."""
+        request_nr = await _recv_int64(reader)
+        while request_nr != 0:
+            request = await _recv_frame(reader)
+
+            should_process, should_send = session.state.triage_request(request_nr)
+
+            if should_process:
+                response = await self._handle_request(request)
+                await session.set_response(response)
+
+            if should_send:
+                response_to_send = await session.wait_get_response(request_nr)
+                if response_to_send is not None:
+                    await _send_frame(writer, response_to_send)
+
+            request_nr = await _recv_int64(reader)
+
+    async def _serve_multiplexed(
+            self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+            session: _MultiplexedSession) -> None:
+        """Handles overlapping requests, until the session ends.
+
+        Each request is preceded by its number and the number of the
+        oldest request the client is still waiting for.
+        """
+        session.writer = writer
+        request_nr = await _recv_int64(reader)
+        while request_nr != 0:
+            done_below = await _recv_int64(reader)
+            request = await _recv_frame(reader)
+
+            for old_nr in [nr for nr in session.responses if nr < done_below]:
+                del session.responses[old_nr]
+
+            # Requests sent again after a reconnect are not handled twice
+            response = session.responses.get(request_nr)
+            if response is None:
+                response = self._track(self._handle_request(request))
+                session.responses[request_nr] = response
+
+            self._track(self._send_response(session, request_nr, response))
+            request_nr = await _recv_int64(reader)
+
+    async def _send_response(
+            self, session: _MultiplexedSession, request_nr: int,
+            response: 'asyncio.Future[Frame]') -> None:
+        """Sends a response when it is ready, with its request number."""
+        try:
+            frame = await asyncio.shield(response)
+        except Exception as e:
+            _logger.error(f'Error handling request {request_nr}: {e}')
+            return
+
+        async with session.write_lock:
+            try:
+                session.writer.write(request_nr.to_bytes(8, byteorder='little'))
+                await _send_frame(session.writer, frame)
+            except Exception as e:
+                # The client will ask again after reconnecting
+                if not is_disconnect(e):
+                    raise
+
+    def _track(self, coro: Awaitable) -> asyncio.Future:
+        """Runs a coroutine as a task that is cancelled on shutdown."""
+        task = asyncio.ensure_future(coro)
+        self._requests.add(task)
+        task.add_done_callback(self._requests.discard)
+        return task
+
+    async def _handle_request(self, request: Buffer) -> Frame:
+        """Has the handler handle a request, without blocking the loop."""
+        future = self._handler.handle_request_async(request)
+        if future is None:
+            future = self._workers.submit(request)
+        elif future.done():
+            return future.result()
+        return await asyncio.wrap_future(future)
+
+    async def _start_session(
+            self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+            ) -> Tuple[int, Union[_Session, _MultiplexedSession]]:
+        """(Re)starts a session
+
+        See :meth:`TcpHandler._start_session`.
+
+        Returns:
+            The id of the new session, and the session
+        """
+        req_session_id = await _recv_int64(reader)
+        multiplexed = bool(req_session_id & MULTIPLEXED_SESSION)
+        req_session_id &= ~MULTIPLEXED_SESSION
+
+        session: Union[_Session, _MultiplexedSession]
+        if req_session_id == 0:
+            with self._session_lock:
+                session_id = self._next_session
+                session = _MultiplexedSession(writer) if multiplexed else _Session()
+                self._sessions[session_id] = session
+                self._next_session += 1
+
+        else:
+            _logger.warning(
+                    f'The TCP network connection for session {req_session_id} was lost')
+
+            with self._session_lock:
+                if req_session_id not in self._sessions:
+                    raise RuntimeError(f'Unknown session {req_session_id} requested')
+                session = self._sessions[req_session_id]
+
+            session_id = req_session_id
+            _logger.warning(f'Resuming session {session_id}')
+
+        writer.write(session_id.to_bytes(8, byteorder='little'))
+        await writer.drain()
+        return session_id, session
+
+    def _end_session(self, session_id: int) -> None:
+        """Removes a closed session"""
+        with self._session_lock:
+            del self._sessions[session_id]
+
+
+async def _recv_int64(reader: asyncio.StreamReader) -> int:
+    """Receives an int as a 64-bit signed little endian number."""
+    return int.from_bytes(await reader.readexactly(8), 'little')
+
+
+async def _recv_frame(reader: asyncio.StreamReader) -> bytes:
+    """Receives a frame as length + data."""
+    length = await _recv_int64(reader)
+    return await reader.readexactly(length)
+
+
+async def _send_frame(writer: asyncio.StreamWriter, data: Frame) -> None:
+    """Sends a frame as length + data."""
+    segments = data if isinstance(data, list) else [data]
+    views = [memoryview(s).cast('B') for s in segments]
+    length = sum(view.nbytes for view in views)
+    writer.write(length.to_bytes(8, byteorder='little'))
+    writer.writelines(view for view in views if view.nbytes)
+    await writer.drain()
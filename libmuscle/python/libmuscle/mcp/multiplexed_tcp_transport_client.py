@@ -0,0 +1,247 @@
+from concurrent.futures import Future, TimeoutError as WaitTimeout
+import logging
+import socket
+import threading
+import time
+from typing import Dict, Optional, Tuple
+from typing_extensions import Buffer
+
+import libmuscle.mcp.tcp_transport_client as tcp_transport_client
+from libmuscle.mcp.tcp_transport_client import TcpTransportClient
+from libmuscle.mcp.tcp_util import (
+        MULTIPLEXED_SESSION, is_disconnect, recv_frame, recv_int64, send_frame,
+        send_int64)
+from libmuscle.mcp.transport_client import Placer, ProfileData, TimeoutHandler
+from libmuscle.profiling import ProfileTimestamp
+from libmuscle.util import Retrier
+
+
+_logger = logging.getLogger(__name__)
+
+
+_Response = Tuple[Buffer, ProfileTimestamp, ProfileTimestamp]
+
+
+class MultiplexedTcpTransportClient(TcpTransportClient):
+    """A TCP client that can have several requests in progress at once.
+
+    Each request is sent with its number, and the server sends the
+    number back with the response, so that responses can arrive in any
+    order. A background thread receives the responses and hands them to
+    the threads waiting for them, so that a thread making a slow request
+    does not hold up other threads using the same connection.
+
+    If the connection is lost, then the background thread reconnects and
+    sends the requests that have not been answered yet again. Each
+    request also carries the number of the oldest request still waiting
+    for a response, so that the server can forget the older responses it
+    keeps for this purpose.
+
+    This requires an :class:`AsyncTcpTransportServer` on the other side.
+    Placers are not supported, responses are always received into buffers
+    owned by the client.
+    """
+    _SESSION_FLAGS = MULTIPLEXED_SESSION
+
+    def __init__(self, location: str) -> None:
+        """Create a MultiplexedTcpTransportClient for a given location.
+
+        Args:
+            location: A location string for the peer.
+        """
+        self._send_lock = threading.Lock()
+        self._pending_cond = threading.Condition()
+        self._pending: Dict[int, Tuple[Buffer, Future[_Response]]] = {}
+        self._next_request = 1
+        self._error: Optional[Exception] = None
+        self._closing = False
+
+        super().__init__(location)
+        self._connected = self._socket is not None
+
+        self._receiver = threading.Thread(
+                target=self._receive, name='MultiplexedTcpReceiver', daemon=True)
+        self._receiver.start()
+
+    def call(self, request: Buffer, timeout_handler: Optional[TimeoutHandler] = None,
+             placer: Optional[Placer] = None) -> Tuple[Buffer, ProfileData]:
+        """Send a request to the server and receive the response.
+
+        This blocks until the response arrives, but other threads may make
+        requests in the mean time.
+
+        Args:
+            request: The request to send
+            timeout_handler: Optional timeout handler. This is used for communication
+                deadlock detection.
+            placer: Ignored, responses are always received in one piece.
+
+        Returns:
+            The received response
+        """
+        future: Future[_Response] = Future()
+        start_wait = ProfileTimestamp()
+        with self._pending_cond:
+            if self._error is not None:
+                raise self._error
+            request_nr = self._next_request
+            self._next_request += 1
+            self._pending[request_nr] = (request, future)
+            self._pending_cond.notify_all()
+
+        with self._send_lock:
+            # If we're disconnected, then the receiver will send it on reconnect
+            if self._connected:
+                try:
+                    self._send_request(request_nr, request)
+                except Exception:
+                    with self._pending_cond:
+                        del self._pending[request_nr]
+                    raise
+
+        response, start_transfer, stop_transfer = self._wait(future, timeout_handler)
+        return response, (start_wait, start_transfer, stop_transfer)
+
+    def is_connected(self) -> bool:
+        """Returns whether requests can currently be sent.
+
+        This is False while the connection is being reestablished.
+        """
+        return self._connected
+
+    def close(self) -> None:
+        """Closes this client.
+
+        Any requests that are still waiting for a response will raise a
+        ConnectionError.
+        """
+        with self._pending_cond:
+            self._closing = True
+            self._pending_cond.notify_all()
+
+        with self._send_lock:
+            self._end_session()
+            self._close_connection()
+        self._receiver.join()
+
+    def _wait(
+            self, future: 'Future[_Response]',
+            timeout_handler: Optional[TimeoutHandler]) -> _Response:
+        """Waits for a response, calling the timeout handler if needed.
+
+        Args:
+            future: The future to wait for.
+            timeout_handler: Optional timeout handler.
+        """
+        if timeout_handler is None:
+            return future.result()
+
+        deadline = time.monotonic() + timeout_handler.timeout
+        did_timeout = False
+        while True:
+            try:
+                response = future.result(max(deadline - time.monotonic(), 0.0))
+                break
+            except WaitTimeout:
+                timeout_handler.on_timeout()
+                deadline += timeout_handler.timeout
+                did_timeout = True
+
+        if did_timeout:
+            timeout_handler.on_receive()
+        return response
+
+    def _send_request(self, request_nr: int, request: Buffer) -> None:
+        """Sends a request, leaving any disconnect to the receiver.
+
+        Must be called with the send lock held.
+        """
+        assert self._socket is not None     # mypy
+        with self._pending_cond:
+            done_below = min(self._pending, default=self._next_request)
+
+        try:
+            send_int64(self._socket, request_nr)
+            send_int64(self._socket, done_below)
+            send_frame(self._socket, request)
+        except Exception as e:
+            if not is_disconnect(e):
+                raise
+            self._shutdown_socket()
+
+    def _shutdown_socket(self) -> None:
+        """Shuts down the socket, so that the receiver will reconnect."""
+        self._connected = False
+        if self._socket is not None:
+            try:
+                self._socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _receive(self) -> None:
+        """Receives responses and reconnects as needed, until closed."""
+        retrier = Retrier(tcp_transport_client.RECONNECT_TIMEOUT)
+        while True:
+            try:
+                if self._socket is None:
+                    raise ConnectionError('No connection could be established')
+
+                request_nr = recv_int64(self._socket)
+                start_transfer = ProfileTimestamp()
+                response = recv_frame(self._socket, self._pool)
+                stop_transfer = ProfileTimestamp()
+
+                with self._pending_cond:
+                    entry = self._pending.pop(request_nr, None)
+                # A response to a request that was sent again may arrive twice
+                if entry is not None:
+                    entry[1].set_result((response, start_transfer, stop_transfer))
+                retrier = Retrier(tcp_transport_client.RECONNECT_TIMEOUT)
+
+            except Exception as e:
+                self._connected = False
+                if self._closing:
+                    break
+
+                if not is_disconnect(e):
+                    self._fail(e)
+                    return
+
+                # Reconnect only once we have something to say
+                with self._pending_cond:
+                    while not self._pending and not self._closing:
+                        self._pending_cond.wait()
+                if self._closing:
+                    break
+
+                try:
+                    with self._send_lock:
+                        self._handle_disconnect(retrier)
+                        self._resend()
+                except Exception as error:
+                    self._fail(error)
+                    return
+
+        self._fail(ConnectionError('The connection was closed'))
+
+    def _resend(self) -> None:
+        """Sends all requests that have not been answered again.
+
+        Must be called with the send lock held, after reconnecting.
+        """
+        with self._pending_cond:
+            pending = sorted(self._pending.items())
+
+        self._connected = self._socket is not None
+        for request_nr, (request, _) in pending:
+            if not self._connected:
+                break
+            self._send_request(request_nr, request)
+
+    def _fail(self, error: Exception) -> None:
+        """Fails all current and future requests with the given error."""
+        with self._pending_cond:
+            self._error = error
+            for _, future in self._pending.values():
+                future.set_exception(error)
+            self._pending.clear()
@@ -26,9 +26,13 @@ class RequestType(Enum):
     WAITING_FOR_RECEIVE = 9
     WAITING_FOR_RECEIVE_DONE = 10
     IS_DEADLOCKED = 11
+    SUBMIT_LOG_MESSAGES = 12
+    BOOTSTRAP = 13
 
     # MUSCLE Peer Protocol
     GET_NEXT_MESSAGE = 21
+    GET_NEXT_MESSAGES = 22
+    GET_CHUNK = 23
 
     # MUSCLE Agent Protocol
     REPORT_RESOURCES = 41
@@ -48,6 +52,28 @@ class ResponseType(Enum):
     PENDING = 2
 
 
+class MPPFeature(Enum):
+    """Optional features of the MUSCLE Peer Protocol
+
+    Not all implementations of MPP support all features. Servers advertise the
+    features they support using an additional location of the form
+    ``mpp:<feature>,<feature>``, which clients that don't know about it will ignore.
+    Clients then list the features they want to use in their requests, and the
+    server only uses those.
+    """
+    OUT_OF_BAND = 'oob'
+    # Messages with a fixed-size binary header, see libmuscle.mpp_message
+    COMPACT_HEADER = 'compact'
+    # Compression codecs, see libmuscle.compression
+    ZLIB = 'zlib'
+    LZMA = 'lzma'
+    BZ2 = 'bz2'
+    # Several messages in one response, see RequestType.GET_NEXT_MESSAGES
+    BATCH = 'batch'
+    # Large messages fetched in parts, see RequestType.GET_CHUNK
+    CHUNKED = 'chunked'
+
+
 class AgentCommandType(Enum):
     """Identifier for different types of commands
 
@@ -1,6 +1,7 @@
 import threading
 from typing import Optional, Tuple
-from typing_extensions import Buffer
+
+from libmuscle.mcp.transport_server import Frame
 
 
 class SessionState:
@@ -41,7 +42,7 @@ class SessionState:
         self._response_ready = threading.Condition()
 
         self._cur_request = 0
-        self._response: Optional[Buffer] = bytes()
+        self._response: Optional[Frame] = bytes()
 
     def __str__(self) -> str:
         with self._response_ready:
@@ -111,7 +112,7 @@ class SessionState:
 
             return should_process, should_send
 
-    def set_response(self, response: Buffer) -> None:
+    def set_response(self, response: Frame) -> None:
         """Set the response and notify that we're done.
 
         This sets the response and notifies any threads waiting in wait_get_response()
@@ -134,7 +135,7 @@ class SessionState:
             self._response = response
             self._response_ready.notify_all()
 
-    def wait_get_response(self, request_nr: int) -> Optional[Buffer]:
+    def wait_get_response(self, request_nr: int) -> Optional[Frame]:
         """Wait for a response to be available and return it
 
         It shouldn't be possible for anyone to be waiting for response n while response
@@ -156,3 +157,25 @@ class SessionState:
                     return self._response
 
             return None
+
+    def try_get_response(self, request_nr: int) -> Tuple[bool, Optional[Frame]]:
+        """Get a response if it is available, without waiting
+
+        This is a non-blocking version of :meth:`wait_get_response`, for servers that
+        do not use a thread per connection and wait in some other way.
+
+        Returns:
+            Whether we're done waiting, and if so the response for the current request,
+            or None if it's no longer available.
+        """
+        with self._response_ready:
+            if self._cur_request > request_nr:
+                return True, None
+
+            if self._response is None:
+                return False, None
+
+            if self._cur_request == request_nr:
+                return True, self._response
+
+            return False, None
@@ -0,0 +1,80 @@
+from typing import Optional, Tuple
+from typing_extensions import Buffer
+
+from libmuscle.mcp.shm_util import (
+        CONTROL_SOCKET, map_segment, parse_descriptor, segment_dir)
+from libmuscle.mcp.transport_client import (
+        Placer, ProfileData, TransportClient, TimeoutHandler)
+from libmuscle.mcp.unix_transport_client import UnixTransportClient
+from libmuscle.profiling import ProfileTimestamp
+
+
+class ShmTransportClient(TransportClient):
+    """A client that connects to a ShmTransportServer.
+
+    Requests are sent over a Unix domain socket, on which the
+    server returns either a small response, or a descriptor of a shared
+    memory segment that contains the response. Segments are mapped
+    rather than copied, so received grids refer directly to the shared
+    memory.
+    """
+    @staticmethod
+    def can_connect_to(location: str) -> bool:
+        """Whether this client class can connect to the given location.
+
+        This is only the case if the server is on the same node, which we
+        check by looking for its control socket.
+
+        Args:
+            location: The location to potentially connect to.
+
+        Returns:
+            True iff this class can connect to this location.
+        """
+        if not location.startswith('shm:'):
+            return False
+        return UnixTransportClient.can_connect_to(
+                f'unix:{segment_dir(location[4:]) / CONTROL_SOCKET}')
+
+    def __init__(self, location: str) -> None:
+        """Create a ShmTransportClient for a given location.
+
+        Args:
+            location: A location string for the peer.
+        """
+        self._directory = segment_dir(location[4:])
+        self._client = UnixTransportClient(
+                f'unix:{self._directory / CONTROL_SOCKET}')
+
+    def call(self, request: Buffer, timeout_handler: Optional[TimeoutHandler] = None,
+             placer: Optional[Placer] = None) -> Tuple[Buffer, ProfileData]:
+        """Send a request to the server and receive the response.
+
+        This is a blocking call.
+
+        Args:
+            request: The request to send
+            timeout_handler: Optional timeout handler. This is used for communication
+                deadlock detection.
+            placer: Ignored, large responses are mapped rather than received.
+
+        Returns:
+            The received response
+        """
+        response, (start_wait, start_transfer, _) = self._client.call(
+                request, timeout_handler)
+
+        descriptor = parse_descriptor(response)
+        if descriptor is not None:
+            response = map_segment(self._directory, *descriptor)
+
+        stop_transfer = ProfileTimestamp()
+        return response, (start_wait, start_transfer, stop_transfer)
+
+    def close(self) -> None:
+        """Closes this client.
+
+        This closes any connections this client has and performs other shutdown
+        activities as needed.
+        """
+        self._client.close()
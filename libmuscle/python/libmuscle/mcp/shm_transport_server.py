@@ -0,0 +1,108 @@
+from pathlib import Path
+import shutil
+import tempfile
+import weakref
+
+from typing_extensions import Buffer
+
+from libmuscle.mcp.shm_util import (
+        CONTROL_SOCKET, INLINE_LIMIT, SHM_ROOT, write_segment)
+from libmuscle.mcp.transport_server import (
+        Frame, RequestHandler, ServerNotSupported, TransportServer)
+from libmuscle.mcp.unix_transport_server import UnixTransportServer
+
+
+class ShmRequestHandler(RequestHandler):
+    """Moves large responses into shared memory.
+
+    This wraps another RequestHandler. Responses of at least
+    :data:`INLINE_LIMIT` bytes are written to a shared memory segment, and
+    a small descriptor of the segment is returned instead.
+    """
+    def __init__(self, handler: RequestHandler, directory: Path) -> None:
+        """Create a ShmRequestHandler.
+
+        Args:
+            handler: The handler to forward requests to.
+            directory: Directory to create segments in.
+        """
+        self._handler = handler
+        self._directory = directory
+
+    def handle_request(self, request: Buffer) -> Frame:
+        """Handle a request.
+
+        Args:
+            request: A received request
+
+        Returns:
+            An encoded response, or a segment descriptor
+        """
+        response = self._handler.handle_request(request)
+        segments = response if isinstance(response, list) else [response]
+        if sum(memoryview(s).nbytes for s in segments) < INLINE_LIMIT:
+            return response
+        return write_segment(self._directory, segments)
+
+    def close(self) -> None:
+        """Free per-thread resources."""
+        self._handler.close()
+
+
+class ShmTransportServer(TransportServer):
+    """A TransportServer that uses shared memory to communicate.
+
+    This can only be used by clients on the same node. Requests and small
+    responses are sent over a Unix domain socket, which also carries
+    descriptors of the shared memory segments that large responses are
+    placed in.
+    """
+    def __init__(self, handler: RequestHandler) -> None:
+        """Create a ShmTransportServer.
+
+        Args:
+            handler: A RequestHandler to handle requests
+
+        Raises:
+            ServerNotSupported: If shared memory or Unix domain sockets are
+                not available here.
+        """
+        super().__init__(handler)
+
+        if not SHM_ROOT.is_dir():
+            raise ServerNotSupported(f'Shared memory directory {SHM_ROOT} not found')
+
+        self._directory = Path(tempfile.mkdtemp(prefix='muscle3_', dir=SHM_ROOT))
+        # Also clean up if we're never closed, e.g. because of an error
+        self._cleanup = weakref.finalize(
+                self, shutil.rmtree, self._directory, ignore_errors=True)
+        try:
+            self._server = UnixTransportServer(
+                    ShmRequestHandler(handler, self._directory),
+                    self._directory / CONTROL_SOCKET)
+        except ServerNotSupported:
+            self._cleanup()
+            raise
+
+    def get_location(self) -> str:
+        """Returns the location this server listens on.
+
+        This is of the form shm:<name>, where name identifies the directory
+        that the segments and the control socket are created in.
+
+        Returns:
+            A string containing the location.
+        """
+        return f'shm:{self._directory.name}'
+
+    def close(self, graceful: bool = True) -> None:
+        """Closes this server.
+
+        Stops the server listening, waits for existing clients to
+        disconnect, then removes any segments that were not picked up.
+
+        Args:
+            graceful: Wait for clients to finish their sessions, where applicable.
+        """
+        self._server.close(graceful)
+        self._cleanup()
@@ -0,0 +1,114 @@
+import mmap
+import os
+from pathlib import Path
+import struct
+import tempfile
+from typing import List, Optional, Tuple
+from typing_extensions import Buffer
+
+
+SHM_ROOT = Path('/dev/shm')
+"""Directory in which shared memory segments are created."""
+
+
+CONTROL_SOCKET = 'control'
+"""Name of the Unix domain socket in the segment directory."""
+
+
+INLINE_LIMIT = 65536
+"""Responses smaller than this many bytes are sent over the control channel.
+
+For small responses, creating and mapping a segment costs more than copying
+the data through the socket.
+"""
+
+
+_DESCRIPTOR_MAGIC = b'\xc1SH\x01'
+"""Marks a response as a shared memory segment descriptor.
+
+0xc1 is never used by MessagePack, so this cannot be mistaken for the
+start of an encoded response.
+"""
+
+
+_DESCRIPTOR = struct.Struct('<4sQ')
+"""Magic and segment size, followed by the name of the segment file."""
+
+
+def segment_dir(name: str) -> Path:
+    """Returns the directory holding a server's segments and socket.
+
+    Args:
+        name: Name of the server, as given in its location.
+    """
+    return SHM_ROOT / name
+
+
+def write_segment(directory: Path, segments: List[Buffer]) -> bytes:
+    """Writes data to a new shared memory segment.
+
+    Args:
+        directory: The directory to create the segment file in.
+        segments: The data to write, as consecutive buffers.
+
+    Returns:
+        A descriptor referring to the new segment.
+    """
+    views = [memoryview(s).cast('B') for s in segments]
+    size = sum(len(v) for v in views)
+
+    fd, path = tempfile.mkstemp(dir=directory)
+    try:
+        os.ftruncate(fd, size)
+        with mmap.mmap(fd, size) as shm:
+            offset = 0
+            for view in views:
+                shm[offset:offset + len(view)] = view
+                offset += len(view)
+    finally:
+        os.close(fd)
+
+    name = os.path.basename(path).encode('utf-8')
+    return _DESCRIPTOR.pack(_DESCRIPTOR_MAGIC, size) + name
+
+
+def parse_descriptor(response: Buffer) -> Optional[Tuple[str, int]]:
+    """Checks whether a response is a segment descriptor and decodes it.
+
+    Args:
+        response: A response received over the control channel.
+
+    Returns:
+        The name and size of the segment, or None if this is an ordinary
+        response.
+    """
+    buf = memoryview(response)
+    if buf[:len(_DESCRIPTOR_MAGIC)] != _DESCRIPTOR_MAGIC:
+        return None
+    _, size = _DESCRIPTOR.unpack_from(buf)
+    name = bytes(buf[_DESCRIPTOR.size:]).decode('utf-8')
+    return name, size
+
+
+def map_segment(directory: Path, name: str, size: int) -> memoryview:
+    """Maps a shared memory segment and removes its file.
+
+    The segment stays available until the returned buffer and any views
+    of it have been released.
+
+    Args:
+        directory: The directory the segment file is in.
+        name: Name of the segment file.
+        size: Size of the segment in bytes.
+
+    Returns:
+        A writable buffer with the contents of the segment.
+    """
+    path = directory / os.path.basename(name)
+    fd = os.open(path, os.O_RDWR)
+    try:
+        shm = mmap.mmap(fd, size)
+    finally:
+        os.close(fd)
+        os.unlink(path)
+    return memoryview(shm)
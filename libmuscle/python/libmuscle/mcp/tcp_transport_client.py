@@ -1,13 +1,17 @@
+import errno
 import select
+import selectors
 import logging
+import os
 import socket
 import time
-from typing import Optional, Tuple
+from typing import List, Optional, Tuple
 from typing_extensions import Buffer
 
-from libmuscle.mcp.transport_client import ProfileData, TransportClient, TimeoutHandler
+from libmuscle.mcp.transport_client import (
+        Placer, ProfileData, TransportClient, TimeoutHandler)
 from libmuscle.mcp.tcp_util import (
-        is_disconnect, recv_frame, recv_int64, send_frame, send_int64)
+        BufferPool, is_disconnect, recv_frame, recv_int64, send_frame, send_int64)
 from libmuscle.profiling import ProfileTimestamp
 from libmuscle.util import Retrier
 
@@ -25,6 +29,11 @@ class NoPendingResponse(RuntimeError):
 
 class TcpTransportClient(TransportClient):
     """A client that connects to a TCPTransport server."""
+    network = True
+
+    _SESSION_FLAGS = 0
+    """Flags to set in the session id sent when (re)connecting."""
+
     @staticmethod
     def can_connect_to(location: str) -> bool:
         """Whether this client class can connect to the given location.
@@ -46,23 +55,27 @@ class TcpTransportClient(TransportClient):
         Args:
             location: A location string for the peer.
         """
-        self._addresses = location[4:].split(',')
+        self._addresses = location.split(':', 1)[1].split(',')
         self._socket: Optional[socket.SocketType] = None
         self._session = 0
         self._cur_request = 0
+        self._pool = BufferPool()
 
         self._reconnect(False)
 
-    def call(self, request: Buffer, timeout_handler: Optional[TimeoutHandler] = None
-             ) -> Tuple[Buffer, ProfileData]:
+    def call(self, request: Buffer, timeout_handler: Optional[TimeoutHandler] = None,
+             placer: Optional[Placer] = None) -> Tuple[Buffer, ProfileData]:
         """Send a request to the server and receive the response.
 
-        This is a blocking call.
+        This is a blocking call. Large responses are received into buffers
+        that are reused once nothing refers to them anymore.
 
         Args:
             request: The request to send
             timeout_handler: Optional timeout handler. This is used for communication
                 deadlock detection.
+            placer: Optional placer deciding where to receive parts of the
+                response.
 
         Returns:
             The received response
@@ -107,7 +120,7 @@ class TcpTransportClient(TransportClient):
                         did_timeout = False
 
                 start_transfer = ProfileTimestamp()
-                response = recv_frame(self._socket)
+                response = recv_frame(self._socket, self._pool, placer)
                 stop_transfer = ProfileTimestamp()
                 return response, (start_wait, start_transfer, stop_transfer)
 
@@ -183,7 +196,7 @@ class TcpTransportClient(TransportClient):
         try:
             self._make_connection()
             assert self._socket is not None
-            send_int64(self._socket, self._session)
+            send_int64(self._socket, self._session | self._SESSION_FLAGS)
             self._session = recv_int64(self._socket)
 
             if re:
@@ -205,30 +218,78 @@ class TcpTransportClient(TransportClient):
 
         Uses self._addresses and creates a (new) self._socket and self._poll_obj.
         """
-        sock: Optional[socket.SocketType] = None
+        self._socket = self._open_socket()
+
+        if hasattr(select, 'poll'):
+            self._poll_obj: Optional[select.poll] = select.poll()
+            self._poll_obj.register(self._socket, select.POLLIN)
+        else:
+            self._poll_obj = None  # On platforms that don't support select.poll
+
+    def _open_socket(self) -> socket.SocketType:
+        """Connect to whichever of the server's addresses answers first.
+
+        Connection attempts to all addresses are made at the same time, so
+        that addresses that cannot be reached from here don't hold up the
+        connection. If several connect at once, the one listed first wins.
+
+        Returns:
+            A connected socket.
+        """
+        pending: List[socket.SocketType] = []
         for address in self._addresses:
             try:
-                sock = self._connect(address)
-                break
-            except RuntimeError:
-                pass
+                pending.append(self._start_connect(address))
+            except Exception as e:
+                _logger.debug(f'Failed to connect to {address}: {e}')
+
+        deadline = time.monotonic() + _CONNECT_TIMEOUT
+        sock: Optional[socket.SocketType] = None
+        # select.select() cannot handle file descriptors of 1024 and up
+        with selectors.DefaultSelector() as selector:
+            for candidate in pending:
+                selector.register(candidate, selectors.EVENT_WRITE)
+
+            while pending and sock is None:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0.0:
+                    break
+
+                writable = {key.fileobj for key, _ in selector.select(timeout)}
+                for candidate in [c for c in pending if c in writable]:
+                    pending.remove(candidate)
+                    selector.unregister(candidate)
+                    error = candidate.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    if error == 0 and sock is None:
+                        sock = candidate
+                    else:
+                        if error != 0:
+                            _logger.info(f'Failed to connect: {os.strerror(error)}')
+                        candidate.close()
+
+            for candidate in pending:
+                selector.unregister(candidate)
+                candidate.close()
 
         if sock is None:
             raise ConnectionRefusedError('Failed to connect')
 
+        sock.setblocking(True)
         if hasattr(socket, 'TCP_NODELAY'):
             sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
         if hasattr(socket, 'TCP_QUICKACK'):
             sock.setsockopt(socket.SOL_TCP, socket.TCP_QUICKACK, 1)
-        self._socket = sock
+        return sock
 
-        if hasattr(select, 'poll'):
-            self._poll_obj: Optional[select.poll] = select.poll()
-            self._poll_obj.register(self._socket, select.POLLIN)
-        else:
-            self._poll_obj = None  # On platforms that don't support select.poll
+    def _start_connect(self, address: str) -> socket.SocketType:
+        """Start connecting to an address without waiting for the result.
+
+        Args:
+            address: The address to connect to, as host:port.
 
-    def _connect(self, address: str) -> socket.SocketType:
+        Returns:
+            A non-blocking socket that is connecting.
+        """
         loc_parts = address.rsplit(':', 1)
         host = loc_parts[0]
         if host.startswith('['):
@@ -240,25 +301,15 @@ class TcpTransportClient(TransportClient):
 
         addrinfo = socket.getaddrinfo(
                 host, port, 0, socket.SOCK_STREAM, socket.IPPROTO_TCP)
-
-        for family, socktype, proto, _, sockaddr in addrinfo:
-            try:
-                sock = socket.socket(family, socktype, proto)
-                sock.settimeout(_CONNECT_TIMEOUT)
-                sock.connect(sockaddr)
-                sock.settimeout(None)
-                return sock
-            except (ConnectionRefusedError, ConnectionAbortedError):
-                _logger.info(f'Failed to connect to {sockaddr}')
-                sock.close()
-                break
-
-            except Exception as e:
-                _logger.debug(f'Failed to connect socket: {e}')
-                sock.close()
-                break
-
-        raise RuntimeError('Could not connect')
+        family, socktype, proto, _, sockaddr = addrinfo[0]
+
+        sock = socket.socket(family, socktype, proto)
+        sock.setblocking(False)
+        error = sock.connect_ex(sockaddr)
+        if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            sock.close()
+            raise RuntimeError(os.strerror(error))
+        return sock
 
     def _end_session(self) -> None:
         try:
@@ -25,10 +25,11 @@ class TcpTransportServerImpl(ss.ThreadingMixIn, ss.TCPServer):
                  ) -> None:
         super().__init__(host_port_tuple, streamhandler)
         self.transport_server = transport_server
-        if hasattr(socket, "TCP_NODELAY"):
-            self.socket.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
-        if hasattr(socket, "TCP_QUICKACK"):
-            self.socket.setsockopt(socket.SOL_TCP, socket.TCP_QUICKACK, 1)
+        if self.address_family == socket.AF_INET:
+            if hasattr(socket, "TCP_NODELAY"):
+                self.socket.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
+            if hasattr(socket, "TCP_QUICKACK"):
+                self.socket.setsockopt(socket.SOL_TCP, socket.TCP_QUICKACK, 1)
 
         self.session_store: Dict[int, SessionState] = dict()
         self.session_lock = threading.Lock()
@@ -132,12 +133,14 @@ class TcpHandler(ss.BaseRequestHandler):
 
 class TcpTransportServer(TransportServer):
     """A TransportServer that uses TCP to communicate."""
-    def __init__(self, handler: RequestHandler, port: int = 0) -> None:
+    def __init__(
+            self, handler: RequestHandler, port: int = 0, host: str = '') -> None:
         """Create a TCPServer.
 
         Args:
             handler: A RequestHandler to handle requests
             port: The port to use.
+            host: The address to listen on, all interfaces by default.
 
         Raises:
             OSError: With errno set to errno.EADDRINUSE if the port is not
@@ -145,7 +148,7 @@ class TcpTransportServer(TransportServer):
         """
         super().__init__(handler)
 
-        self._server = TcpTransportServerImpl(('', port), TcpHandler, self)
+        self._server = self._create_server(host, port)
         self._server_thread = threading.Thread(
                 target=self._server.serve_forever, args=(0.1,), daemon=True)
         self._server_thread.start()
@@ -156,14 +159,27 @@ class TcpTransportServer(TransportServer):
         Returns:
             A string containing the location.
         """
-        # IPv6 may give two more (unneeded) items, so can't unpack directly
-        port = self._server.server_address[1]
+        port = self.get_port()
 
         locs: List[str] = []
         for address in self._get_if_addresses():
             locs.append('{}:{}'.format(address, port))
         return 'tcp:{}'.format(','.join(locs))
 
+    def _create_server(self, host: str, port: int) -> TcpTransportServerImpl:
+        """Creates the underlying socket server.
+
+        Args:
+            host: The address to listen on.
+            port: The port to use.
+        """
+        return TcpTransportServerImpl((host, port), TcpHandler, self)
+
+    def get_port(self) -> int:
+        """Returns the TCP port this server listens on."""
+        # IPv6 may give two more (unneeded) items, so can't unpack directly
+        return self._server.server_address[1]
+
     def close(self, graceful: bool = True) -> None:
         """Closes this server.
 
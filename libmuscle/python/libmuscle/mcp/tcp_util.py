@@ -1,8 +1,16 @@
+from collections import deque
 from errno import EBADF, ENOTCONN
 from socket import SocketType
+import threading
+from typing import Deque, List, Optional, Tuple
 from typing_extensions import Buffer
+import weakref
+
+import numpy as np
 
 import libmuscle.mark as mark
+from libmuscle.mcp.transport_client import Placer
+from libmuscle.mcp.transport_server import Frame
 
 
 class SocketClosed(Exception):
@@ -17,6 +25,82 @@ _CONNECTION_ERRORS = (BrokenPipeError, ConnectionError, SocketClosed, TimeoutErr
 _CONNECTION_ERRNOS = (EBADF, ENOTCONN)
 
 
+_ALIGNMENT = 64
+"""Alignment of received buffers, in bytes."""
+
+
+MULTIPLEXED_SESSION = 1 << 62
+"""Set in the session id sent by a client to start a multiplexed session.
+
+In a multiplexed session, several requests may be in progress at once, see
+:class:`libmuscle.mcp.multiplexed_tcp_transport_client.MultiplexedTcpTransportClient`.
+"""
+
+
+_MAX_SEGMENTS = 512
+"""Maximum number of segments to pass to sendmsg() at once.
+
+This needs to be below IOV_MAX, which is 1024 on Linux.
+"""
+
+
+_POOL_MIN_SIZE = 65536
+"""Buffers smaller than this are not worth pooling."""
+
+
+class BufferPool:
+    """Reuses receive buffers of the same size.
+
+    Allocating a large buffer is costly, because the operating system
+    has to provide fresh memory every time. When receiving a series of
+    messages of the same size, the buffer of an earlier message can be
+    reused instead, once nothing refers to it anymore. Messages and
+    arrays received into a buffer keep it in use for as long as they
+    exist, so that their contents are never overwritten.
+    """
+    def __init__(self, max_buffers: int = 2) -> None:
+        """Create a BufferPool.
+
+        Args:
+            max_buffers: Maximum number of unused buffers to keep.
+        """
+        self._max_buffers = max_buffers
+        self._free: Deque[Tuple[int, np.ndarray]] = deque()
+        # Buffers may be released by the garbage collector at any time
+        self._lock = threading.RLock()
+
+    def get(self, length: int) -> memoryview:
+        """Returns a writable buffer aligned to a 64-byte boundary.
+
+        Args:
+            length: Size of the buffer in bytes.
+        """
+        if length < _POOL_MIN_SIZE:
+            return aligned_buffer(length)
+
+        raw: Optional[np.ndarray] = None
+        with self._lock:
+            for i, (size, free) in enumerate(self._free):
+                if size == length:
+                    raw = free
+                    del self._free[i]
+                    break
+
+        if raw is None:
+            raw = np.empty(length + _ALIGNMENT, np.uint8)
+        offset = -raw.ctypes.data % _ALIGNMENT
+        view = raw[offset:offset + length]
+        weakref.finalize(view, self._release, length, raw)
+        return view.data
+
+    def _release(self, length: int, raw: np.ndarray) -> None:
+        """Returns a buffer that is no longer used to the pool."""
+        with self._lock:
+            self._free.append((length, raw))
+            if len(self._free) > self._max_buffers:
+                self._free.popleft()
+
+
 def is_disconnect(exception: Exception) -> bool:
     """Checks whether this is a disconnect or another problem."""
     if isinstance(exception, _CONNECTION_ERRORS):
@@ -27,24 +111,23 @@ def is_disconnect(exception: Exception) -> bool:
     return False
 
 
-def recv_all(socket: SocketType, length: int) -> Buffer:
-    """Receive length bytes from a socket.
+def recv_into(socket: SocketType, buf: memoryview) -> None:
+    """Receive exactly enough bytes from a socket to fill a buffer.
 
     Args:
         socket: Socket to receive on.
-        length: Number of bytes to receive.
+        buf: Buffer to receive into.
 
     Raises:
         SocketClosed: If the socket was closed by the peer.
         RuntimeError: If a read error occurred.
     """
-    databuf = bytearray(length)
+    length = len(buf)
     received_count = 0
     while received_count < length:
         mark.before_tcp_receive(socket)
         bytes_left = length - received_count
-        received_now = socket.recv_into(
-            memoryview(databuf)[received_count:], bytes_left)
+        received_now = socket.recv_into(buf[received_count:], bytes_left)
 
         if received_now == 0:
             raise SocketClosed("Socket closed while receiving")
@@ -54,9 +137,89 @@ def recv_all(socket: SocketType, length: int) -> Buffer:
 
         received_count += received_now
 
+
+def recv_placed(socket: SocketType, buf: memoryview, placer: Placer) -> None:
+    """Receive data into a buffer, with parts of it going elsewhere.
+
+    See :data:`Placer` for how the data is distributed.
+
+    Args:
+        socket: Socket to receive on.
+        buf: Buffer to receive into.
+        placer: Decides where to put the data.
+
+    Raises:
+        SocketClosed: If the socket was closed by the peer.
+        RuntimeError: If a read error occurred.
+    """
+    received = 0
+    while received < len(buf):
+        end, target = placer(buf, received)
+        target_size = 0 if target is None else len(target)
+        if not received <= end < end + target_size <= len(buf) and not (
+                received < end <= len(buf) and target is None):
+            raise RuntimeError('Invalid placement of received data')
+
+        recv_into(socket, buf[received:end])
+        if target is not None:
+            recv_into(socket, target)
+        received = end + target_size
+
+
+def recv_all(socket: SocketType, length: int) -> Buffer:
+    """Receive length bytes from a socket.
+
+    The data is received into freshly allocated memory, aligned to a
+    64-byte boundary, so that arrays can be used in place.
+
+    Args:
+        socket: Socket to receive on.
+        length: Number of bytes to receive.
+
+    Raises:
+        SocketClosed: If the socket was closed by the peer.
+        RuntimeError: If a read error occurred.
+    """
+    databuf = aligned_buffer(length)
+    recv_into(socket, databuf)
     return databuf
 
 
+def aligned_buffer(length: int) -> memoryview:
+    """Allocates a writable buffer aligned to a 64-byte boundary.
+
+    Args:
+        length: Size of the buffer in bytes.
+    """
+    raw = np.empty(length + _ALIGNMENT, np.uint8)
+    offset = -raw.ctypes.data % _ALIGNMENT
+    return raw[offset:offset + length].data
+
+
+def send_segments(socket: SocketType, segments: List[Buffer]) -> None:
+    """Sends a sequence of buffers, one after the other.
+
+    This uses vectored I/O, so that the buffers don't need to be copied
+    into a single buffer before sending.
+
+    Args:
+        socket: The socket to send on.
+        segments: The buffers to send.
+    """
+    views = [memoryview(s).cast('B') for s in segments if memoryview(s).nbytes]
+    first = 0
+    while first < len(views):
+        mark.before_tcp_send(socket)
+        sent = socket.sendmsg(views[first:first + _MAX_SEGMENTS])
+        while sent > 0:
+            if sent >= len(views[first]):
+                sent -= len(views[first])
+                first += 1
+            else:
+                views[first] = views[first][sent:]
+                sent = 0
+
+
 def send_int64(socket: SocketType, data: int) -> None:
     """Sends an int as a 64-bit signed little endian number.
 
@@ -82,30 +245,39 @@ def recv_int64(socket: SocketType) -> int:
         SocketClosed: If the socket was closed by the peer.
         RuntimeError: If a read error occurred.
     """
-    mark.before_tcp_receive(socket)
-    buf = recv_all(socket, 8)
+    buf = bytearray(8)
+    recv_into(socket, memoryview(buf))
     return int.from_bytes(buf, 'little')
 
 
-def send_frame(socket: SocketType, data: Buffer) -> None:
+def send_frame(socket: SocketType, data: Frame) -> None:
     """Sends a frame as length + data.
 
     Args:
         socket: The socket to send on
-        data: The data to send
+        data: The data to send, either as a single buffer or as a list of
+                segments
 
     Raises:
         RuntimeError: If there was an error sending the data.
     """
-    send_int64(socket, len(memoryview(data)))
-    socket.sendall(data)
+    if isinstance(data, list):
+        send_int64(socket, sum(memoryview(s).nbytes for s in data))
+        send_segments(socket, data)
+    else:
+        send_int64(socket, len(memoryview(data)))
+        socket.sendall(data)
 
 
-def recv_frame(socket: SocketType) -> Buffer:
+def recv_frame(
+        socket: SocketType, pool: Optional[BufferPool] = None,
+        placer: Optional[Placer] = None) -> Buffer:
     """Receives a frame as length + data.
 
     Args:
         socket: The socket to receive on
+        pool: Pool to get the buffer to receive into from, if any
+        placer: Decides where to put parts of the data, if given
 
     Returns:
         The received data.
@@ -114,5 +286,12 @@ def recv_frame(socket: SocketType) -> Buffer:
         RuntimeError: If there was an error receiving the data.
     """
     length = recv_int64(socket)
-    data = recv_all(socket, length)
+    if pool is None and placer is None:
+        return recv_all(socket, length)
+
+    data = aligned_buffer(length) if pool is None else pool.get(length)
+    if placer is None:
+        recv_into(socket, data)
+    else:
+        recv_placed(socket, data, placer)
     return data
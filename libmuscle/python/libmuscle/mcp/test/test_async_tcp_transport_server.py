@@ -0,0 +1,149 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+import socket
+import threading
+from typing import List, Optional
+
+import pytest
+
+from libmuscle.mcp.async_tcp_transport_server import AsyncTcpTransportServer
+from libmuscle.mcp.tcp_transport_client import TcpTransportClient
+from libmuscle.mcp.tcp_util import recv_frame, recv_int64, send_frame, send_int64
+from libmuscle.mcp.transport_server import Frame, RequestHandler
+
+
+class EchoHandler(RequestHandler):
+    def __init__(self) -> None:
+        self.closed = 0
+
+    def handle_request(self, request: bytes) -> Frame:
+        return b'echo ' + request
+
+    def close(self) -> None:
+        self.closed += 1
+
+
+class FutureHandler(RequestHandler):
+    def __init__(self) -> None:
+        self.futures: List[Future] = []
+        self.received = threading.Semaphore(0)
+
+    def handle_request(self, request: bytes) -> Frame:
+        raise RuntimeError('Should not be called')
+
+    def handle_request_async(self, request: bytes) -> Optional['Future[Frame]']:
+        future: Future[Frame] = Future()
+        self.futures.append(future)
+        self.received.release()
+        return future
+
+
+@pytest.fixture
+def handler():
+    return EchoHandler()
+
+
+@pytest.fixture
+def server(handler):
+    server = AsyncTcpTransportServer(handler)
+    yield server
+    server.close()
+
+
+def test_location(server):
+    assert server.get_location().startswith('tcp:')
+    assert f':{server.get_port()}' in server.get_location()
+
+
+def test_request(server):
+    client = TcpTransportClient(server.get_location())
+    response, _ = client.call(b'request')
+    assert response == b'echo request'
+    response, _ = client.call(b'again')
+    assert response == b'echo again'
+    client.close()
+
+
+def test_close_handler(handler):
+    server = AsyncTcpTransportServer(handler)
+    client = TcpTransportClient(server.get_location())
+    client.call(b'request')
+    client.close()
+    server.close()
+    assert handler.closed == 1
+
+
+def test_segments():
+    segments = [b'abc', memoryview(bytearray(b'')), bytearray(100000), b'xyz']
+
+    class SegmentsHandler(RequestHandler):
+        def handle_request(self, request: bytes) -> Frame:
+            return segments
+
+    server = AsyncTcpTransportServer(SegmentsHandler())
+    client = TcpTransportClient(server.get_location())
+
+    response, _ = client.call(b'request')
+    assert response == b''.join(bytes(s) for s in segments)
+
+    client.close()
+    server.close()
+
+
+def test_async_handler():
+    handler = FutureHandler()
+    server = AsyncTcpTransportServer(handler)
+    clients = [TcpTransportClient(server.get_location()) for _ in range(10)]
+
+    with ThreadPoolExecutor(10) as pool:
+        results = [pool.submit(client.call, b'request') for client in clients]
+        for _ in clients:
+            handler.received.acquire()
+
+        # no thread per pending request
+        assert len(server._workers._threads) == 0
+
+        for i, future in enumerate(reversed(handler.futures)):
+            future.set_result(str(i).encode())
+        responses = {bytes(result.result()[0]) for result in results}
+
+    assert responses == {str(i).encode() for i in range(10)}
+
+    for client in clients:
+        client.close()
+    server.close()
+
+
+def test_resume_session(server):
+    address = ('127.0.0.1', server.get_port())
+    with socket.create_connection(address) as sock:
+        send_int64(sock, 0)
+        session = recv_int64(sock)
+
+        send_int64(sock, 1)
+        send_frame(sock, b'request')
+        assert recv_frame(sock) == b'echo request'
+
+    # reconnect and re-request
+    with socket.create_connection(address) as sock:
+        send_int64(sock, session)
+        assert recv_int64(sock) == session
+
+        send_int64(sock, 1)
+        send_frame(sock, b'request')
+        assert recv_frame(sock) == b'echo request'
+
+        send_int64(sock, 2)
+        send_frame(sock, b'next')
+        assert recv_frame(sock) == b'echo next'
+
+        send_int64(sock, 0)
+
+
+def test_many_clients(server):
+    clients = [TcpTransportClient(server.get_location()) for _ in range(200)]
+    for i, client in enumerate(clients):
+        response, _ = client.call(str(i).encode())
+        assert response == f'echo {i}'.encode()
+
+    for client in clients:
+        client.close()
@@ -0,0 +1,81 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+import socket
+import threading
+from typing import List, Optional
+
+import pytest
+
+from libmuscle.mcp.async_tcp_transport_server import AsyncTcpTransportServer
+from libmuscle.mcp.multiplexed_tcp_transport_client import (
+        MultiplexedTcpTransportClient)
+from libmuscle.mcp.transport_server import Frame, RequestHandler
+
+
+class FutureHandler(RequestHandler):
+    def __init__(self) -> None:
+        self.requests: List[bytes] = []
+        self.futures: List[Future] = []
+        self.received = threading.Semaphore(0)
+
+    def handle_request(self, request: bytes) -> Frame:
+        raise RuntimeError('Should not be called')
+
+    def handle_request_async(self, request: bytes) -> Optional['Future[Frame]']:
+        future: Future[Frame] = Future()
+        self.requests.append(request)
+        self.futures.append(future)
+        self.received.release()
+        return future
+
+
+@pytest.fixture
+def handler():
+    return FutureHandler()
+
+
+@pytest.fixture
+def server(handler):
+    server = AsyncTcpTransportServer(handler)
+    yield server
+    server.close()
+
+
+def test_out_of_order(server, handler):
+    client = MultiplexedTcpTransportClient(server.get_location())
+    with ThreadPoolExecutor(2) as pool:
+        first = pool.submit(client.call, b'first')
+        handler.received.acquire()
+        second = pool.submit(client.call, b'second')
+        handler.received.acquire()
+
+        handler.futures[1].set_result(b'second done')
+        assert second.result()[0] == b'second done'
+        assert not first.done()
+
+        handler.futures[0].set_result(b'first done')
+        assert first.result()[0] == b'first done'
+
+    client.close()
+
+
+def test_reconnect(server, handler):
+    client = MultiplexedTcpTransportClient(server.get_location())
+    with ThreadPoolExecutor(1) as pool:
+        result = pool.submit(client.call, b'request')
+        handler.received.acquire()
+
+        assert client._socket is not None
+        client._socket.shutdown(socket.SHUT_RDWR)
+
+        # sent again on reconnect, but not handled again
+        handler.futures[0].set_result(b'response')
+        assert result.result()[0] == b'response'
+        assert handler.requests == [b'request']
+
+    next_result = ThreadPoolExecutor(1).submit(client.call, b'next')
+    handler.received.acquire()
+    handler.futures[1].set_result(b'next response')
+    assert next_result.result()[0] == b'next response'
+    assert client.is_connected()
+
+    client.close()
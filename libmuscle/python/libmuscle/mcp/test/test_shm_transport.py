@@ -0,0 +1,42 @@
+from unittest.mock import MagicMock
+
+import numpy as np
+import pytest
+
+from libmuscle.mcp.shm_transport_client import ShmTransportClient
+from libmuscle.mcp.shm_transport_server import ShmTransportServer
+from libmuscle.mcp.shm_util import CONTROL_SOCKET, SHM_ROOT
+
+
+pytestmark = pytest.mark.skipif(
+        not SHM_ROOT.is_dir(), reason='Shared memory not available')
+
+
+def test_shm_transport():
+    small = b'response'
+    large = [b'abc', np.arange(100000, dtype=np.uint8).data, b'xyz']
+
+    handler = MagicMock()
+    handler.handle_request.return_value = small
+
+    server = ShmTransportServer(handler)
+    location = server.get_location()
+    assert ShmTransportClient.can_connect_to(location)
+    assert not ShmTransportClient.can_connect_to('shm:muscle3_nonexistent')
+    assert not ShmTransportClient.can_connect_to('tcp:127.0.0.1:1234')
+
+    client = ShmTransportClient(location)
+
+    response, _ = client.call(b'request')
+    assert response == small
+    handler.handle_request.assert_called_with(b'request')
+
+    handler.handle_request.return_value = large
+    response, _ = client.call(b'request')
+    assert response == b''.join(bytes(s) for s in large)
+    assert not memoryview(response).readonly
+    assert [p.name for p in server._directory.iterdir()] == [CONTROL_SOCKET]
+
+    client.close()
+    server.close()
+    assert not server._directory.exists()
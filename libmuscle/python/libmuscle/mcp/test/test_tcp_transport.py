@@ -1,7 +1,13 @@
+import gc
+import os
 from unittest.mock import MagicMock
 
+import numpy as np
+import pytest
+
 from libmuscle.mcp.tcp_transport_client import TcpTransportClient
 from libmuscle.mcp.tcp_transport_server import TcpTransportServer
+from libmuscle.mcp.tcp_util import BufferPool
 
 
 def test_tcp_transport():
@@ -28,3 +34,115 @@ def test_tcp_transport():
 
     client.close()
     server.close()
+
+
+def test_tcp_transport_segments():
+    segments = [b'abc', memoryview(bytearray(b'')), bytearray(100000), b'xyz']
+
+    handler = MagicMock()
+    handler.handle_request.return_value = segments
+
+    server = TcpTransportServer(handler)
+    client = TcpTransportClient(server.get_location())
+
+    response, _ = client.call(b'request')
+    assert response == b''.join(bytes(s) for s in segments)
+    assert len(response) == 100006
+
+    client.close()
+    server.close()
+
+
+def test_tcp_unreachable_address():
+    handler = MagicMock()
+    handler.handle_request.return_value = b'response'
+
+    server = TcpTransportServer(handler)
+    port = server.get_port()
+
+    # 192.0.2.0/24 is reserved for documentation, so this will not connect
+    client = TcpTransportClient(f'tcp:192.0.2.1:{port},127.0.0.1:{port}')
+    response, _ = client.call(b'request')
+    assert response == b'response'
+
+    client.close()
+    server.close()
+
+
+def test_tcp_transport_many_fds():
+    resource = pytest.importorskip('resource')
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < 1200:
+        if hard != resource.RLIM_INFINITY and hard < 1200:
+            pytest.skip('Cannot open enough file descriptors')
+        resource.setrlimit(resource.RLIMIT_NOFILE, (1200, hard))
+
+    handler = MagicMock()
+    handler.handle_request.return_value = b'response'
+    server = TcpTransportServer(handler)
+
+    # make sure the client's sockets get descriptors that select() can't handle
+    fds = [os.dup(0) for _ in range(1100)]
+    try:
+        client = TcpTransportClient(server.get_location())
+        response, _ = client.call(b'request')
+        assert response == b'response'
+        client.close()
+    finally:
+        for fd in fds:
+            os.close(fd)
+        server.close()
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+
+
+def test_tcp_transport_placer():
+    handler = MagicMock()
+    handler.handle_request.return_value = bytes(range(100)) * 1000
+
+    server = TcpTransportServer(handler)
+    client = TcpTransportClient(server.get_location())
+
+    target = bytearray(1000)
+
+    def placer(frame, received):
+        if received == 0:
+            return 500, memoryview(target)
+        return len(frame), None
+
+    response, _ = client.call(b'request', placer=placer)
+    assert target == (bytes(range(100)) * 1000)[500:1500]
+    assert response[:500] == (bytes(range(100)) * 1000)[:500]
+    assert response[1500:] == (bytes(range(100)) * 1000)[1500:]
+
+    client.close()
+    server.close()
+
+
+def test_buffer_pool():
+    pool = BufferPool()
+    buf = pool.get(100000)
+    address = np.frombuffer(buf, np.uint8).ctypes.data
+    assert address % 64 == 0
+    assert not buf.readonly
+
+    # still in use, so not reused
+    buf2 = pool.get(100000)
+    assert np.frombuffer(buf2, np.uint8).ctypes.data != address
+
+    # arrays using it keep it in use
+    array = np.frombuffer(buf, np.float64)
+    del buf
+    gc.collect()
+    buf3 = pool.get(100000)
+    assert np.frombuffer(buf3, np.uint8).ctypes.data != address
+
+    del array
+    gc.collect()
+    buf4 = pool.get(100000)
+    assert np.frombuffer(buf4, np.uint8).ctypes.data == address
+
+    # other sizes get a new buffer
+    del buf4
+    gc.collect()
+    buf5 = pool.get(200000)
+    assert np.frombuffer(buf5, np.uint8).ctypes.data != address
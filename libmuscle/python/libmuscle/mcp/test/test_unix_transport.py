@@ -0,0 +1,31 @@
+import socket
+from unittest.mock import MagicMock
+
+import pytest
+
+from libmuscle.mcp.unix_transport_client import UnixTransportClient
+from libmuscle.mcp.unix_transport_server import UnixTransportServer
+
+
+@pytest.mark.skipif(
+        not hasattr(socket, 'AF_UNIX'), reason='Unix domain sockets not available')
+def test_unix_transport():
+    handler = MagicMock()
+    handler.handle_request.return_value = b'response'
+
+    server = UnixTransportServer(handler)
+    location = server.get_location()
+    assert location.startswith('unix:')
+    assert UnixTransportClient.can_connect_to(location)
+    assert not UnixTransportClient.can_connect_to('unix:/nonexistent/mpp')
+    assert not UnixTransportClient.can_connect_to('tcp:127.0.0.1:1234')
+
+    client = UnixTransportClient(location)
+    response, _ = client.call(b'request')
+    assert response == b'response'
+    handler.handle_request.assert_called_with(b'request')
+
+    client.close()
+    server.close()
+    assert not UnixTransportClient.can_connect_to(location)
+
@@ -1,4 +1,4 @@
-from typing import Optional, Tuple
+from typing import Callable, Optional, Tuple
 from typing_extensions import Buffer
 
 from libmuscle.profiling import ProfileTimestamp
@@ -7,6 +7,18 @@ from libmuscle.profiling import ProfileTimestamp
 ProfileData = Tuple[ProfileTimestamp, ProfileTimestamp, ProfileTimestamp]
 
 
+Placer = Callable[[memoryview, int], Tuple[int, Optional[memoryview]]]
+"""Decides where the parts of a response are received into.
+
+This is called with the buffer the response is being received into,
+and the number of bytes received so far. It returns the offset up to
+which to receive into the buffer next, and optionally a target buffer.
+If a target is given, then the bytes after that offset are received
+into the target instead, and skipped in the response buffer. The
+placer is called again until the whole response has been received.
+"""
+
+
 class TimeoutHandler:
     """Object handling timeouts during :meth:`TransportClient.call`."""
 
@@ -36,6 +48,13 @@ class TransportClient:
     Client connects to an MCP Transport Server over some communication
     protocol, requests messages from it, and returns responses.
     """
+    network = False
+    """Whether this transport goes through the network.
+
+    Optional features that only pay off over the network, like compression,
+    are only used with transports for which this is True.
+    """
+
     @staticmethod
     def can_connect_to(location: str) -> bool:
         """Whether this client class can connect to the given location.
@@ -48,8 +67,8 @@ class TransportClient:
         """
         raise NotImplementedError()     # pragma: no cover
 
-    def call(self, request: Buffer, timeout_handler: Optional[TimeoutHandler] = None
-             ) -> Tuple[Buffer, ProfileData]:
+    def call(self, request: Buffer, timeout_handler: Optional[TimeoutHandler] = None,
+             placer: Optional[Placer] = None) -> Tuple[Buffer, ProfileData]:
         """Send a request to the server and receive the response.
 
         This is a blocking call. Besides the result, this function
@@ -62,6 +81,9 @@ class TransportClient:
             request: The request to send
             timeout_handler: Optional timeout handler. This is used for communication
                 deadlock detection.
+            placer: Optional placer deciding where to receive parts of the
+                response. Transports that do not receive the response as a
+                stream ignore this, and so it is just a hint.
 
         Returns:
             The received response, and the timestamps
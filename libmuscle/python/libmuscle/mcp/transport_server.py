@@ -1,6 +1,12 @@
+from concurrent.futures import Future
+from typing import List, Optional, Union
 from typing_extensions import Buffer
 
 
+Frame = Union[Buffer, List[Buffer]]
+"""A response, either as a single buffer or as a list of consecutive segments."""
+
+
 class RequestHandler:
     """Handles requests sent to a TransportServer.
 
@@ -9,17 +15,35 @@ class RequestHandler:
     handle the request, and return a chunk of bytes containing an
     encoded response.
     """
-    def handle_request(self, request: Buffer) -> Buffer:
+    def handle_request(self, request: Buffer) -> Frame:
         """Handle a request.
 
         Args:
             request: A received request
 
         Returns:
-            An encoded response
+            An encoded response, possibly split into segments
         """
         raise NotImplementedError()     # pragma: no cover
 
+    def handle_request_async(self, request: Buffer) -> Optional['Future[Frame]']:
+        """Handle a request without blocking.
+
+        Handlers whose requests may take a long time to complete, e.g.
+        because they wait for something else to happen, can override
+        this to return a future for the response instead, so that a
+        server does not need to tie up a thread while they wait.
+
+        Args:
+            request: A received request
+
+        Returns:
+            A future for the encoded response, or None if this handler
+            does not support this, in which case the server will call
+            :meth:`handle_request` instead.
+        """
+        return None
+
     def close(self) -> None:
         """Free per-thread resources.
 
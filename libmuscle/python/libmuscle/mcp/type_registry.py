@@ -1,9 +1,16 @@
+from libmuscle.mcp.async_tcp_transport_server import AsyncTcpTransportServer
+from libmuscle.mcp.shm_transport_client import ShmTransportClient
+from libmuscle.mcp.shm_transport_server import ShmTransportServer
 from libmuscle.mcp.tcp_transport_client import TcpTransportClient
-from libmuscle.mcp.tcp_transport_server import TcpTransportServer
+from libmuscle.mcp.unix_transport_client import UnixTransportClient
+from libmuscle.mcp.unix_transport_server import UnixTransportServer
 
 
-# These must be in order of preference, i.e. most efficient first
-transport_client_types = [TcpTransportClient]
+# These must be in order of preference, i.e. most efficient first. Clients for
+# node-local transports only accept locations on the same node, so peers on the
+# same node use those, and other peers fall back to TCP.
+transport_client_types = [ShmTransportClient, UnixTransportClient, TcpTransportClient]
 
 
-transport_server_types = [TcpTransportServer]
+transport_server_types = [
+        ShmTransportServer, UnixTransportServer, AsyncTcpTransportServer]
@@ -0,0 +1,48 @@
+from pathlib import Path
+import socket
+
+from libmuscle.mcp.tcp_transport_client import TcpTransportClient
+
+
+class UnixTransportClient(TcpTransportClient):
+    """A client that connects to a UnixTransportServer.
+
+    This speaks the same protocol as the TCP client, but over a Unix
+    domain socket, which only works if the server is on the same node.
+    """
+    network = False
+
+    @staticmethod
+    def can_connect_to(location: str) -> bool:
+        """Whether this client class can connect to the given location.
+
+        This is only the case if the server is on the same node, which we
+        check by looking for its socket.
+
+        Args:
+            location: The location to potentially connect to.
+
+        Returns:
+            True iff this class can connect to this location.
+        """
+        if not hasattr(socket, 'AF_UNIX') or not location.startswith('unix:'):
+            return False
+        return Path(location[5:]).is_socket()
+
+    def _open_socket(self) -> socket.SocketType:
+        """Connect to the server's socket.
+
+        Returns:
+            A connected socket.
+        """
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self._addresses[0])
+        except FileNotFoundError as e:
+            # The server removes its socket when it shuts down
+            sock.close()
+            raise ConnectionRefusedError('Failed to connect') from e
+        except Exception:
+            sock.close()
+            raise
+        return sock
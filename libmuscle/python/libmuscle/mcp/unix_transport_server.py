@@ -0,0 +1,100 @@
+import os
+from pathlib import Path
+import shutil
+import socket
+import tempfile
+from typing import Any, Callable, cast, Optional
+import weakref
+
+from libmuscle.mcp.tcp_transport_server import (
+        TcpHandler, TcpTransportServer, TcpTransportServerImpl)
+from libmuscle.mcp.transport_server import RequestHandler, ServerNotSupported
+
+
+_MAX_PATH_LENGTH = 103
+"""Maximum length of a socket path, 108 on Linux but 104 on macOS."""
+
+
+class UnixTransportServerImpl(TcpTransportServerImpl):
+    address_family = getattr(socket, 'AF_UNIX', socket.AF_INET)
+    allow_reuse_address = False
+
+
+class UnixTransportServer(TcpTransportServer):
+    """A TransportServer that uses a Unix domain socket to communicate.
+
+    This can only be reached from the same node, but avoids the overhead of
+    the TCP/IP stack. The protocol on top of the socket is the same as for
+    TCP.
+    """
+    def __init__(
+            self, handler: RequestHandler, path: Optional[Path] = None) -> None:
+        """Create a UnixTransportServer.
+
+        Args:
+            handler: A RequestHandler to handle requests
+            path: Path to create the socket at. If not given, the socket is
+                created in a new temporary directory.
+
+        Raises:
+            ServerNotSupported: If Unix domain sockets are not available, or
+                if the path is too long to bind to.
+        """
+        if not hasattr(socket, 'AF_UNIX'):
+            raise ServerNotSupported('Unix domain sockets are not available')
+
+        self._cleanup: Callable[[], Any]
+        if path is None:
+            directory = tempfile.mkdtemp(prefix='muscle3_')
+            path = Path(directory) / 'mpp'
+            self._cleanup = weakref.finalize(
+                    self, shutil.rmtree, directory, ignore_errors=True)
+        else:
+            self._cleanup = weakref.finalize(self, _unlink, path)
+
+        if len(str(path)) > _MAX_PATH_LENGTH:
+            self._cleanup()
+            raise ServerNotSupported(f'Socket path {path} is too long')
+
+        self._path = path
+        super().__init__(handler)
+
+    def _create_server(self, host: str, port: int) -> TcpTransportServerImpl:
+        """Creates the underlying socket server.
+
+        Args:
+            host: Ignored.
+            port: Ignored.
+        """
+        # The socketserver type stubs only know about IP addresses
+        return UnixTransportServerImpl(cast(Any, str(self._path)), TcpHandler, self)
+
+    def get_location(self) -> str:
+        """Returns the location this server listens on.
+
+        This is of the form unix:<path>.
+
+        Returns:
+            A string containing the location.
+        """
+        return f'unix:{self._path}'
+
+    def close(self, graceful: bool = True) -> None:
+        """Closes this server.
+
+        Stops the server listening, waits for existing clients to
+        disconnect, then removes the socket.
+
+        Args:
+            graceful: Wait for clients to finish their sessions, where applicable.
+        """
+        super().close(graceful)
+        self._cleanup()
+
+
+def _unlink(path: Path) -> None:
+    """Removes a socket, if it still exists."""
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
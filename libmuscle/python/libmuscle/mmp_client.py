@@ -1,8 +1,6 @@
 import dataclasses
 from pathlib import Path
-from random import uniform
-from threading import get_ident, RLock
-from time import perf_counter, sleep
+from time import perf_counter
 from typing import Any, Dict, Iterable, List, Optional, Tuple
 
 import msgpack
@@ -12,7 +10,8 @@ from ymmsl.v0_2 import (
 
 import libmuscle
 from libmuscle.mcp.protocol import RequestType, ResponseType
-from libmuscle.mcp.tcp_transport_client import TcpTransportClient
+from libmuscle.mcp.multiplexed_tcp_transport_client import (
+        MultiplexedTcpTransportClient)
 from libmuscle.peer_info import PeerInfo
 from libmuscle.profiling import ProfileEvent
 from libmuscle.logging import LogMessage
@@ -20,13 +19,10 @@ from libmuscle.snapshot import SnapshotMetadata
 from libmuscle.util import instance_to_kernel, instance_indices
 
 
-TIMID_WAIT = 1.0
-
 PEER_TIMEOUT = 600
-PEER_INTERVAL_MIN = 5.0
-PEER_INTERVAL_MAX = 10.0
+PEER_WAIT = 60.0
 
-_CheckpointInfoType = Tuple[
+CheckpointInfoType = Tuple[
         float, Checkpoints, Optional[Path], Optional[Path]]
 
 
@@ -76,7 +72,7 @@ def decode_checkpoint_info(
         checkpoints_dict: Dict[str, Any],
         resume: Optional[str],
         snapshot_dir: Optional[str]
-        ) -> _CheckpointInfoType:
+        ) -> CheckpointInfoType:
     """Decode checkpoint info from a MsgPack-compatible value.
 
     Args:
@@ -115,8 +111,10 @@ class MMPClient():
     It manages the connection, and converts between our native types
     and the gRPC generated types.
 
-    Communication is protected by an internal lock, so this class can
-    be called simultaneously from different threads.
+    This class can be called simultaneously from different threads. Their
+    requests share a single connection, but are sent without waiting for
+    earlier ones to be answered, so that e.g. a thread submitting profiling
+    events does not hold up a log message.
     """
     def __init__(self, instance_id: Reference, location: str) -> None:
         """Create an MMPClient
@@ -125,9 +123,7 @@ class MMPClient():
             location: A connection string of the form hostname:port
         """
         self._instance_id = instance_id
-        self._transport_client = TcpTransportClient(location)
-        self._mutex = RLock()
-        self._cur_owner = 0
+        self._transport_client = MultiplexedTcpTransportClient(location)
 
     def close(self) -> None:
         """Close the connection
@@ -141,31 +137,26 @@ class MMPClient():
         """Send a log message to the manager.
 
         This particular call is a bit tricky because of its potentially recursive
-        nature. It's used by a special logging handler (see logging_handler.py) to send
-        high-priority log messages to the manager for inclusion in the manager log. The
-        problem is that the connection to the manager may fail while doing so, which
-        causes more log messages to be generated (dropped connection are rare and
-        shouldn't really happen, so we want the user to know about them). Of course
-        those then get picked up by the handler, which sends them here recursively.
-
-        The Python logging system has an internal mutex, and we've got a mutex here as
-        well, and this recursion causes a thread to try to lock them alternatingly. If
-        the thread starts with making a request to the manager, then it will try to lock
-        the MMPClient mutex first, then the logging mutex, but if it starts with sending
-        a log message, then it will try to lock the logging mutex first and then the
-        MMPClient one. If two threads try to lock two mutexes in a different order then
-        you'll get a deadlock.
-
-        To avoid this, this function will not wait for the internal lock forever, but
-        time out after a while and raise. Note that the actual implementation is in
+        nature, if it's called from a logging handler to send high-priority log
+        messages to the manager for inclusion in the manager log. The problem is that
+        the connection to the manager may fail while doing so, which causes more log
+        messages to be generated (dropped connection are rare and shouldn't really
+        happen, so we want the user to know about them). Of course those then get
+        picked up by the handler, which sends them here recursively. The handler in
+        logging_handler.py avoids this by using :meth:`submit_log_messages` from a
+        background thread instead.
+
+        While the connection is being reestablished, the thread doing so holds the
+        lock that protects sending on it, and the log messages it generates would
+        wait for that lock forever. So if we're disconnected, this function raises
+        rather than sending the message. Note that the actual implementation is in
         _call_manager().
 
         Args:
             message: The message to send.
 
         Raises:
-            ConnectionLockedError: if the connection to the manager was being used
-                already.
+            ConnectionLockedError: if the connection to the manager is down.
         """
         request = [
                 RequestType.SUBMIT_LOG_MESSAGE.value,
@@ -173,6 +164,24 @@ class MMPClient():
                 message.level.value, message.text]
         self._call_manager(request, True)
 
+    def submit_log_messages(self, messages: Iterable[LogMessage]) -> None:
+        """Send a batch of log messages to the manager.
+
+        Unlike :meth:`submit_log_message`, this waits for a reconnect if the
+        connection is down, so it must not be called from a logging handler
+        directly.
+
+        Args:
+            messages: The messages to send, all from this instance.
+        """
+        request = [
+                RequestType.SUBMIT_LOG_MESSAGES.value,
+                str(self._instance_id),
+                [
+                    [m.timestamp.seconds, m.level.value, m.text, m.count]
+                    for m in messages]]
+        self._call_manager(request)
+
     def submit_profile_events(self, events: Iterable[ProfileEvent]) -> None:
         """Sends profiling events to the manager.
 
@@ -208,7 +217,7 @@ class MMPClient():
         response = self._call_manager(request)
         return Settings(response[1])
 
-    def get_checkpoint_info(self) -> _CheckpointInfoType:
+    def get_checkpoint_info(self) -> CheckpointInfoType:
         """Get the checkpoint info from the manager.
 
         Returns:
@@ -240,34 +249,63 @@ class MMPClient():
             raise RuntimeError(
                     f'Error registering instance: {response[1]}')
 
+    def bootstrap(
+            self, locations: List[str], ports: List[Port]
+            ) -> Tuple[Optional[PeerInfo], Settings, CheckpointInfoType]:
+        """Register with the manager and get what we need to start up.
+
+        This does the work of :meth:`register_instance`,
+        :meth:`request_peers`, :meth:`get_settings` and
+        :meth:`get_checkpoint_info` in a single request. The manager answers
+        as soon as all our peers have registered, or after PEER_WAIT seconds.
+
+        Args:
+            locations: List of places where the instance can be
+                    reached.
+            ports: List of ports of this instance.
+
+        Returns:
+            The PeerInfo, or None if the peers were not available (yet), in
+            which case :meth:`request_peers` should be used to get it, the
+            settings, and the checkpoint info as returned by
+            :meth:`get_checkpoint_info`.
+        """
+        request = [
+                RequestType.BOOTSTRAP.value,
+                str(self._instance_id), locations,
+                [encode_port(p) for p in ports],
+                libmuscle.__version__, min(PEER_WAIT, PEER_TIMEOUT)]
+        response = self._call_manager(request)
+        if response[0] == ResponseType.ERROR.value:
+            raise RuntimeError(
+                    f'Error registering instance: {response[1]}')
+
+        peer_info = None
+        if response[1][0] == ResponseType.SUCCESS.value:
+            peer_info = self._decode_peer_info(response[1])
+
+        return (
+                peer_info, Settings(response[2]),
+                decode_checkpoint_info(*response[3]))
+
     def request_peers(self) -> PeerInfo:
         """Request connection information about peers.
 
-        This will repeat the request at an exponentially increasing
-        query interval at first, until it reaches the interval
-        specified by PEER_INTERVAL_MIN and PEER_INTERVAL_MAX. From
-        there on, intervals are drawn randomly from that range.
+        The manager answers as soon as all our peers have registered, or
+        after PEER_WAIT seconds, in which case we ask again, until
+        PEER_TIMEOUT seconds have passed.
 
         Returns:
             PeerInfo received from the muscle manager.
         """
-        sleep_time = 0.1
-        start_time = perf_counter()
-
-        request = [RequestType.GET_PEERS.value, str(self._instance_id)]
-        response = self._call_manager(request)
-
-        while (response[0] == ResponseType.PENDING.value and
-               perf_counter() < start_time + PEER_TIMEOUT and
-               sleep_time < PEER_INTERVAL_MIN):
-            sleep(sleep_time)
-            response = self._call_manager(request)
-            sleep_time *= 1.5
+        deadline = perf_counter() + PEER_TIMEOUT
 
-        while (response[0] == ResponseType.PENDING.value and
-               perf_counter() < start_time + PEER_TIMEOUT):
-            sleep(uniform(PEER_INTERVAL_MIN, PEER_INTERVAL_MAX))
+        while True:
+            wait = min(PEER_WAIT, max(deadline - perf_counter(), 0.0))
+            request = [RequestType.GET_PEERS.value, str(self._instance_id), wait]
             response = self._call_manager(request)
+            if response[0] != ResponseType.PENDING.value or wait < PEER_WAIT:
+                break
 
         if response[0] == ResponseType.PENDING.value:
             raise RuntimeError('Timeout waiting for peers to appear')
@@ -276,22 +314,7 @@ class MMPClient():
             raise RuntimeError('Error getting peers from manager: {}'.format(
                     response[1]))
 
-        conduits = [Conduit(snd, recv) for snd, recv in response[1]]
-
-        peer_dimensions = {
-                Reference(component): dims
-                for component, dims in response[2].items()}
-
-        peer_locations = {
-                Reference(instance): locs
-                for instance, locs in response[3].items()}
-
-        ports = [
-            Port(Identifier(name), Operator[op]) for name, op in response[4]
-        ]
-        name = instance_to_kernel(self._instance_id)
-        index = instance_indices(self._instance_id)
-        return PeerInfo(name, index, conduits, peer_dimensions, peer_locations, ports)
+        return self._decode_peer_info(response)
 
     def deregister_instance(self) -> None:
         """Deregister a component instance with the manager.
@@ -331,44 +354,43 @@ class MMPClient():
         response = self._call_manager(request)
         return bool(response[1])
 
+    def _decode_peer_info(self, response: Any) -> PeerInfo:
+        """Decode a successful response to a get peers request."""
+        conduits = [Conduit(snd, recv) for snd, recv in response[1]]
+
+        peer_dimensions = {
+                Reference(component): dims
+                for component, dims in response[2].items()}
+
+        peer_locations = {
+                Reference(instance): locs
+                for instance, locs in response[3].items()}
+
+        ports = [
+            Port(Identifier(name), Operator[op]) for name, op in response[4]
+        ]
+        name = instance_to_kernel(self._instance_id)
+        index = instance_indices(self._instance_id)
+        return PeerInfo(name, index, conduits, peer_dimensions, peer_locations, ports)
+
     def _call_manager(self, request: Any, timid: bool = False) -> Any:
         """Call the manager and do en/decoding.
 
         Args:
             request: The request to encode and send
-            timid: If True, raise if we can't get the lock after a while
+            timid: If True, raise rather than wait for a reconnect
 
         Returns:
             The decoded response
 
         Raises:
-            ConnectionLockedError: If timid was True and we failed to get the lock
+            ConnectionLockedError: If timid was True and we're disconnected
         """
-        if timid:
-            if self._mutex.acquire(timeout=TIMID_WAIT):
-                # We were trying to log, disconnected, then logged the disconnect and
-                # now we're back here. Since we're still disconnected, we need to raise
-                # and drop this message.
-                if self._cur_owner == get_ident():
-                    self._mutex.release()
-                    raise ConnectionLockedError()
-            else:
-                # Timed out, someone else has held the lock for a long time, so either
-                # the manager is overloaded or there are connection problems. Raise and
-                # drop.
-                raise ConnectionLockedError()
-        else:
-            self._mutex.acquire()
-
-        self._cur_owner = get_ident()
-
-        try:
-            encoded_request = msgpack.packb(request, use_bin_type=True)
-            response, _ = self._transport_client.call(encoded_request)
-            result = msgpack.unpackb(response, raw=False)
-
-            return result
-
-        finally:
-            self._cur_owner = 0
-            self._mutex.release()
+        if timid and not self._transport_client.is_connected():
+            # We may be the thread that is reconnecting, logging that it is, so
+            # we cannot wait. Raise and drop.
+            raise ConnectionLockedError()
+
+        encoded_request = msgpack.packb(request, use_bin_type=True)
+        response, _ = self._transport_client.call(encoded_request)
+        return msgpack.unpackb(response, raw=False)
@@ -1,25 +1,94 @@
-from typing import List, Optional, Tuple
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+import logging
+from threading import Lock
+from typing import Any, List, Optional, Tuple
 from typing_extensions import Buffer
 
 import msgpack
 from ymmsl.v0_2 import Reference
 
-from libmuscle.mcp.protocol import RequestType
-from libmuscle.mcp.transport_client import ProfileData, TransportClient, TimeoutHandler
+from libmuscle.compression import codec_features
+from libmuscle.mcp.protocol import MPPFeature, RequestType
+from libmuscle.mcp.tcp_util import aligned_buffer
+from libmuscle.mcp.transport_client import (
+        Placer, ProfileData, TransportClient, TimeoutHandler)
 from libmuscle.mcp.type_registry import transport_client_types
+from libmuscle.mpp_message import parse_chunked_descriptor, split_batch
+from libmuscle.profiling import ProfileTimestamp
+
+
+_logger = logging.getLogger(__name__)
+
+
+SUPPORTED_FEATURES = [
+        MPPFeature.OUT_OF_BAND, MPPFeature.COMPACT_HEADER,
+        MPPFeature.BATCH, MPPFeature.CHUNKED] + codec_features()
+"""MPP features supported by this client, see :class:`MPPFeature`."""
+
+
+_network_feature_names = [
+        feature.value for feature in codec_features() + [MPPFeature.CHUNKED]]
+
+
+_CHUNK_SIZE = 8 * 1024 * 1024
+"""Size of the parts in which large messages are fetched."""
+
+
+_STRIPES = 4
+"""Number of connections over which to fetch the chunks of a message."""
+
+
+def peer_features(
+        locations: List[str], network: bool = True) -> List[MPPFeature]:
+    """Determines which MPP features a peer supports.
+
+    Peers that support optional features list them in an ``mpp:``
+    location. Peers without one support only the basic protocol.
+
+    Args:
+        locations: The peer's location strings
+        network: Whether to include features that only pay off over the
+                network, i.e. compression codecs and chunked transfers
+
+    Returns:
+        The features supported by both the peer and us.
+    """
+    for location in locations:
+        if location.startswith('mpp:'):
+            names = location[4:].split(',')
+            if not network:
+                names = [
+                        name for name in names
+                        if name not in _network_feature_names]
+            return [
+                    feature for feature in SUPPORTED_FEATURES
+                    if feature.value in names]
+    return []
 
 
 class MPPClient:
     """A client that connects to an MPP server.
 
     This client connects to a peer to retrieve messages. It uses an MCP
-    Transport to connect.
+    Transport to connect. It may be used from multiple threads, but
+    receives are done one at a time.
+
+    Large messages from peers that support it are fetched in chunks, over
+    several connections at once. The chunks are received straight
+    into place, so that no more memory is used than for the message
+    itself, and to make better use of fast networks. The extra connections
+    use the same transport as the first one.
+
+    Attributes:
+        supports_batches: Whether the peer supports :meth:`receive_batch`.
     """
     def __init__(self, locations: List[str]) -> None:
         """Create an MPPClient for the given peer.
 
         The client will connect to the peer on one of its locations. It
-        tries the most efficient protocol first. Once connected, it can
+        tries the most efficient protocol first, which for peers on the same
+        node is one that does not go through the network stack. Once connected, it can
         request messages from any component and port represented by it.
 
         Args:
@@ -31,6 +100,8 @@ class MPPClient:
                 if ClientType.can_connect_to(location):
                     try:
                         client = ClientType(location)
+                        self._client_type = ClientType
+                        self._location = location
                         break
                     except Exception:
                         pass
@@ -40,20 +111,80 @@ class MPPClient:
             raise RuntimeError('Failed to connect')
 
         self._transport_client = client
+        # Compression and chunking only pay off over the network
+        self._features = peer_features(locations, client.network)
+        self._mutex = Lock()
+        # extra connections for fetching chunks, created when first needed
+        self._stripes: List[TransportClient] = []
+        self._stripe_pool: Optional[ThreadPoolExecutor] = None
+        self.supports_batches = MPPFeature.BATCH in self._features
 
-    def receive(self, receiver: Reference, timeout_handler: Optional[TimeoutHandler]
-                ) -> Tuple[Buffer, ProfileData]:
+    def receive(self, receiver: Reference, timeout_handler: Optional[TimeoutHandler],
+                placer: Optional[Placer] = None) -> Tuple[Buffer, ProfileData]:
         """Receive a message from a port this client connects to.
 
         Args:
             receiver: The receiving (local) port.
+            timeout_handler: Optional timeout handler, for deadlock
+                    detection.
+            placer: Optional placer deciding where to receive parts of the
+                    message, see :class:`libmuscle.mpp_message.BufferPlacer`.
 
         Returns:
             The received message, and profiling data
         """
-        request = [RequestType.GET_NEXT_MESSAGE.value, str(receiver)]
+        request: List[Any] = [RequestType.GET_NEXT_MESSAGE.value, str(receiver)]
+        if self._features:
+            request.append([feature.value for feature in self._features])
         encoded_request = msgpack.packb(request, use_bin_type=True)
-        return self._transport_client.call(encoded_request, timeout_handler)
+        with self._mutex:
+            frame, profile = self._transport_client.call(
+                    encoded_request, timeout_handler, placer)
+            chunked = parse_chunked_descriptor(frame)
+            if chunked is not None:
+                frame = self._receive_chunked(*chunked, placer)
+                profile = profile[0], profile[1], ProfileTimestamp()
+        return frame, profile
+
+    def receive_batch(
+            self, receivers: List[Reference],
+            timeout_handler: Optional[TimeoutHandler], max_messages: int,
+            max_bytes: int) -> Tuple[List[Tuple[int, memoryview]], ProfileData]:
+        """Receive the next message and any others that are waiting.
+
+        This waits for the next message for the first receiver, and
+        receives any further messages that the peer already has for any of
+        the receivers along with it, up to max_messages messages and
+        max_bytes bytes for the further messages. May only be used if
+        :attr:`supports_batches` is True.
+
+        Args:
+            receivers: The receiving (local) ports.
+            timeout_handler: Optional timeout handler, for deadlock
+                    detection.
+            max_messages: Maximum number of messages to receive.
+            max_bytes: Maximum size of the further messages.
+
+        Returns:
+            The index of the receiver and the encoded message for each
+            received message, starting with the one for the first
+            receiver, and profiling data for the whole transfer.
+        """
+        request = [
+                RequestType.GET_NEXT_MESSAGES.value,
+                [str(receiver) for receiver in receivers],
+                max_messages, max_bytes,
+                [feature.value for feature in self._features]]
+        encoded_request = msgpack.packb(request, use_bin_type=True)
+        with self._mutex:
+            frame, profile = self._transport_client.call(
+                    encoded_request, timeout_handler)
+            messages = split_batch(frame)
+            chunked = parse_chunked_descriptor(messages[0][1])
+            if chunked is not None:
+                messages[0] = 0, self._receive_chunked(*chunked)
+                profile = profile[0], profile[1], ProfileTimestamp()
+        return messages, profile
 
     def close(self) -> None:
         """Closes this client.
@@ -62,3 +193,131 @@ class MPPClient:
         other shutdown activities.
         """
         self._transport_client.close()
+        for stripe in self._stripes:
+            stripe.close()
+        if self._stripe_pool is not None:
+            self._stripe_pool.shutdown()
+
+    def _receive_chunked(
+            self, transfer_id: int, size: int, placer: Optional[Placer] = None
+            ) -> memoryview:
+        """Fetches a large message in chunks.
+
+        Must be called with the mutex held.
+
+        Args:
+            transfer_id: Id of the transfer, from the descriptor.
+            size: Size of the message's frame.
+            placer: Optional placer deciding where to receive parts of the
+                    message.
+
+        Returns:
+            The message's frame.
+        """
+        frame = aligned_buffer(size)
+        progress = _Progress(transfer_id, size)
+        if placer is None:
+            self._fetch_chunks(transfer_id, 0, frame, progress)
+            return frame
+
+        received = 0
+        while received < size:
+            end, target = placer(frame, received)
+            target_size = 0 if target is None else len(target)
+            if not received <= end < end + target_size <= size and not (
+                    received < end <= size and target is None):
+                raise RuntimeError('Invalid placement of received data')
+
+            self._fetch_chunks(
+                    transfer_id, received, frame[received:end], progress)
+            if target is not None:
+                self._fetch_chunks(transfer_id, end, target, progress)
+            received = end + target_size
+        return frame
+
+    def _fetch_chunks(
+            self, transfer_id: int, offset: int, target: memoryview,
+            progress: '_Progress') -> None:
+        """Fetches part of a large message into the given buffer.
+
+        The part is fetched in chunks, over several connections at once if
+        it is large enough.
+
+        Args:
+            transfer_id: Id of the transfer, from the descriptor.
+            offset: Offset of the part within the message.
+            target: Buffer to receive the part into.
+            progress: Tracks the progress of the whole message.
+        """
+        starts = deque(range(0, len(target), _CHUNK_SIZE))
+
+        def fetch(client: TransportClient) -> None:
+            try:
+                while starts:
+                    start = starts.popleft()
+                    chunk = target[start:start + _CHUNK_SIZE]
+                    request = msgpack.packb([
+                            RequestType.GET_CHUNK.value, transfer_id,
+                            offset + start, len(chunk)])
+                    client.call(request, None, lambda _, __: (0, chunk))
+                    progress.add(len(chunk))
+            except IndexError:
+                pass
+            except Exception:
+                # don't let the other connections continue in vain
+                starts.clear()
+                raise
+
+        if len(starts) <= 1:
+            fetch(self._transport_client)
+            return
+
+        if self._stripe_pool is None:
+            self._stripes = [
+                    self._client_type(self._location)
+                    for _ in range(_STRIPES - 1)]
+            self._stripe_pool = ThreadPoolExecutor(
+                    len(self._stripes), thread_name_prefix='MPPStripe')
+
+        futures = [
+                self._stripe_pool.submit(fetch, stripe)
+                for stripe in self._stripes]
+        try:
+            fetch(self._transport_client)
+        finally:
+            wait(futures)
+        for future in futures:
+            future.result()
+
+
+class _Progress:
+    """Logs the progress of fetching a large message."""
+    def __init__(self, transfer_id: int, size: int) -> None:
+        """Create a _Progress.
+
+        Args:
+            transfer_id: Id of the transfer.
+            size: Size of the message in bytes.
+        """
+        self._transfer_id = transfer_id
+        self._size = size
+        self._received = 0
+        self._reported = 0
+        self._lock = Lock()
+        _logger.debug(
+                'Receiving message %d of %d bytes in chunks', transfer_id, size)
+
+    def add(self, nbytes: int) -> None:
+        """Records that a number of bytes have been received.
+
+        Args:
+            nbytes: Number of bytes received.
+        """
+        with self._lock:
+            self._received += nbytes
+            percent = self._received * 100 // self._size
+            if percent >= self._reported + 10:
+                self._reported = percent - percent % 10
+                _logger.debug(
+                        'Received %d%% of message %d', self._reported,
+                        self._transfer_id)
@@ -1,5 +1,9 @@
 from enum import IntEnum
-from typing import Any, cast, Optional
+from itertools import count
+import struct
+from typing import (
+        Any, Callable, cast, Collection, Dict, List, Literal, Optional, Sequence,
+        Tuple)
 from typing_extensions import Buffer
 
 import msgpack
@@ -7,7 +11,9 @@ import numpy as np
 
 from ymmsl.v0_2 import Reference, Settings
 
+from libmuscle.compression import Codec, CompressedBuffer, Compressor
 from libmuscle.grid import Grid
+from libmuscle.mcp.protocol import MPPFeature
 
 
 class ExtTypeId(IntEnum):
@@ -24,14 +30,57 @@ class ExtTypeId(IntEnum):
     GRID_FLOAT32 = 4
     GRID_FLOAT64 = 5
     GRID_BOOL = 6
+    GRID_INT8 = 7
+    GRID_INT16 = 8
+    GRID_UINT8 = 9
+    GRID_UINT16 = 10
+    GRID_UINT32 = 11
+    GRID_UINT64 = 12
+    GRID_FLOAT16 = 13
+    GRID_COMPLEX64 = 14
+    GRID_COMPLEX128 = 15
+    GRID_SPARSE = 16
+    GRID_DELTA = 17
+    GRID_BUNDLE = 18
 
 
-_grid_types = {
-        ExtTypeId.GRID_INT32,
-        ExtTypeId.GRID_INT64,
-        ExtTypeId.GRID_FLOAT32,
-        ExtTypeId.GRID_FLOAT64,
-        ExtTypeId.GRID_BOOL}
+_grid_dtypes: Dict[ExtTypeId, np.dtype] = {
+        ExtTypeId.GRID_INT8: np.dtype(np.int8),
+        ExtTypeId.GRID_INT16: np.dtype(np.int16),
+        ExtTypeId.GRID_INT32: np.dtype(np.int32),
+        ExtTypeId.GRID_INT64: np.dtype(np.int64),
+        ExtTypeId.GRID_UINT8: np.dtype(np.uint8),
+        ExtTypeId.GRID_UINT16: np.dtype(np.uint16),
+        ExtTypeId.GRID_UINT32: np.dtype(np.uint32),
+        ExtTypeId.GRID_UINT64: np.dtype(np.uint64),
+        ExtTypeId.GRID_FLOAT16: np.dtype(np.float16),
+        ExtTypeId.GRID_FLOAT32: np.dtype(np.float32),
+        ExtTypeId.GRID_FLOAT64: np.dtype(np.float64),
+        ExtTypeId.GRID_COMPLEX64: np.dtype(np.complex64),
+        ExtTypeId.GRID_COMPLEX128: np.dtype(np.complex128),
+        ExtTypeId.GRID_BOOL: np.dtype(np.bool_)}
+"""Element type of the array for each grid extension type id."""
+
+
+_grid_ext_types = {str(dtype): code for code, dtype in _grid_dtypes.items()}
+"""Grid extension type id for each array element type name."""
+
+
+_grid_dtype_types = {dtype: code for code, dtype in _grid_dtypes.items()}
+"""Grid extension type id for each array element type."""
+
+
+_grid_types = set(_grid_dtypes)
+
+
+_array_ext_types = _grid_types | {ExtTypeId.GRID_SPARSE, ExtTypeId.GRID_DELTA}
+"""Extension types that may refer to out-of-band buffers."""
+
+
+_order_map: Dict[str, Literal['C', 'F']] = {
+        'fa': 'F',
+        'la': 'C'}
+"""NumPy order for each wire order."""
 
 
 class ClosePort:
@@ -46,16 +95,118 @@ class ClosePort:
     pass
 
 
-def _encode_grid(grid: Grid) -> msgpack.ExtType:
+_ALIGNMENT = 64
+"""Alignment in bytes of out-of-band buffers within a frame."""
+
+
+_OOB_MAGIC = b'\xc1MP\x02'
+"""Marks a frame as an out-of-band message.
+
+0xc1 is never used by MessagePack, so this cannot be mistaken for the
+start of an in-band message.
+"""
+
+
+_OOB_PREFIX = struct.Struct('<4sII4xQQ')
+"""Magic, number of buffers, flags, envelope length, body length."""
+
+
+_HAS_DELTAS = 1
+"""Flag in the out-of-band prefix marking data with delta grids in it."""
+
+
+_OOB_BUFFER_ENTRY = struct.Struct('<QQ')
+"""Offset and size of an out-of-band buffer."""
+
+
+_OOB_COMPRESSED_MAGIC = b'\xc1MP\x03'
+"""Marks a frame as an out-of-band message with compressed buffers.
+
+These have the same prefix, but use _OOB_COMPRESSED_BUFFER_ENTRY.
+"""
+
+
+_OOB_COMPRESSED_BUFFER_ENTRY = struct.Struct('<QQQB7x')
+"""Offset, size, decompressed size and codec of an out-of-band buffer."""
+
+
+_BATCH_MAGIC = b'\xc1MPB'
+"""Marks a frame as a batch of out-of-band messages."""
+
+
+_BATCH_PREFIX = struct.Struct('<4sI')
+"""Magic and number of messages."""
+
+
+_BATCH_ENTRY = struct.Struct('<I4xQQ')
+"""Receiver index, offset and size of a message in a batch."""
+
+
+_CHUNKED_MAGIC = b'\xc1MPC'
+"""Marks a frame as describing a message that is to be fetched in chunks."""
+
+
+_CHUNKED_DESCRIPTOR = struct.Struct('<4s4xQQ')
+"""Magic, transfer id and size of a message to be fetched in chunks."""
+
+
+_COMPACT_ENVELOPE = struct.Struct('<BBHIQddd')
+"""Marker, version, flags, port length, message number and timestamps.
+
+This is used instead of a MessagePack map for receivers that support it.
+The marker is 0xc1, which MessagePack never uses, so that the two can be
+told apart. The timestamps are the timestamp, the next timestamp and the
+saved_until field. If there is a settings overlay, then it follows as
+MessagePack, unless it is the same as in the previous message to the same
+receiver.
+"""
+
+
+_COMPACT_MARKER = 0xc1
+
+
+_COMPACT_VERSION = 1
+
+
+_HAS_PORT_LENGTH = 1
+_HAS_NEXT_TIMESTAMP = 2
+_HAS_SETTINGS_OVERLAY = 4
+_SAME_SETTINGS_OVERLAY = 8
+"""Flags in a compact envelope, saying which optional fields are set."""
+
+
+_UNKNOWN_ENDPOINT = Reference('_')
+"""Sender and receiver of messages received with a compact envelope."""
+
+
+_NOT_DECODED = object()
+"""Data of a received message that has not been decoded yet."""
+
+
+def _padding(offset: int) -> int:
+    """Returns the number of bytes needed to align the given offset."""
+    return -offset % _ALIGNMENT
+
+
+def _encode_grid(
+        grid: Grid, buffers: Optional[List[memoryview]] = None,
+        deltas: Optional['DeltaReferences'] = None, position: int = 0
+        ) -> msgpack.ExtType:
     """Encodes a Grid object into the wire format.
-    """
-    ext_type_map = {
-            'int32': ExtTypeId.GRID_INT32,
-            'int64': ExtTypeId.GRID_INT64,
-            'float32': ExtTypeId.GRID_FLOAT32,
-            'float64': ExtTypeId.GRID_FLOAT64,
-            'bool': ExtTypeId.GRID_BOOL}
 
+    If buffers is given, then the array data is not put in-band. Instead,
+    a copy of it is appended to buffers, and its index is sent instead.
+
+    Sparse grids are sent as their non-zero elements if that is smaller.
+    Delta grids are sent as the elements that changed if deltas is given,
+    and as ordinary grids otherwise.
+
+    Args:
+        grid: The grid to encode.
+        buffers: List of out-of-band buffers to add to, if any.
+        deltas: References for delta grids, if any.
+        position: Number of this delta grid in the message.
+    """
     array = grid.array
     if array.flags.f_contiguous:
         # indexes that differ in the first place are adjacent
@@ -70,47 +221,419 @@ def _encode_grid(grid: Grid) -> msgpack.ExtType:
     else:
         array_type = str(np.dtype(array_type))
 
-    if array_type not in ext_type_map:
+    if array_type not in _grid_ext_types:
         raise RuntimeError('Unsupported array data type')
 
-    buf = array.tobytes(order='A')
-
-    # array_type is redundant, but useful metadata.
-    grid_dict = {
+    # array_type is redundant for ordinary grids, but useful metadata.
+    grid_dict: Dict[str, Any] = {
             'type': array_type,
             'shape': list(array.shape),
-            'order': order,
-            'data': buf,
-            'indexes': grid.indexes}
+            'order': order}
+
+    code = _grid_ext_types[array_type]
+    if grid.encoding == 'delta' and deltas is not None:
+        code = ExtTypeId.GRID_DELTA
+        grid_dict.update(deltas.encode(position, array, buffers))
+    elif grid.encoding == 'sparse' and _is_sparse(
+            int(np.count_nonzero(array)), array):
+        code = ExtTypeId.GRID_SPARSE
+        flat = array.reshape(-1, order='A')
+        grid_dict.update(_encode_elements(flat, np.flatnonzero(flat), buffers))
+    elif buffers is None:
+        grid_dict['data'] = array.tobytes(order='A')
+    else:
+        # We copy once here so that the user can modify the array after
+        # sending, and then send the copy straight from memory.
+        snapshot = array.copy(order='A').reshape(-1, order='A')
+        grid_dict['data'] = _encode_array(snapshot, buffers)
+
+    grid_dict['indexes'] = grid.indexes
     packed_data = msgpack.packb(grid_dict, use_bin_type=True)
-    return msgpack.ExtType(ext_type_map[array_type], packed_data)
+    return msgpack.ExtType(code, packed_data)
 
 
-def _decode_grid(code: int, data: Buffer) -> Grid:
-    """Creates a Grid from serialised data.
+def _encode_array(array: np.ndarray, buffers: Optional[List[memoryview]]) -> Any:
+    """Encodes the data of a one-dimensional array.
+
+    If buffers is given, then the array is appended to it, and must not
+    be modified afterwards.
+
+    Args:
+        array: The array to encode.
+        buffers: List of out-of-band buffers to add to, if any.
+
+    Returns:
+        The data as bytes, or the index of the buffer.
+    """
+    if buffers is None:
+        return array.tobytes()
+    buffers.append(array.view(np.uint8).data.toreadonly())
+    return len(buffers) - 1
+
+
+def _index_type(size: int) -> np.dtype:
+    """Returns the type of the positions of elements in an array."""
+    return np.dtype(np.uint32 if size <= 2**32 else np.uint64)
+
+
+def _is_sparse(num_elements: int, array: np.ndarray) -> bool:
+    """Returns whether sending some elements is smaller than the array.
+
+    Args:
+        num_elements: Number of elements to send.
+        array: The whole array.
+    """
+    element_size = array.itemsize + _index_type(array.size).itemsize
+    return num_elements * element_size < array.nbytes
+
+
+def _encode_elements(
+        flat: np.ndarray, positions: np.ndarray,
+        buffers: Optional[List[memoryview]]) -> Dict[str, Any]:
+    """Encodes some of the elements of an array.
+
+    Args:
+        flat: The array, flattened in memory order.
+        positions: Positions in flat of the elements to encode.
+        buffers: List of out-of-band buffers to add to, if any.
+
+    Returns:
+        The fields to add to the grid dict.
+    """
+    index_type = _index_type(flat.size)
+    return {
+            'index_type': str(index_type),
+            'index': _encode_array(positions.astype(index_type), buffers),
+            'data': _encode_array(flat[positions], buffers)}
+
+
+def _decode_elements(
+        flat: np.ndarray, grid_dict: Dict[str, Any],
+        buffers: Sequence[memoryview]) -> None:
+    """Puts elements encoded by _encode_elements() into an array.
+
+    Args:
+        flat: The array, flattened in memory order.
+        grid_dict: The decoded grid dict.
+        buffers: Out-of-band buffers received with the message, if any.
     """
-    type_map = {
-            ExtTypeId.GRID_INT32: np.int32,
-            ExtTypeId.GRID_INT64: np.int64,
-            ExtTypeId.GRID_FLOAT32: np.float32,
-            ExtTypeId.GRID_FLOAT64: np.float64,
-            ExtTypeId.GRID_BOOL: np.bool_}
+    index_type = _index_type(flat.size)
+    if grid_dict['index_type'] != str(index_type):
+        raise RuntimeError('Received a grid with invalid element positions')
+    index = np.frombuffer(
+            _array_data(grid_dict['index'], buffers), index_type)
+    flat[index] = np.frombuffer(
+            _array_data(grid_dict['data'], buffers), flat.dtype)
+
+
+def _array_data(data: Any, buffers: Sequence[memoryview]) -> Any:
+    """Returns array data encoded by _encode_array()."""
+    if isinstance(data, int):
+        return buffers[data]
+    return data
+
+
+def _decode_grid(
+        code: int, data: Buffer, buffers: Sequence[memoryview] = ()) -> Grid:
+    """Creates a Grid from serialised data.
 
-    order_map = {
-            'fa': 'F',
-            'la': 'C'}
+    If the array data was sent out-of-band, then the resulting array is
+    a view of the corresponding buffer, rather than a copy.
 
+    Args:
+        code: The extension type id.
+        data: The encoded grid.
+        buffers: Out-of-band buffers received with the message, if any.
+    """
     grid_dict = msgpack.unpackb(data, raw=False)
-    order = order_map[grid_dict['order']]
+    order = _order_map[grid_dict['order']]
     shape = tuple(grid_dict['shape'])
-    dtype = type_map[ExtTypeId(code)]
-    array = np.ndarray(shape, dtype, grid_dict['data'], order=order)  # type: ignore
+    dtype = _grid_dtypes[ExtTypeId(code)]
+    array_data = _array_data(grid_dict['data'], buffers)
+    array = np.ndarray(shape, dtype, array_data, order=order)  # type: ignore
     indexes = grid_dict['indexes']
     if indexes == []:
         indexes = None
     return Grid(array, indexes)
 
 
+def _decode_sparse_grid(data: Buffer, buffers: Sequence[memoryview] = ()) -> Grid:
+    """Creates a Grid from a serialised sparse grid.
+
+    Args:
+        data: The encoded grid.
+        buffers: Out-of-band buffers received with the message, if any.
+    """
+    grid_dict = msgpack.unpackb(data, raw=False)
+    dtype = _grid_dtypes[_grid_ext_types[grid_dict['type']]]
+    shape = tuple(grid_dict['shape'])
+    flat = np.zeros(int(np.prod(shape)), dtype)
+    _decode_elements(flat, grid_dict, buffers)
+    array = flat.reshape(shape, order=_order_map[grid_dict['order']])
+    return Grid(array, grid_dict['indexes'] or None)
+
+
+class DeltaReferences:
+    """The arrays that delta grids sent on a port and slot refer to.
+
+    The sender and the receiver each keep the array that was last sent
+    in each delta grid, so that the next one can be sent as the elements
+    that changed. Delta grids are numbered by their position in the
+    message data, and each array sent gets a sequence number, so that
+    the receiver can check that it has the right reference.
+    """
+    def __init__(self) -> None:
+        """Create a DeltaReferences without any references."""
+        # indexed by position, sequence number and array
+        self._references: Dict[int, Tuple[int, np.ndarray]] = {}
+
+    def encode(
+            self, position: int, array: np.ndarray,
+            buffers: Optional[List[memoryview]]) -> Dict[str, Any]:
+        """Encodes an array as the changes to its reference.
+
+        The array is sent in full if there is no compatible reference, or
+        if too many elements changed. Either way, a copy of it becomes the
+        new reference.
+
+        Args:
+            position: Number of the delta grid in the message.
+            array: The array to encode.
+            buffers: List of out-of-band buffers to add to, if any.
+
+        Returns:
+            The fields to add to the grid dict.
+        """
+        snapshot = array.copy(order='A')
+        flat = snapshot.reshape(-1, order='A')
+        seq = 0
+        fields: Dict[str, Any] = {'base': None}
+
+        reference = self._references.get(position)
+        if reference is not None:
+            ref_seq, ref_array = reference
+            seq = ref_seq + 1
+            if (
+                    ref_array.shape == snapshot.shape and
+                    ref_array.dtype == snapshot.dtype and
+                    ref_array.flags.f_contiguous == snapshot.flags.f_contiguous):
+                changed = np.flatnonzero(flat != ref_array.reshape(-1, order='A'))
+                if _is_sparse(len(changed), snapshot):
+                    fields['base'] = ref_seq
+                    fields.update(_encode_elements(flat, changed, buffers))
+
+        if fields['base'] is None:
+            # The reference is never modified, so it can be sent as is.
+            fields['data'] = _encode_array(flat, buffers)
+
+        fields['seq'] = seq
+        self._references[position] = seq, snapshot
+        return fields
+
+    def decode(
+            self, position: int, grid_dict: Dict[str, Any],
+            buffers: Sequence[memoryview]) -> np.ndarray:
+        """Decodes an array sent by :meth:`encode`.
+
+        The result is a read-only copy, which becomes the new reference.
+
+        Args:
+            position: Number of the delta grid in the message.
+            grid_dict: The decoded grid dict.
+            buffers: Out-of-band buffers received with the message, if any.
+
+        Raises:
+            RuntimeError: If the array refers to a reference we don't have.
+        """
+        dtype = _grid_dtypes[_grid_ext_types[grid_dict['type']]]
+        shape = tuple(grid_dict['shape'])
+        order = _order_map[grid_dict['order']]
+
+        if grid_dict['base'] is None:
+            flat = np.frombuffer(_array_data(grid_dict['data'], buffers), dtype)
+            array: np.ndarray = flat.reshape(shape, order=order).copy(order='A')
+        else:
+            reference = self._references.get(position)
+            if (
+                    reference is None or reference[0] != grid_dict['base'] or
+                    reference[1].shape != shape or reference[1].dtype != dtype):
+                raise RuntimeError(
+                        'Received the changes to an array, but not the array'
+                        ' itself. Were the sender and receiver restarted'
+                        ' separately?')
+            array = reference[1].copy(order='A')
+            _decode_elements(array.reshape(-1, order='A'), grid_dict, buffers)
+
+        array.flags.writeable = False
+        self._references[position] = grid_dict['seq'], array
+        return array
+
+    def reference(self, position: int) -> np.ndarray:
+        """Returns the current reference of a delta grid.
+
+        This is the array that was last encoded or decoded, which is
+        never modified.
+
+        Args:
+            position: Number of the delta grid in the message.
+        """
+        return self._references[position][1]
+
+
+def _decode_delta_grid(
+        data: Buffer, buffers: Sequence[memoryview],
+        deltas: Optional[DeltaReferences], position: int) -> Grid:
+    """Creates a Grid from a serialised delta grid.
+
+    Args:
+        data: The encoded grid.
+        buffers: Out-of-band buffers received with the message, if any.
+        deltas: References for delta grids.
+        position: Number of this delta grid in the message.
+    """
+    if deltas is None:
+        raise RuntimeError(
+                'Delta grids can only be decoded when receiving a message')
+    grid_dict = msgpack.unpackb(data, raw=False)
+    array = deltas.decode(position, grid_dict, buffers)
+    return Grid(array, grid_dict['indexes'] or None)
+
+
+_MIN_BUNDLE_SIZE = 4
+"""Minimum number of arrays in a dict for them to be sent as a bundle."""
+
+
+_MAX_BUNDLED_NBYTES = 65536
+"""Size in bytes of the largest array that is put in a bundle.
+
+For larger arrays, the overhead of sending them separately is small, and
+doing so lets them be compressed separately.
+"""
+
+
+class _Bundle:
+    """Wraps a dict whose small arrays are to be sent together.
+
+    Attributes:
+        items: The dict.
+    """
+    def __init__(self, items: Dict[Any, Any]) -> None:
+        self.items = items
+
+
+def _in_bundle(value: Any) -> bool:
+    """Returns whether a value can be put in a bundle."""
+    if isinstance(value, Grid):
+        if value.encoding != 'dense':
+            return False
+        value = value.array
+    return (
+            isinstance(value, np.ndarray) and
+            value.nbytes <= _MAX_BUNDLED_NBYTES and
+            value.dtype in _grid_dtype_types)
+
+
+def _bundled(data: Any) -> Any:
+    """Wraps data in a _Bundle, if it is a dict with enough arrays.
+
+    Args:
+        data: Message data to send.
+    """
+    if isinstance(data, dict):
+        if sum(map(_in_bundle, data.values())) >= _MIN_BUNDLE_SIZE:
+            return _Bundle(data)
+    return data
+
+
+def _encode_bundle(
+        bundle: _Bundle, buffers: List[memoryview],
+        encoder: Callable[[Any], Any]) -> msgpack.ExtType:
+    """Encodes a dict with the small arrays in it in a single buffer.
+
+    The arrays are copied into the buffer one after the other, each at
+    an aligned offset. The buffer is described by a table containing,
+    for each array, its position in the dict, its extension type id,
+    whether it is in Fortran order, its offset, its number of dimensions
+    and its shape. The other values are encoded as usual.
+
+    Args:
+        bundle: The dict to encode.
+        buffers: List of out-of-band buffers to add the buffer to.
+        encoder: Encoder for the other values.
+    """
+    table: List[int] = []
+    grids: List[Tuple[int, Grid]] = []
+    values: List[Any] = []
+    size = 0
+    for position, value in enumerate(bundle.items.values()):
+        if not _in_bundle(value):
+            values.append(value)
+            continue
+        grid = value if isinstance(value, Grid) else Grid(value)
+        array = grid.array
+        size += _padding(size)
+        table.extend((
+                position, _grid_dtype_types[array.dtype],
+                int(array.flags.f_contiguous), size, array.ndim))
+        table.extend(array.shape)
+        grids.append((size, grid))
+        size += array.nbytes
+
+    payload = np.zeros(size, np.uint8)
+    for offset, grid in grids:
+        array = grid.array
+        order = 'F' if array.flags.f_contiguous else 'C'
+        target = np.ndarray(
+                array.shape, array.dtype, payload.data, offset,
+                order=order)  # type: ignore
+        np.copyto(target, array)
+
+    bundle_dict: Dict[str, Any] = {
+            'keys': list(bundle.items),
+            'table': table,
+            'data': _encode_array(payload, buffers),
+            'values': values}
+    if any(grid.indexes for _, grid in grids):
+        bundle_dict['indexes'] = [grid.indexes for _, grid in grids]
+
+    packed_data = msgpack.packb(bundle_dict, default=encoder, use_bin_type=True)
+    return msgpack.ExtType(ExtTypeId.GRID_BUNDLE, packed_data)
+
+
+def _decode_bundle(
+        data: Buffer, buffers: Sequence[memoryview],
+        ext_hook: Callable[[int, Buffer], Any]) -> Dict[Any, Any]:
+    """Decodes a dict encoded by _encode_bundle().
+
+    The arrays in the result are views of the received buffer.
+
+    Args:
+        data: The encoded bundle.
+        buffers: Out-of-band buffers received with the message.
+        ext_hook: Decoder for the other values.
+    """
+    bundle_dict = msgpack.unpackb(data, ext_hook=ext_hook, raw=False)
+    payload = _array_data(bundle_dict['data'], buffers)
+    table = bundle_dict['table']
+    indexes = bundle_dict.get('indexes')
+
+    grids: Dict[int, Grid] = {}
+    i = 0
+    while i < len(table):
+        position, code, fortran, offset, ndim = table[i:i + 5]
+        shape = tuple(table[i + 5:i + 5 + ndim])
+        array = np.ndarray(
+                shape, _grid_dtypes[code], payload, offset,
+                order='F' if fortran else 'C')  # type: ignore
+        grids[position] = Grid(array, indexes[len(grids)] if indexes else None)
+        i += 5 + ndim
+
+    values = iter(bundle_dict['values'])
+    return {
+            key: grids[position] if position in grids else next(values)
+            for position, key in enumerate(bundle_dict['keys'])}
+
+
 def _data_encoder(obj: Any) -> Any:
     """Encodes custom objects for MessagePack.
 
@@ -130,17 +653,536 @@ def _data_encoder(obj: Any) -> Any:
     return obj
 
 
-def _ext_decoder(code: int, data: Buffer) -> msgpack.ExtType:
+class _OutOfBandEncoder:
+    """Encodes custom objects, putting grid data into out-of-band buffers.
+
+    Attributes:
+        delta_arrays: The arrays of the grids encoded as deltas so far.
+    """
+    def __init__(
+            self, buffers: List[memoryview],
+            deltas: Optional[DeltaReferences] = None) -> None:
+        """Create an _OutOfBandEncoder.
+
+        Args:
+            buffers: List to append the buffers to.
+            deltas: References for delta grids, if any.
+        """
+        self._buffers = buffers
+        self._deltas = deltas
+        self._positions = count()
+        self.delta_arrays: List[np.ndarray] = []
+
+    def __call__(self, obj: Any) -> Any:
+        if isinstance(obj, np.ndarray):
+            return _encode_grid(Grid(obj), self._buffers)
+        elif isinstance(obj, Grid):
+            position = next(self._positions) if obj.encoding == 'delta' else 0
+            ext = _encode_grid(obj, self._buffers, self._deltas, position)
+            if ext.code == ExtTypeId.GRID_DELTA:
+                assert self._deltas is not None     # mypy
+                self.delta_arrays.append(self._deltas.reference(position))
+            return ext
+        elif isinstance(obj, _Bundle):
+            return _encode_bundle(obj, self._buffers, self)
+        return _data_encoder(obj)
+
+
+def _ext_decoder(
+        code: int, data: Buffer, buffers: Sequence[memoryview] = ()
+        ) -> msgpack.ExtType:
     if code == ExtTypeId.CLOSE_PORT:
         return ClosePort()
     elif code == ExtTypeId.SETTINGS:
         plain_dict = msgpack.unpackb(data, raw=False)
         return Settings(plain_dict)
     elif code in _grid_types:
-        return _decode_grid(code, data)
+        return _decode_grid(code, data, buffers)
+    elif code == ExtTypeId.GRID_SPARSE:
+        return _decode_sparse_grid(data, buffers)
+    return msgpack.ExtType(code, data)
+
+
+def _in_band_ext(
+        code: int, data: Buffer, buffers: Sequence[memoryview],
+        next_delta: Callable[[], np.ndarray]) -> Any:
+    """Converts an out-of-band grid extension value to in-band.
+
+    Bundles are converted back into a dict of ordinary grids, and sparse
+    and delta grids into ordinary grids, which all peers understand.
+    Other extension values are passed through unchanged.
+
+    Args:
+        code: The extension type id.
+        data: The encoded value.
+        buffers: Out-of-band buffers referred to by the value.
+        next_delta: Returns the array of the next delta grid.
+    """
+    if code == ExtTypeId.GRID_BUNDLE:
+        def ext_hook(code: int, data: Buffer) -> Any:
+            return _in_band_ext(code, data, buffers, next_delta)
+
+        bundle = _decode_bundle(data, buffers, ext_hook)
+        return {
+                key: _encode_grid(value) if isinstance(value, Grid) else value
+                for key, value in bundle.items()}
+
+    if code == ExtTypeId.GRID_SPARSE:
+        return _encode_grid(_decode_sparse_grid(data, buffers))
+
+    if code == ExtTypeId.GRID_DELTA:
+        indexes = msgpack.unpackb(data, raw=False)['indexes']
+        return _encode_grid(Grid(next_delta(), indexes or None))
+
+    if code in _array_ext_types:
+        grid_dict = msgpack.unpackb(data, raw=False)
+        keys = [key for key in ('index', 'data') if key in grid_dict]
+        if any(isinstance(grid_dict[key], int) for key in keys):
+            for key in keys:
+                grid_dict[key] = _array_data(grid_dict[key], buffers)
+            data = cast(bytes, msgpack.packb(grid_dict, use_bin_type=True))
     return msgpack.ExtType(code, data)
 
 
+class EncodedData:
+    """Message data encoded for transmission.
+
+    This is the part of an encoded message that does not depend on the
+    receiver, so that it can be shared between messages sent to different
+    receivers. Any grids in the data have their array contents stored
+    separately in out-of-band buffers, so that they can be sent straight
+    from memory, without copying them into a single large buffer first.
+
+    Received messages keep their data in this form until it is used, so
+    that it can be forwarded without decoding and encoding it again.
+
+    The buffers may also be available in compressed form, in which case
+    that is what is sent to receivers that support it. Received compressed
+    buffers are decompressed when they are first used.
+
+    Attributes:
+        body: MessagePack-encoded message data.
+        compressed: The out-of-band buffers in compressed form, if any.
+        has_deltas: Whether the data contains any delta grids. These must
+                be decoded in the order in which they were received.
+        delta_arrays: The arrays of the delta grids in the data, in order,
+                if it was encoded here. These are needed to send them to
+                receivers that do not support out-of-band data.
+        shared: Whether the data has been sent on. If so, the buffers may
+                still be waiting to be sent, and must not be modified.
+    """
+    def __init__(
+            self, body: Buffer, buffers: Optional[List[memoryview]],
+            compressed: Optional[List[CompressedBuffer]] = None,
+            has_deltas: bool = False) -> None:
+        """Create an EncodedData.
+
+        Args:
+            body: MessagePack-encoded message data.
+            buffers: Out-of-band buffers referred to by body, or None if
+                    they are only available compressed.
+            compressed: The buffers in compressed form, if available.
+            has_deltas: Whether the data contains any delta grids.
+        """
+        self.body = body
+        self._buffers = buffers
+        self.compressed = compressed
+        self.has_deltas = has_deltas
+        self.delta_arrays: List[np.ndarray] = []
+        self.shared = False
+        self._in_band: Optional[bytes] = None
+        self._is_close_port: Optional[bool] = None
+
+    @property
+    def buffers(self) -> List[memoryview]:
+        """Out-of-band buffers referred to by body.
+
+        If the buffers were received compressed, then they are
+        decompressed when this is first used.
+        """
+        self.decompress()
+        assert self._buffers is not None    # mypy
+        return self._buffers
+
+    def decompress(self) -> None:
+        """Decompresses the buffers, if they haven't been already.
+
+        This is done automatically when the buffers are first used, but
+        can be done up front using this function.
+        """
+        if self._buffers is None:
+            assert self.compressed is not None
+            self._buffers = [buf.decompressed() for buf in self.compressed]
+
+    @property
+    def compression_savings(self) -> int:
+        """Number of bytes saved by compressing the buffers."""
+        if self.compressed is None:
+            return 0
+        return sum(
+                buf.size - memoryview(buf.data).nbytes for buf in self.compressed)
+
+    def compress(self, compressor: Compressor) -> None:
+        """Compresses the buffers, if they aren't already.
+
+        Args:
+            compressor: The compressor to use.
+        """
+        if self.compressed is None and self.buffers:
+            self.compressed = [compressor.compress(buf) for buf in self.buffers]
+
+    def decoded(self, deltas: Optional[DeltaReferences] = None) -> Any:
+        """Decodes the data.
+
+        Grids in the result refer to the buffers rather than to a copy,
+        unless the data is shared.
+
+        Args:
+            deltas: References for delta grids, needed if there are any.
+        """
+        buffers = self.buffers
+        if self.shared:
+            buffers = [np.frombuffer(buf, np.uint8).copy().data for buf in buffers]
+        positions = count()
+
+        def ext_hook(code: int, data: Buffer) -> Any:
+            if code == ExtTypeId.GRID_DELTA:
+                return _decode_delta_grid(data, buffers, deltas, next(positions))
+            elif code == ExtTypeId.GRID_BUNDLE:
+                return _decode_bundle(data, buffers, ext_hook)
+            return _ext_decoder(code, data, buffers)
+
+        return msgpack.unpackb(self.body, ext_hook=ext_hook, raw=False)
+
+    def is_close_port(self) -> bool:
+        """Returns whether this is an encoded ClosePort.
+
+        This does not decode anything but the smallest of objects, so it is
+        cheap to call on large data. The result is cached.
+        """
+        if self._is_close_port is None:
+            # ClosePort is an empty extension object, which takes at most 6
+            # bytes
+            self._is_close_port = (
+                    memoryview(self.body).nbytes <= 6 and
+                    isinstance(self.decoded(), ClosePort))
+        return self._is_close_port
+
+    def in_band(self) -> bytes:
+        """Returns the data encoded with the grid contents in-band.
+
+        The result is cached, so that it's only converted once.
+        """
+        if self._in_band is None:
+            if self.buffers:
+                next_delta = iter(self.delta_arrays).__next__
+
+                def ext_hook(code: int, data: Buffer) -> Any:
+                    return _in_band_ext(code, data, self.buffers, next_delta)
+
+                data = msgpack.unpackb(
+                        self.body, ext_hook=ext_hook, raw=False,
+                        strict_map_key=False)
+                self._in_band = cast(bytes, msgpack.packb(data, use_bin_type=True))
+            else:
+                self._in_band = bytes(self.body)
+
+        return self._in_band
+
+
+class EncodedMessage:
+    """An MPPMessage encoded for transmission.
+
+    This contains the encoded message header fields (the envelope) and the
+    encoded data. Messages with the same contents sent to different
+    receivers have different envelopes, but share their data.
+
+    Peers that support it receive this as an out-of-band frame, which is
+    produced by :meth:`frame`. For peers that don't, the old in-band format
+    can be produced using :meth:`in_band`.
+    """
+    def __init__(
+            self, envelope: bytes, data: EncodedData,
+            compact_envelope: Optional[bytes] = None,
+            settings_overlay: Optional[bytes] = None) -> None:
+        """Create an EncodedMessage.
+
+        Args:
+            envelope: MessagePack-encoded map with the header fields.
+            data: The encoded message data.
+            compact_envelope: The header fields without the sender and
+                    receiver, in the compact format, if available.
+            settings_overlay: The encoded settings overlay, if available.
+        """
+        self.envelope = envelope
+        self.data = data
+        self.compact_envelope = compact_envelope
+        self.settings_overlay = settings_overlay
+        # The size, and the compressed buffers it was calculated for, if any
+        self._nbytes: Optional[Tuple[Optional[List[CompressedBuffer]], int]] = None
+
+    @property
+    def nbytes(self) -> int:
+        """Size of the message as an out-of-band frame.
+
+        If the data has been compressed, then this is the compressed size.
+        This is calculated without making the frame, and cached until the
+        data is compressed.
+        """
+        compressed = self.data.compressed
+        if self._nbytes is None or self._nbytes[0] is not compressed:
+            self._nbytes = compressed, self._frame_size()
+        return self._nbytes[1]
+
+    def _frame_size(self) -> int:
+        """Calculates the size of the frame for a peer with all features.
+
+        This matches what :meth:`frame` makes.
+        """
+        envelope = self.envelope
+        if self.compact_envelope is not None:
+            envelope = self.compact_envelope
+
+        if self.data.compressed is not None:
+            entry = _OOB_COMPRESSED_BUFFER_ENTRY
+            sizes = [memoryview(buf.data).nbytes for buf in self.data.compressed]
+        else:
+            entry = _OOB_BUFFER_ENTRY
+            sizes = [buf.nbytes for buf in self.data.buffers]
+
+        size = (
+                _OOB_PREFIX.size + entry.size * len(sizes) + len(envelope) +
+                memoryview(self.data.body).nbytes)
+        for buf_size in sizes:
+            size += _padding(size) + buf_size
+        return size
+
+    def frame(self, features: Collection[str] = ()) -> List[Buffer]:
+        """Returns the message as an out-of-band frame.
+
+        The frame is returned as a list of segments, which are to be sent
+        one after the other. The buffers are placed at aligned offsets
+        within the frame, so that the receiver can use them in place.
+
+        If the data has been compressed with a codec that the receiver
+        supports, then the compressed buffers are sent, together with their
+        codec. If the receiver supports compact headers, then the compact
+        envelope is sent.
+
+        Args:
+            features: The MPP features the receiver supports.
+        """
+        envelope = self.envelope
+        if (
+                self.compact_envelope is not None and
+                MPPFeature.COMPACT_HEADER.value in features):
+            envelope = self.compact_envelope
+
+        body = self.data.body
+        compressed = self.data.compressed
+        if compressed is not None and all(
+                buf.codec == Codec.NONE or buf.codec.feature().value in features
+                for buf in compressed):
+            magic, entry = _OOB_COMPRESSED_MAGIC, _OOB_COMPRESSED_BUFFER_ENTRY
+            buffers = compressed
+        else:
+            magic, entry = _OOB_MAGIC, _OOB_BUFFER_ENTRY
+            buffers = [
+                    CompressedBuffer(Codec.NONE, buf, buf.nbytes)
+                    for buf in self.data.buffers]
+
+        body_size = memoryview(body).nbytes
+        table_size = _OOB_PREFIX.size + entry.size * len(buffers)
+        offset = table_size + len(envelope) + body_size
+
+        flags = _HAS_DELTAS if self.data.has_deltas else 0
+        table = bytearray(table_size)
+        _OOB_PREFIX.pack_into(
+                table, 0, magic, len(buffers), flags, len(envelope), body_size)
+
+        segments: List[Buffer] = [table, envelope, body]
+        for i, buf in enumerate(buffers):
+            padding = _padding(offset)
+            if padding:
+                segments.append(bytes(padding))
+            offset += padding
+            size = memoryview(buf.data).nbytes
+            fields: Tuple[int, ...] = (offset, size)
+            if entry is _OOB_COMPRESSED_BUFFER_ENTRY:
+                fields += (buf.size, buf.codec)
+            entry.pack_into(table, _OOB_PREFIX.size + i * entry.size, *fields)
+            segments.append(buf.data)
+            offset += size
+
+        return segments
+
+    def in_band(self) -> bytes:
+        """Returns the message in the in-band format.
+
+        This is the format produced by :meth:`MPPMessage.encoded`, which all
+        peers understand.
+        """
+        # The envelope is a fixmap with the first eight fields, we
+        # append the data as the ninth.
+        return (
+                b'\x89' + self.envelope[1:] +
+                cast(bytes, msgpack.packb('data')) + self.data.in_band())
+
+
+def batch_frame(messages: Sequence[Tuple[int, List[Buffer]]]) -> List[Buffer]:
+    """Combines several out-of-band frames into a single batch frame.
+
+    Each message is given as the index of its receiver in the request and
+    its frame, as produced by :meth:`EncodedMessage.frame`. The frames are
+    placed at aligned offsets, so that their buffers stay aligned.
+
+    Args:
+        messages: The messages to combine, in order.
+
+    Returns:
+        The batch frame, as a list of segments.
+    """
+    table_size = _BATCH_PREFIX.size + _BATCH_ENTRY.size * len(messages)
+    table = bytearray(table_size)
+    _BATCH_PREFIX.pack_into(table, 0, _BATCH_MAGIC, len(messages))
+
+    segments: List[Buffer] = [table]
+    offset = table_size
+    for i, (index, frame) in enumerate(messages):
+        padding = _padding(offset)
+        if padding:
+            segments.append(bytes(padding))
+        offset += padding
+        size = sum(memoryview(segment).nbytes for segment in frame)
+        _BATCH_ENTRY.pack_into(
+                table, _BATCH_PREFIX.size + i * _BATCH_ENTRY.size,
+                index, offset, size)
+        segments.extend(frame)
+        offset += size
+
+    return segments
+
+
+def split_batch(frame: Buffer) -> List[Tuple[int, memoryview]]:
+    """Splits a batch frame made by :func:`batch_frame`.
+
+    The returned messages refer to the given buffer rather than to a copy.
+
+    Args:
+        frame: The received batch frame.
+
+    Returns:
+        The index of the receiver and the frame of each message, in order.
+    """
+    buf = memoryview(frame)
+    magic, count = _BATCH_PREFIX.unpack_from(buf)
+    if magic != _BATCH_MAGIC:
+        raise RuntimeError('Invalid batch frame received')
+
+    messages = list()
+    for i in range(count):
+        index, offset, size = _BATCH_ENTRY.unpack_from(
+                buf, _BATCH_PREFIX.size + i * _BATCH_ENTRY.size)
+        messages.append((index, buf[offset:offset + size]))
+    return messages
+
+
+def chunked_descriptor(transfer_id: int, size: int) -> bytes:
+    """Makes a frame describing a message to be fetched in chunks.
+
+    This is sent instead of a large message, which the receiver then
+    fetches using GET_CHUNK requests.
+
+    Args:
+        transfer_id: Id under which the sender keeps the message.
+        size: Size of the message's frame in bytes.
+    """
+    return _CHUNKED_DESCRIPTOR.pack(_CHUNKED_MAGIC, transfer_id, size)
+
+
+def parse_chunked_descriptor(frame: Buffer) -> Optional[Tuple[int, int]]:
+    """Reads a frame made by :func:`chunked_descriptor`.
+
+    Args:
+        frame: A received frame.
+
+    Returns:
+        The transfer id and size, or None if this is not a descriptor.
+    """
+    buf = memoryview(frame)
+    if buf.nbytes != _CHUNKED_DESCRIPTOR.size or buf[:4] != _CHUNKED_MAGIC:
+        return None
+    _, transfer_id, size = _CHUNKED_DESCRIPTOR.unpack(buf)
+    return transfer_id, size
+
+
+class BufferPlacer:
+    """Receives the array data of a message into a given buffer.
+
+    This is used as a :data:`libmuscle.mcp.transport_client.Placer`. If
+    the received message is an out-of-band frame with a single,
+    uncompressed buffer of the same size as the target, then that buffer
+    is received straight into the target. The rest of the frame is
+    received as usual, and the part of it where the buffer would have
+    been is left as is.
+
+    Attributes:
+        target: The buffer to receive into.
+        placed: Whether the last message was received into the target.
+    """
+    def __init__(self, target: memoryview) -> None:
+        """Create a BufferPlacer.
+
+        Args:
+            target: The buffer to receive into.
+        """
+        self.target = target
+        self.placed = False
+
+    def __call__(
+            self, frame: memoryview, received: int
+            ) -> Tuple[int, Optional[memoryview]]:
+        """Decides where to receive the next part of the frame.
+
+        Args:
+            frame: The buffer the frame is being received into.
+            received: The number of bytes received so far.
+        """
+        table_size = _OOB_PREFIX.size + _OOB_BUFFER_ENTRY.size
+        if received == 0:
+            self.placed = False
+            return min(_OOB_PREFIX.size, len(frame)), None
+
+        if received == _OOB_PREFIX.size:
+            magic, num_buffers, _, _, _ = _OOB_PREFIX.unpack_from(frame)
+            if magic == _OOB_MAGIC and num_buffers == 1:
+                return min(table_size, len(frame)), None
+
+        elif received == table_size and not self.placed:
+            offset, size = _OOB_BUFFER_ENTRY.unpack_from(frame, _OOB_PREFIX.size)
+            if (
+                    size == self.target.nbytes and size > 0 and
+                    table_size <= offset <= len(frame) - size):
+                self.placed = True
+                return offset, self.target
+
+        return len(frame), None
+
+    def encoded_data(self, data: EncodedData) -> EncodedData:
+        """Returns the data of a received message, with the target in it.
+
+        If the buffer was received into the target, then the data refers
+        to the part of the frame where the buffer would have been. This
+        returns data that refers to the target instead.
+
+        Args:
+            data: The data of the received message.
+        """
+        if not self.placed:
+            return data
+        return EncodedData(data.body, [self.target], has_deltas=data.has_deltas)
+
+
 class MPPMessage:
     """A MUSCLE Peer Protocol message.
 
@@ -188,22 +1230,84 @@ class MPPMessage:
         self.settings_overlay = settings_overlay
         self.message_number = message_number
         self.saved_until = saved_until
+        self.same_settings_overlay = False
+        self._data: Any = None
+        self._encoded_data: Optional[EncodedData] = None
+        self.data = data
+
+    @property
+    def data(self) -> Any:
+        """The contents of the message.
+
+        For received messages, this is decoded when it is first used.
+        """
+        if self._data is _NOT_DECODED:
+            self._data = cast(EncodedData, self._encoded_data).decoded()
+        return self._data
+
+    @data.setter
+    def data(self, data: Any) -> None:
         if isinstance(data, np.ndarray):
-            self.data = Grid(data)
-        else:
-            self.data = data
+            data = Grid(data)
+        self._data = data
+        self._encoded_data = None
+
+    @property
+    def encoded_data(self) -> Optional[EncodedData]:
+        """The contents of a received message, as received.
+
+        Setting this replaces the data of the message, which will be
+        decoded from it when it is first used.
+        """
+        return self._encoded_data
+
+    @encoded_data.setter
+    def encoded_data(self, encoded_data: Optional[EncodedData]) -> None:
+        self._encoded_data = encoded_data
+        self._data = None if encoded_data is None else _NOT_DECODED
+
+    def is_close_port(self) -> bool:
+        """Returns whether this message closes its port.
+
+        For received messages, this does not decode the data.
+        """
+        if self._data is _NOT_DECODED:
+            return cast(EncodedData, self._encoded_data).is_close_port()
+        return isinstance(self._data, ClosePort)
 
     @staticmethod
     def from_bytes(message: Buffer) -> 'MPPMessage':
         """Create an MPP Message from an encoded buffer.
 
+        The message may be in either the in-band format produced by
+        :meth:`encoded`, or in the out-of-band format produced by
+        :meth:`EncodedMessage.frame`.
+
+        Only the header fields are decoded here. The data is kept in
+        :attr:`encoded_data`, and decoded when it is first used. Its
+        body and buffers refer to the given buffer rather than to a copy,
+        and so do any grids decoded from an out-of-band message.
+
+        A compact envelope does not contain the sender and receiver, as
+        the receiver already knows them. For those messages, they are set
+        to ``_``. It may also leave out the settings overlay if it is the
+        same as in the previous message, in which case
+        :attr:`same_settings_overlay` is set and the overlay is empty.
+
         Args:
             message: MessagePack encoded message data.
         """
-        message_dict = msgpack.unpackb(
-                message, ext_hook=_ext_decoder, raw=False)
-        sender = Reference(message_dict["sender"])
-        receiver = Reference(message_dict["receiver"])
+        buf = memoryview(message)
+        if buf[:len(_OOB_MAGIC)] in (_OOB_MAGIC, _OOB_COMPRESSED_MAGIC):
+            message_dict, encoded_data = MPPMessage._split_out_of_band(buf)
+        else:
+            message_dict, encoded_data = MPPMessage._split_in_band(buf)
+
+        if 'sender' in message_dict:
+            sender = Reference(message_dict["sender"])
+            receiver = Reference(message_dict["receiver"])
+        else:
+            sender = receiver = _UNKNOWN_ENDPOINT
         port_length = message_dict["port_length"]
         timestamp = message_dict["timestamp"]
         next_timestamp = message_dict["next_timestamp"]
@@ -211,13 +1315,19 @@ class MPPMessage:
         message_number = message_dict["message_number"]
         saved_until = message_dict["saved_until"]
 
-        data = message_dict["data"]
-        return MPPMessage(
+        mpp_message = MPPMessage(
                 sender, receiver, port_length, timestamp, next_timestamp,
-                settings_overlay, message_number, saved_until, data)
+                settings_overlay, message_number, saved_until, None)
+        mpp_message.same_settings_overlay = message_dict.get(
+                'same_settings_overlay', False)
+        mpp_message.encoded_data = encoded_data
+        return mpp_message
 
     def encoded(self) -> Buffer:
         """Encode the message and return as a bytes buffer.
+
+        This produces the in-band format, in which everything including
+        any grid data is contained in a single MessagePack object.
         """
         message_dict = {
                 'sender': str(self.sender),
@@ -233,3 +1343,200 @@ class MPPMessage:
 
         return cast(Buffer, msgpack.packb(
             message_dict, default=_data_encoder, use_bin_type=True))
+
+    def encoded_out_of_band(
+            self, data: Optional[EncodedData] = None,
+            deltas: Optional[DeltaReferences] = None,
+            previous_overlay: Optional[bytes] = None) -> EncodedMessage:
+        """Encode the message with grid data in out-of-band buffers.
+
+        This copies any grid data only once, and does not copy it again
+        when the message is sent. When sending the same data to several
+        receivers, the data of the first encoded message can be passed
+        when encoding the others, so that it is encoded only once and
+        shared.
+
+        Delta grids are sent as the changes to the references in deltas,
+        if given, and in full otherwise. Likewise, the compact envelope
+        leaves out the settings overlay if it is the same as
+        previous_overlay, which must then be the encoded overlay of the
+        previous message to the same receiver, see
+        :attr:`EncodedMessage.settings_overlay`.
+
+        Args:
+            data: The already encoded data of this message, if available.
+            deltas: References for delta grids, if any.
+            previous_overlay: The overlay sent to the receiver before, if
+                    any.
+        """
+        # The overlay is encoded once for both envelopes, and compared in
+        # encoded form, which is much quicker than comparing Settings.
+        overlay = cast(bytes, msgpack.packb(
+                self.settings_overlay, default=_data_encoder, use_bin_type=True))
+        head = {
+                'sender': str(self.sender),
+                'receiver': str(self.receiver),
+                'port_length': self.port_length,
+                'timestamp': self.timestamp,
+                'next_timestamp': self.next_timestamp}
+        tail = {
+                'message_number': self.message_number,
+                'saved_until': self.saved_until}
+        # A fixmap with eight fields, put together from the parts. The
+        # fields are in the same order as in encoded().
+        encoded_envelope = (
+                b'\x88' + msgpack.packb(head, use_bin_type=True)[1:] +
+                cast(bytes, msgpack.packb('settings_overlay')) + overlay +
+                msgpack.packb(tail, use_bin_type=True)[1:])
+
+        if data is None:
+            buffers: List[memoryview] = []
+            encoder = _OutOfBandEncoder(buffers, deltas)
+            encoded_body = msgpack.packb(
+                    _bundled(self.data), default=encoder, use_bin_type=True)
+            data = EncodedData(
+                    encoded_body, buffers,
+                    has_deltas=bool(encoder.delta_arrays))
+            data.delta_arrays = encoder.delta_arrays
+
+        return EncodedMessage(
+                encoded_envelope, data,
+                self._compact_envelope(overlay, overlay == previous_overlay),
+                overlay)
+
+    def _compact_envelope(self, overlay: bytes, same_overlay: bool) -> bytes:
+        """Encodes the header fields except sender and receiver compactly.
+
+        See _COMPACT_ENVELOPE for the format.
+
+        Args:
+            overlay: The encoded settings overlay.
+            same_overlay: Whether the receiver has it already.
+        """
+        flags = 0
+        if self.port_length is not None:
+            flags |= _HAS_PORT_LENGTH
+        if self.next_timestamp is not None:
+            flags |= _HAS_NEXT_TIMESTAMP
+        if not self.settings_overlay:
+            overlay = b''
+        elif same_overlay:
+            flags |= _SAME_SETTINGS_OVERLAY
+            overlay = b''
+        else:
+            flags |= _HAS_SETTINGS_OVERLAY
+
+        return _COMPACT_ENVELOPE.pack(
+                _COMPACT_MARKER, _COMPACT_VERSION, flags, self.port_length or 0,
+                self.message_number, self.timestamp,
+                self.next_timestamp or 0.0, self.saved_until) + overlay
+
+    @staticmethod
+    def _decode_compact_envelope(envelope: memoryview) -> Dict[str, Any]:
+        """Decodes an envelope encoded by :meth:`_compact_envelope`.
+
+        Args:
+            envelope: The encoded envelope.
+
+        Returns:
+            A dict with the header fields, except sender and receiver.
+        """
+        (
+                _, version, flags, port_length, message_number, timestamp,
+                next_timestamp, saved_until) = _COMPACT_ENVELOPE.unpack_from(
+                        envelope)
+        if version != _COMPACT_VERSION:
+            raise RuntimeError(
+                    f'Received a message with a header of unknown version'
+                    f' {version}')
+
+        settings_overlay = Settings()
+        if flags & _HAS_SETTINGS_OVERLAY:
+            settings_overlay = msgpack.unpackb(
+                    envelope[_COMPACT_ENVELOPE.size:], ext_hook=_ext_decoder,
+                    raw=False)
+
+        return {
+                'port_length': port_length if flags & _HAS_PORT_LENGTH else None,
+                'timestamp': timestamp,
+                'next_timestamp': (
+                    next_timestamp if flags & _HAS_NEXT_TIMESTAMP else None),
+                'settings_overlay': settings_overlay,
+                'same_settings_overlay': bool(flags & _SAME_SETTINGS_OVERLAY),
+                'message_number': message_number,
+                'saved_until': saved_until}
+
+    @staticmethod
+    def _split_out_of_band(frame: memoryview) -> Tuple[Any, EncodedData]:
+        """Decode the header of an out-of-band frame.
+
+        Args:
+            frame: The received frame.
+
+        Returns:
+            A dict with the header fields, and the encoded data.
+        """
+        magic, num_buffers, flags, envelope_len, body_len = _OOB_PREFIX.unpack_from(
+                frame)
+        has_deltas = bool(flags & _HAS_DELTAS)
+
+        buffers: List[memoryview] = []
+        compressed: List[CompressedBuffer] = []
+        if magic == _OOB_COMPRESSED_MAGIC:
+            entry = _OOB_COMPRESSED_BUFFER_ENTRY
+            for i in range(num_buffers):
+                offset, size, full_size, codec = entry.unpack_from(
+                        frame, _OOB_PREFIX.size + i * entry.size)
+                compressed.append(CompressedBuffer(
+                        Codec(codec), frame[offset:offset + size], full_size))
+        else:
+            entry = _OOB_BUFFER_ENTRY
+            for i in range(num_buffers):
+                offset, size = entry.unpack_from(
+                        frame, _OOB_PREFIX.size + i * entry.size)
+                buffers.append(frame[offset:offset + size])
+
+        pos = _OOB_PREFIX.size + num_buffers * entry.size
+        envelope = frame[pos:pos + envelope_len]
+        if envelope[0] == _COMPACT_MARKER:
+            message_dict = MPPMessage._decode_compact_envelope(envelope)
+        else:
+            message_dict = msgpack.unpackb(
+                    envelope, ext_hook=_ext_decoder, raw=False)
+
+        pos += envelope_len
+        body = frame[pos:pos + body_len]
+        if magic == _OOB_COMPRESSED_MAGIC:
+            return message_dict, EncodedData(
+                    body, None, compressed, has_deltas)
+        return message_dict, EncodedData(body, buffers, has_deltas=has_deltas)
+
+    @staticmethod
+    def _split_in_band(message: memoryview) -> Tuple[Any, EncodedData]:
+        """Decode the header of an in-band message.
+
+        This decodes all fields of the message except for the data, which
+        is skipped over.
+
+        Args:
+            message: The received message.
+
+        Returns:
+            A dict with the header fields, and the encoded data.
+        """
+        unpacker = msgpack.Unpacker(
+                ext_hook=_ext_decoder, raw=False, max_buffer_size=len(message))
+        unpacker.feed(message)
+
+        message_dict = dict()
+        encoded_data = EncodedData(b'\xc0', [])
+        for _ in range(unpacker.read_map_header()):
+            key = unpacker.unpack()
+            if key == 'data':
+                start = unpacker.tell()
+                unpacker.skip()
+                encoded_data = EncodedData(message[start:unpacker.tell()], [])
+            else:
+                message_dict[key] = unpacker.unpack()
+
+        return message_dict, encoded_data
@@ -1,13 +1,96 @@
-from typing import List
+from concurrent.futures import Future
+import threading
+from typing import Any, Dict, List, Optional, Tuple
 from typing_extensions import Buffer
 
 import msgpack
 from ymmsl.v0_2 import Reference
 
-from libmuscle.mcp.protocol import RequestType
-from libmuscle.mcp.transport_server import RequestHandler, TransportServer
+from libmuscle.compression import codec_features
+from libmuscle.mcp.protocol import MPPFeature, RequestType
+from libmuscle.mcp.transport_server import (
+        Frame, RequestHandler, ServerNotSupported, TransportServer)
 from libmuscle.mcp.type_registry import transport_server_types
+from libmuscle.mpp_message import batch_frame, chunked_descriptor, EncodedMessage
+from libmuscle.outbox import OutboxLimits
 from libmuscle.post_office import PostOffice
+from libmuscle.spiller import Spiller
+
+
+SUPPORTED_FEATURES = [
+        MPPFeature.OUT_OF_BAND, MPPFeature.COMPACT_HEADER,
+        MPPFeature.BATCH, MPPFeature.CHUNKED] + codec_features()
+"""MPP features supported by this server, see :class:`MPPFeature`."""
+
+
+_CHUNKED_MIN_BYTES = 64 * 1024 * 1024
+"""Messages at least this large are fetched in chunks, if supported."""
+
+
+class _ChunkedTransfers:
+    """Keeps large messages while their chunks are being fetched.
+
+    A message is kept until all of its bytes have been requested once.
+    Requests that are repeated after a reconnect are answered by the
+    transport server from its session state, so they do not get here.
+    """
+    def __init__(self) -> None:
+        self._frames: Dict[int, Tuple[List[Buffer], int]] = {}
+        self._next_id = 1
+        self._done = threading.Condition()
+
+    def add(self, frame: List[Buffer], size: int) -> int:
+        """Adds a message to be fetched in chunks.
+
+        Args:
+            frame: The message's frame.
+            size: The size of the frame in bytes.
+
+        Returns:
+            The id of the transfer.
+        """
+        with self._done:
+            transfer_id = self._next_id
+            self._next_id += 1
+            self._frames[transfer_id] = (frame, size)
+        return transfer_id
+
+    def get_chunk(self, transfer_id: int, offset: int, size: int) -> List[Buffer]:
+        """Returns part of a message.
+
+        Args:
+            transfer_id: The id of the transfer.
+            offset: Offset of the chunk in the frame.
+            size: Size of the chunk.
+
+        Returns:
+            The chunk, as a list of segments.
+        """
+        with self._done:
+            if transfer_id not in self._frames:
+                raise RuntimeError(f'Unknown transfer {transfer_id} requested')
+            frame, remaining = self._frames[transfer_id]
+            remaining -= size
+            if remaining > 0:
+                self._frames[transfer_id] = (frame, remaining)
+            else:
+                del self._frames[transfer_id]
+                self._done.notify_all()
+
+        chunk: List[Buffer] = []
+        for segment in frame:
+            view = memoryview(segment).cast('B')
+            if offset < view.nbytes and size > 0:
+                part = view[offset:offset + size]
+                chunk.append(part)
+                size -= part.nbytes
+            offset = max(offset - view.nbytes, 0)
+        return chunk
+
+    def wait(self) -> None:
+        """Waits until all messages have been fetched completely."""
+        with self._done:
+            self._done.wait_for(lambda: not self._frames)
 
 
 class MPPRequestHandler(RequestHandler):
@@ -16,32 +99,151 @@ class MPPRequestHandler(RequestHandler):
     This accepts peer protocol message requests and responds to them by
     getting messages from a PostOffice.
     """
-    def __init__(self, post_office: PostOffice) -> None:
+    def __init__(self, post_office: PostOffice[EncodedMessage]) -> None:
         """Create an MPPRequestHandler.
 
         Args:
             post_office: The PostOffice to get messages from.
         """
         self._post_office = post_office
+        self._transfers = _ChunkedTransfers()
 
-    def handle_request(self, request: Buffer) -> Buffer:
+    def handle_request(self, request: Buffer) -> Frame:
         """Handle a request.
 
         This receives an MCP request and handles it by blocking until
         the requested message is available, then returning it.
 
+        Requests may have a third item, a list of MPP features that the
+        client supports. The message is encoded using those, or in the
+        basic format if there is no such list. Large messages may be
+        replaced by a descriptor, after which the client fetches them in
+        parts using GET_CHUNK requests.
+
         Args:
             request: A received request
 
         Returns:
             An encoded response
         """
+        return self.handle_request_async(request).result()
+
+    def handle_request_async(self, request: Buffer) -> 'Future[Frame]':
+        """Handle a request without blocking.
+
+        Like :meth:`handle_request`, but returns a future that completes
+        when the requested message is available.
+
+        Args:
+            request: A received request
+
+        Returns:
+            A future for the encoded response
+        """
         req = msgpack.unpackb(request, raw=False)
-        if len(req) != 2 or req[0] != RequestType.GET_NEXT_MESSAGE.value:
+        if len(req) == 5 and req[0] == RequestType.GET_NEXT_MESSAGES.value:
+            return self._handle_batch_request(req)
+        if len(req) == 4 and req[0] == RequestType.GET_CHUNK.value:
+            chunk: Future[Frame] = Future()
+            chunk.set_result(self._transfers.get_chunk(req[1], req[2], req[3]))
+            return chunk
+        if (
+                len(req) not in (2, 3) or
+                req[0] != RequestType.GET_NEXT_MESSAGE.value):
             raise RuntimeError(
                     'Invalid request type. Did the streams get crossed?')
         recv_port = Reference(req[1])
-        return self._post_office.get_message(recv_port)
+        features = req[2] if len(req) == 3 else []
+        out_of_band = MPPFeature.OUT_OF_BAND.value in features
+
+        response: Future[Frame] = Future()
+
+        def encode(message_future: 'Future[EncodedMessage]') -> None:
+            if not response.set_running_or_notify_cancel():
+                return
+            try:
+                message = message_future.result()
+                if out_of_band:
+                    response.set_result(self._frame(message, features))
+                else:
+                    response.set_result(message.in_band())
+            except Exception as e:
+                response.set_exception(e)
+
+        self._post_office.get_message_future(recv_port).add_done_callback(encode)
+        return response
+
+    def _handle_batch_request(self, req: List[Any]) -> 'Future[Frame]':
+        """Handle a request for several messages.
+
+        The request lists one or more receivers, a maximum number of
+        messages and a maximum number of bytes. The response is sent when
+        there is a message for the first receiver. It contains that
+        message, followed by any further messages that are waiting for
+        any of the receivers, in order of the receivers, up to the given
+        maximums. Those are only counted for the additional messages, so
+        that the first one is always sent.
+
+        Args:
+            req: The decoded request
+
+        Returns:
+            A future for the encoded response, a batch frame
+        """
+        _, receivers, max_messages, max_bytes, features = req
+        recv_ports = [Reference(receiver) for receiver in receivers]
+
+        response: Future[Frame] = Future()
+
+        def encode(message_future: 'Future[EncodedMessage]') -> None:
+            if not response.set_running_or_notify_cancel():
+                return
+            try:
+                messages = [(0, self._frame(message_future.result(), features))]
+                remaining: int = max_bytes
+
+                def accept(message: EncodedMessage) -> bool:
+                    return message.nbytes <= remaining
+
+                for i, recv_port in enumerate(recv_ports):
+                    while len(messages) < max_messages:
+                        message = self._post_office.get_message_now(
+                                recv_port, accept)
+                        if message is None:
+                            break
+                        messages.append((i, self._frame(message, features)))
+                        remaining -= message.nbytes
+
+                response.set_result(batch_frame(messages))
+            except Exception as e:
+                response.set_exception(e)
+
+        self._post_office.get_message_future(recv_ports[0]).add_done_callback(
+                encode)
+        return response
+
+    def wait_for_transfers(self) -> None:
+        """Waits until all large messages have been fetched completely."""
+        self._transfers.wait()
+
+    def _frame(
+            self, message: EncodedMessage, features: List[str]) -> List[Buffer]:
+        """Encodes a message as an out-of-band frame.
+
+        If the frame is large and the receiver supports it, then the
+        message is kept to be fetched in chunks, and a descriptor of it is
+        returned instead.
+
+        Args:
+            message: The message to encode.
+            features: The MPP features the receiver supports.
+        """
+        frame = message.frame(features)
+        if MPPFeature.CHUNKED.value in features:
+            size = sum(memoryview(segment).nbytes for segment in frame)
+            if size >= _CHUNKED_MIN_BYTES:
+                return [chunked_descriptor(self._transfers.add(frame, size), size)]
+        return frame
 
 
 class MPPServer:
@@ -51,13 +253,18 @@ class MPPServer:
     PostOffice that stores outgoing messages.
     """
     def __init__(self) -> None:
-        self._post_office = PostOffice()
+        self._limits = OutboxLimits[EncodedMessage](lambda m: m.nbytes)
+        self._spiller = Spiller()
+        self._post_office = PostOffice(self._limits)
         self._handler = MPPRequestHandler(self._post_office)
         self._servers: List[TransportServer] = []
 
         for server_type in transport_server_types:
-            server = server_type(self._handler)
-            self._servers.append(server)
+            try:
+                server = server_type(self._handler)
+                self._servers.append(server)
+            except ServerNotSupported:
+                pass
 
     def get_locations(self) -> List[str]:
         """Returns a list of locations that we can be reached at.
@@ -66,12 +273,44 @@ class MPPServer:
         the protocol name does not contain a colon and location may
         be an arbitrary string.
 
+        In addition to the locations of the transport servers, this includes
+        an ``mpp:`` location listing the supported MPP features, which
+        clients use to decide which features they can use.
+
         Returns:
             A list of strings describing network locations.
         """
-        return [server.get_location() for server in self._servers]
+        locations = [server.get_location() for server in self._servers]
+        features = ','.join([feature.value for feature in SUPPORTED_FEATURES])
+        locations.append(f'mpp:{features}')
+        return locations
+
+    def set_outbox_limits(
+            self, max_bytes: Optional[int], total_max_bytes: Optional[int],
+            spill: bool) -> None:
+        """Limits the memory used by messages waiting to be received.
+
+        Args:
+            max_bytes: Maximum number of bytes waiting for a single
+                    receiver, if any.
+            total_max_bytes: Maximum number of bytes waiting for all
+                    receivers together, if any.
+            spill: If True, write messages to disk when over a limit,
+                    otherwise block the sender until there is room.
+        """
+        self._limits.set_limits(
+                max_bytes, total_max_bytes,
+                self._spiller.spill if spill else None)
+
+    def get_high_water(self, receiver: Reference) -> int:
+        """Returns the largest number of bytes held for a receiver.
+
+        Args:
+            receiver: The receiver to get the high-water mark for.
+        """
+        return self._post_office.get_high_water(receiver)
 
-    def deposit(self, receiver: Reference, message: Buffer) -> None:
+    def deposit(self, receiver: Reference, message: EncodedMessage) -> None:
         """Deposits a message for the receiver to retrieve.
 
         Args:
@@ -83,8 +322,10 @@ class MPPServer:
     def wait_for_receivers(self) -> None:
         """Waits for all deposited messages to have been received."""
         self._post_office.wait_for_receivers()
+        self._handler.wait_for_transfers()
 
     def shutdown(self) -> None:
         """Shut down all servers."""
         for server in self._servers:
             server.close()
+        self._spiller.close()
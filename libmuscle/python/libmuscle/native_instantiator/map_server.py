@@ -6,7 +6,7 @@ from typing_extensions import Buffer
 import msgpack
 
 from libmuscle.mcp.protocol import AgentCommandType, RequestType, ResponseType
-from libmuscle.mcp.tcp_transport_server import TcpTransportServer
+from libmuscle.mcp.async_tcp_transport_server import AsyncTcpTransportServer
 from libmuscle.mcp.transport_server import RequestHandler
 from libmuscle.native_instantiator.agent.agent_commands import (
         AgentCommand, CancelAllCommand, ShutdownCommand, StartCommand)
@@ -22,7 +22,9 @@ _logger = logging.getLogger(__name__)
 
 class MAPRequestHandler(RequestHandler):
     """Handles Agent requests."""
-    def __init__(self, agent_manager: IAgentManager, post_office: PostOffice) -> None:
+    def __init__(
+            self, agent_manager: IAgentManager,
+            post_office: PostOffice[bytes]) -> None:
         """Create a MAPRequestHandler.
 
         Args:
@@ -86,7 +88,7 @@ class MAPRequestHandler(RequestHandler):
             node_name: Hostname (name) of the agent's node
         """
         node_ref = Reference('_' + node_name.replace('-', '_'))
-        next_request: Optional[Buffer] = None
+        next_request: Optional[bytes] = None
         if self._post_office.have_message(node_ref):
             next_request = self._post_office.get_message(node_ref)
 
@@ -126,14 +128,14 @@ class MAPServer:
         Args:
             agent_manager: AgentManager to forward requests to
         """
-        self._post_office = PostOffice()
+        self._post_office = PostOffice[bytes]()
         self._handler = MAPRequestHandler(agent_manager, self._post_office)
         try:
-            self._server = TcpTransportServer(self._handler, 9009)
+            self._server = AsyncTcpTransportServer(self._handler, 9009)
         except OSError as e:
             if e.errno != errno.EADDRINUSE:
                 raise
-            self._server = TcpTransportServer(self._handler)
+            self._server = AsyncTcpTransportServer(self._handler)
 
     def get_location(self) -> str:
         """Return this server's network location.
@@ -1,36 +1,196 @@
-from typing_extensions import Buffer
+from collections import deque
+from concurrent.futures import Future
+import threading
+from typing import (
+        Callable, Deque, Generic, List, Optional, Tuple, TypeVar, Union)
 
-from queue import Queue
 
+T = TypeVar('T')
 
-class Outbox:
+
+class OutboxLimits(Generic[T]):
+    """Limits the memory used by messages waiting in Outboxes.
+
+    A PostOffice shares a single OutboxLimits between all its Outboxes, so
+    that the total limit applies to all of them together.
+
+    When a deposit would exceed a limit, then it either blocks until enough
+    messages have been retrieved, or it moves the oldest messages in the
+    Outbox out of memory using ``spill``, if set. An empty Outbox always
+    accepts a message, so that every receiver can make progress.
+
+    Attributes:
+        size_of: Function that returns the size of a message in bytes.
+        max_bytes: Maximum number of bytes in a single Outbox, if any.
+        total_max_bytes: Maximum number of bytes in all Outboxes together,
+                if any.
+        spill: Function that stores a message elsewhere, returning a
+                function that loads it back. If None, deposits block.
+        used: Number of bytes currently held in all Outboxes.
+        cond: Condition protecting the limits and the Outboxes using them.
+    """
+    def __init__(
+            self, size_of: Callable[[T], int], max_bytes: Optional[int] = None,
+            total_max_bytes: Optional[int] = None,
+            spill: Optional[Callable[[T], Callable[[], T]]] = None) -> None:
+        """Create an OutboxLimits.
+
+        Args:
+            size_of: Function that returns the size of a message in bytes.
+            max_bytes: Maximum number of bytes in a single Outbox, if any.
+            total_max_bytes: Maximum number of bytes in all Outboxes
+                    together, if any.
+            spill: Function that stores a message elsewhere, returning a
+                    function that loads it back. If None, deposits block.
+        """
+        self.size_of = size_of
+        self.max_bytes = max_bytes
+        self.total_max_bytes = total_max_bytes
+        self.spill = spill
+        self.used = 0
+        self.cond = threading.Condition()
+
+    def set_limits(
+            self, max_bytes: Optional[int], total_max_bytes: Optional[int],
+            spill: Optional[Callable[[T], Callable[[], T]]]) -> None:
+        """Changes the limits.
+
+        Args:
+            max_bytes: Maximum number of bytes in a single Outbox, if any.
+            total_max_bytes: Maximum number of bytes in all Outboxes
+                    together, if any.
+            spill: Function that stores a message elsewhere, returning a
+                    function that loads it back. If None, deposits block.
+        """
+        with self.cond:
+            self.max_bytes = max_bytes
+            self.total_max_bytes = total_max_bytes
+            self.spill = spill
+            self.cond.notify_all()
+
+    @property
+    def enabled(self) -> bool:
+        """Whether any limits are set.
+
+        If not, then message sizes need not be tracked.
+        """
+        return self.max_bytes is not None or self.total_max_bytes is not None
+
+    def fits(self, outbox_bytes: int, size: int) -> bool:
+        """Returns whether a message fits within the limits.
+
+        Must be called with the lock held.
+
+        Args:
+            outbox_bytes: Number of bytes held by the Outbox to add to.
+            size: Size of the message.
+        """
+        if self.max_bytes is not None and outbox_bytes + size > self.max_bytes:
+            return False
+        if self.total_max_bytes is not None:
+            return self.used + size <= self.total_max_bytes
+        return True
+
+
+class _Spilled(Generic[T]):
+    """A message that has been moved out of memory."""
+    def __init__(self, load: Callable[[], T]) -> None:
+        self.load = load
+
+
+class Outbox(Generic[T]):
     """Stores messages to be sent to a particular receiver.
 
     An Outbox is a queue of messages, which may be deposited and
-    then retrieved in the same order.
+    then retrieved in the same order. It is generic in the type of the
+    messages, which is normally an encoded message of some kind.
+
+    Messages can be retrieved either by blocking until one is available,
+    or via a future, so that an asynchronous server does not need a
+    thread for every receiver that is waiting.
+
+    The memory used by the waiting messages can be limited, see
+    :class:`OutboxLimits`.
+
+    Attributes:
+        high_water: The largest number of bytes held in memory at any
+                time while limits were set.
     """
-    def __init__(self) -> None:
+    def __init__(self, limits: Optional[OutboxLimits[T]] = None) -> None:
         """Create an empty Outbox.
+
+        Args:
+            limits: Limits on the memory used, if any.
         """
-        self.__queue: Queue[Buffer] = Queue()
+        self.__queue: Deque[Tuple[Union[T, _Spilled[T]], int]] = deque()
+        self.__waiters: Deque[Future[T]] = deque()
+        self.__limits = limits
+        self.__lock = threading.Condition() if limits is None else limits.cond
+        self.__bytes = 0
+        self.high_water = 0
 
     def is_empty(self) -> bool:
         """Returns True iff the outbox is empty.
         """
-        return self.__queue.empty()
+        return not self.__queue
 
-    def deposit(self, message: Buffer) -> None:
+    def deposit(self, message: T) -> None:
         """Put a message in the Outbox.
 
         The message will be placed at the back of a queue, and may be
-        retrieved later via :py:meth:`retrieve`.
+        retrieved later via :py:meth:`retrieve`. If someone is waiting for
+        a message already, then it is given to them directly.
+
+        If this would exceed the limits, then this blocks until enough
+        messages have been retrieved, or older messages are spilled, as
+        configured. Spilling is done with the lock released, so that other
+        Outboxes sharing the limits can be used in the mean time.
 
         Args:
             message: The message to store.
         """
-        self.__queue.put(message)
+        limits = self.__limits
+        size = 0
+        if limits is not None and limits.enabled:
+            size = limits.size_of(message)
+
+        spill: Optional[Callable[[T], Callable[[], T]]] = None
+        victims: List[Tuple[T, int]] = []
+        spill_message = False
+        with self.__lock:
+            while True:
+                while self.__waiters:
+                    waiter = self.__waiters.popleft()
+                    if waiter.set_running_or_notify_cancel():
+                        waiter.set_result(message)
+                        return
+
+                if limits is None or self.__fits(size):
+                    break
 
-    def retrieve(self) -> Buffer:
+                if limits.spill is not None:
+                    spill = limits.spill
+                    victims = self.__pick_victims(limits, size)
+                    if not self.__fits(size):
+                        spill_message = True
+                        size = 0
+                    break
+
+                limits.cond.wait()
+
+            entry = (message, size)
+            self.__queue.append(entry)
+            self.__bytes += size
+            self.high_water = max(self.high_water, self.__bytes)
+            if limits is not None:
+                limits.used += size
+
+        if spill_message:
+            victims.append(entry)
+        if spill is not None and victims:
+            self.__spill(spill, victims)
+
+    def retrieve(self) -> T:
         """Retrieve a message from the Outbox.
 
         The message will be removed from the front of the queue, and
@@ -40,4 +200,112 @@ class Outbox:
         Returns:
             The next message.
         """
-        return self.__queue.get()
+        return self.retrieve_future().result()
+
+    def retrieve_future(self) -> 'Future[T]':
+        """Retrieve a message from the Outbox, without blocking.
+
+        If the queue is empty, then the future completes when the next
+        message is deposited. Waiters get messages in the order in which
+        they called this function. A cancelled future does not consume
+        a message.
+
+        Returns:
+            A future for the next message.
+        """
+        future: Future[T] = Future()
+        with self.__lock:
+            if self.__waiters or not self.__queue:
+                self.__waiters.append(future)
+                return future
+
+            item = self.__pop()
+
+        if isinstance(item, _Spilled):
+            item = item.load()
+        future.set_running_or_notify_cancel()
+        future.set_result(item)
+        return future
+
+    def retrieve_now(self, accept: Callable[[T], bool]) -> Optional[T]:
+        """Retrieve a message from the Outbox, if one is ready.
+
+        This returns the next message if it is in memory and accepted,
+        and nobody else is waiting for it. Spilled messages are left
+        alone, as they are large and take time to load.
+
+        Args:
+            accept: Function that returns whether a message is wanted.
+
+        Returns:
+            The next message, or None if there is none to retrieve.
+        """
+        with self.__lock:
+            if self.__waiters or not self.__queue:
+                return None
+            item = self.__queue[0][0]
+            if isinstance(item, _Spilled) or not accept(item):
+                return None
+            self.__pop()
+            return item
+
+    def __pop(self) -> Union[T, _Spilled[T]]:
+        """Removes the next message from the queue and returns it.
+
+        Must be called with the lock held.
+        """
+        item, size = self.__queue.popleft()
+        self.__bytes -= size
+        if self.__limits is not None:
+            self.__limits.used -= size
+            self.__limits.cond.notify_all()
+        return item
+
+    def __fits(self, size: int) -> bool:
+        """Returns whether a message of the given size may be added.
+
+        Must be called with the lock held, and with limits set.
+        """
+        assert self.__limits is not None
+        return not self.__queue or self.__limits.fits(self.__bytes, size)
+
+    def __pick_victims(
+            self, limits: OutboxLimits[T], size: int) -> List[Tuple[T, int]]:
+        """Picks the oldest messages to spill until one of size bytes fits.
+
+        The picked messages stay in the queue until they have been spilled,
+        but no longer count towards the limits, so that they are not picked
+        again. Must be called with the lock held.
+
+        Returns:
+            The queue entries of the picked messages.
+        """
+        victims: List[Tuple[T, int]] = []
+        for i in range(len(self.__queue)):
+            if limits.fits(self.__bytes, size):
+                break
+            item, item_size = self.__queue[i]
+            if item_size > 0 and not isinstance(item, _Spilled):
+                victim = (item, 0)
+                self.__queue[i] = victim
+                self.__bytes -= item_size
+                limits.used -= item_size
+                victims.append(victim)
+        return victims
+
+    def __spill(
+            self, spill: Callable[[T], Callable[[], T]],
+            victims: List[Tuple[T, int]]) -> None:
+        """Spills the given queue entries and puts the result in their place.
+
+        Must be called without the lock held. Victims that were retrieved
+        while they were being spilled are left alone.
+        """
+        spilled = {
+                id(victim): (_Spilled(spill(victim[0])), 0)
+                for victim in victims}
+        with self.__lock:
+            for i in range(len(self.__queue)):
+                replacement = spilled.get(id(self.__queue[i]))
+                if replacement is not None:
+                    self.__queue[i] = replacement
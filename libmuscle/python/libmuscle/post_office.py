@@ -1,23 +1,28 @@
+from concurrent.futures import Future
 from threading import Lock
 import time
-from typing import Dict
-from typing_extensions import Buffer
+from typing import Callable, Dict, Generic, Optional
 
 from ymmsl.v0_2 import Reference
 
-from libmuscle.outbox import Outbox
+from libmuscle.outbox import Outbox, OutboxLimits, T
 
 
-class PostOffice:
+class PostOffice(Generic[T]):
     """A PostOffice is an object that holds messages to be retrieved.
 
     A PostOffice holds outboxes with messages for receivers. It also
     acts as a request handler for incoming requests for messages.
     """
-    def __init__(self) -> None:
+    def __init__(self, limits: Optional[OutboxLimits[T]] = None) -> None:
         """Create a PostOffice.
+
+        Args:
+            limits: Limits on the memory used by the outboxes, shared by
+                    all of them.
         """
-        self._outboxes: Dict[Reference, Outbox] = {}
+        self._outboxes: Dict[Reference, Outbox[T]] = {}
+        self._limits = limits
 
         self._outbox_lock = Lock()
 
@@ -27,10 +32,9 @@ class PostOffice:
         Args:
             receiver: The receiver of the message.
         """
-        self._ensure_outbox_exists(receiver)
-        return not self._outboxes[receiver].is_empty()
+        return not self._get_outbox(receiver).is_empty()
 
-    def get_message(self, receiver: Reference) -> Buffer:
+    def get_message(self, receiver: Reference) -> T:
         """Get a message from a receiver's outbox.
 
         Used by servers to get messages that have been sent to another
@@ -39,18 +43,53 @@ class PostOffice:
         Args:
             receiver: The receiver of the message.
         """
-        self._ensure_outbox_exists(receiver)
-        return self._outboxes[receiver].retrieve()
+        return self._get_outbox(receiver).retrieve()
+
+    def get_message_future(self, receiver: Reference) -> 'Future[T]':
+        """Get a future for a message from a receiver's outbox.
+
+        Like :meth:`get_message`, but returns immediately with a future
+        that completes when the message is available.
+
+        Args:
+            receiver: The receiver of the message.
+        """
+        return self._get_outbox(receiver).retrieve_future()
+
+    def get_message_now(
+            self, receiver: Reference, accept: Callable[[T], bool]
+            ) -> Optional[T]:
+        """Get a message from a receiver's outbox, if one is ready.
+
+        See :meth:`Outbox.retrieve_now`.
+
+        Args:
+            receiver: The receiver of the message.
+            accept: Function that returns whether a message is wanted.
+
+        Returns:
+            The next message, or None if there is none to retrieve.
+        """
+        return self._get_outbox(receiver).retrieve_now(accept)
+
+    def get_high_water(self, receiver: Reference) -> int:
+        """Returns the largest number of bytes held for a receiver.
+
+        This is only tracked if the PostOffice has limits.
+
+        Args:
+            receiver: The receiver of the messages.
+        """
+        return self._get_outbox(receiver).high_water
 
-    def deposit(self, receiver: Reference, message: Buffer) -> None:
+    def deposit(self, receiver: Reference, message: T) -> None:
         """Deposits a message into an outbox.
 
         Args:
             receiver: Receiver of the message.
             message: The message to deposit.
         """
-        self._ensure_outbox_exists(receiver)
-        self._outboxes[receiver].deposit(message)
+        self._get_outbox(receiver).deposit(message)
 
     def wait_for_receivers(self) -> None:
         """Waits until all outboxes are empty.
@@ -59,17 +98,20 @@ class PostOffice:
             while not outbox.is_empty():
                 time.sleep(0.1)
 
-    def _ensure_outbox_exists(self, receiver: Reference) -> None:
-        """Ensure that an outbox exists.
+    def _get_outbox(self, receiver: Reference) -> Outbox[T]:
+        """Returns the outbox for a receiver.
 
         Outboxes are created dynamically, the first time a message is
-        sent to a receiver. This function checks that an outbox exists
-        for a receiver, and if not, creates one.
+        sent to a receiver. This function returns the outbox for a
+        receiver, creating it if it does not exist yet.
 
         Args:
-            receiver: The receiver that should have an outbox.
+            receiver: The receiver whose outbox to get.
         """
-        self._outbox_lock.acquire()
-        if receiver not in self._outboxes:
-            self._outboxes[receiver] = Outbox()
-        self._outbox_lock.release()
+        # Hashing a Reference is relatively slow, so look it up only once
+        with self._outbox_lock:
+            outbox = self._outboxes.get(receiver)
+            if outbox is None:
+                outbox = Outbox(self._limits)
+                self._outboxes[receiver] = outbox
+        return outbox
@@ -0,0 +1,226 @@
+from collections import deque
+import logging
+import threading
+import time
+from typing import Deque, Optional, Tuple
+from typing_extensions import Buffer
+
+from ymmsl.v0_2 import Reference
+
+from libmuscle.mcp.transport_client import ProfileData, TimeoutHandler
+from libmuscle.mpp_client import MPPClient
+from libmuscle.mpp_message import MPPMessage
+
+
+_logger = logging.getLogger(__name__)
+
+
+class PrefetchBudget:
+    """Limits the memory used by prefetched messages.
+
+    A single budget is shared by all the Prefetchers of a Communicator, so
+    that the limit applies to all ports together.
+
+    Attributes:
+        max_bytes: Maximum number of bytes to hold in prefetched messages.
+        used: Number of bytes currently held.
+        cond: Condition protecting the budget and the Prefetchers using it.
+    """
+    def __init__(self, max_bytes: int) -> None:
+        """Create a PrefetchBudget.
+
+        Args:
+            max_bytes: Maximum number of bytes to hold in prefetched messages.
+        """
+        self.max_bytes = max_bytes
+        self.used = 0
+        self.cond = threading.Condition()
+
+    def set_max_bytes(self, max_bytes: int) -> None:
+        """Changes the maximum number of bytes to hold.
+
+        Args:
+            max_bytes: The new maximum.
+        """
+        with self.cond:
+            self.max_bytes = max_bytes
+            self.cond.notify_all()
+
+
+class Prefetcher:
+    """Receives messages for a port in the background.
+
+    A Prefetcher has its own connection to the peer, on which it requests
+    the next message for a single receiving port (and slot) as soon as there
+    is room for it. This overlaps the transfer of the next message with
+    whatever the model does in the mean time.
+
+    At most ``depth`` messages are held at a time. Further requests are also
+    held back while the shared budget is exhausted, except when nothing has
+    been prefetched for this port yet, so that every port can make progress.
+
+    Prefetching stops after a ClosePort message, since none will follow.
+    """
+    def __init__(
+            self, client: MPPClient, receiver: Reference, depth: int,
+            budget: PrefetchBudget) -> None:
+        """Create a Prefetcher and start prefetching.
+
+        Args:
+            client: A client connected to the peer, for use by this
+                    Prefetcher only. It is closed when prefetching stops.
+            receiver: The receiving port to prefetch messages for.
+            depth: Maximum number of messages to hold.
+            budget: Memory budget shared with other Prefetchers.
+        """
+        self._client = client
+        self._receiver = receiver
+        self._depth = depth
+        self._budget = budget
+        self._cond = budget.cond
+
+        self._queue: Deque[Tuple[Buffer, ProfileData, int]] = deque()
+        self._error: Optional[Exception] = None
+        self._busy = False
+        self._stopping = False
+        self._finished = False
+
+        self._thread = threading.Thread(
+                target=self._run, name=f'Prefetcher-{receiver}', daemon=True)
+        self._thread.start()
+
+    def receive(self, timeout_handler: Optional[TimeoutHandler]
+                ) -> Tuple[Buffer, ProfileData]:
+        """Returns the next message.
+
+        This blocks until a message is available, like
+        :meth:`MPPClient.receive`.
+
+        Args:
+            timeout_handler: Optional timeout handler, used for deadlock
+                    detection.
+
+        Returns:
+            The received message, and profiling data.
+
+        Raises:
+            ConnectionError: If no more messages can be received.
+            Exception: Anything raised while receiving in the background.
+        """
+        deadline = None
+        if timeout_handler is not None:
+            deadline = time.monotonic() + timeout_handler.timeout
+        did_timeout = False
+
+        while True:
+            with self._cond:
+                while not self._has_result():
+                    if deadline is None:
+                        self._cond.wait()
+                    else:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0.0:
+                            break
+                        self._cond.wait(remaining)
+
+                if self._has_result():
+                    break
+
+            assert timeout_handler is not None      # mypy
+            assert deadline is not None             # mypy
+            timeout_handler.on_timeout()
+            deadline += timeout_handler.timeout
+            did_timeout = True
+
+        if did_timeout:
+            assert timeout_handler is not None      # mypy
+            timeout_handler.on_receive()
+
+        with self._cond:
+            if not self._queue:
+                if self._error is not None:
+                    raise self._error
+                raise ConnectionError(
+                        f'No more messages will arrive on {self._receiver}')
+
+            response, profile, size = self._queue.popleft()
+            self._budget.used -= size
+            self._cond.notify_all()
+        return response, profile
+
+    def close(self) -> None:
+        """Stops prefetching.
+
+        If a request is outstanding, then it is left to complete in the
+        background, after which the connection is closed.
+        """
+        with self._cond:
+            self._stopping = True
+            self._budget.used -= sum(size for _, _, size in self._queue)
+            self._queue.clear()
+            self._cond.notify_all()
+            busy = self._busy
+
+        if not busy:
+            self._thread.join()
+
+    def _has_result(self) -> bool:
+        """Returns whether receive() can return or raise.
+
+        Must be called with the lock held.
+        """
+        return bool(self._queue) or self._finished
+
+    def _run(self) -> None:
+        """Prefetches messages until stopped or the port is closed."""
+        try:
+            while self._wait_for_room():
+                response, profile = self._client.receive(self._receiver, None)
+                size = memoryview(response).nbytes
+                is_close_port = MPPMessage.from_bytes(response).is_close_port()
+
+                with self._cond:
+                    self._busy = False
+                    if not self._stopping:
+                        self._queue.append((response, profile, size))
+                        self._budget.used += size
+                    self._cond.notify_all()
+
+                if is_close_port:
+                    break
+
+        except Exception as e:
+            _logger.debug(f'Prefetching for {self._receiver} failed: {e}')
+            with self._cond:
+                self._error = e
+
+        finally:
+            with self._cond:
+                self._busy = False
+                self._finished = True
+                self._cond.notify_all()
+            self._client.close()
+
+    def _wait_for_room(self) -> bool:
+        """Waits until another message may be requested.
+
+        Returns:
+            True if a message should be requested, False if we are stopping.
+        """
+        with self._cond:
+            while not self._stopping and self._is_full():
+                self._cond.wait()
+
+            if self._stopping:
+                return False
+            self._busy = True
+            return True
+
+    def _is_full(self) -> bool:
+        """Returns whether there is no room for another message.
+
+        Must be called with the lock held.
+        """
+        if len(self._queue) >= self._depth:
+            return True
+        return bool(self._queue) and self._budget.used >= self._budget.max_bytes
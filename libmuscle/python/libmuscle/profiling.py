@@ -18,6 +18,7 @@ class ProfileEventType(Enum):
     DISCONNECT_WAIT = 8
     SHUTDOWN = 10
     DEREGISTER = 1
+    OUTBOX_HIGH_WATER = 11
 
 
 class ProfileTimestamp:
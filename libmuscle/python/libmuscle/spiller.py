@@ -0,0 +1,84 @@
+import mmap
+import os
+from pathlib import Path
+import shutil
+import tempfile
+import threading
+from typing import Any, Callable, Optional
+import weakref
+
+from libmuscle.mcp.protocol import MPPFeature
+from libmuscle.mpp_message import EncodedMessage, MPPMessage
+
+
+class Spiller:
+    """Moves messages waiting to be sent out of memory, into files.
+
+    The files are created in a temporary directory, which is made when
+    the first message is spilled and removed on :meth:`close`. A spilled
+    message is loaded back using a memory map, so that it is paged in
+    from the file as it is sent rather than copied into memory first.
+    """
+    def __init__(self, directory: Optional[Path] = None) -> None:
+        """Create a Spiller.
+
+        Args:
+            directory: Directory in which to make the temporary directory.
+                    Defaults to the current working directory, which is
+                    the instance's work directory when started by the
+                    manager.
+        """
+        self._parent = directory
+        self._directory: Optional[Path] = None
+        self._cleanup: Optional[Callable[[], Any]] = None
+        self._lock = threading.Lock()
+
+    def spill(self, message: EncodedMessage) -> Callable[[], EncodedMessage]:
+        """Writes a message to a file.
+
+        Args:
+            message: The message to spill.
+
+        Returns:
+            A function that loads the message back and removes the file.
+        """
+        # Keep any compressed data compressed, it is decompressed if needed
+        # when the message is sent.
+        features = [feature.value for feature in MPPFeature]
+        fd, path = tempfile.mkstemp(dir=self._get_directory())
+        with os.fdopen(fd, 'wb') as f:
+            for segment in message.frame(features):
+                f.write(segment)
+
+        envelope = message.envelope
+        compact_envelope = message.compact_envelope
+        # These are not in the frame, and are needed to send the message
+        # in-band. They are the sender's delta references, and not copies.
+        delta_arrays = message.data.delta_arrays
+
+        def load() -> EncodedMessage:
+            with open(path, 'rb') as f:
+                frame = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            os.unlink(path)
+            data = MPPMessage.from_bytes(frame).encoded_data
+            assert data is not None
+            data.delta_arrays = delta_arrays
+            return EncodedMessage(envelope, data, compact_envelope)
+
+        return load
+
+    def close(self) -> None:
+        """Removes the spill directory and any files still in it."""
+        with self._lock:
+            if self._cleanup is not None:
+                self._cleanup()
+
+    def _get_directory(self) -> Path:
+        """Returns the spill directory, creating it if needed."""
+        with self._lock:
+            if self._directory is None:
+                self._directory = Path(tempfile.mkdtemp(
+                        prefix='muscle3_spill_', dir=self._parent or Path.cwd()))
+                self._cleanup = weakref.finalize(
+                        self, shutil.rmtree, self._directory, ignore_errors=True)
+            return self._directory
@@ -17,7 +17,7 @@ from libmuscle.timestamp import Timestamp
 
 @pytest.fixture
 def mocked_mmp_client():
-    with patch('libmuscle.mmp_client.TcpTransportClient') as mock_ttc:
+    with patch('libmuscle.mmp_client.MultiplexedTcpTransportClient') as mock_ttc:
         yield MMPClient(Reference('component[13]'), ''), mock_ttc.return_value
 
 
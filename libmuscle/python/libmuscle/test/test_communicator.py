@@ -1,11 +1,17 @@
 import logging
-from unittest.mock import MagicMock, Mock, patch
+import threading
+import time
+from unittest.mock import ANY, MagicMock, Mock, patch
 
+import numpy as np
 import pytest
 
-from libmuscle.communicator import Communicator, Message
+from libmuscle.communicator import Communicator, Message, copy_data_into
+from libmuscle.grid import Grid
+from libmuscle.compression import Codec, Compressor
 from libmuscle.mpp_message import ClosePort, MPPMessage
 from libmuscle.peer_info import PeerInfo
+from libmuscle.profiling import ProfileEventType
 from ymmsl.v0_2 import Conduit, Reference as Ref, Settings
 
 
@@ -22,7 +28,9 @@ def MPPServer():
 
 @pytest.fixture
 def mpp_server(MPPServer):
-    return MPPServer.return_value
+    mpp_server = MPPServer.return_value
+    mpp_server.get_high_water.return_value = 0
+    return mpp_server
 
 
 @pytest.fixture
@@ -36,6 +44,7 @@ def port_manager():
 @pytest.fixture(autouse=True)
 def MPPClient():
     with patch('libmuscle.communicator.MPPClient') as MPPClient:
+        MPPClient.return_value.supports_batches = False
         yield MPPClient
 
 
@@ -86,7 +95,7 @@ def test_send_message(connected_communicator, mpp_server):
     args = mpp_server.deposit.call_args[0]
     assert args[0] == Ref('peer2[7].in')
 
-    encoded_msg = MPPMessage.from_bytes(args[1])
+    encoded_msg = MPPMessage.from_bytes(args[1].in_band())
     assert encoded_msg.sender == Ref('component.out_v[7]')
     assert encoded_msg.receiver == Ref('peer2[7].in')
     assert encoded_msg.port_length is None
@@ -100,6 +109,128 @@ def test_send_message(connected_communicator, mpp_server):
     assert encoded_msg.data == 'Testing'
 
 
+def test_send_multicast(communicator, mpp_server):
+    conduits = [
+            Conduit('component.out', 'peer.in'),
+            Conduit('component.out', 'peer2.in')]
+    peer_dims = {Ref('peer'): [], Ref('peer2'): []}
+    peer_locations = {
+            Ref('peer'): ['tcp:peer:9001'], Ref('peer2'): ['tcp:peer2:9001']}
+    communicator.set_peer_info(
+            PeerInfo(Ref('component'), [], conduits, peer_dims, peer_locations, []))
+
+    msg = Message(0.0, None, np.arange(10.0), Settings())
+    communicator.send_message('out', msg)
+
+    assert mpp_server.deposit.call_count == 2
+    (recv1, encoded1), (recv2, encoded2) = [
+            call[0] for call in mpp_server.deposit.call_args_list]
+    assert {recv1, recv2} == {Ref('peer.in'), Ref('peer2.in')}
+    assert encoded1.data is encoded2.data
+
+    for receiver, encoded in [(recv1, encoded1), (recv2, encoded2)]:
+        decoded = MPPMessage.from_bytes(encoded.in_band())
+        assert decoded.receiver == receiver
+        assert (decoded.data.array == np.arange(10.0)).all()
+
+
+def test_send_compressed(connected_communicator, mpp_server):
+    connected_communicator.set_compression('out', Compressor(Codec.LZMA))
+    msg = Message(0.0, None, np.zeros(10000), Settings())
+    connected_communicator.send_message('out', msg)
+
+    encoded = mpp_server.deposit.call_args[0][1]
+    assert encoded.data.compressed[0].codec == Codec.LZMA
+    event = connected_communicator._profiler.record_event.call_args[0][0]
+    assert event.message_size == encoded.nbytes
+    assert event.message_size < 10000
+
+    connected_communicator.set_compression('out', None)
+    connected_communicator.send_message('out', msg)
+    encoded = mpp_server.deposit.call_args[0][1]
+    assert encoded.data.compressed is None
+
+
+def test_outbox_high_water(connected_communicator, mpp_server, profiler):
+    connected_communicator.set_outbox_limits(1000, None, True)
+    mpp_server.set_outbox_limits.assert_called_with(1000, None, True)
+
+    msg = Message(0.0, None, 'test', Settings())
+    for high_water in (100, 300, 200):
+        mpp_server.get_high_water.return_value = high_water
+        connected_communicator.send_message('out', msg)
+
+    profiler.reset_mock()
+    with patch.object(connected_communicator, '_close_ports'):
+        connected_communicator.shutdown()
+
+    events = [
+            call[0][0] for call in profiler.record_event.call_args_list
+            if call[0][0].event_type == ProfileEventType.OUTBOX_HIGH_WATER]
+    assert len(events) == 1
+    assert events[0].port.name == 'out'
+    assert events[0].message_size == 300
+
+
+def test_outbox_high_water_unlimited(connected_communicator, mpp_server, profiler):
+    msg = Message(0.0, None, 'test', Settings())
+    connected_communicator.send_message('out', msg)
+    mpp_server.get_high_water.assert_not_called()
+
+    profiler.reset_mock()
+    with patch.object(connected_communicator, '_close_ports'):
+        connected_communicator.shutdown()
+
+    assert not any(
+            call[0][0].event_type == ProfileEventType.OUTBOX_HIGH_WATER
+            for call in profiler.record_event.call_args_list)
+
+
+def test_send_deferred(connected_communicator, mpp_server, profiler):
+    encoding = threading.Event()
+    proceed = threading.Event()
+
+    def deposit(receiver, message):
+        encoding.set()
+        assert proceed.wait(5.0)
+
+    mpp_server.deposit.side_effect = deposit
+
+    array = np.zeros(1000)
+    connected_communicator.send_message(
+            'out', Message(0.0, None, array), deferred=True)
+    assert encoding.wait(5.0)
+    port = connected_communicator._port_manager.get_port('out')
+    assert port.get_num_messages() == 1
+    profiler.record_event.assert_not_called()
+
+    array[0] = 1.0
+    proceed.set()
+    connected_communicator.flush()
+    mpp_server.deposit.side_effect = None
+
+    # encoding copied the array before we modified it
+    encoded = mpp_server.deposit.call_args[0][1]
+    assert (np.frombuffer(encoded.data.buffers[0]) == 0.0).all()
+    event = profiler.record_event.call_args[0][0]
+    assert event.message_number == 0
+    assert event.message_size == encoded.nbytes
+
+    # errors are raised by flush()
+    connected_communicator.send_message(
+            'out', Message(0.0, None, object()), deferred=True)
+    with pytest.raises(TypeError):
+        connected_communicator.flush()
+
+    # sending without deferred flushes first
+    connected_communicator.send_message('out', Message(0.0, None, 'a'), deferred=True)
+    connected_communicator.send_message('out', Message(0.0, None, 'b'))
+    messages = [call[0][1] for call in mpp_server.deposit.call_args_list[-2:]]
+    assert [MPPMessage.from_bytes(m.in_band()).data for m in messages] == ['a', 'b']
+
+    connected_communicator._send_executor.shutdown()
+
+
 def test_send_message_disconnected(connected_communicator, mpp_server):
     msg = MagicMock()
 
@@ -108,6 +239,54 @@ def test_send_message_disconnected(connected_communicator, mpp_server):
     mpp_server.deposit.assert_not_called()
 
 
+def test_receive_message_into(connected_communicator, mpp_client):
+    array = np.arange(1000.0)
+    msg = MPPMessage(
+            Ref('peer.out'), Ref('component.in'), None, 2.0, None,
+            Settings(), 0, 1.0, Grid(array))
+    frame = b''.join(bytes(s) for s in msg.encoded_out_of_band().frame())
+
+    out = np.zeros(1000)
+
+    def receive(receiver, timeout_handler, placer):
+        assert placer.target.nbytes == out.nbytes
+        placer.placed = True
+        placer.target[:] = array.view(np.uint8)
+        return frame, MagicMock()
+
+    mpp_client.receive.side_effect = receive
+
+    connected_communicator.set_receive_timeout(-1)
+    recv_msg, _ = connected_communicator.receive_message('in', None, out)
+    assert recv_msg.frame is None
+    assert np.shares_memory(recv_msg.data.array, out)
+
+    copy_data_into(recv_msg, out)
+    assert recv_msg.data.array is out
+    assert (out == array).all()
+
+
+def test_copy_data_into():
+    out = np.zeros((2, 3), order='F')
+    message = Message(0.0, None, Grid(np.arange(6.0).reshape(2, 3), ['x', 'y']))
+    copy_data_into(message, out)
+    assert message.data.array is out
+    assert message.data.indexes == ['x', 'y']
+    assert (out == np.arange(6.0).reshape(2, 3)).all()
+
+    # received in place, in the wrong order
+    out[...] = 0.0
+    out.reshape(-1, order='A')[:] = np.arange(6.0)
+    in_place = np.ndarray((2, 3), np.float64, out.reshape(-1, order='A').data)
+    message = Message(0.0, None, Grid(in_place))
+    copy_data_into(message, out)
+    assert (out == np.arange(6.0).reshape(2, 3)).all()
+
+    for data in (np.zeros((3, 2)), np.zeros((2, 3), np.int64), 'test'):
+        with pytest.raises(RuntimeError):
+            copy_data_into(Message(0.0, None, data), out)
+
+
 def test_receive_message(connected_communicator, mpp_client):
     msg = MPPMessage(
             Ref('peer.out'), Ref('component.in'), None, 2.0, 3.0,
@@ -129,6 +308,106 @@ def test_receive_message(connected_communicator, mpp_client):
     assert saved_until == 1.0
 
 
+def test_receive_and_forward(connected_communicator, mpp_client, mpp_server):
+    msg = MPPMessage(
+            Ref('peer.out'), Ref('component.in'), None, 2.0, 3.0,
+            Settings(), 0, 1.0, np.arange(4.0))
+    frame = b''.join(msg.encoded_out_of_band().frame())
+
+    mpp_client.receive.return_value = frame, MagicMock()
+
+    connected_communicator.set_receive_timeout(-1)
+    recv_msg, _ = connected_communicator.receive_message('in')
+    assert recv_msg.frame == frame
+    assert recv_msg.frame.readonly
+
+    connected_communicator.send_message('out', recv_msg)
+    encoded_msg = mpp_server.deposit.call_args[0][1]
+    assert encoded_msg.data.shared
+    assert recv_msg.frame is not None
+
+    sent_msg = MPPMessage.from_bytes(encoded_msg.in_band())
+    assert sent_msg.receiver == Ref('peer.in')
+    assert (sent_msg.data.array == np.arange(4.0)).all()
+
+    # the sent buffers are not affected by changes to the received data
+    array = recv_msg.data.array
+    assert recv_msg.frame is None
+    assert not any(np.shares_memory(array, buf) for buf in encoded_msg.data.buffers)
+
+
+def test_send_receive_delta(connected_communicator, mpp_client, mpp_server):
+    state = np.zeros(10000)
+    frames = list()
+    for i in range(3):
+        state[i] = i + 1.0
+        connected_communicator.send_message(
+                'out', Message(float(i), None, Grid.delta(state)))
+        encoded = mpp_server.deposit.call_args[0][1]
+        frames.append(b''.join(bytes(s) for s in encoded.frame()))
+
+    assert len(frames[1]) < len(frames[0]) // 20
+
+    mpp_client.receive.side_effect = [(frame, MagicMock()) for frame in frames]
+    connected_communicator.set_receive_timeout(-1)
+    for i in range(3):
+        recv_msg, _ = connected_communicator.receive_message('in')
+        assert recv_msg.frame is None
+        assert (recv_msg.data.array[:i + 1] == np.arange(1.0, i + 2.0)).all()
+        assert not recv_msg.data.array[i + 1:].any()
+
+
+def test_send_receive_same_overlay(
+        connected_communicator, mpp_client, mpp_server):
+    overlays = [Settings({'s1': i // 2}) for i in range(4)]
+    frames = list()
+    for i, overlay in enumerate(overlays):
+        connected_communicator.send_message(
+                'out', Message(float(i), None, i, overlay))
+        encoded = mpp_server.deposit.call_args[0][1]
+        frames.append(b''.join(bytes(s) for s in encoded.frame(['compact'])))
+
+    assert len(frames[1]) < len(frames[0])
+    assert len(frames[2]) == len(frames[0])
+
+    mpp_client.receive.side_effect = [(frame, MagicMock()) for frame in frames]
+    connected_communicator.set_receive_timeout(-1)
+    for i, overlay in enumerate(overlays):
+        recv_msg, _ = connected_communicator.receive_message('in')
+        assert recv_msg.data == i
+        assert recv_msg.settings == overlay
+
+    # the first message on a port must have it
+    mpp_client.receive.side_effect = [(frames[1], MagicMock())]
+    with pytest.raises(RuntimeError):
+        connected_communicator.receive_message('in_r', 0)
+
+
+def test_receive_prefetch(connected_communicator, MPPClient, mpp_client):
+    msgs = [
+            MPPMessage(
+                Ref('peer.out'), Ref('component.in'), None, 2.0, None,
+                Settings(), 0, 1.0, 'Testing'),
+            MPPMessage(
+                Ref('peer.out'), Ref('component.in'), None, float('inf'), None,
+                Settings(), 1, 1.0, ClosePort())]
+    responses = [(msg.encoded(), MagicMock()) for msg in msgs]
+    mpp_client.receive.side_effect = responses
+
+    connected_communicator.set_receive_timeout(-1)
+    connected_communicator.set_prefetch_depth('in', 2)
+    recv_msg, _ = connected_communicator.receive_message('in')
+    assert recv_msg.data == 'Testing'
+    recv_msg, _ = connected_communicator.receive_message('in')
+    assert isinstance(recv_msg.data, ClosePort)
+
+    MPPClient.assert_called_once_with(['tcp:peer:9001'])
+    mpp_client.receive.assert_called_with(Ref('component.in'), None)
+    assert mpp_client.receive.call_count == 2
+    connected_communicator._prefetchers[('in', None)]._thread.join(5.0)
+    mpp_client.close.assert_called_once()
+
+
 def test_receive_message_vector(connected_communicator, mpp_client):
     msg = MPPMessage(
             Ref('peer2.out_v'), Ref('component.in_v'), 5, 4.0, 6.0,
@@ -150,6 +429,88 @@ def test_receive_message_vector(connected_communicator, mpp_client):
     assert saved_until == 3.5
 
 
+def test_receive_message_batched(connected_communicator, mpp_client):
+    def encoded(receiver, num, data):
+        return MPPMessage(
+                Ref('peer.out'), Ref(receiver), None, 0.0, None, Settings(),
+                num, 0.0, data).encoded()
+
+    mpp_client.supports_batches = True
+    mpp_client.receive_batch.return_value = [
+            (0, encoded('component.in', 0, 'a')),
+            (0, encoded('component.in', 1, 'b'))], MagicMock()
+
+    connected_communicator.set_receive_timeout(-1)
+    assert connected_communicator.receive_message('in')[0].data == 'a'
+    assert connected_communicator.receive_message('in')[0].data == 'b'
+    mpp_client.receive_batch.assert_called_once_with(
+            [Ref('component.in')], None, ANY, ANY)
+
+    mpp_client.receive_batch.return_value = [
+            (0, encoded('component.in_v[5]', 0, 'c')),
+            (1, encoded('component.in', 2, 'd'))], MagicMock()
+    assert connected_communicator.receive_message('in_v', 5)[0].data == 'c'
+    mpp_client.receive_batch.assert_called_with(
+            [Ref('component.in_v[5]'), Ref('component.in')], None, ANY, ANY)
+
+    # in already has a message waiting, so no more are fetched for it
+    mpp_client.receive_batch.return_value = [
+            (0, encoded('component.in_v[5]', 1, 'e'))], MagicMock()
+    assert connected_communicator.receive_message('in_v', 5)[0].data == 'e'
+    mpp_client.receive_batch.assert_called_with(
+            [Ref('component.in_v[5]')], None, ANY, ANY)
+
+    assert connected_communicator.receive_message('in')[0].data == 'd'
+    assert mpp_client.receive_batch.call_count == 3
+    mpp_client.receive.assert_not_called()
+
+
+def test_receive_messages(connected_communicator, MPPClient):
+    def make_client(locations):
+        client = MagicMock()
+        client.supports_batches = False
+
+        def receive(receiver, timeout_handler):
+            slot = int(str(receiver[-1]))
+            time.sleep((3 - slot) * 0.05)
+            msg = MPPMessage(
+                    Ref(f'peer2[{slot}].out_v'), receiver, None, 0.0, None,
+                    Settings(), client.receive.call_count - 1, 0.0, slot)
+            return msg.encoded(), MagicMock()
+
+        client.receive.side_effect = receive
+        return client
+
+    MPPClient.side_effect = make_client
+    connected_communicator._manager.is_deadlocked.return_value = False
+    connected_communicator.set_receive_timeout(0.01)
+
+    received = list(connected_communicator.receive_messages('in_v', [0, 1, 2]))
+    assert [slot for slot, _, _ in received] == [0, 1, 2]
+    assert [msg.data for _, msg, _ in received] == [0, 1, 2]
+    assert MPPClient.call_count == 3
+
+    received = list(connected_communicator.receive_messages(
+        'in_v', [0, 1, 2], False))
+    assert [slot for slot, _, _ in received] == [2, 1, 0]
+    assert [msg.data for _, msg, _ in received] == [2, 1, 0]
+
+    port = connected_communicator._port_manager.get_port('in_v')
+    assert port.get_message_counts()[:3] == [2, 2, 2]
+    connected_communicator._manager.waiting_for_receive.assert_called()
+    connected_communicator._manager.waiting_for_receive_done.assert_called()
+    connected_communicator._receive_pool.shutdown()
+
+
+def test_receive_messages_error(connected_communicator, mpp_client):
+    mpp_client.receive.side_effect = ConnectionError()
+    connected_communicator.set_receive_timeout(-1)
+
+    with pytest.raises(RuntimeError, match='peer2'):
+        list(connected_communicator.receive_messages('in_v', [0, 1]))
+    connected_communicator._receive_pool.shutdown()
+
+
 def test_receive_close_port(connected_communicator, mpp_client, port_manager):
     msg = MPPMessage(
             Ref('peer.out'), Ref('component.in'), None, float('inf'), None,
@@ -294,7 +655,7 @@ def test_shutdown(
 
     for call in mpp_server.deposit.call_args_list:
         assert call[0][0] in expected_receivers
-        msg = MPPMessage.from_bytes(call[0][1])
+        msg = MPPMessage.from_bytes(call[0][1].in_band())
         assert isinstance(msg.data, ClosePort)
         expected_receivers.remove(call[0][0])
 
@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+
+from libmuscle.compression import Codec, CompressedBuffer, Compressor
+from libmuscle.mcp.protocol import MPPFeature
+
+
+@pytest.fixture
+def zeros():
+    return np.zeros(100000).data.cast('B')
+
+
+@pytest.fixture
+def noise():
+    return np.random.default_rng(1).random(100000).data.cast('B')
+
+
+@pytest.mark.parametrize('codec', [Codec.ZLIB, Codec.LZMA, Codec.BZ2])
+def test_roundtrip(codec, zeros):
+    compressed = Compressor(codec).compress(zeros)
+    assert compressed.codec == codec
+    assert compressed.size == zeros.nbytes
+    assert len(compressed.data) < zeros.nbytes // 100
+
+    decompressed = compressed.decompressed()
+    assert decompressed == zeros
+    assert not decompressed.readonly
+
+
+def test_codec_feature():
+    assert Codec.ZLIB.feature() == MPPFeature.ZLIB
+
+
+def test_small_buffer():
+    buf = bytes(100)
+    compressed = Compressor(Codec.ZLIB).compress(buf)
+    assert compressed.codec == Codec.NONE
+    assert compressed.data is buf
+    assert compressed.decompressed() == buf
+
+
+def test_incompressible(noise):
+    compressed = Compressor(Codec.ZLIB).compress(bytes(noise) + bytes(100))
+    assert compressed.codec == Codec.ZLIB
+
+    compressed = Compressor(Codec.ZLIB, True).compress(noise)
+    assert compressed.codec == Codec.NONE
+
+
+def test_adaptive(zeros):
+    compressed = Compressor(Codec.ZLIB, True).compress(zeros)
+    assert compressed.codec == Codec.ZLIB
+    assert compressed.decompressed() == zeros
+
+    compressor = Compressor(Codec.ZLIB, True, 0.0)
+    assert compressor.compress(zeros).codec == Codec.NONE
+
+
+def test_corrupt(zeros):
+    compressed = Compressor(Codec.ZLIB).compress(zeros)
+    corrupt = CompressedBuffer(Codec.ZLIB, compressed.data, 10)
+    with pytest.raises(RuntimeError):
+        corrupt.decompressed()
+
+
+def test_from_setting():
+    assert Compressor.from_setting('none', 0.8) is None
+    assert Compressor.from_setting('lzma', 0.8).codec == Codec.LZMA
+    assert Compressor.from_setting('adaptive', 0.5)._adaptive
+
+    with pytest.raises(ValueError):
+        Compressor.from_setting('NONE', 0.8)
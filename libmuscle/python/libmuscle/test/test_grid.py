@@ -14,3 +14,21 @@ def test_grid() -> None:
 
     with pytest.raises(ValueError):
         _ = Grid(a, ['x', 'y', 'z'])
+
+
+def test_grid_encodings() -> None:
+    a = np.zeros((2, 3))
+    assert Grid(a).encoding == 'dense'
+
+    grid = Grid.sparse(a, ['x', 'y'])
+    assert grid.array is a
+    assert grid.indexes == ['x', 'y']
+    assert grid.encoding == 'sparse'
+
+    grid = Grid.delta(a)
+    assert grid.array is a
+    assert grid.indexes is None
+    assert grid.encoding == 'delta'
+
+    with pytest.raises(ValueError):
+        Grid.delta(a, ['x'])
@@ -3,8 +3,11 @@ from contextlib import nullcontext as does_not_raise
 import logging
 from unittest.mock import MagicMock, patch
 
+import numpy as np
 import pytest
 
+from libmuscle.communicator import Message
+from libmuscle.grid import Grid
 from libmuscle.instance import Instance, InstanceFlags
 from libmuscle.mpp_message import ClosePort
 from ymmsl.v0_2 import Checkpoints, Operator, Reference as Ref, Settings
@@ -20,12 +23,11 @@ def logger():
 def MMPClient():
     with patch('libmuscle.instance.MMPClient') as MMPClient:
         mmp_client = MMPClient.return_value
-        mmp_client.request_peers.return_value = PeerInfo(*[MagicMock()]*6)
-
         checkpoints = MagicMock()
         checkpoints.__bool__.return_value = False
-        mmp_client.get_checkpoint_info.return_value = [
-                MagicMock(), checkpoints, MagicMock(), MagicMock()]
+        mmp_client.bootstrap.return_value = (
+                PeerInfo(*[MagicMock()]*6), MagicMock(),
+                [MagicMock(), checkpoints, MagicMock(), MagicMock()])
         yield MMPClient
 
 
@@ -131,7 +133,9 @@ def instance(
         communicator, settings_manager, no_resume_snapshot_manager, trigger_manager,
         manager_location_argv, instance_argv, declared_ports):
 
-    return Instance(declared_ports)
+    instance = Instance(declared_ports)
+    yield instance
+    instance.error_shutdown('')  # ensure all threads and resources are cleaned up
 
 
 @pytest.fixture
@@ -140,7 +144,9 @@ def instance_dont_apply_overlay(
         communicator, settings_manager, no_resume_snapshot_manager, trigger_manager,
         manager_location_argv, instance_argv, declared_ports):
 
-    return Instance(declared_ports, InstanceFlags.DONT_APPLY_OVERLAY)
+    instance = Instance(declared_ports, InstanceFlags.DONT_APPLY_OVERLAY)
+    yield instance
+    instance.error_shutdown('')  # ensure all threads and resources are cleaned up
 
 
 def test_create_instance_manager_location_default(
@@ -179,9 +185,9 @@ def test_create_instance_registration(
 
     locations = communicator.get_locations.return_value
 
-    mmp_client.register_instance.assert_called_once()
-    assert mmp_client.register_instance.call_args[0][0] == locations
-    port_desc = mmp_client.register_instance.call_args[0][1]
+    mmp_client.bootstrap.assert_called_once()
+    assert mmp_client.bootstrap.call_args[0][0] == locations
+    port_desc = mmp_client.bootstrap.call_args[0][1]
     assert port_desc[0].name == 'in'
     assert port_desc[0].operator == Operator.F_INIT
     assert port_desc[1].name == 'not_connected'
@@ -213,19 +219,33 @@ def test_create_instance_connecting(
         manager_location_argv, instance_argv, mmp_client, port_manager, communicator,
         settings_manager, declared_ports):
     peer_info = MagicMock()
-    mmp_client.request_peers.return_value = peer_info
-
     settings = MagicMock()
-    mmp_client.get_settings.return_value = settings
+    checkpoint_info = mmp_client.bootstrap.return_value[2]
+    mmp_client.bootstrap.return_value = (peer_info, settings, checkpoint_info)
 
     instance = Instance(declared_ports)
     port_manager.connect_ports.assert_called_once_with(peer_info)
     communicator.set_peer_info.assert_called_once_with(peer_info)
+    mmp_client.request_peers.assert_not_called()
 
     assert settings_manager.base == settings
     instance.error_shutdown("Ensure all threads and resources are cleaned up")
 
 
+def test_create_instance_connecting_late_peers(
+        manager_location_argv, instance_argv, mmp_client, port_manager,
+        declared_ports):
+    peer_info = MagicMock()
+    mmp_client.request_peers.return_value = peer_info
+    mmp_client.bootstrap.return_value = (
+            None,) + mmp_client.bootstrap.return_value[1:]
+
+    instance = Instance(declared_ports)
+    mmp_client.request_peers.assert_called_once_with()
+    port_manager.connect_ports.assert_called_once_with(peer_info)
+    instance.error_shutdown("Ensure all threads and resources are cleaned up")
+
+
 def test_create_instance_set_up_checkpointing(
         manager_location_argv, instance_argv, mmp_client, trigger_manager,
         no_resume_snapshot_manager, settings_manager, declared_ports):
@@ -233,7 +253,7 @@ def test_create_instance_set_up_checkpointing(
     instance = Instance(declared_ports)
 
     elapsed_time, checkpoints, resume_path, snapshot_path = (
-            mmp_client.get_checkpoint_info.return_value)
+            mmp_client.bootstrap.return_value[2])
 
     trigger_manager.set_checkpoint_info.assert_called_with(elapsed_time, checkpoints)
     no_resume_snapshot_manager.prepare_resume.assert_called_with(
@@ -322,7 +342,8 @@ def test_get_setting_with_default_and_type(instance, settings_manager):
 
 
 def test_list_ports(instance, port_manager):
-    port_manager.list_ports.assert_called_once_with()
+    # called by the MMSF validator and to set up prefetching and compression
+    assert port_manager.list_ports.call_count == 3
     port_manager.list_ports.reset_mock()
     instance.list_ports()
     port_manager.list_ports.assert_called_once_with()
@@ -414,9 +435,15 @@ def test_reuse_f_init_vector_port(instance, port_manager, communicator):
         mock_msg.data = Settings()
         return mock_msg, 0.0
 
+    def receive_messages(port, slots, in_order=True):
+        for slot in slots:
+            yield (slot, *receive_message(port, slot))
+
     communicator.receive_message = receive_message
+    communicator.receive_messages = receive_messages
 
     assert instance.reuse_instance() is True
+    assert len(instance._f_init_cache) == 10
 
 
 def test_reuse_no_f_init_ports(instance, connected_port_manager, communicator):
@@ -441,6 +468,15 @@ def test_send_message(instance, settings_manager, communicator):
     assert args[2] == slot
 
 
+def test_send_deferred(instance, communicator):
+    msg = Message(0.0, None, 'test', Settings())
+    instance.send('out', msg, deferred=True)
+    assert communicator.send_message.call_args[0][4] is True
+
+    instance.flush()
+    communicator.flush.assert_called_once()
+
+
 def test_send_on_invalid_port(instance):
     with pytest.raises(RuntimeError):
         instance.send('does_not_exist', MagicMock())
@@ -505,6 +541,52 @@ def test_receive_no_default(instance):
         instance.receive('not_connected_v', 14)
 
 
+def test_receive_into(instance, communicator, settings_manager):
+    settings_manager.overlay = Settings()
+    out = np.zeros((2, 3))
+    received = Message(0.0, None, Grid(np.ones((2, 3))), Settings())
+    communicator.receive_message.return_value = received, 0.0
+
+    msg = instance.receive_into('in_v', out, 3)
+    communicator.receive_message.assert_called_with('in_v', 3, out)
+    assert msg.data.array is out
+    assert (out == 1.0).all()
+
+    received.data = Grid(np.ones((3, 2)))
+    with pytest.raises(RuntimeError):
+        instance.receive_into('in_v', out, 3)
+
+    with pytest.raises(ValueError):
+        instance.receive_into('in_v', np.broadcast_to(0.0, (2, 3)), 3)
+
+
+def test_receive_all(instance, communicator, settings_manager):
+    settings_manager.overlay = Settings()
+
+    def receive_messages(port_name, slots, in_order=True):
+        assert port_name == 'in_v'
+        for slot in (slots if in_order else reversed(slots)):
+            yield slot, Message(0.0, None, slot, Settings()), 0.0
+
+    communicator.receive_messages = receive_messages
+
+    msgs = instance.receive_all('in_v')
+    assert [msg.data for msg in msgs] == list(range(13))
+    assert all(msg.settings is None for msg in msgs)
+
+    received = list(instance.receive_any('in_v'))
+    assert [slot for slot, _ in received] == list(reversed(range(13)))
+    assert all(msg.data == slot for slot, msg in received)
+
+
+def test_receive_all_invalid(instance):
+    with pytest.raises(RuntimeError):
+        instance.receive_all('not_connected_v')
+
+    with pytest.raises(RuntimeError):
+        list(instance.receive_any('in'))
+
+
 def test_receive_inconsistent_settings(
         instance, settings_manager, port_manager, communicator):
 
@@ -567,7 +649,8 @@ def test_checkpoint_support(
         instance_argv, mmp_client, tmp_path, flags, expectation):
 
     checkpoint_info = (0.0, Checkpoints(at_end=True), None, tmp_path)
-    mmp_client.get_checkpoint_info.return_value = checkpoint_info
+    peer_info, settings, _ = mmp_client.bootstrap.return_value
+    mmp_client.bootstrap.return_value = (peer_info, settings, checkpoint_info)
 
     with expectation:
         instance = Instance(flags=flags)
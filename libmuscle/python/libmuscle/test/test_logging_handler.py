@@ -0,0 +1,64 @@
+import logging
+from unittest.mock import MagicMock, patch
+
+from libmuscle.logging import LogLevel
+from libmuscle.logging_handler import MuscleManagerHandler
+
+
+def make_record(text: str, level: int = logging.WARNING) -> logging.LogRecord:
+    return logging.LogRecord('test', level, __file__, 1, text, None, None)
+
+
+def sent_messages(mmp_client: MagicMock):
+    return [
+            (m.level, m.text, m.count)
+            for call in mmp_client.submit_log_messages.call_args_list
+            for m in call[0][0]]
+
+
+def test_batching() -> None:
+    mmp_client = MagicMock()
+    handler = MuscleManagerHandler('instance[1]', logging.WARNING, mmp_client)
+    handler.emit(make_record('first'))
+    handler.emit(make_record('again'))
+    handler.emit(make_record('again'))
+    handler.emit(make_record('error', logging.ERROR))
+    handler.emit(make_record('again'))
+    assert not mmp_client.submit_log_messages.called
+
+    handler.close()
+    assert mmp_client.submit_log_messages.call_count == 1
+    assert sent_messages(mmp_client) == [
+            (LogLevel.WARNING, 'first', 1), (LogLevel.WARNING, 'again', 2),
+            (LogLevel.ERROR, 'error', 1), (LogLevel.WARNING, 'again', 1)]
+
+
+def test_flush_interval() -> None:
+    mmp_client = MagicMock()
+    with patch('libmuscle.logging_handler._FLUSH_INTERVAL', 0.01):
+        handler = MuscleManagerHandler('instance[1]', logging.WARNING, mmp_client)
+        handler.emit(make_record('message'))
+        handler._thread.join(0.2)
+
+    assert sent_messages(mmp_client) == [(LogLevel.WARNING, 'message', 1)]
+    handler.close()
+
+
+def test_dropped_messages() -> None:
+    mmp_client = MagicMock()
+    mmp_client.submit_log_messages.side_effect = [ConnectionError(), None]
+    with patch('libmuscle.logging_handler._BUFFER_SIZE', 2):
+        handler = MuscleManagerHandler('instance[1]', logging.WARNING, mmp_client)
+        for i in range(3):
+            handler.emit(make_record(f'message {i}'))
+
+        with handler._cv:
+            handler._flush()
+            assert handler._num_dropped == 3
+
+        handler.emit(make_record('last'))
+        handler.close()
+
+    last_batch = mmp_client.submit_log_messages.call_args[0][0]
+    assert last_batch[0].text.startswith('3 log messages were not sent')
+    assert last_batch[1].text == 'last'
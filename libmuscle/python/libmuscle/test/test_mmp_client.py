@@ -7,11 +7,11 @@ from ymmsl.v0_2 import Conduit, Operator, Port, Reference
 import libmuscle
 from libmuscle.logging import LogLevel, LogMessage, Timestamp
 from libmuscle.mcp.protocol import RequestType, ResponseType
-from libmuscle.mmp_client import MMPClient
+from libmuscle.mmp_client import MMPClient, PEER_WAIT
 
 
 def test_init() -> None:
-    with patch('libmuscle.mmp_client.TcpTransportClient') as mock_ttc:
+    with patch('libmuscle.mmp_client.MultiplexedTcpTransportClient') as mock_ttc:
         stub = mock_ttc.return_value
         client = MMPClient(Reference([]), '')
         assert client._transport_client == stub     # type: ignore
@@ -52,6 +52,27 @@ def test_submit_log_message(mocked_mmp_client, profile_data) -> None:
             'Testing the MMPClient']
 
 
+def test_submit_log_messages(mocked_mmp_client, profile_data) -> None:
+    client, stub = mocked_mmp_client
+    result = [ResponseType.SUCCESS.value]
+    stub.call.return_value = (
+            msgpack.packb(result, use_bin_type=True), profile_data)
+
+    messages = [
+            LogMessage('component[13]', Timestamp(1.0), LogLevel.WARNING, 'First'),
+            LogMessage('component[13]', Timestamp(2.0), LogLevel.ERROR, 'Again', 3)]
+
+    client.submit_log_messages(messages)
+
+    sent_request = stub.call.call_args[0][0]
+    decoded_request = msgpack.unpackb(sent_request, raw=False)
+
+    assert decoded_request == [
+            RequestType.SUBMIT_LOG_MESSAGES.value, 'component[13]', [
+                [1.0, LogLevel.WARNING.value, 'First', 1],
+                [2.0, LogLevel.ERROR.value, 'Again', 3]]]
+
+
 def test_get_settings(mocked_mmp_client, profile_data) -> None:
     client, stub = mocked_mmp_client
 
@@ -95,6 +116,67 @@ def test_register_instance(mocked_mmp_client, profile_data) -> None:
             libmuscle.__version__]
 
 
+def test_bootstrap(mocked_mmp_client, profile_data) -> None:
+    client, stub = mocked_mmp_client
+
+    result = [
+            ResponseType.SUCCESS.value,
+            [
+                ResponseType.SUCCESS.value,
+                [['component.out', 'other.in']],
+                {'other': [20]},
+                {'other': ['direct:test']},
+                [['out', 'O_F']]],
+            {'test': 13},
+            [12.3, {'at_end': True, 'wallclock_time': [], 'simulation_time': []},
+             None, '/tmp']]
+    stub.call.return_value = (
+            msgpack.packb(result, use_bin_type=True), profile_data)
+
+    peer_info, settings, checkpoint_info = client.bootstrap(
+            ['direct:test'], [Port('out', Operator.O_F)])
+
+    sent_msg = msgpack.unpackb(stub.call.call_args[0][0], raw=False)
+    assert sent_msg == [
+            RequestType.BOOTSTRAP.value, 'component[13]', ['direct:test'],
+            [['out', 'O_F']], libmuscle.__version__, PEER_WAIT]
+
+    assert peer_info is not None
+    assert peer_info._peer_locations == {'other': ['direct:test']}
+    assert settings['test'] == 13
+    assert checkpoint_info[0] == 12.3
+    assert checkpoint_info[1].at_end
+    assert checkpoint_info[2] is None
+    assert str(checkpoint_info[3]) == '/tmp'
+
+
+def test_bootstrap_pending(mocked_mmp_client, profile_data) -> None:
+    client, stub = mocked_mmp_client
+
+    result = [
+            ResponseType.SUCCESS.value,
+            [ResponseType.PENDING.value, 'Waiting for component other'],
+            {},
+            [12.3, {'at_end': False, 'wallclock_time': [], 'simulation_time': []},
+             None, None]]
+    stub.call.return_value = (
+            msgpack.packb(result, use_bin_type=True), profile_data)
+
+    peer_info, _, _ = client.bootstrap(['direct:test'], [])
+    assert peer_info is None
+
+
+def test_bootstrap_error(mocked_mmp_client, profile_data) -> None:
+    client, stub = mocked_mmp_client
+
+    result = [ResponseType.ERROR.value, 'test_error_message']
+    stub.call.return_value = (
+            msgpack.packb(result, use_bin_type=True), profile_data)
+
+    with pytest.raises(RuntimeError):
+        client.bootstrap(['direct:test'], [])
+
+
 def test_request_peers(mocked_mmp_client, profile_data) -> None:
     client, stub = mocked_mmp_client
 
@@ -113,6 +195,7 @@ def test_request_peers(mocked_mmp_client, profile_data) -> None:
     sent_msg = msgpack.unpackb(stub.call.call_args[0][0], raw=False)
     assert sent_msg[0] == RequestType.GET_PEERS.value
     assert sent_msg[1] == 'component[13]'
+    assert sent_msg[2] == PEER_WAIT
 
     assert peer_info._kernel == Reference("component")
     assert peer_info._index == [13]
@@ -153,11 +236,14 @@ def test_request_peers_timeout(mocked_mmp_client, profile_data) -> None:
             msgpack.packb(result_msg, use_bin_type=True), profile_data)
 
     with patch('libmuscle.mmp_client.PEER_TIMEOUT', 1), \
-            patch('libmuscle.mmp_client.PEER_INTERVAL_MIN', 0.1), \
-            patch('libmuscle.mmp_client.PEER_INTERVAL_MAX', 1.0):
+            patch('libmuscle.mmp_client.PEER_WAIT', 0.4):
         with pytest.raises(RuntimeError):
             client.request_peers()
 
+    waits = [msgpack.unpackb(c[0][0])[2] for c in stub.call.call_args_list]
+    assert waits[0] == 0.4
+    assert 0.0 <= waits[-1] < 0.4
+
 
 def test_deregister_instance(mocked_mmp_client, profile_data) -> None:
     client, stub = mocked_mmp_client
@@ -0,0 +1,103 @@
+import socket
+from unittest.mock import patch
+
+import numpy as np
+import pytest
+from ymmsl.v0_2 import Reference, Settings
+
+from libmuscle.mcp.protocol import MPPFeature
+from libmuscle.mcp.unix_transport_client import UnixTransportClient
+from libmuscle.mpp_client import MPPClient, peer_features
+from libmuscle.mpp_message import BufferPlacer, MPPMessage
+from libmuscle.mpp_server import MPPServer
+
+
+def test_peer_features():
+    locations = ['tcp:localhost:9001', 'mpp:oob,chunked,zlib,unknown']
+    assert peer_features(locations) == [
+            MPPFeature.OUT_OF_BAND, MPPFeature.CHUNKED, MPPFeature.ZLIB]
+    assert peer_features(locations, False) == [MPPFeature.OUT_OF_BAND]
+    assert peer_features(['tcp:localhost:9001']) == []
+
+
+@pytest.mark.skipif(
+        not hasattr(socket, 'AF_UNIX'), reason='Unix domain sockets not available')
+def test_unix_features():
+    server = MPPServer()
+    locations = [
+            location for location in server.get_locations()
+            if location.startswith(('unix:', 'mpp:'))]
+    client = MPPClient(locations)
+    assert MPPFeature.OUT_OF_BAND in client._features
+    assert MPPFeature.ZLIB not in client._features
+    assert MPPFeature.CHUNKED not in client._features
+
+    client.close()
+    server.shutdown()
+
+
+@pytest.fixture
+def chunked_server():
+    with patch('libmuscle.mpp_server._CHUNKED_MIN_BYTES', 10000), \
+            patch('libmuscle.mpp_client._CHUNK_SIZE', 4096):
+        server = MPPServer()
+        yield server
+        server.shutdown()
+
+
+def test_receive_chunked(chunked_server):
+    locations = [
+            location for location in chunked_server.get_locations()
+            if location.startswith(('tcp:', 'mpp:'))]
+    client = MPPClient(locations)
+
+    receiver = Reference('micro.in')
+    array = np.arange(10000.0)
+    msg = MPPMessage(
+            Reference('macro.out'), receiver, None, 0.0, None, Settings(), 0,
+            0.0, array).encoded_out_of_band()
+
+    chunked_server.deposit(receiver, msg)
+    frame, _ = client.receive(receiver, None)
+    assert (MPPMessage.from_bytes(frame).data.array == array).all()
+    assert len(client._stripes) == 3
+
+    out = np.zeros(10000)
+    placer = BufferPlacer(out.data.cast('B'))
+    chunked_server.deposit(receiver, msg)
+    client.receive(receiver, None, placer)
+    assert placer.placed
+    assert (out == array).all()
+
+    chunked_server.deposit(receiver, msg)
+    messages, _ = client.receive_batch([receiver], None, 10, 100000)
+    assert (MPPMessage.from_bytes(messages[0][1]).data.array == array).all()
+
+    client.close()
+    chunked_server.wait_for_receivers()
+
+
+@pytest.mark.skipif(
+        not hasattr(socket, 'AF_UNIX'), reason='Unix domain sockets not available')
+def test_receive_chunked_unix(chunked_server):
+    locations = [
+            location for location in chunked_server.get_locations()
+            if location.startswith(('unix:', 'mpp:'))]
+    client = MPPClient(locations)
+    # not negotiated by default on a node-local transport, but it should work
+    client._features.append(MPPFeature.CHUNKED)
+
+    receiver = Reference('micro.in')
+    array = np.arange(10000.0)
+    msg = MPPMessage(
+            Reference('macro.out'), receiver, None, 0.0, None, Settings(), 0,
+            0.0, array).encoded_out_of_band()
+
+    chunked_server.deposit(receiver, msg)
+    frame, _ = client.receive(receiver, None)
+    assert (MPPMessage.from_bytes(frame).data.array == array).all()
+    assert len(client._stripes) == 3
+    assert all(isinstance(s, UnixTransportClient) for s in client._stripes)
+
+    client.close()
+    chunked_server.wait_for_receivers()
@@ -1,12 +1,18 @@
 import struct
+from unittest.mock import patch
 
 import msgpack
 import numpy as np
+import pytest
 
 from ymmsl.v0_2 import Reference, Settings
 
+from libmuscle.compression import Codec, Compressor
 from libmuscle.grid import Grid
-from libmuscle.mpp_message import MPPMessage
+from libmuscle.mpp_message import (
+        batch_frame, BufferPlacer, chunked_descriptor, ClosePort,
+        DeltaReferences, EncodedData, ExtTypeId, MPPMessage,
+        parse_chunked_descriptor, split_batch, _NOT_DECODED)
 
 
 def test_create() -> None:
@@ -188,3 +194,544 @@ def test_non_contiguous_grid_roundtrip() -> None:
     assert grid_out.array.size == 12
     assert grid_out.array[1, 0, 1] == 8.0
     assert grid_out.array[0, 0, 2] == 3.0
+
+
+def test_extra_dtypes_roundtrip() -> None:
+    sender = Reference('sender.port')
+    receiver = Reference('receiver.port')
+
+    dtypes = [
+            np.int8, np.int16, np.uint8, np.uint16, np.uint32, np.uint64,
+            np.float16, np.complex64, np.complex128]
+
+    for dtype in dtypes:
+        array = np.arange(12).reshape(3, 4).astype(dtype)
+        if np.issubdtype(dtype, np.complexfloating):
+            array += 0.5j
+        msg = MPPMessage(
+                sender, receiver, None, 1.0, None, Settings(), 0, 1.0,
+                Grid(array))
+
+        grid_out = MPPMessage.from_bytes(msg.encoded()).data
+        assert grid_out.array.dtype == dtype
+        assert (grid_out.array == array).all()
+
+        frame = _join(msg.encoded_out_of_band().frame())
+        buf = bytearray(len(frame) + 64)
+        offset = -np.frombuffer(buf, np.uint8).ctypes.data % 64
+        buf[offset:offset + len(frame)] = frame
+        view = memoryview(buf)[offset:offset + len(frame)]
+
+        grid_out = MPPMessage.from_bytes(view).data
+        assert grid_out.array.dtype == dtype
+        assert (grid_out.array == array).all()
+        assert np.shares_memory(grid_out.array, np.frombuffer(buf, np.uint8))
+
+
+def test_unsupported_dtype() -> None:
+    msg = MPPMessage(
+            Reference('sender.port'), Reference('receiver.port'), None, 1.0,
+            None, Settings(), 0, 1.0, np.array(['a', 'b']))
+
+    with pytest.raises(RuntimeError):
+        msg.encoded()
+
+
+def _join(frame) -> bytes:
+    return b''.join(bytes(segment) for segment in frame)
+
+
+def test_out_of_band_roundtrip() -> None:
+    sender = Reference('sender.port')
+    receiver = Reference('receiver.port')
+
+    array = np.arange(24, dtype=np.float64).reshape(2, 3, 4, order='F')
+    mask = np.array([True, False, True])
+    data = {'state': Grid(array, ['x', 'y', 'z']), 'mask': mask, 'step': 3}
+    msg = MPPMessage(
+            sender, receiver, 4, 10.0, 11.0, Settings({'s1': 1}), 5, 2.0, data)
+
+    encoded = msg.encoded_out_of_band()
+    assert len(encoded.data.buffers) == 2
+
+    # the sender may modify the array after sending
+    array[0, 0, 0] = 100.0
+
+    frame = _join(encoded.frame())
+    assert len(_join(encoded.frame(['compact']))) == encoded.nbytes
+
+    buf = bytearray(len(frame) + 64)
+    offset = -np.frombuffer(buf, np.uint8).ctypes.data % 64
+    buf[offset:offset + len(frame)] = frame
+    msg_out = MPPMessage.from_bytes(memoryview(buf)[offset:offset + len(frame)])
+
+    assert msg_out.sender == sender
+    assert msg_out.receiver == receiver
+    assert msg_out.port_length == 4
+    assert msg_out.timestamp == 10.0
+    assert msg_out.next_timestamp == 11.0
+    assert msg_out.settings_overlay == Settings({'s1': 1})
+    assert msg_out.message_number == 5
+    assert msg_out.saved_until == 2.0
+    assert msg_out.data['step'] == 3
+
+    grid_out = msg_out.data['state']
+    assert grid_out.indexes == ['x', 'y', 'z']
+    assert grid_out.array.flags.f_contiguous
+    assert grid_out.array[0, 0, 0] == 0.0
+    assert (grid_out.array[1:] == np.arange(24).reshape(2, 3, 4, order='F')[1:]).all()
+    assert grid_out.array.ctypes.data % 64 == 0
+
+    mask_out = msg_out.data['mask'].array
+    assert mask_out.dtype == np.bool_
+    assert (mask_out == mask).all()
+    assert mask_out.ctypes.data % 64 == 0
+
+    # received arrays refer to the received buffer, rather than a copy
+    assert np.shares_memory(grid_out.array, np.frombuffer(buf, np.uint8))
+
+
+def test_sparse_grid() -> None:
+    array = np.zeros((100, 20), np.float32, order='F')
+    array[3, 4] = 1.5
+    array[99, 19] = -2.0
+    msg = MPPMessage(
+            Reference('sender.port'), Reference('receiver.port'), None, 1.0,
+            None, Settings(), 0, 1.0, Grid.sparse(array, ['x', 'y']))
+
+    encoded = msg.encoded_out_of_band()
+    assert sum(buf.nbytes for buf in encoded.data.buffers) == 16
+
+    for wire_data in (_join(encoded.frame()), encoded.in_band(), msg.encoded()):
+        grid_out = MPPMessage.from_bytes(wire_data).data
+        assert grid_out.indexes == ['x', 'y']
+        assert grid_out.array.dtype == np.float32
+        assert grid_out.array.flags.f_contiguous
+        assert (grid_out.array == array).all()
+
+    # dense arrays are sent as usual
+    array = np.ones((100, 20))
+    msg.data = Grid.sparse(array)
+    encoded = msg.encoded_out_of_band()
+    assert sum(buf.nbytes for buf in encoded.data.buffers) == array.nbytes
+    assert (MPPMessage.from_bytes(_join(encoded.frame())).data.array == array).all()
+
+
+def test_delta_grids() -> None:
+    sender = Reference('sender.port')
+    receiver = Reference('receiver.port')
+    send_deltas = DeltaReferences()
+    receive_deltas = DeltaReferences()
+
+    def transfer(data):
+        msg = MPPMessage(sender, receiver, None, 1.0, None, Settings(), 0, 1.0, data)
+        encoded = msg.encoded_out_of_band(None, send_deltas)
+        msg_out = MPPMessage.from_bytes(_join(encoded.frame()))
+        assert msg_out.encoded_data.has_deltas
+        return encoded.nbytes, msg_out.encoded_data.decoded(receive_deltas)
+
+    state = np.zeros((100, 100))
+    mask = np.zeros(10000, np.bool_)
+    full_size, data = transfer([Grid.delta(state, ['x', 'y']), Grid.delta(mask)])
+    assert data[0].indexes == ['x', 'y']
+    assert (data[0].array == 0.0).all()
+    assert not data[0].array.flags.writeable
+    assert not data[1].array.any()
+
+    for i in range(3):
+        state[i, 2 * i] = i + 1.0
+        mask[i] = True
+        size, data = transfer([Grid.delta(state, ['x', 'y']), Grid.delta(mask)])
+        assert size < full_size // 20
+        assert (data[0].array == state).all()
+        assert (data[1].array == mask).all()
+
+    # changed shape, so sent in full
+    state = np.ones((10, 10), order='F')
+    size, data = transfer([Grid.delta(state), Grid.delta(mask)])
+    assert data[0].array.flags.f_contiguous
+    assert (data[0].array == state).all()
+
+    # receiver without the reference
+    msg = MPPMessage(
+            sender, receiver, None, 1.0, None, Settings(), 0, 1.0,
+            Grid.delta(state))
+    frame = _join(msg.encoded_out_of_band(None, send_deltas).frame())
+    encoded_data = MPPMessage.from_bytes(frame).encoded_data
+    with pytest.raises(RuntimeError):
+        encoded_data.decoded(DeltaReferences())
+    with pytest.raises(RuntimeError):
+        encoded_data.decoded()
+
+    # without references, delta grids are ordinary grids
+    msg_out = MPPMessage.from_bytes(_join(msg.encoded_out_of_band().frame()))
+    assert not msg_out.encoded_data.has_deltas
+    assert (msg_out.data.array == state).all()
+
+
+def test_bundle() -> None:
+    sender = Reference('sender.port')
+    receiver = Reference('receiver.port')
+
+    data = {f'a{i}': np.arange(i, dtype=np.float32) for i in range(20)}
+    data['mask'] = np.array([True, False])
+    data['state'] = Grid(np.ones((3, 4), order='F'), ['x', 'y'])
+    data['step'] = 3
+    data['sparse'] = Grid.sparse(np.zeros(100))
+    data['empty'] = np.zeros((0, 3), np.int64)
+    data['large'] = np.zeros(100000)
+    msg = MPPMessage(sender, receiver, None, 1.0, None, Settings(), 0, 1.0, data)
+
+    # one for the bundle, two for the sparse grid, and one for the large array
+    encoded = msg.encoded_out_of_band()
+    assert len(encoded.data.buffers) == 4
+
+    frame = _join(encoded.frame())
+    buf = bytearray(len(frame) + 64)
+    offset = -np.frombuffer(buf, np.uint8).ctypes.data % 64
+    buf[offset:offset + len(frame)] = frame
+    view = memoryview(buf)[offset:offset + len(frame)]
+
+    codes = set()
+
+    def ext_hook(code, data):
+        codes.add(code)
+
+    for wire_data in (view, encoded.in_band()):
+        data_out = MPPMessage.from_bytes(wire_data).data
+        assert list(data_out) == list(data)
+        for i in range(20):
+            assert data_out[f'a{i}'].array.dtype == np.float32
+            assert (data_out[f'a{i}'].array == np.arange(i)).all()
+            assert data_out[f'a{i}'].indexes is None
+        assert (data_out['mask'].array == [True, False]).all()
+        assert data_out['state'].indexes == ['x', 'y']
+        assert data_out['state'].array.flags.f_contiguous
+        assert (data_out['state'].array == 1.0).all()
+        assert data_out['step'] == 3
+        assert not data_out['sparse'].array.any()
+        assert data_out['empty'].array.shape == (0, 3)
+        assert data_out['large'].array.shape == (100000,)
+
+        # received arrays are aligned views of the received buffer
+        if wire_data is view:
+            for i in range(20):
+                array = data_out[f'a{i}'].array
+                assert array.ctypes.data % 64 == 0
+                assert i == 0 or np.shares_memory(array, np.frombuffer(buf, np.uint8))
+
+        # peers that don't support out-of-band data get ordinary grids
+        else:
+            msgpack.unpackb(wire_data, ext_hook=ext_hook)
+            assert ExtTypeId.GRID_FLOAT32 in codes
+            assert ExtTypeId.GRID_BUNDLE not in codes
+
+    # delta grids still work inside a bundle
+    send_deltas = DeltaReferences()
+    receive_deltas = DeltaReferences()
+    array = np.zeros(1000)
+    for i in range(2):
+        array[i] = 1.0
+        msg.data = {'a': array, 'b': array, 'c': array, 'd': array,
+                    'e': Grid.delta(array)}
+        frame = _join(msg.encoded_out_of_band(None, send_deltas).frame())
+        encoded_data = MPPMessage.from_bytes(frame).encoded_data
+        assert encoded_data.has_deltas
+        data_out = encoded_data.decoded(receive_deltas)
+        assert (data_out['e'].array == array).all()
+
+
+def test_out_of_band_in_band() -> None:
+    sender = Reference('sender.port')
+    receiver = Reference('receiver.port')
+
+    datas = [
+            'testing', None, {'a': [1, 2.0, 'three']},
+            Grid(np.array([[1, 2], [3, 4]], np.int32), ['i', 'j']),
+            [np.array([1.5, 2.5], np.float32), Settings({'x': 1})]]
+
+    for data in datas:
+        msg = MPPMessage(
+                sender, receiver, None, 1.0, None, Settings({'s': 'v'}), 0, 3.0,
+                data)
+        assert msg.encoded_out_of_band().in_band() == msg.encoded()
+
+
+def test_sparse_delta_in_band() -> None:
+    sender = Reference('sender.port')
+    receiver = Reference('receiver.port')
+    deltas = DeltaReferences()
+    state = np.zeros((100, 100))
+    mask = np.zeros(10000, np.bool_)
+
+    for i in range(2):
+        state[i, i] = 1.0
+        mask[i] = True
+        msg = MPPMessage(
+                sender, receiver, None, 1.0, None, Settings(), i, 3.0,
+                [Grid.sparse(state, ['x', 'y']), Grid.delta(state, ['x', 'y']),
+                 {'d': Grid.delta(mask), 'b': np.ones(3), 'c': np.ones(3),
+                  'e': np.ones(3), 'f': np.ones(3)}])
+        encoded = msg.encoded_out_of_band(None, deltas)
+        if i == 1:
+            # only the changes are sent out-of-band
+            assert encoded.nbytes < state.nbytes // 20
+
+        # in-band receivers only get ordinary grids
+        codes = set()
+
+        def ext_hook(code, data):
+            codes.add(code)
+            return msgpack.ExtType(code, data)
+
+        wire_data = encoded.in_band()
+        msgpack.unpackb(wire_data, ext_hook=ext_hook)
+        assert codes == {
+                ExtTypeId.SETTINGS, ExtTypeId.GRID_FLOAT64, ExtTypeId.GRID_BOOL}
+
+        data = MPPMessage.from_bytes(wire_data).data
+        assert (data[0].array == state).all()
+        assert data[0].indexes == ['x', 'y']
+        assert (data[1].array == state).all()
+        assert data[1].indexes == ['x', 'y']
+        assert (data[2]['d'].array == mask).all()
+
+
+def test_non_contiguous_out_of_band() -> None:
+    array = np.arange(12, dtype=np.int64).reshape(3, 4)[:, ::2]
+    msg = MPPMessage(
+            Reference('sender.port'), Reference('receiver.port'), None, 1.0,
+            None, Settings(), 0, 3.0, array)
+
+    msg_out = MPPMessage.from_bytes(_join(msg.encoded_out_of_band().frame()))
+    assert isinstance(msg_out.data, Grid)
+    assert (msg_out.data.array == array).all()
+
+
+def test_lazy_decoding() -> None:
+    data = {'state': np.arange(5.0), 'step': 3}
+    msg = MPPMessage(
+            Reference('sender.port'), Reference('receiver.port'), None, 1.0,
+            None, Settings({'s': 1}), 0, 3.0, data)
+
+    for wire_data in [msg.encoded(), _join(msg.encoded_out_of_band().frame())]:
+        msg_out = MPPMessage.from_bytes(wire_data)
+        assert msg_out.settings_overlay == Settings({'s': 1})
+        assert msg_out.encoded_data is not None
+        assert msg_out._data is _NOT_DECODED
+        assert not msg_out.is_close_port()
+
+        assert msg_out.data['step'] == 3
+        assert (msg_out.data['state'].array == np.arange(5.0)).all()
+
+
+def test_lazy_decoding_close_port() -> None:
+    msg = MPPMessage(
+            Reference('sender.port'), Reference('receiver.port'), None, 1.0,
+            None, Settings(), 0, 3.0, ClosePort())
+
+    for wire_data in [msg.encoded(), _join(msg.encoded_out_of_band().frame())]:
+        msg_out = MPPMessage.from_bytes(wire_data)
+        assert msg_out.is_close_port()
+        assert isinstance(msg_out.data, ClosePort)
+
+
+def test_lazy_decoding_none() -> None:
+    msg = MPPMessage(
+            Reference('sender.port'), Reference('receiver.port'), None, 1.0,
+            None, Settings(), 0, 3.0, None)
+
+    for wire_data in [msg.encoded(), _join(msg.encoded_out_of_band().frame())]:
+        msg_out = MPPMessage.from_bytes(wire_data)
+        with patch.object(
+                EncodedData, 'decoded', autospec=True,
+                side_effect=EncodedData.decoded) as decoded:
+            for _ in range(3):
+                assert not msg_out.is_close_port()
+            assert decoded.call_count == 1
+            for _ in range(3):
+                assert msg_out.data is None
+            assert decoded.call_count == 2
+            assert not msg_out.is_close_port()
+            assert decoded.call_count == 2
+
+
+def test_in_band_data_first() -> None:
+    # other implementations may put the data anywhere in the message
+    message_dict = {
+            'data': 'testing', 'sender': 'sender.port',
+            'receiver': 'receiver.port', 'port_length': None, 'timestamp': 1.0,
+            'next_timestamp': None, 'settings_overlay': msgpack.ExtType(1, b'\x80'),
+            'message_number': 0, 'saved_until': 3.0}
+    msg_out = MPPMessage.from_bytes(msgpack.packb(message_dict, use_bin_type=True))
+    assert msg_out.receiver == Reference('receiver.port')
+    assert msg_out.saved_until == 3.0
+    assert msg_out.data == 'testing'
+
+
+def test_compact_envelope() -> None:
+    sender = Reference('sender.port')
+    receiver = Reference('receiver.port')
+
+    for port_length, next_timestamp, overlay in (
+            (None, None, Settings()), (13, 11.5, Settings({'s1': [1.5, 2.5]}))):
+        msg = MPPMessage(
+                sender, receiver, port_length, 10.0, next_timestamp, overlay,
+                7, float('-inf'), 'data')
+        encoded = msg.encoded_out_of_band()
+        compact = _join(encoded.frame(['oob', 'compact']))
+        assert len(compact) < len(_join(encoded.frame(['oob'])))
+
+        msg_out = MPPMessage.from_bytes(compact)
+        assert msg_out.sender == Reference('_')
+        assert msg_out.receiver == Reference('_')
+        assert msg_out.port_length == port_length
+        assert msg_out.timestamp == 10.0
+        assert msg_out.next_timestamp == next_timestamp
+        assert msg_out.settings_overlay == overlay
+        assert msg_out.message_number == 7
+        assert msg_out.saved_until == float('-inf')
+        assert msg_out.data == 'data'
+        assert not msg_out.same_settings_overlay
+
+    # an unchanged overlay is left out
+    same = msg.encoded_out_of_band(previous_overlay=encoded.settings_overlay)
+    assert len(same.compact_envelope) < len(encoded.compact_envelope)
+    msg_out = MPPMessage.from_bytes(_join(same.frame(['oob', 'compact'])))
+    assert msg_out.same_settings_overlay
+    assert msg_out.settings_overlay == Settings()
+    msg_out = MPPMessage.from_bytes(_join(same.frame(['oob'])))
+    assert not msg_out.same_settings_overlay
+    assert msg_out.settings_overlay == overlay
+
+    # a future version that we don't understand
+    envelope = bytearray(encoded.compact_envelope)
+    envelope[1] = 2
+    encoded.compact_envelope = bytes(envelope)
+    with pytest.raises(RuntimeError):
+        MPPMessage.from_bytes(_join(encoded.frame(['oob', 'compact'])))
+
+
+def test_compressed_out_of_band() -> None:
+    mask = np.zeros((100, 100), np.bool_)
+    mask[10, 10] = True
+    noise = np.random.default_rng(1).integers(-2**31, 2**31, 2000, np.int32)
+    msg = MPPMessage(
+            Reference('sender.port'), Reference('receiver.port'), None, 1.0,
+            None, Settings(), 0, 3.0, {'mask': mask, 'noise': noise, 'step': 3})
+
+    encoded = msg.encoded_out_of_band()
+    full_size = encoded.nbytes
+    assert full_size == len(_join(encoded.frame(['oob', 'compact'])))
+    encoded.data.compress(Compressor(Codec.ZLIB))
+    codecs = [buf.codec for buf in encoded.data.compressed]
+    assert codecs == [Codec.ZLIB, Codec.NONE]
+
+    # receivers that don't support the codec get the uncompressed frame
+    plain = _join(encoded.frame(['oob']))
+    frame = _join(encoded.frame(['oob', 'zlib']))
+    assert len(frame) < len(plain)
+    assert encoded.nbytes == len(_join(encoded.frame(['oob', 'zlib', 'compact'])))
+    assert encoded.nbytes < full_size
+
+    for wire_data in [plain, frame, encoded.in_band()]:
+        msg_out = MPPMessage.from_bytes(wire_data)
+        assert msg_out.data['step'] == 3
+        assert (msg_out.data['mask'].array == mask).all()
+        assert (msg_out.data['noise'].array == noise).all()
+
+    msg_out = MPPMessage.from_bytes(frame)
+    assert msg_out.encoded_data._buffers is None
+    msg_out.encoded_data.decompress()
+    assert len(msg_out.encoded_data._buffers) == 2
+
+    mask_size = len(encoded.data.compressed[0].data)
+    assert msg_out.encoded_data.compression_savings == 10000 - mask_size
+    assert msg_out.data['mask'].array.flags.writeable
+
+    # forwarded data stays compressed
+    forwarded = msg_out.encoded_out_of_band(msg_out.encoded_data)
+    assert _join(forwarded.frame(['oob', 'zlib'])) == frame
+
+
+def _place(frame: bytes, placer: BufferPlacer) -> memoryview:
+    buf = memoryview(bytearray(len(frame)))
+    received = 0
+    while received < len(frame):
+        end, target = placer(buf, received)
+        buf[received:end] = frame[received:end]
+        received = end
+        if target is not None:
+            target[:] = frame[received:received + len(target)]
+            received += len(target)
+    return buf
+
+
+def _address(buf) -> int:
+    return np.frombuffer(buf, np.uint8).ctypes.data
+
+
+def test_batch_frame() -> None:
+    arrays = [np.arange(3.0), np.arange(100, dtype=np.int32)]
+    msgs = [
+            MPPMessage(
+                Reference('sender.port'), Reference('receiver.port'), None,
+                float(i), None, Settings(), i, 0.0, array)
+            for i, array in enumerate(arrays)]
+    frames = [msg.encoded_out_of_band().frame() for msg in msgs]
+
+    batch = _join(batch_frame([(0, frames[0]), (2, frames[1])]))
+    messages = split_batch(batch)
+    assert [index for index, _ in messages] == [0, 2]
+
+    for (_, frame), array in zip(messages, arrays):
+        assert frame.obj is batch
+        msg_out = MPPMessage.from_bytes(frame)
+        assert (msg_out.data.array == array).all()
+        offset = _address(frame) - _address(batch)
+        assert offset % 64 == 0
+
+    assert split_batch(_join(batch_frame([]))) == []
+    with pytest.raises(RuntimeError):
+        split_batch(_join(frames[0]))
+
+
+def test_chunked_descriptor() -> None:
+    descriptor = chunked_descriptor(3, 1 << 40)
+    assert parse_chunked_descriptor(descriptor) == (3, 1 << 40)
+    assert parse_chunked_descriptor(bytearray(descriptor)) == (3, 1 << 40)
+    assert parse_chunked_descriptor(b'\xc1MPB' + descriptor[4:]) is None
+    assert parse_chunked_descriptor(descriptor + bytes(1)) is None
+
+
+def test_buffer_placer() -> None:
+    array = np.arange(1000.0)
+    msg = MPPMessage(
+            Reference('sender.out'), Reference('receiver.in'), None, 0.0,
+            None, Settings(), 0, 1.0, Grid(array, ['x']))
+    frame = _join(msg.encoded_out_of_band().frame())
+
+    out = np.zeros(1000)
+    placer = BufferPlacer(out.view(np.uint8).data)
+    received = _place(frame, placer)
+    assert placer.placed
+    assert (out == array).all()
+
+    msg_out = MPPMessage.from_bytes(received)
+    assert msg_out.encoded_data is not None
+    grid = msg_out.encoded_data.decoded()
+    assert not np.shares_memory(grid.array, out)
+
+    data = placer.encoded_data(msg_out.encoded_data)
+    grid = data.decoded()
+    assert grid.indexes == ['x']
+    assert np.shares_memory(grid.array, out)
+    assert (grid.array == array).all()
+
+    # a different size is received as usual
+    out = np.zeros(999)
+    placer = BufferPlacer(out.view(np.uint8).data)
+    received = _place(frame, placer)
+    assert not placer.placed
+    assert (out == 0.0).all()
+    assert bytes(received) == frame
@@ -1,8 +1,15 @@
 from unittest.mock import MagicMock, patch
 
+import msgpack
+import numpy as np
 import pytest
+from ymmsl.v0_2 import Reference, Settings
 
-from libmuscle.mpp_server import MPPServer
+from libmuscle.compression import codec_features
+from libmuscle.mcp.protocol import RequestType
+from libmuscle.mpp_message import MPPMessage, parse_chunked_descriptor, split_batch
+from libmuscle.mpp_server import MPPRequestHandler, MPPServer
+from libmuscle.post_office import PostOffice as RealPostOffice
 
 
 @pytest.fixture(autouse=True)
@@ -36,4 +43,85 @@ def mpp_server():
 
 
 def test_get_locations(mpp_server, transport_server):
-    assert mpp_server.get_locations() == [transport_server.get_location.return_value]
+    features = ['oob', 'compact', 'batch', 'chunked'] + [
+            feature.value for feature in codec_features()]
+    assert mpp_server.get_locations() == [
+            transport_server.get_location.return_value, f'mpp:{",".join(features)}']
+
+
+def test_batch_request():
+    post_office = RealPostOffice()
+    handler = MPPRequestHandler(post_office)
+    msgs = [
+            MPPMessage(
+                Reference('sender.out'), Reference(receiver), None, 0.0, None,
+                Settings(), 0, 0.0, data).encoded_out_of_band()
+            for receiver, data in [
+                ('receiver.in1', 'a'), ('receiver.in2', np.zeros(1000)),
+                ('receiver.in2', 'b'), ('receiver.in1', 'c')]]
+
+    def request(max_messages, max_bytes):
+        request = msgpack.packb([
+                RequestType.GET_NEXT_MESSAGES.value,
+                ['receiver.in1', 'receiver.in2'], max_messages, max_bytes,
+                ['oob']])
+        response = handler.handle_request_async(request)
+        return response, lambda: [
+                (index, MPPMessage.from_bytes(frame).data)
+                for index, frame in split_batch(
+                    b''.join(bytes(s) for s in response.result()))]
+
+    for msg, receiver in zip(msgs, ['in1', 'in2', 'in2', 'in1']):
+        post_office.deposit(Reference(f'receiver.{receiver}'), msg)
+    _, result = request(10, 100)
+    assert result() == [(0, 'a'), (0, 'c')]
+
+    response, result = request(10, 100000)
+    assert not response.done()
+    post_office.deposit(Reference('receiver.in1'), msgs[0])
+    data = result()
+    assert [index for index, _ in data] == [0, 1, 1]
+    assert (data[1][1].array == 0.0).all()
+    assert data[2][1] == 'b'
+
+    post_office.deposit(Reference('receiver.in2'), msgs[2])
+    post_office.deposit(Reference('receiver.in1'), msgs[0])
+    _, result = request(1, 100000)
+    assert result() == [(0, 'a')]
+
+
+def test_chunked_request():
+    handler = MPPRequestHandler(RealPostOffice())
+    receiver = Reference('receiver.in')
+    msg = MPPMessage(
+            Reference('sender.out'), receiver, None, 0.0, None, Settings(), 0,
+            0.0, np.arange(1000.0)).encoded_out_of_band()
+    frame = b''.join(msg.frame(['oob']))
+
+    def call(*request):
+        response = handler.handle_request_async(msgpack.packb(list(request)))
+        return b''.join(bytes(s) for s in response.result())
+
+    handler._post_office.deposit(receiver, msg)
+    assert call(RequestType.GET_NEXT_MESSAGE.value, 'receiver.in', ['oob']) == frame
+
+    with patch('libmuscle.mpp_server._CHUNKED_MIN_BYTES', 1000):
+        handler._post_office.deposit(receiver, msg)
+        descriptor = call(
+                RequestType.GET_NEXT_MESSAGE.value, 'receiver.in',
+                ['oob', 'chunked'])
+    transfer_id, size = parse_chunked_descriptor(descriptor)
+    assert size == len(frame)
+
+    chunks = [
+            call(RequestType.GET_CHUNK.value, transfer_id, offset, 1000)
+            for offset in range(0, size - 1000, 1000)]
+    assert handler._transfers._frames
+    last = size - len(chunks) * 1000
+    chunks.append(call(
+            RequestType.GET_CHUNK.value, transfer_id, size - last, last))
+    assert b''.join(chunks) == frame
+    handler.wait_for_transfers()
+
+    with pytest.raises(RuntimeError):
+        call(RequestType.GET_CHUNK.value, transfer_id, 0, 1000)
@@ -1,7 +1,10 @@
-from libmuscle.outbox import Outbox
+from libmuscle.outbox import Outbox, OutboxLimits
 from libmuscle.mpp_message import MPPMessage
 
 from copy import copy
+import threading
+import time
+
 import pytest
 
 from ymmsl.v0_2 import Reference
@@ -25,17 +28,17 @@ def message():
 
 def test_create_outbox():
     box = Outbox()
-    assert box._Outbox__queue.qsize() == 0
+    assert len(box._Outbox__queue) == 0
 
 
 def test_deposit_message(outbox, message):
     outbox.deposit(message)
-    assert outbox._Outbox__queue.qsize() == 1
-    assert outbox._Outbox__queue.get(message)
+    assert len(outbox._Outbox__queue) == 1
+    assert outbox._Outbox__queue[0][0] is message
 
 
 def test_retrieve_message(outbox, message):
-    outbox._Outbox__queue.put(message)
+    outbox._Outbox__queue.append((message, 0))
     assert outbox.retrieve() == message
 
 
@@ -48,3 +51,171 @@ def test_deposit_retrieve_order(outbox, message):
 
     assert outbox.retrieve() == m1
     assert outbox.retrieve() == m2
+
+
+def test_retrieve_future(outbox, message):
+    future = outbox.retrieve_future()
+    assert not future.done()
+
+    outbox.deposit(message)
+    assert future.result() is message
+    assert outbox.is_empty()
+
+    outbox.deposit(message)
+    assert outbox.retrieve_future().result() is message
+
+
+def test_retrieve_future_cancelled(outbox, message):
+    m1 = copy(message)
+    future1 = outbox.retrieve_future()
+    future2 = outbox.retrieve_future()
+    future1.cancel()
+
+    outbox.deposit(m1)
+    assert future2.result() is m1
+    assert outbox.is_empty()
+
+
+def test_limits_block():
+    limits = OutboxLimits(len, max_bytes=10)
+    outbox = Outbox(limits)
+    outbox.deposit(bytes(20))
+    assert limits.used == 20
+
+    deposited = threading.Event()
+
+    def deposit() -> None:
+        outbox.deposit(bytes(5))
+        deposited.set()
+
+    thread = threading.Thread(target=deposit)
+    thread.start()
+    time.sleep(0.1)
+    assert not deposited.is_set()
+
+    assert len(outbox.retrieve()) == 20
+    assert deposited.wait(5.0)
+    thread.join()
+    assert limits.used == 5
+    assert outbox.high_water == 20
+
+
+def test_limits_total():
+    limits = OutboxLimits(len, total_max_bytes=10)
+    spilled = []
+
+    def spill(message):
+        spilled.append(message)
+        return lambda: message
+
+    limits.set_limits(None, 10, spill)
+    outbox1 = Outbox(limits)
+    outbox2 = Outbox(limits)
+    outbox1.deposit(bytes(8))
+    outbox2.deposit(bytes(4))
+    assert spilled == []
+    outbox2.deposit(bytes(3))
+    assert spilled == [bytes(4), bytes(3)]
+    assert limits.used == 8
+
+    assert outbox2.retrieve() == bytes(4)
+    assert outbox2.retrieve() == bytes(3)
+    assert outbox1.retrieve() == bytes(8)
+    assert limits.used == 0
+
+
+def test_limits_spill():
+    loaded = []
+
+    def spill(message):
+        def load():
+            loaded.append(message)
+            return message
+        return load
+
+    limits = OutboxLimits(len, max_bytes=10, spill=spill)
+    outbox = Outbox(limits)
+    m1, m2, m3 = bytes(6), bytes(4), bytes(7)
+    outbox.deposit(m1)
+    outbox.deposit(m2)
+    outbox.deposit(m3)
+    assert limits.used == 7
+    assert outbox.high_water == 10
+
+    assert outbox.retrieve() is m1
+    assert outbox.retrieve() is m2
+    assert loaded == [m1, m2]
+    assert outbox.retrieve() is m3
+    assert loaded == [m1, m2]
+    assert limits.used == 0
+
+
+def test_limits_unset():
+    sizes = []
+
+    def size_of(message):
+        sizes.append(message)
+        return len(message)
+
+    limits = OutboxLimits(size_of)
+    outbox = Outbox(limits)
+    outbox.deposit(bytes(20))
+    assert sizes == []
+    assert limits.used == 0
+    assert outbox.high_water == 0
+    assert len(outbox.retrieve()) == 20
+
+
+def test_spill_unlocked():
+    spilling = threading.Event()
+    proceed = threading.Event()
+
+    def spill(message):
+        spilling.set()
+        assert proceed.wait(5.0)
+        return lambda: message
+
+    limits = OutboxLimits(len, max_bytes=10, spill=spill)
+    outbox1 = Outbox(limits)
+    outbox2 = Outbox(limits)
+    m1, m2 = bytes(8), bytes(5)
+    outbox1.deposit(m1)
+
+    thread = threading.Thread(target=outbox1.deposit, args=(m2,))
+    thread.start()
+    assert spilling.wait(5.0)
+
+    # the limits can be used while m1 is being written
+    outbox2.deposit(bytes(3))
+    assert len(outbox2.retrieve()) == 3
+
+    # and m1 is still there until it has been
+    assert outbox1.retrieve() is m1
+
+    proceed.set()
+    thread.join()
+    assert outbox1.retrieve() is m2
+    assert limits.used == 0
+
+
+def test_retrieve_now(outbox, message):
+    assert outbox.retrieve_now(lambda m: True) is None
+
+    outbox.deposit(message)
+    assert outbox.retrieve_now(lambda m: False) is None
+    assert outbox.retrieve_now(lambda m: True) is message
+    assert outbox.is_empty()
+
+    future = outbox.retrieve_future()
+    outbox.deposit(message)
+    assert future.result() is message
+
+    limits = OutboxLimits(len, max_bytes=10, spill=lambda m: lambda: m)
+    outbox = Outbox(limits)
+    m1, m2 = bytes(6), bytes(7)
+    outbox.deposit(m1)
+    outbox.deposit(m2)
+    assert outbox.retrieve_now(lambda m: True) is None
+    assert outbox.retrieve() is m1
+    assert outbox.retrieve_now(lambda m: True) is m2
+    assert limits.used == 0
@@ -0,0 +1,125 @@
+import threading
+import time
+from unittest.mock import MagicMock
+
+import pytest
+from ymmsl.v0_2 import Reference as Ref, Settings
+
+from libmuscle.mpp_message import ClosePort, MPPMessage
+from libmuscle.prefetcher import PrefetchBudget, Prefetcher
+
+
+def _message(number, data):
+    return MPPMessage(
+            Ref('peer.out'), Ref('component.in'), None, float(number), None,
+            Settings(), number, 0.0, data).encoded()
+
+
+class MockClient:
+    def __init__(self, messages):
+        self.messages = list(messages)
+        self.requested = 0
+        self.closed = False
+        self.release = threading.Semaphore(0)
+        self.cond = threading.Condition()
+
+    def receive(self, receiver, timeout_handler):
+        assert receiver == Ref('component.in')
+        assert timeout_handler is None
+        with self.cond:
+            self.requested += 1
+            self.cond.notify_all()
+        self.release.acquire()
+        message = self.messages.pop(0)
+        if isinstance(message, Exception):
+            raise message
+        return message, MagicMock()
+
+    def close(self):
+        self.closed = True
+
+    def wait_for_requests(self, n):
+        with self.cond:
+            assert self.cond.wait_for(lambda: self.requested >= n, 5.0)
+
+
+def test_prefetch_depth():
+    messages = [_message(i, i) for i in range(4)]
+    client = MockClient(messages + [_message(4, ClosePort())])
+    budget = PrefetchBudget(1000000)
+    prefetcher = Prefetcher(client, Ref('component.in'), 2, budget)
+
+    client.release.release()
+    client.release.release()
+    client.wait_for_requests(2)
+
+    assert prefetcher.receive(None)[0] == messages[0]
+    client.wait_for_requests(3)
+    assert client.requested == 3
+    assert budget.used == len(messages[1])
+
+    client.release.release()
+    client.release.release()
+    assert prefetcher.receive(None)[0] == messages[1]
+    assert prefetcher.receive(None)[0] == messages[2]
+    assert prefetcher.receive(None)[0] == messages[3]
+
+    client.release.release()
+    assert MPPMessage.from_bytes(prefetcher.receive(None)[0]).is_close_port()
+    prefetcher._thread.join(5.0)
+    assert client.requested == 5
+    assert client.closed
+    assert budget.used == 0
+
+    with pytest.raises(ConnectionError):
+        prefetcher.receive(None)
+
+
+def test_prefetch_budget():
+    messages = [_message(i, bytes(100)) for i in range(3)]
+    client = MockClient(messages)
+    budget = PrefetchBudget(1)
+    prefetcher = Prefetcher(client, Ref('component.in'), 3, budget)
+
+    client.release.release()
+    assert prefetcher.receive(None)[0] == messages[0]
+    client.release.release()
+    client.wait_for_requests(2)
+    time.sleep(0.1)
+    assert client.requested == 2
+
+    budget.set_max_bytes(10000)
+    client.wait_for_requests(3)
+
+    prefetcher.close()
+    assert budget.used == 0
+    client.release.release()
+    prefetcher._thread.join(5.0)
+    assert client.closed
+
+
+def test_prefetch_error():
+    messages = [_message(0, 'test'), ConnectionError('test error')]
+    client = MockClient(messages)
+    prefetcher = Prefetcher(client, Ref('component.in'), 1, PrefetchBudget(1000))
+
+    client.release.release()
+    client.release.release()
+    assert prefetcher.receive(None)[0] == messages[0]
+    with pytest.raises(ConnectionError, match='test error'):
+        prefetcher.receive(None)
+    assert client.closed
+
+
+def test_prefetch_timeout():
+    client = MockClient([_message(0, 'test')])
+    prefetcher = Prefetcher(client, Ref('component.in'), 1, PrefetchBudget(1000))
+
+    timeout_handler = MagicMock()
+    timeout_handler.timeout = 0.01
+    timeout_handler.on_timeout.side_effect = client.release.release
+
+    prefetcher.receive(timeout_handler)
+    timeout_handler.on_timeout.assert_called_once()
+    timeout_handler.on_receive.assert_called_once()
+    prefetcher.close()
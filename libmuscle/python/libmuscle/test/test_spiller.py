@@ -0,0 +1,51 @@
+import numpy as np
+
+from ymmsl.v0_2 import Reference as Ref, Settings
+
+from libmuscle.compression import Codec, Compressor
+from libmuscle.grid import Grid
+from libmuscle.mpp_message import DeltaReferences, MPPMessage
+from libmuscle.spiller import Spiller
+
+
+def test_spill_load(tmp_path):
+    spiller = Spiller(tmp_path)
+    data = {'array': np.arange(1000.0), 'zeros': np.zeros(1000)}
+    message = MPPMessage(
+            Ref('sender.out'), Ref('receiver.in'), None, 0.0, 1.0,
+            Settings(), 0, 1.0, data).encoded_out_of_band()
+    message.data.compress(Compressor(Codec.ZLIB))
+
+    load = spiller.spill(message)
+    spill_dirs = list(tmp_path.iterdir())
+    assert len(spill_dirs) == 1
+    assert len(list(spill_dirs[0].iterdir())) == 1
+
+    loaded = load()
+    assert not list(spill_dirs[0].iterdir())
+    assert loaded.envelope == message.envelope
+    assert loaded.data.compressed[1].codec == Codec.ZLIB
+
+    received = MPPMessage.from_bytes(b''.join(loaded.frame()))
+    assert (received.data['array'].array == np.arange(1000.0)).all()
+    assert (received.data['zeros'].array == 0.0).all()
+
+    spiller.close()
+    assert not list(tmp_path.iterdir())
+
+
+def test_spill_load_deltas(tmp_path):
+    spiller = Spiller(tmp_path)
+    deltas = DeltaReferences()
+    state = np.zeros(1000)
+    for i in range(2):
+        state[i] = 1.0
+        message = MPPMessage(
+                Ref('sender.out'), Ref('receiver.in'), None, 0.0, 1.0,
+                Settings(), i, 1.0, Grid.delta(state)
+                ).encoded_out_of_band(None, deltas)
+
+    loaded = spiller.spill(message)()
+    received = MPPMessage.from_bytes(loaded.in_band())
+    assert (received.data.array == state).all()
+    spiller.close()
@@ -0,0 +1,92 @@
+"""Measures the time and memory needed to transfer a large message.
+
+This sends a large array from an MPPServer to an MPPClient in the same
+process, over TCP, and reports how long the transfer took and the peak
+amount of memory allocated during it, on top of the array itself. This is
+done once fetching the message in chunks over several connections, and once
+as a single frame, by hiding the feature from the client.
+
+Run with e.g. ``python scripts/benchmark_large_messages.py -s 1024``
+"""
+import time
+import tracemalloc
+from typing import List, Tuple
+
+import click
+import numpy as np
+from ymmsl.v0_2 import Reference, Settings
+
+from libmuscle.mpp_client import MPPClient
+from libmuscle.mpp_message import MPPMessage
+from libmuscle.mpp_server import MPPServer
+
+
+SENDER = Reference('macro.state_out')
+RECEIVER = Reference('micro.state_in')
+
+
+def tcp_locations(locations: List[str], chunked: bool) -> List[str]:
+    """Selects the TCP and mpp: locations, optionally without chunking."""
+    result = []
+    for location in locations:
+        if location.startswith('mpp:') and not chunked:
+            features = [name for name in location[4:].split(',') if name != 'chunked']
+            location = 'mpp:' + ','.join(features)
+        if location.startswith(('tcp:', 'mpp:')):
+            result.append(location)
+    return result
+
+
+def benchmark(
+        server: MPPServer, locations: List[str], array: np.ndarray
+        ) -> Tuple[float, int]:
+    """Transfers the array and returns the time taken and peak memory."""
+    client = MPPClient(locations)
+    msg = MPPMessage(
+            SENDER, RECEIVER, None, 0.0, None, Settings(), 0, 0.0, array)
+    encoded = msg.encoded_out_of_band()
+    try:
+        tracemalloc.start()
+        begin = time.perf_counter()
+        server.deposit(RECEIVER, encoded)
+        frame, _ = client.receive(RECEIVER, None)
+        elapsed = time.perf_counter() - begin
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        received = MPPMessage.from_bytes(frame).data.array
+        assert received.shape == array.shape
+    finally:
+        client.close()
+
+    return elapsed, peak
+
+
+@click.command()    # type: ignore
+@click.option(
+        '-s', '--size', type=int, default=512,
+        help='Size of the message in MiB')
+@click.option(
+        '-r', '--repeats', type=int, default=3,
+        help='Number of times to repeat each measurement, the best is shown')
+def main(size: int, repeats: int) -> None:
+    array = np.random.default_rng(1).random(size * 1024 * 1024 // 8)
+    server = MPPServer()
+    try:
+        locations = server.get_locations()
+        for name, chunked in [('chunked', True), ('single frame', False)]:
+            variant_locations = tcp_locations(locations, chunked)
+            results = [
+                    benchmark(server, variant_locations, array)
+                    for _ in range(repeats)]
+            elapsed = min(elapsed for elapsed, _ in results)
+            peak = min(peak for _, peak in results)
+            print(
+                    f'{name}: {size / elapsed:.0f} MiB/s, peak'
+                    f' {peak / 2**20:.0f} MiB allocated')
+    finally:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+"""Measures how fast the manager answers requests for peers.
+
+This sets up the manager's request handler for a model with a macro model
+connected to a number of micro models, which have many instances between
+them, without starting any actual instances. It then registers all the
+instances, and asks for the peers of each micro model instance, printing
+the time taken per request for each.
+
+Every instance gets the same conduits, ports and peer dimensions as the
+other instances of its component, so the cost of working those out and
+encoding them shows up here, multiplied by the number of instances.
+
+Run with e.g. ``python scripts/benchmark_manager_topology.py -n 100000``
+"""
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import time
+from typing import Any, List
+
+import click
+import msgpack
+from ymmsl.v0_2 import (
+        Component, Conduit, Configuration, Model, Ports, Reference, Settings)
+
+import libmuscle
+from libmuscle.manager.deadlock_detector import DeadlockDetector
+from libmuscle.manager.instance_registry import InstanceRegistry
+from libmuscle.manager.logger import Logger
+from libmuscle.manager.mmp_server import MMPRequestHandler
+from libmuscle.manager.profile_store import ProfileStore
+from libmuscle.manager.snapshot_registry import SnapshotRegistry
+from libmuscle.manager.topology_store import TopologyStore
+from libmuscle.mcp.protocol import RequestType, ResponseType
+
+
+def make_configuration(num_micros: int, num_instances: int) -> Configuration:
+    """Creates a macro model with num_micros micro models."""
+    macro_ports = Ports(
+            o_i=[f'out{i}' for i in range(num_micros)],
+            s=[f'in{i}' for i in range(num_micros)])
+    components = [Component('macro', macro_ports, '', 'macro')]
+    conduits: List[Conduit] = []
+    for i in range(num_micros):
+        components.append(Component(
+                f'micro{i}', Ports(f_init='in', o_f='out'), '', 'micro', False,
+                [num_instances // num_micros]))
+        conduits.append(Conduit(f'macro.out{i}', f'micro{i}.in'))
+        conduits.append(Conduit(f'micro{i}.out', f'macro.in{i}'))
+
+    model = Model('benchmark', None, '', None, components, conduits)
+    settings = Settings({f'setting{i}': float(i) for i in range(100)})
+    return Configuration(
+            'benchmark_manager_topology', None, [model], None, settings)
+
+
+def call(handler: MMPRequestHandler, request: List) -> Any:
+    """Sends a request to the handler and returns the decoded response."""
+    encoded_request = msgpack.packb(request, use_bin_type=True)
+    response = msgpack.unpackb(handler.handle_request(encoded_request), raw=False)
+    if response[0] != ResponseType.SUCCESS.value:
+        raise RuntimeError(f'Request {request} failed: {response}')
+    return response
+
+
+@click.command()    # type: ignore
+@click.option(
+        '-n', '--num-instances', type=int, default=100000,
+        help='Total number of micro model instances')
+@click.option(
+        '-m', '--num-micros', type=int, default=100,
+        help='Number of micro models')
+def main(num_instances: int, num_micros: int) -> None:
+    configuration = make_configuration(num_micros, num_instances)
+
+    begin = time.perf_counter()
+    topology_store = TopologyStore(configuration)
+    print(f'create topology store: {(time.perf_counter() - begin) * 1e3:.1f} ms')
+
+    instances = [Reference('macro')] + [
+            Reference(f'micro{i}') + j
+            for i in range(num_micros)
+            for j in range(num_instances // num_micros)]
+
+    with TemporaryDirectory() as tmp_dir:
+        logger = Logger(Path(tmp_dir))
+        profile_store = ProfileStore(Path(tmp_dir))
+        handler = MMPRequestHandler(
+                logger, profile_store, configuration, InstanceRegistry(),
+                topology_store,
+                SnapshotRegistry(configuration, Path(tmp_dir), topology_store),
+                DeadlockDetector(), None)
+
+        begin = time.perf_counter()
+        for instance in instances:
+            call(handler, [
+                    RequestType.REGISTER_INSTANCE.value, str(instance),
+                    [f'tcp:{instance}'], [], libmuscle.__version__])
+        elapsed = time.perf_counter() - begin
+        print(f'register instance: {elapsed / len(instances) * 1e6:.1f} us')
+
+        begin = time.perf_counter()
+        for instance in instances[1:]:
+            call(handler, [RequestType.GET_PEERS.value, str(instance)])
+        elapsed = time.perf_counter() - begin
+        print(f'get peers: {elapsed / (len(instances) - 1) * 1e6:.1f} us')
+
+        begin = time.perf_counter()
+        for instance in instances[1:]:
+            call(handler, [RequestType.GET_SETTINGS.value])
+        elapsed = time.perf_counter() - begin
+        print(f'get settings: {elapsed / (len(instances) - 1) * 1e6:.1f} us')
+
+        handler.close()
+        profile_store.shutdown()
+        logger.close()
+
+
+if __name__ == '__main__':
+    main()
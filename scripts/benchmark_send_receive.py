@@ -0,0 +1,71 @@
+"""Measures the overhead of sending and receiving small messages.
+
+This runs a macro and a micro model, where the macro model sends many small
+messages to the micro model. The time taken per message by the sends in the
+macro model and the receives in the micro model is printed.
+
+Sending doesn't wait for the receiver, so the time per send is the overhead
+of sending. The receiver has to wait for each message to be transferred,
+so the time per receive includes that.
+
+Run with e.g. ``python scripts/benchmark_send_receive.py -n 20000``
+"""
+import time
+
+import click
+from ymmsl.v0_2 import (
+        Component, Conduit, Configuration, Model, Operator, Ports, Settings)
+
+from libmuscle import Instance, InstanceFlags, Message
+from libmuscle.runner import run_simulation
+
+
+def report(instance: Instance, what: str, elapsed: float) -> None:
+    """Prints the time per message."""
+    num_messages = instance.get_setting('num_messages', 'int')
+    print(f'{what}: {elapsed / num_messages * 1e6:.1f} us', flush=True)
+
+
+def macro() -> None:
+    instance = Instance({Operator.O_I: ['out']})
+
+    while instance.reuse_instance():
+        num_messages = instance.get_setting('num_messages', 'int')
+        begin = time.perf_counter()
+        for i in range(num_messages):
+            instance.send('out', Message(float(i), data=i))
+        report(instance, 'send', time.perf_counter() - begin)
+
+
+def micro() -> None:
+    # receives on S many times, which isn't a valid MMSF sequence
+    instance = Instance(
+            {Operator.S: ['in']}, InstanceFlags.SKIP_MMSF_SEQUENCE_CHECKS)
+
+    while instance.reuse_instance():
+        num_messages = instance.get_setting('num_messages', 'int')
+        begin = time.perf_counter()
+        for _ in range(num_messages):
+            instance.receive('in')
+        report(instance, 'receive', time.perf_counter() - begin)
+
+
+@click.command()    # type: ignore
+@click.option(
+        '-n', '--num-messages', type=int, default=20000,
+        help='Number of messages to send')
+def main(num_messages: int) -> None:
+    components = [
+            Component('macro', Ports(o_i='out'), '', 'macro'),
+            Component('micro', Ports(s='in'), '', 'micro')]
+    conduits = [Conduit('macro.out', 'micro.in')]
+    model = Model('benchmark', None, '', None, components, conduits)
+
+    settings = Settings({'num_messages': num_messages})
+    configuration = Configuration(
+            'benchmark_send_receive', None, [model], None, settings)
+    run_simulation(configuration, {'macro': macro, 'micro': micro})
+
+
+if __name__ == '__main__':
+    main()
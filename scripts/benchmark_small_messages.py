@@ -0,0 +1,100 @@
+"""Measures the throughput of small messages between two peers.
+
+This sends many small messages from an MPPServer to an MPPClient in the same
+process, over TCP, and reports how many messages per second are encoded,
+transferred and decoded. This is done with batched requests, which fetch
+all waiting messages at once, then with one request per message, and then
+with the original MessagePack header rather than the compact one. Features
+are turned off by hiding them from the client.
+
+Run with e.g. ``python scripts/benchmark_small_messages.py -n 20000``
+"""
+import threading
+import time
+from typing import List
+
+import click
+from ymmsl.v0_2 import Reference, Settings
+
+from libmuscle.mpp_client import MPPClient
+from libmuscle.mpp_message import MPPMessage
+from libmuscle.mpp_server import MPPServer
+
+
+SENDER = Reference('macro[12].state_out')
+RECEIVER = Reference('micro[12].state_in')
+
+
+def without_features(locations: List[str], *features: str) -> List[str]:
+    """Removes features from the mpp: location of a peer."""
+    result = []
+    for location in locations:
+        if location.startswith('mpp:'):
+            names = [name for name in location[4:].split(',') if name not in features]
+            location = 'mpp:' + ','.join(names)
+        result.append(location)
+    return result
+
+
+def benchmark(server: MPPServer, locations: List[str], num_messages: int) -> float:
+    """Sends messages and returns the number per second."""
+    client = MPPClient(locations)
+
+    def send() -> None:
+        for i in range(num_messages):
+            msg = MPPMessage(
+                    SENDER, RECEIVER, None, float(i), float(i + 1), Settings(),
+                    i, float('-inf'), {'step': i, 'value': 1.5})
+            server.deposit(RECEIVER, msg.encoded_out_of_band())
+
+    sender = threading.Thread(target=send)
+    try:
+        begin = time.perf_counter()
+        sender.start()
+        i = 0
+        while i < num_messages:
+            if client.supports_batches:
+                frames, _ = client.receive_batch([RECEIVER], None, 64, 1 << 20)
+            else:
+                frame, _ = client.receive(RECEIVER, None)
+                frames = [(0, memoryview(frame))]
+            for _, frame in frames:
+                msg = MPPMessage.from_bytes(frame)
+                assert msg.message_number == i
+                assert msg.data['step'] == i
+                i += 1
+        elapsed = time.perf_counter() - begin
+    finally:
+        sender.join()
+        client.close()
+
+    return num_messages / elapsed
+
+
+@click.command()    # type: ignore
+@click.option(
+        '-n', '--num-messages', type=int, default=20000,
+        help='Number of messages to send')
+@click.option(
+        '-r', '--repeats', type=int, default=3,
+        help='Number of times to repeat each measurement, the best is shown')
+def main(num_messages: int, repeats: int) -> None:
+    server = MPPServer()
+    try:
+        locations = server.get_locations()
+        variants = [
+                ('batched', locations),
+                ('compact header', without_features(locations, 'batch')),
+                ('MessagePack header', without_features(
+                    locations, 'batch', 'compact'))]
+        for name, variant_locations in variants:
+            rate = max(
+                    benchmark(server, variant_locations, num_messages)
+                    for _ in range(repeats))
+            print(f'{name}: {rate:.0f} messages/s')
+    finally:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+"""Measures how the TCP transport servers scale with the number of clients.
+
+This connects many clients to a TcpTransportServer and to an
+AsyncTcpTransportServer, and reports how long that takes, how many threads
+the server needs, and the request latency with all the clients connected.
+
+Clients and servers run in the same process, so every connection needs two
+file descriptors. The soft limit on open files is raised as far as the hard
+limit allows.
+
+Run with e.g. ``python scripts/benchmark_tcp_server_connections.py -n 10000``
+"""
+from concurrent.futures import Future
+import resource
+import socket
+import statistics
+import threading
+import time
+from typing import List, Optional, Type
+
+import click
+from typing_extensions import Buffer
+
+from libmuscle.mcp.async_tcp_transport_server import AsyncTcpTransportServer
+from libmuscle.mcp.tcp_transport_server import TcpTransportServer
+from libmuscle.mcp.tcp_util import recv_frame, recv_int64, send_frame, send_int64
+from libmuscle.mcp.transport_server import (
+        Frame, RequestHandler, TransportServer)
+
+
+class EchoHandler(RequestHandler):
+    """Returns requests immediately, like MPP does if a message is ready."""
+    def handle_request(self, request: Buffer) -> Frame:
+        return request
+
+    def handle_request_async(self, request: Buffer) -> Optional['Future[Frame]']:
+        future: Future[Frame] = Future()
+        future.set_result(request)
+        return future
+
+
+def raise_file_limit(num_clients: int) -> int:
+    """Raise the limit on open files, returning the number of clients we can do."""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = 2 * num_clients + 100
+    if hard != resource.RLIM_INFINITY:
+        wanted = min(wanted, hard)
+    if wanted > soft:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+    return min(num_clients, (wanted - 100) // 2)
+
+
+def call(sock: socket.socket, request_nr: int, request: bytes) -> None:
+    send_int64(sock, request_nr)
+    send_frame(sock, request)
+    recv_frame(sock)
+
+
+def benchmark(
+        server_type: Type[TransportServer], num_clients: int,
+        num_requests: int) -> None:
+    """Run the benchmark for one type of server and print the results."""
+    base_threads = threading.active_count()
+    server = server_type(EchoHandler())
+    port = server.get_port()     # type: ignore
+
+    socks: List[socket.socket] = []
+    try:
+        begin = time.perf_counter()
+        try:
+            for _ in range(num_clients):
+                sock = socket.create_connection(('127.0.0.1', port))
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                send_int64(sock, 0)
+                recv_int64(sock)
+                socks.append(sock)
+        except Exception as e:
+            print(f'    failed after {len(socks)} connections: {e}')
+        connect_time = time.perf_counter() - begin
+
+        threads = threading.active_count() - base_threads
+
+        latencies: List[float] = []
+        step = max(1, len(socks) // num_requests)
+        for sock in socks[::step]:
+            begin = time.perf_counter()
+            call(sock, 1, b'request')
+            latencies.append(time.perf_counter() - begin)
+
+        begin = time.perf_counter()
+        for sock in socks:
+            send_int64(sock, 2)
+            send_frame(sock, b'request')
+        for sock in socks:
+            recv_frame(sock)
+        round_time = time.perf_counter() - begin
+
+        print(f'    connected {len(socks)} clients in {connect_time:.2f} s')
+        print(f'    server threads: {threads}')
+        if latencies:
+            print(
+                    f'    latency: median {statistics.median(latencies) * 1e6:.0f} us,'
+                    f' max {max(latencies) * 1e6:.0f} us')
+        print(f'    one request from every client: {round_time:.2f} s')
+
+    finally:
+        for sock in socks:
+            try:
+                send_int64(sock, 0)
+            except OSError:
+                pass
+            sock.close()
+        server.close()
+
+
+@click.command()    # type: ignore
+@click.option(
+        '-n', '--num-clients', type=int, multiple=True,
+        default=[100, 1000, 10000], help='Number of clients to connect')
+@click.option(
+        '-r', '--num-requests', type=int, default=100,
+        help='Number of single requests to measure latency with')
+def main(num_clients: List[int], num_requests: int) -> None:
+    for n in num_clients:
+        possible = raise_file_limit(n)
+        if possible < n:
+            print(f'Open file limit allows only {possible} clients')
+            n = possible
+
+        for server_type in (TcpTransportServer, AsyncTcpTransportServer):
+            print(f'{server_type.__name__}, {n} clients:')
+            benchmark(server_type, n, num_requests)
+
+
+if __name__ == '__main__':
+    main()